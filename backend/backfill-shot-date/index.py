@@ -2,7 +2,7 @@
 Business: Заполняет shot_date (дату и время съёмки из EXIF) для уже загруженных фото,
 у которых это поле пустое. Особенно для RAW (CR2/NEF/ARW), т.к. их EXIF читается только
 через специализированные библиотеки. Без shot_date не работает сортировка "По времени".
-Args: event с httpMethod, body (user_id, folder_id опционально, limit опционально)
+Args: event с httpMethod, body (user_id, folder_id и photo_ids опционально, limit опционально)
 Returns: HTTP ответ со статистикой обработки
 '''
 import json
@@ -14,6 +14,7 @@ from botocore.config import Config
 import psycopg2
 from psycopg2.extras import RealDictCursor
 import exifread
+from raw_preview import S3RangeSource, read_shot_date
 
 RAW_EXT = ('.cr2', '.cr3', '.nef', '.nrw', '.arw', '.srf', '.sr2',
            '.dng', '.orf', '.rw2', '.raf', '.pef', '.raw', '.rwl', '.iiq', '.3fr')
@@ -83,6 +84,8 @@ def handler(event: dict, context) -> dict:
     user_id = body.get('user_id') or qs.get('user_id') or event.get('headers', {}).get('X-User-Id')
     folder_id = body.get('folder_id') or qs.get('folder_id')
     limit = int(body.get('limit') or qs.get('limit') or 200)
+    # Точечно по фото (задачи exif из очереди processing_jobs)
+    photo_ids = [int(x) for x in (body.get('photo_ids') or []) if str(x).isdigit()]
 
     if not user_id:
         return {
@@ -112,6 +115,9 @@ def handler(event: dict, context) -> dict:
         if folder_id:
             where += ' AND folder_id = %s'
             params.append(int(folder_id))
+        if photo_ids:
+            where += ' AND id = ANY(%s)'
+            params.append(photo_ids)
         params.append(limit)
 
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
@@ -127,10 +133,17 @@ def handler(event: dict, context) -> dict:
         for row in rows:
             processed += 1
             try:
-                obj = s3_client.get_object(Bucket='foto-mix', Key=row['s3_key'])
-                raw_bytes = obj['Body'].read()
-                shot_date = extract_shot_date(raw_bytes)
-                del raw_bytes
+                # Дата лежит в заголовке контейнера — читаем только его ranged-запросами.
+                # Целиком файл качаем, лишь если разбор контейнера не дал даты.
+                src = S3RangeSource(s3_client, 'foto-mix', row['s3_key'])
+                shot_date = read_shot_date(src)
+                if shot_date:
+                    print(f'[BACKFILL] id={row["id"]}: date from {src.bytes_fetched} bytes in {src.requests} ranged GETs')
+                else:
+                    obj = s3_client.get_object(Bucket='foto-mix', Key=row['s3_key'])
+                    raw_bytes = obj['Body'].read()
+                    shot_date = extract_shot_date(raw_bytes)
+                    del raw_bytes
                 if shot_date:
                     with conn.cursor() as cur:
                         cur.execute(
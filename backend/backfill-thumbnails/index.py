@@ -2,6 +2,8 @@
 без готового thumbnail_s3_key. Обрабатывает партию за вызов (лёгкий Pillow-ресайз ~500px).
 RAW-файлы пропускает — для них есть отдельная тяжёлая функция generate-thumbnail.
 Вызывается многократно партиями, пока remaining не станет 0.
+С ?mode=hashes досчитывает перцептивные хэши (dHash/pHash) по уже готовым
+миниатюрам — для фото, загруженных до появления группировки серий.
 '''
 import json
 import os
@@ -12,6 +14,8 @@ from PIL import Image, ImageOps
 import psycopg2
 from psycopg2.extras import RealDictCursor
 from botocore.client import Config
+from image_hash import hash_image
+from stage_timer import Trace, span
 
 RAW_EXT = ('.cr2', '.cr3', '.nef', '.nrw', '.arw', '.srf', '.sr2', '.dng',
            '.orf', '.rw2', '.raf', '.pef', '.raw', '.rwl', '.iiq', '.3fr')
@@ -25,6 +29,65 @@ def is_raw(name: str) -> bool:
     return any(n.endswith(e) for e in RAW_EXT)
 
 
+def backfill_hashes(conn, s3, schema: str, batch: int, deadline: float, photo_ids=None) -> dict:
+    '''Считает dHash/pHash по готовым миниатюрам партии фото без хэшей.'''
+    processed, failed = 0, 0
+    errors = []
+    only_ids = 'AND id = ANY(%s)' if photo_ids else ''
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute(f'''
+            SELECT id, thumbnail_s3_key
+            FROM {schema}.photo_bank
+            WHERE phash IS NULL
+              AND thumbnail_s3_key IS NOT NULL
+              AND (is_trashed IS NULL OR is_trashed = false)
+              {only_ids}
+            ORDER BY id DESC
+            LIMIT %s
+        ''', ((photo_ids, batch * 4) if photo_ids else (batch * 4,)))
+        rows = cur.fetchall()
+
+    hashes = []
+    for row in rows:
+        if time.time() > deadline:
+            break
+        try:
+            with span('s3_get') as sp:
+                data = s3.get_object(Bucket='foto-mix', Key=row['thumbnail_s3_key'])['Body'].read()
+                sp.bytes = len(data)
+            with span('hash'):
+                img = Image.open(BytesIO(data))
+                # Превью большое — декодируем JPEG сразу в уменьшенном масштабе
+                img.draft('L', (256, 256))
+                hashes.append((row['id'], *hash_image(img)))
+            processed += 1
+        except Exception as e:
+            failed += 1
+            if len(errors) < 5:
+                errors.append(f'id={row["id"]}: {e}')
+
+    with span('db'), conn.cursor() as cur:
+        if hashes:
+            # Одним UPDATE на всю партию
+            values = ', '.join(cur.mogrify('(%s, %s::bigint, %s::bigint)', h).decode('utf-8') for h in hashes)
+            cur.execute(f'''
+                UPDATE {schema}.photo_bank pb
+                SET dhash = v.dhash, phash = v.phash
+                FROM (VALUES {values}) AS v (id, dhash, phash)
+                WHERE pb.id = v.id
+            ''')
+        cur.execute(f'''
+            SELECT COUNT(*) FROM {schema}.photo_bank
+            WHERE phash IS NULL
+              AND thumbnail_s3_key IS NOT NULL
+              AND (is_trashed IS NULL OR is_trashed = false)
+        ''')
+        remaining = cur.fetchone()[0]
+    conn.commit()
+
+    return {'processed': processed, 'failed': failed, 'remaining': remaining, 'errors': errors}
+
+
 def handler(event: dict, context) -> dict:
     '''Догенерирует миниатюры для партии обычных фото без превью.'''
     method = event.get('httpMethod', 'POST')
@@ -55,6 +118,7 @@ def handler(event: dict, context) -> dict:
             photo_ids = []
 
     schema = os.environ['MAIN_DB_SCHEMA']
+    mode = params.get('mode', 'thumbnails')
 
     s3 = boto3.client(
         's3',
@@ -70,6 +134,18 @@ def handler(event: dict, context) -> dict:
     errors = []
     deadline = time.time() + 22  # оставляем запас до таймаута функции (30с)
 
+    trace = Trace('backfill-thumbnails', mode=mode)
+
+    if mode == 'hashes':
+        try:
+            with trace:
+                result = backfill_hashes(conn, s3, schema, batch, deadline, photo_ids)
+            trace.emit(processed=result['processed'], failed=result['failed'])
+            trace.flush(conn)
+        finally:
+            conn.close()
+        return {'statusCode': 200, 'headers': cors, 'body': json.dumps(result), 'isBase64Encoded': False}
+
     try:
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
             if photo_ids:
@@ -102,35 +178,46 @@ def handler(event: dict, context) -> dict:
                 skipped_raw += 1
                 continue
             try:
-                obj = s3.get_object(Bucket='foto-mix', Key=row['s3_key'])
-                data = obj['Body'].read()
-
-                img = Image.open(BytesIO(data))
-                img = ImageOps.exif_transpose(img)
-                full_w, full_h = img.size
-                if img.mode not in ('RGB', 'L'):
-                    img = img.convert('RGB')
-                img.thumbnail((THUMB_MAX, THUMB_MAX), Image.Resampling.LANCZOS)
-
-                out = BytesIO()
-                img.save(out, format='JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+                with trace.span('s3_get') as sp:
+                    data = s3.get_object(Bucket='foto-mix', Key=row['s3_key'])['Body'].read()
+                    sp.bytes = len(data)
+
+                with trace.span('decode', len(data)):
+                    img = Image.open(BytesIO(data))
+                    img = ImageOps.exif_transpose(img)
+                    full_w, full_h = img.size
+                    if img.mode not in ('RGB', 'L'):
+                        img = img.convert('RGB')
+                del data
+                with trace.span('resize'):
+                    img.thumbnail((THUMB_MAX, THUMB_MAX), Image.Resampling.LANCZOS)
+                with trace.span('hash'):
+                    dhash, phash = hash_image(img)
+
+                with trace.span('encode'):
+                    out = BytesIO()
+                    img.save(out, format='JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+                    thumb = out.getvalue()
 
                 thumb_key = row['s3_key'].rsplit('.', 1)[0] + '_thumb.jpg'
-                s3.put_object(
-                    Bucket='foto-mix',
-                    Key=thumb_key,
-                    Body=out.getvalue(),
-                    ContentType='image/jpeg',
-                )
-
-                with conn.cursor() as ucur:
+                with trace.span('s3_put', len(thumb)):
+                    s3.put_object(
+                        Bucket='foto-mix',
+                        Key=thumb_key,
+                        Body=thumb,
+                        ContentType='image/jpeg',
+                    )
+
+                with trace.span('db'), conn.cursor() as ucur:
                     ucur.execute(f'''
                         UPDATE {schema}.photo_bank
                         SET thumbnail_s3_key = %s,
                             width = COALESCE(width, %s),
-                            height = COALESCE(height, %s)
+                            height = COALESCE(height, %s),
+                            dhash = %s,
+                            phash = %s
                         WHERE id = %s
-                    ''', (thumb_key, full_w, full_h, row['id']))
+                    ''', (thumb_key, full_w, full_h, dhash, phash, row['id']))
                 conn.commit()
                 processed += 1
             except Exception as e:
@@ -148,6 +235,9 @@ def handler(event: dict, context) -> dict:
                   AND s3_key IS NOT NULL
             ''')
             remaining = cur.fetchone()[0]
+
+        trace.emit(processed=processed, failed=failed, skipped_raw=skipped_raw)
+        trace.flush(conn)
     finally:
         conn.close()
 
@@ -0,0 +1,200 @@
+'''
+Замеры этапов конвейера обработки фото: S3 GET, декод, демозаик, анализ,
+кодирование, PUT и т.д. Каждый этап — span с длительностью и числом байт.
+
+Итог вызова печатается одной JSON-строкой ([STAGES] {...}), а длительности
+раскладываются по логарифмической гистограмме и складываются в таблицу
+pipeline_stage_stats по часам — оттуда берутся p50/p95 по каждому этапу.
+
+    with Trace('backfill-thumbnails') as trace:
+        with span('s3_get') as s:
+            data = s3.get_object(...)['Body'].read()
+            s.bytes = len(data)
+        ...
+        trace.emit(processed=n)
+        trace.flush(conn)
+
+span() без явного trace пишет в активный (открытый через with Trace(...)),
+а если его нет — ничего не делает, поэтому хелперы можно размечать, не
+протаскивая trace через все вызовы.
+'''
+
+import json
+import math
+import threading
+import time
+from typing import Any, Dict, Optional
+
+SCHEMA = 't_p28211681_photo_secure_web'
+
+# Корзина i гистограммы — длительности до HIST_GROWTH ** i мс,
+# т.е. перцентиль известен с точностью до 20%. 64 корзины — до ~2 минут.
+HIST_BUCKETS = 64
+HIST_GROWTH = 1.2
+
+_active: Optional['Trace'] = None
+
+
+def _bucket(ms: float) -> int:
+    if ms <= 1.0:
+        return 0
+    return min(HIST_BUCKETS - 1, int(math.ceil(math.log(ms, HIST_GROWTH))))
+
+
+class Span:
+    '''Один замер этапа. bytes можно заполнить внутри with.'''
+
+    __slots__ = ('_trace', 'stage', 'bytes', '_start')
+
+    def __init__(self, trace: Optional['Trace'], stage: str, nbytes: int = 0):
+        self._trace = trace
+        self.stage = stage
+        self.bytes = nbytes
+        self._start = 0.0
+
+    def __enter__(self) -> 'Span':
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._trace is not None:
+            self._trace.add(self.stage, time.perf_counter() - self._start, self.bytes)
+        return False
+
+
+class Trace:
+    '''Потокобезопасный сборщик замеров одного вызова функции.'''
+
+    def __init__(self, fn: str, **context: Any):
+        self.fn = fn
+        self.context = context
+        self._lock = threading.Lock()
+        self._stages: Dict[str, Dict[str, Any]] = {}
+        self._started = time.perf_counter()
+        self._prev: Optional[Trace] = None
+
+    def __enter__(self) -> 'Trace':
+        global _active
+        self._prev, _active = _active, self
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        global _active
+        _active = self._prev
+        return False
+
+    def span(self, stage: str, nbytes: int = 0) -> Span:
+        '''Контекстный менеджер: with trace.span('decode'): ...'''
+        return Span(self, stage, nbytes)
+
+    def add(self, stage: str, seconds: float, nbytes: int = 0) -> None:
+        ms = seconds * 1000
+        with self._lock:
+            s = self._stages.get(stage)
+            if s is None:
+                s = self._stages[stage] = {
+                    'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'bytes': 0, 'hist': [0] * HIST_BUCKETS,
+                }
+            s['count'] += 1
+            s['total_ms'] += ms
+            s['max_ms'] = max(s['max_ms'], ms)
+            s['bytes'] += int(nbytes or 0)
+            s['hist'][_bucket(ms)] += 1
+
+    def as_dict(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            result = {}
+            for stage, s in self._stages.items():
+                entry = {
+                    'total_ms': round(s['total_ms'], 1),
+                    'count': s['count'],
+                    'avg_ms': round(s['total_ms'] / s['count'], 1),
+                    'max_ms': round(s['max_ms'], 1),
+                }
+                if s['bytes']:
+                    entry['bytes'] = s['bytes']
+                result[stage] = entry
+            return result
+
+    def emit(self, **extra: Any) -> Dict[str, Any]:
+        '''Печатает итог вызова одной JSON-строкой и возвращает его.'''
+        record = {
+            'fn': self.fn,
+            'wall_ms': round((time.perf_counter() - self._started) * 1000, 1),
+            'stages': self.as_dict(),
+            **self.context,
+            **extra,
+        }
+        print('[STAGES] ' + json.dumps(record, ensure_ascii=False, default=str))
+        return record
+
+    def flush(self, conn) -> None:
+        '''
+        Добавляет гистограммы вызова в pipeline_stage_stats (строка на
+        функцию/этап/час) и пересчитывает p50/p95. Ошибки статистики не
+        должны ломать обработку фото — только логируются.
+        '''
+        with self._lock:
+            rows = [(self.fn, stage, s['count'], s['total_ms'], s['max_ms'], s['bytes'], s['hist'])
+                    for stage, s in self._stages.items()]
+        if not rows:
+            return
+        try:
+            with conn.cursor() as cur:
+                values = ', '.join(
+                    cur.mogrify("(%s, %s, date_trunc('hour', NOW()), %s, %s, %s, %s, %s::integer[], NOW())",
+                                row).decode('utf-8')
+                    for row in rows
+                )
+                cur.execute(f'''
+                    INSERT INTO {SCHEMA}.pipeline_stage_stats AS s
+                    (fn, stage, period_start, count, total_ms, max_ms, bytes_total, hist, updated_at)
+                    VALUES {values}
+                    ON CONFLICT (fn, stage, period_start) DO UPDATE SET
+                        count = s.count + EXCLUDED.count,
+                        total_ms = s.total_ms + EXCLUDED.total_ms,
+                        max_ms = GREATEST(s.max_ms, EXCLUDED.max_ms),
+                        bytes_total = s.bytes_total + EXCLUDED.bytes_total,
+                        hist = ARRAY(
+                            SELECT a + b FROM unnest(s.hist, EXCLUDED.hist) WITH ORDINALITY AS h(a, b, i)
+                            ORDER BY i
+                        ),
+                        updated_at = NOW()
+                ''')
+                # Строки уже заблокированы INSERT-ом выше — перцентили считаем по итоговой гистограмме
+                cur.execute(f'''
+                    UPDATE {SCHEMA}.pipeline_stage_stats s
+                    SET p50_ms = {_percentile_sql(0.5)},
+                        p95_ms = {_percentile_sql(0.95)}
+                    WHERE s.fn = %s AND s.stage = ANY(%s) AND s.period_start = date_trunc('hour', NOW())
+                ''', (self.fn, [row[1] for row in rows]))
+            conn.commit()
+        except Exception as e:
+            print(f'[STAGES] flush failed: {e}')
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+
+
+def _percentile_sql(q: float) -> str:
+    '''Верхняя граница корзины, в которой накопленная доля достигает q.'''
+    return f'''(
+        SELECT POWER({HIST_GROWTH}, MIN(x.i) - 1)
+        FROM (
+            SELECT h.i, SUM(h.c) OVER (ORDER BY h.i) AS cum
+            FROM unnest(s.hist) WITH ORDINALITY AS h(c, i)
+        ) x
+        WHERE x.cum >= {q} * s.count
+    )'''
+
+
+def span(stage: str, nbytes: int = 0) -> Span:
+    '''Замер в активном Trace (или пустышка, если замеры не включены).'''
+    return Span(_active, stage, nbytes)
+
+
+def record(stage: str, seconds: float, nbytes: int = 0) -> None:
+    '''Готовый замер (когда этап не укладывается в один with) — в активный Trace.'''
+    if _active is not None:
+        _active.add(stage, seconds, nbytes)
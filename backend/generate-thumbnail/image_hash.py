@@ -0,0 +1,70 @@
+'''
+Перцептивные хэши кадра (dHash и pHash, по 64 бита) для поиска серий
+и почти-дублей. Считаются по миниатюре при её генерации и хранятся
+в photo_bank как BIGINT: сравнить два кадра — это popcount(a ^ b),
+картинки для группировки больше не нужны.
+'''
+
+import math
+from typing import Tuple
+
+from PIL import Image
+
+# Сторона кадра, с которой считаем хэши: дальше всё равно сжимаем до 32x32
+_HASH_SOURCE = 256
+_DCT_SIZE = 32
+_DCT_KEEP = 8
+
+# Косинусы DCT-II: нужны только первые 8 частот из 32
+_COS = [
+    [math.cos((2 * x + 1) * u * math.pi / (2 * _DCT_SIZE)) for x in range(_DCT_SIZE)]
+    for u in range(_DCT_KEEP)
+]
+
+
+def _to_signed64(value: int) -> int:
+    '''BIGINT в Postgres знаковый — старший бит переносим в знак.'''
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def dhash(gray: Image.Image) -> int:
+    '''Разностный хэш: яркость каждого пикселя 9x8 против соседа справа.'''
+    px = list(gray.resize((9, 8), Image.Resampling.LANCZOS).getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (px[row * 9 + col] > px[row * 9 + col + 1])
+    return _to_signed64(bits)
+
+
+def phash(gray: Image.Image) -> int:
+    '''
+    DCT-хэш: низкие 8x8 частоты кадра 32x32 против их медианы.
+    Устойчив к ресайзу, JPEG-пережатию и небольшим сдвигам экспозиции.
+    '''
+    px = list(gray.resize((_DCT_SIZE, _DCT_SIZE), Image.Resampling.LANCZOS).getdata())
+    rows = [px[y * _DCT_SIZE:(y + 1) * _DCT_SIZE] for y in range(_DCT_SIZE)]
+
+    # Разделимое DCT: сначала по строкам, потом по столбцам
+    by_rows = [[sum(c * p for c, p in zip(_COS[u], row)) for u in range(_DCT_KEEP)] for row in rows]
+    coeffs = [
+        sum(_COS[v][y] * by_rows[y][u] for y in range(_DCT_SIZE))
+        for v in range(_DCT_KEEP)
+        for u in range(_DCT_KEEP)
+    ]
+
+    # Постоянную составляющую (средняя яркость) в медиану не берём
+    ac = sorted(coeffs[1:])
+    median = ac[len(ac) // 2]
+    bits = 0
+    for c in coeffs:
+        bits = (bits << 1) | (c > median)
+    return _to_signed64(bits)
+
+
+def hash_image(img: Image.Image) -> Tuple[int, int]:
+    '''Возвращает (dhash, phash) для PIL-изображения любого размера.'''
+    gray = img.convert('L')
+    if max(gray.size) > _HASH_SOURCE:
+        gray.thumbnail((_HASH_SOURCE, _HASH_SOURCE), Image.Resampling.BOX)
+    return dhash(gray), phash(gray)
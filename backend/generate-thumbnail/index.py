@@ -13,6 +13,9 @@ from PIL import Image, ImageOps
 import rawpy
 import psycopg2
 from psycopg2.extras import RealDictCursor
+from image_hash import hash_image
+from raw_preview import BytesSource, S3RangeSource, fetch_embedded_jpeg, read_shot_date
+from stage_timer import Trace, span
 
 # Только эти RAW-форматы заведомо умеют postprocess через libraw.
 # Для них ВСЕГДА делаем полноценный демозаик.
@@ -63,11 +66,16 @@ def postprocess_raw_capture_one_style(raw_data: bytes, file_name: str) -> Image.
 
 
 def extract_shot_date_from_raw(raw_data, file_name):
-    """Извлекает дату съёмки (DateTimeOriginal) из RAW через встроенный JPEG-превью.
+    """Извлекает дату съёмки (DateTimeOriginal) из RAW.
+    Сначала читает теги прямо из контейнера (TIFF IFD / CR3 CMT) — без libraw
+    и без декодирования превью. Если не вышло — через встроенный JPEG-превью.
     Возвращает datetime или None. Безопасно: при любой ошибке возвращает None.
     """
     from datetime import datetime
     from PIL.ExifTags import Base as ExifBase
+    shot_date = read_shot_date(BytesSource(raw_data))
+    if shot_date:
+        return shot_date
     try:
         with rawpy.imread(BytesIO(raw_data)) as raw:
             try:
@@ -95,7 +103,11 @@ def extract_shot_date_from_raw(raw_data, file_name):
 def try_extract_embedded_jpeg(raw_data):
     """Fallback: извлекает встроенный JPEG-превью из RAW.
     Используется ТОЛЬКО если postprocess упал (например, неизвестная камера).
+    Превью ищется разбором контейнера, libraw — только если разбор не помог.
     """
+    preview = fetch_embedded_jpeg(BytesSource(raw_data), min_bytes=0)
+    if preview is not None:
+        return Image.open(BytesIO(preview))
     try:
         with rawpy.imread(BytesIO(raw_data)) as raw:
             try:
@@ -128,38 +140,62 @@ def process_single_thumbnail(conn, s3_client, photo_id, force=False):
         if photo['thumbnail_s3_key'] and not force:
             return {'photo_id': photo_id, 'skipped': True, 'reason': 'already exists', 'thumbnail_key': photo['thumbnail_s3_key']}
     
-    print(f'[THUMBNAIL] Downloading: {photo["s3_key"]}')
-    
-    response = s3_client.get_object(Bucket='foto-mix', Key=photo['s3_key'])
-    raw_data = response['Body'].read()
-    dl_time = time.time() - start
-    
-    print(f'[THUMBNAIL] Downloaded {len(raw_data)//1024//1024}MB in {dl_time:.1f}s, converting...')
-
     file_name = photo['file_name'] or ''
-
-    # Дата съёмки из EXIF (пока RAW в памяти) — для сортировки по дате/времени
-    shot_date = extract_shot_date_from_raw(raw_data, file_name)
-
     img = None
     source = None
+    shot_date = None
+    raw_data = None
+
+    if not is_true_raw(file_name):
+        # Не RAW по расширению — демозаик не нужен, поэтому сначала пробуем
+        # достать только встроенное превью и дату ranged-запросами, не скачивая файл.
+        src = S3RangeSource(s3_client, 'foto-mix', photo['s3_key'])
+        with span('range_preview') as sp:
+            preview = fetch_embedded_jpeg(src, min_bytes=0)
+            if preview is not None:
+                img = Image.open(BytesIO(preview))
+                shot_date = read_shot_date(src)
+            sp.bytes = src.bytes_fetched
+        if preview is not None:
+            source = 'embedded(range)'
+            print(f'[THUMBNAIL] Embedded preview via {src.requests} ranged GETs: '
+                  f'{src.bytes_fetched} of {src.size} bytes')
+        dl_time = time.time() - start
+
+    if img is None:
+        print(f'[THUMBNAIL] Downloading: {photo["s3_key"]}')
+
+        with span('s3_get') as sp:
+            raw_data = s3_client.get_object(Bucket='foto-mix', Key=photo['s3_key'])['Body'].read()
+            sp.bytes = len(raw_data)
+        dl_time = time.time() - start
+
+        print(f'[THUMBNAIL] Downloaded {len(raw_data)//1024//1024}MB in {dl_time:.1f}s, converting...')
+
+        # Дата съёмки из EXIF (пока RAW в памяти) — для сортировки по дате/времени
+        with span('exif'):
+            shot_date = extract_shot_date_from_raw(raw_data, file_name)
 
     # Для RAW — ВСЕГДА полный демозаик с матрицей камеры (Capture One-style),
     # а не встроенный JPEG-превью (он часто красный/перекрученный).
-    if is_true_raw(file_name):
+    if img is None and is_true_raw(file_name):
         try:
-            img = postprocess_raw_capture_one_style(raw_data, file_name)
+            with span('demosaic', len(raw_data)):
+                img = postprocess_raw_capture_one_style(raw_data, file_name)
             source = 'postprocess(C1-style)'
         except Exception as e:
             print(f'[THUMBNAIL] postprocess failed ({e}), fallback to embedded JPEG')
-            img = try_extract_embedded_jpeg(raw_data)
+            with span('embedded'):
+                img = try_extract_embedded_jpeg(raw_data)
             source = 'embedded(fallback)'
-    else:
+    elif img is None:
         # Не RAW (например прислали JPEG с RAW-расширением .raw в имени) — берём embedded
-        img = try_extract_embedded_jpeg(raw_data)
+        with span('embedded'):
+            img = try_extract_embedded_jpeg(raw_data)
         source = 'embedded'
         if img is None:
-            img = postprocess_raw_capture_one_style(raw_data, file_name)
+            with span('demosaic', len(raw_data)):
+                img = postprocess_raw_capture_one_style(raw_data, file_name)
             source = 'postprocess(fallback)'
 
     del raw_data
@@ -180,28 +216,40 @@ def process_single_thumbnail(conn, s3_client, photo_id, force=False):
 
     # Превью отдаём как с камеры (camera WB + лёгкое auto-bright libraw),
     # БЕЗ цветокора. Пресет применяется только на этапе ретуши.
-    img.thumbnail((2400, 2400), Image.Resampling.LANCZOS)
+    with span('resize'):
+        img.thumbnail((2400, 2400), Image.Resampling.LANCZOS)
+
+    # Хэши для поиска серий — по готовой миниатюре, пока она в памяти
+    try:
+        with span('hash'):
+            dhash, phash = hash_image(img)
+    except Exception as e:
+        print(f'[THUMBNAIL] hash failed: {e}')
+        dhash, phash = None, None
 
-    jpeg_buffer = BytesIO()
-    img.save(jpeg_buffer, format='JPEG', quality=92, subsampling=0)
-    jpeg_buffer.seek(0)
+    with span('encode'):
+        jpeg_buffer = BytesIO()
+        img.save(jpeg_buffer, format='JPEG', quality=92, subsampling=0)
+        jpeg_buffer.seek(0)
     del img
 
     print(f'[THUMBNAIL] Generated from {source}')
     
     thumbnail_key = photo['s3_key'].rsplit('.', 1)[0] + '_thumb.jpg'
     
-    s3_client.put_object(
-        Bucket='foto-mix',
-        Key=thumbnail_key,
-        Body=jpeg_buffer.getvalue(),
-        ContentType='image/jpeg'
-    )
+    thumb_bytes = jpeg_buffer.getvalue()
+    with span('s3_put', len(thumb_bytes)):
+        s3_client.put_object(
+            Bucket='foto-mix',
+            Key=thumbnail_key,
+            Body=thumb_bytes,
+            ContentType='image/jpeg'
+        )
     
     total_time = time.time() - start
     print(f'[THUMBNAIL] Done photo_id={photo_id} in {total_time:.1f}s (download: {dl_time:.1f}s)')
     
-    with conn.cursor() as cur:
+    with span('db'), conn.cursor() as cur:
         # shot_date пишем только если он ещё не задан (COALESCE),
         # чтобы не перетирать дату при принудительной перегенерации.
         cur.execute('''
@@ -210,9 +258,11 @@ def process_single_thumbnail(conn, s3_client, photo_id, force=False):
                 is_raw = TRUE,
                 shot_date = COALESCE(shot_date, %s),
                 width = COALESCE(width, %s),
-                height = COALESCE(height, %s)
+                height = COALESCE(height, %s),
+                dhash = %s,
+                phash = %s
             WHERE id = %s
-        ''', (thumbnail_key, shot_date, full_w, full_h, photo_id))
+        ''', (thumbnail_key, shot_date, full_w, full_h, dhash, phash, photo_id))
         conn.commit()
     
     return {'photo_id': photo_id, 'thumbnail_key': thumbnail_key, 'time': round(total_time, 1)}
@@ -281,17 +331,21 @@ def handler(event: dict, context) -> dict:
         conn = psycopg2.connect(dsn)
         results = []
         
-        for photo_id in photo_ids:
-            try:
-                result = process_single_thumbnail(conn, s3_client, photo_id, force=force)
-                results.append(result)
-            except Exception as e:
-                print(f'[THUMBNAIL_ERROR] photo_id={photo_id}: {str(e)}')
-                results.append({'photo_id': photo_id, 'error': str(e)})
+        with Trace('generate-thumbnail', force=force) as trace:
+            for photo_id in photo_ids:
+                try:
+                    result = process_single_thumbnail(conn, s3_client, photo_id, force=force)
+                    results.append(result)
+                except Exception as e:
+                    conn.rollback()
+                    print(f'[THUMBNAIL_ERROR] photo_id={photo_id}: {str(e)}')
+                    results.append({'photo_id': photo_id, 'error': str(e)})
         
+        successful = [r for r in results if 'thumbnail_key' in r]
+        trace.emit(processed=len(results), successful=len(successful))
+        trace.flush(conn)
         conn.close()
         
-        successful = [r for r in results if 'thumbnail_key' in r]
         return {
             'statusCode': 200,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -8,13 +8,13 @@ import base64
 import gzip
 import os
 import tempfile
-from typing import List, Tuple, Optional
+import threading
+import time
+from typing import Any, Callable, Dict, List, Tuple, Optional
 
 import cv2
 import numpy as np
 
-from yunet_model import MODEL_GZ_B64
-
 _model_path_cache = None
 
 
@@ -35,6 +35,8 @@ def _ensure_model() -> Optional[str]:
     try:
         path = os.path.join(tempfile.gettempdir(), 'face_detection_yunet.onnx')
         if not os.path.exists(path):
+            # Модуль с base64 весит мегабайты — импортируем, только если .onnx рядом нет
+            from yunet_model import MODEL_GZ_B64
             with open(path, 'wb') as f:
                 f.write(gzip.decompress(base64.b64decode(MODEL_GZ_B64)))
             print(f'[FACE] Model unpacked to {path}')
@@ -44,32 +46,92 @@ def _ensure_model() -> Optional[str]:
         print(f'[FACE] Failed to unpack model: {e}')
         return None
 
+
+# Реестр моделей: каждая грузится один раз на тёплый инстанс и живёт,
+# пока жив процесс. Для каждой пишем время загрузки и первого прогона —
+# именно они и составляют цену холодного старта.
+_models: Dict[str, Any] = {}
+_model_stats: Dict[str, Dict[str, float]] = {}
+_models_lock = threading.Lock()
+
+
+def get_model(name: str, loader: Callable[[], Any]) -> Any:
+    '''Возвращает модель из реестра, при первом обращении загружая её loader-ом.'''
+    model = _models.get(name)
+    if model is not None:
+        return model
+    with _models_lock:
+        model = _models.get(name)
+        if model is None:
+            started = time.perf_counter()
+            model = loader()
+            load_ms = round((time.perf_counter() - started) * 1000, 1)
+            if model is not None:
+                _models[name] = model
+                _model_stats.setdefault(name, {})['load_ms'] = load_ms
+                print(f'[FACE] Model {name} loaded in {load_ms}ms')
+    return model
+
+
+def record_first_inference(name: str, seconds: float) -> None:
+    '''Запоминает время первого прогона модели (последующие не интересны).'''
+    stats = _model_stats.setdefault(name, {})
+    if 'first_inference_ms' not in stats:
+        stats['first_inference_ms'] = round(seconds * 1000, 1)
+        print(f'[FACE] Model {name} first inference in {stats["first_inference_ms"]}ms')
+
+
+def model_stats() -> Dict[str, Dict[str, float]]:
+    '''Время загрузки и первого прогона по всем загруженным моделям.'''
+    return {name: dict(stats) for name, stats in _model_stats.items()}
+
+
 # Вердикты состояния глаз
 EYES_OPEN = 'open'
 EYES_CLOSED = 'closed'
 EYES_UNCERTAIN = 'uncertain'
 
-_detector = None
+# Пороги раскрытости глаза (высота/ширина тёмной области).
+# Копия — в photobank-folders/bursts.py (выбор лучшего кадра серии)
+EYES_OPEN_RATIO = 0.62
+EYES_CLOSED_RATIO = 0.38
 
+# Лица мельче этого (по меньшей стороне рамки) на резкость не проверяем
+FACE_MIN_MEASURABLE = 90
 
-def _get_detector(size: Tuple[int, int]):
-    '''Создаёт (или переиспользует) детектор лиц YuNet под нужный размер кадра.'''
-    global _detector
+YUNET_INPUT_SIZE = (320, 320)
+
+
+def _load_yunet():
     model_path = _ensure_model()
     if not model_path:
         return None
-    if _detector is None:
-        _detector = cv2.FaceDetectorYN.create(
-            model=model_path,
-            config='',
-            input_size=size,
-            score_threshold=0.6,
-            nms_threshold=0.3,
-            top_k=50,
-        )
-    else:
-        _detector.setInputSize(size)
-    return _detector
+    return cv2.FaceDetectorYN.create(
+        model=model_path,
+        config='',
+        input_size=YUNET_INPUT_SIZE,
+        score_threshold=0.6,
+        nms_threshold=0.3,
+        top_k=50,
+    )
+
+
+def _get_detector(size: Tuple[int, int]):
+    '''Берёт детектор лиц YuNet из реестра и настраивает под размер кадра.'''
+    detector = get_model('yunet', _load_yunet)
+    if detector is not None:
+        detector.setInputSize(size)
+    return detector
+
+
+def warmup() -> Dict[str, Dict[str, float]]:
+    '''
+    Прогрев для холодного старта: загружает YuNet и делает пустой прогон,
+    чтобы первый настоящий кадр не платил за инициализацию.
+    '''
+    blank = np.zeros((YUNET_INPUT_SIZE[1], YUNET_INPUT_SIZE[0], 3), dtype=np.uint8)
+    detect_faces(blank)
+    return model_stats()
 
 
 def detect_faces(img: np.ndarray) -> List[dict]:
@@ -84,7 +146,9 @@ def detect_faces(img: np.ndarray) -> List[dict]:
             print('[FACE] YuNet model file missing, skipping neural detection')
             return []
 
+        started = time.perf_counter()
         _, faces = detector.detect(img)
+        record_first_inference('yunet', time.perf_counter() - started)
         if faces is None:
             return []
 
@@ -177,7 +241,7 @@ def face_is_measurable(img: np.ndarray, face: dict) -> bool:
     и любая оценка будет случайной — такие лица не проверяем.
     '''
     _, _, w, h = face['box']
-    return min(w, h) >= 90
+    return min(w, h) >= FACE_MIN_MEASURABLE
 
 
 def eye_patch(img_gray: np.ndarray, center: Tuple[float, float], face_w: int) -> Optional[np.ndarray]:
@@ -229,13 +293,12 @@ def _eye_openness(patch: np.ndarray) -> Optional[float]:
     return float(bh) / float(bw)
 
 
-def eyes_state(img: np.ndarray, face: dict) -> Tuple[str, str]:
+def eye_openness(img: np.ndarray, face: dict) -> Tuple[Optional[float], int]:
     '''
-    Определяет состояние глаз по точкам нейросети.
-    Работает и при повороте головы — координаты глаз известны заранее,
-    поэтому взгляд в сторону НЕ считается браком.
+    Раскрытость глаз лица — лучшая из двух по точкам нейросети.
+    Именно это число сохраняется в метриках, вердикт считается из него.
 
-    Returns: (вердикт, пояснение для логов)
+    Returns: (раскрытость или None, по скольким глазам удалось оценить)
     '''
     x, y, w, h = face['box']
     gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if len(img.shape) == 3 else img
@@ -248,15 +311,32 @@ def eyes_state(img: np.ndarray, face: dict) -> Tuple[str, str]:
             ratios.append(r)
 
     if not ratios:
-        return EYES_UNCERTAIN, 'не удалось разглядеть глаза'
+        return None, 0
+    return max(ratios), len(ratios)
 
-    best = max(ratios)
-    detail = f'раскрытость={best:.2f} (по {len(ratios)} глазам)'
 
+def eyes_verdict(openness: Optional[float]) -> str:
+    '''Вердикт по раскрытости глаз (EYES_OPEN / EYES_CLOSED / EYES_UNCERTAIN).'''
+    if openness is None:
+        return EYES_UNCERTAIN
     # Открытый глаз: тёмная область почти круглая (высота ~ ширина)
-    if best >= 0.62:
-        return EYES_OPEN, detail
+    if openness >= EYES_OPEN_RATIO:
+        return EYES_OPEN
     # Закрытый или моргание: осталась узкая полоска
-    if best <= 0.38:
-        return EYES_CLOSED, detail
-    return EYES_UNCERTAIN, detail
\ No newline at end of file
+    if openness <= EYES_CLOSED_RATIO:
+        return EYES_CLOSED
+    return EYES_UNCERTAIN
+
+
+def eyes_state(img: np.ndarray, face: dict) -> Tuple[str, str]:
+    '''
+    Определяет состояние глаз по точкам нейросети.
+    Работает и при повороте головы — координаты глаз известны заранее,
+    поэтому взгляд в сторону НЕ считается браком.
+
+    Returns: (вердикт, пояснение для логов)
+    '''
+    best, count = eye_openness(img, face)
+    if best is None:
+        return EYES_UNCERTAIN, 'не удалось разглядеть глаза'
+    return eyes_verdict(best), f'раскрытость={best:.2f} (по {count} глазам)'
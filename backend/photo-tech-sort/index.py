@@ -8,7 +8,8 @@ Returns: Статус обработки и количество забрако
 import json
 import os
 import io
-from typing import Dict, Any, List, Tuple
+import time
+from typing import Dict, Any, List, Tuple, Optional
 import psycopg2
 from psycopg2.extras import RealDictCursor
 import boto3
@@ -20,11 +21,16 @@ from face_quality import (
     detect_faces,
     face_sharpness,
     face_exposure,
-    face_is_measurable,
-    eyes_state,
-    EYES_CLOSED,
-    EYES_UNCERTAIN,
+    eye_openness,
+    model_stats,
+    warmup,
+    EYES_OPEN_RATIO,
+    EYES_CLOSED_RATIO,
+    FACE_MIN_MEASURABLE,
 )
+from prefetch import PhotoPrefetcher
+from stage_timer import Trace, span
+from raw_preview import S3RangeSource, find_embedded_jpeg
 
 # Пороги резкости ПО ЛИЦУ. Анализ идёт по уменьшенной копии кадра
 # (640-800px), поэтому абсолютные значения невысокие.
@@ -37,469 +43,606 @@ FACE_BLUR_OK = 35.0
 # Нормальная кожа обычно 90-200. За пределами — кожа не читается.
 FACE_TOO_BRIGHT = 235.0
 FACE_TOO_DARK = 45.0
+# Доля выбитых в белое / проваленных в чёрное пикселей кожи
+FACE_BLOWN_MAX = 0.5
+FACE_CRUSHED_MAX = 0.6
+
+# Пороги ПО ВСЕМУ КАДРУ — когда лиц нет или лицо слишком мелкое
+FRAME_BLUR_THRESHOLD = 100.0
+FRAME_BRIGHT_RATIO = 0.3
+FRAME_DARK_RATIO = 0.4
+
+# Версия алгоритма метрик. Повышать при любом изменении measure_image:
+# метрики старой версии для переклассификации не используются.
+METRICS_VERSION = 1
 
 # Причины, которые считаются спорными и идут в папку «Проверить»
 REVIEW_REASONS = ('review_blur', 'review_eyes')
 
 
-def detect_closed_eyes(img: np.ndarray) -> bool:
+def _as_gray(img: np.ndarray) -> np.ndarray:
+    '''Серая копия кадра; уже серый кадр возвращается как есть.'''
+    return img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+
+# Размер копии кадра для анализа. Все проверки (резкость, экспозиция,
+# лица, глаза) работают по одной уменьшенной копии 640-800px.
+ANALYSIS_MAX_DIM = 800
+RAW_PREVIEW_MAX_DIM = 640
+
+# Из RAW скачиваем только встроенное JPEG-превью (ranged GET по контейнеру).
+# Целиком RAW качается лишь если превью не нашлось — тогда rawpy читает весь
+# файл, и крупные пропускаем, чтобы не выйти за 256MB. JPEG декодируется
+# сразу в 1/2-1/8 масштабе (DCT scaling), в памяти остаются только сжатые байты.
+MAX_RAW_FILE_MB = 35
+MAX_ANALYZE_FILE_MB = 80
+
+RAW_EXTENSIONS = ('.cr2', '.cr3', '.nef', '.nrw', '.arw', '.raw', '.dng',
+                  '.orf', '.rw2', '.raf', '.pef')
+
+# Конвейерный режим: пока текущий кадр анализируется, следующие
+# PREFETCH_LOOKAHEAD файлов уже качаются в PREFETCH_WORKERS потоков.
+# Скачанные, но не разобранные байты держим в PREFETCH_BUDGET_MB —
+# вместе с декодом самого крупного кадра это укладывается в 256 МБ.
+PIPELINE_BATCH_SIZE = 20
+PIPELINE_MAX_BATCH_SIZE = 40
+PREFETCH_WORKERS = 3
+PREFETCH_LOOKAHEAD = 4
+PREFETCH_BUDGET_MB = 64
+
+
+def fetch_photo(s3_client, bucket: str, s3_key: str, budget=None, timings=None) -> Tuple[Optional[bytes], int]:
     """
-    Улучшенная детекция закрытых глаз - СТРОЖЕ к ложным срабатываниям
-    КРИТИЧНО: Прищур при улыбке НЕ ДОЛЖЕН считаться закрытыми глазами!
-    
-    Изменения от предыдущей версии:
-    - Повышен порог EAR (зрачки должны быть более заметны)
-    - Увеличен порог яркости (белки глаз должны быть ярче)
-    - Требуется больше признаков для решения "глаза закрыты"
-    - Приоритет: лучше пропустить брак, чем отбраковать нормальное фото
-    
-    Returns: True если ОДНОЗНАЧНО закрыты глаза БЕЗ улыбки, False в остальных случаях
+    Скачивает фото из S3 с проверкой размера (этапы head + get).
+    Для RAW сначала пробует достать только встроенное JPEG-превью (этап raw_preview).
+    budget — ByteBudget конвейера (BudgetTicket фото): место под файл занимаем ДО скачивания.
+    Returns: (байты или None если файл пропущен, сколько байт занято в бюджете)
     """
-    try:
-        face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
-        eye_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_eye.xml')
-        smile_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_smile.xml')
-        
-        # Медианный блюр для шумоподавления
-        img_filtered = cv2.medianBlur(img, 5)
-        gray = cv2.cvtColor(img_filtered, cv2.COLOR_BGR2GRAY)
-        
-        # CLAHE для выравнивания контраста
-        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-        gray = clahe.apply(gray)
-        
-        faces = face_cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(30, 30))
-        
-        if len(faces) == 0:
-            print('[TECH_SORT] No faces detected → ACCEPT (no rejection without faces)')
-            return False
-        
-        faces_with_definitely_closed_eyes = 0
-        faces_ok = 0
-        
-        for (x, y, w, h) in faces:
-            print(f'[TECH_SORT] Analyzing face at ({x},{y}) size {w}x{h}')
-            
-            face_roi = gray[y:y+h, x:x+w]
-            
-            if face_roi.size == 0:
-                continue
-            
-            # Upscale small faces
-            if w < 80 or h < 80:
-                scale_factor = 120 / min(w, h)
-                new_w = int(w * scale_factor)
-                new_h = int(h * scale_factor)
-                face_roi = cv2.resize(face_roi, (new_w, new_h), interpolation=cv2.INTER_CUBIC)
-                print(f'[TECH_SORT] Face upscaled from {w}x{h} to {new_w}x{new_h}')
-                w, h = new_w, new_h
-            
-            # ШАГ 1: Детекция улыбки (СТРОЖЕ - требуем высокую уверенность)
-            mouth_region_y = int(h * 0.5)
-            mouth_region = face_roi[mouth_region_y:h, 0:w]
-            
-            smiles_detected = smile_cascade.detectMultiScale(
-                mouth_region,
-                scaleFactor=1.3,
-                minNeighbors=22,  # УВЕЛИЧЕНО с 20 до 22 (строже)
-                minSize=(int(w*0.25), int(h*0.15))
-            )
-            
-            is_smiling = len(smiles_detected) > 0
-            print(f'[TECH_SORT] Smile detection: {len(smiles_detected)} smiles found → {"😊 SMILING" if is_smiling else "neutral"}')
-            
-            # ШАГ 2: Детекция глаз
-            eye_region_y = int(h * 0.25)
-            eye_region_h = int(h * 0.25)
-            eye_region = face_roi[eye_region_y:eye_region_y + eye_region_h, 0:w]
-            
-            if eye_region.size == 0:
-                faces_ok += 1  # Не можем проверить - считаем OK
-                continue
-            
-            # Детекция глаз каскадом (оптимизировано для экономии памяти)
-            eyes_detected = eye_cascade.detectMultiScale(
-                eye_region, 
-                scaleFactor=1.1,  # Увеличено с 1.03 (меньше масштабов = меньше памяти)
-                minNeighbors=3,   # Снижено с 4 (меньше проходов)
-                minSize=(int(w*0.15), int(h*0.2))  # Увеличен минимальный размер
-            )
-            
-            print(f'[TECH_SORT] Eyes detected by cascade: {len(eyes_detected)}')
-            
-            # Тройная бинаризация (ищем зрачки)
-            _, binary_dark_strict = cv2.threshold(eye_region, 40, 255, cv2.THRESH_BINARY_INV)  # Понижен с 45 до 40
-            
-            binary_dark_adaptive = cv2.adaptiveThreshold(
-                eye_region, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, 
-                cv2.THRESH_BINARY_INV, 13, 3
-            )
-            
-            _, binary_dark_otsu = cv2.threshold(eye_region, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
-            
-            binary_dark = cv2.bitwise_or(binary_dark_strict, binary_dark_adaptive)
-            binary_dark = cv2.bitwise_or(binary_dark, binary_dark_otsu)
-            
-            # Морфологическое закрытие
-            kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
-            binary_dark = cv2.morphologyEx(binary_dark, cv2.MORPH_CLOSE, kernel)
-            
-            # Поиск круглых контуров (зрачки)
-            contours, _ = cv2.findContours(binary_dark, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-            
-            circular_contours = 0
-            for contour in contours:
-                area = cv2.contourArea(contour)
-                min_area = max(12, (w * h) / 2000)  # Понижен с 15 и 1800
-                max_area = (w * h) / 8
-                
-                if area < min_area or area > max_area:
-                    continue
-                
-                perimeter = cv2.arcLength(contour, True)
-                if perimeter == 0:
-                    continue
-                
-                circularity = 4 * np.pi * area / (perimeter * perimeter)
-                
-                x_cnt, y_cnt, w_cnt, h_cnt = cv2.boundingRect(contour)
-                aspect_ratio = w_cnt / float(h_cnt) if h_cnt > 0 else 0
-                
-                # СТРОЖЕ проверка на круглость (понижен порог)
-                if circularity > 0.6 and 0.65 <= aspect_ratio <= 1.5:  # Было 0.65/0.7-1.4
-                    circular_contours += 1
-                    print(f'[TECH_SORT] Pupil candidate: area={area:.1f}, circularity={circularity:.2f}, aspect={aspect_ratio:.2f}')
-            
-            print(f'[TECH_SORT] Circular contours found (pupils): {circular_contours}')
-            
-            # Анализ яркости области глаз
-            mean_brightness = np.mean(eye_region)
-            std_brightness = np.std(eye_region)
-            print(f'[TECH_SORT] Eye region: mean_brightness={mean_brightness:.1f}, std={std_brightness:.1f}')
-            
-            # НОВАЯ ЛОГИКА: СТРОЖЕ к закрытию глаз (меньше ложных срабатываний)
-            # Глаза ОДНОЗНАЧНО ОТКРЫТЫ если:
-            # 1. Каскад нашёл 2+ глаза (даже при низкой яркости) ИЛИ
-            # 2. Найдено 2+ зрачка ИЛИ
-            # 3. Найдено 1+ глаз каскадом И яркость > 50 ИЛИ
-            # 4. Яркость > 65 (очень светлая область - точно открыты) ИЛИ
-            # 5. Стандартное отклонение > 30 (контрастная область - зрачок+белок)
-            
-            eyes_definitely_open = False
-            
-            if len(eyes_detected) >= 2:
-                eyes_definitely_open = True
-                print(f'[TECH_SORT] ✅ Eyes DEFINITELY open: cascade found 2+ eyes')
-            elif circular_contours >= 2:
-                eyes_definitely_open = True
-                print(f'[TECH_SORT] ✅ Eyes DEFINITELY open: found 2+ circular pupils')
-            elif len(eyes_detected) >= 1 and mean_brightness > 50:
-                eyes_definitely_open = True
-                print(f'[TECH_SORT] ✅ Eyes DEFINITELY open: 1 eye detected + brightness > 50')
-            elif mean_brightness > 65:
-                eyes_definitely_open = True
-                print(f'[TECH_SORT] ✅ Eyes DEFINITELY open: very bright region (>{mean_brightness:.1f})')
-            elif std_brightness > 30:
-                eyes_definitely_open = True
-                print(f'[TECH_SORT] ✅ Eyes DEFINITELY open: high contrast (std={std_brightness:.1f} > 30)')
-            elif circular_contours >= 1 and mean_brightness > 45:
-                eyes_definitely_open = True
-                print(f'[TECH_SORT] ✅ Eyes DEFINITELY open: 1+ pupil + brightness > 45')
-            else:
-                print(f'[TECH_SORT] ⚠️ UNCERTAIN: cascade={len(eyes_detected)}, pupils={circular_contours}, brightness={mean_brightness:.1f}, std={std_brightness:.1f}')
-            
-            # ФИНАЛЬНОЕ РЕШЕНИЕ с приоритетом на безопасность
-            if eyes_definitely_open:
-                faces_ok += 1
-                print(f'[TECH_SORT] Face verdict: ✅ Eyes open → OK')
-            elif is_smiling:
-                faces_ok += 1
-                print(f'[TECH_SORT] Face verdict: 😊 Smiling (uncertain eyes) → OK (не браковать)')
-            elif len(eyes_detected) == 0 and circular_contours == 0 and mean_brightness < 45:
-                # ТОЛЬКО если ВСЕ признаки указывают на закрытые глаза
-                faces_with_definitely_closed_eyes += 1
-                print(f'[TECH_SORT] Face verdict: ❌ Eyes DEFINITELY closed → REJECT')
-            else:
-                # Сомнительный случай - НЕ браковать (лучше пропустить брак чем отбраковать норму)
-                faces_ok += 1
-                print(f'[TECH_SORT] Face verdict: ⚠️ UNCERTAIN → OK (приоритет на безопасность)')
-        
-        # Итог: браковать ТОЛЬКО если есть ОДНОЗНАЧНО закрытые глаза БЕЗ улыбки
-        is_rejected = faces_with_definitely_closed_eyes > 0
-        print(f'[TECH_SORT] Final: faces_ok={faces_ok}, faces_definitely_closed={faces_with_definitely_closed_eyes} → {"❌ REJECT" if is_rejected else "✅ ACCEPT"}')
-        return is_rejected
-        
-    except Exception as e:
-        print(f'[TECH_SORT] Error in eye detection: {str(e)}')
-        return False
+    if s3_key.lower().endswith(RAW_EXTENSIONS):
+        t0 = time.perf_counter()
+        src = S3RangeSource(s3_client, bucket, s3_key)
+        try:
+            location = find_embedded_jpeg(src)
+        except Exception as e:
+            print(f'[TECH_SORT] RAW container parse failed: {e}')
+            location = None
+        if location:
+            offset, length = location
+            if budget is not None and not budget.acquire(length):
+                return None, 0
+            try:
+                preview = src.read(offset, length)
+            except Exception:
+                if budget is not None:
+                    budget.release(length)
+                raise
+            if timings is not None:
+                timings.add('raw_preview', time.perf_counter() - t0, src.bytes_fetched)
+            if preview[:2] == b'\xff\xd8' and len(preview) == length:
+                print(f'[TECH_SORT] RAW preview via {src.requests} ranged GETs: '
+                      f'{src.bytes_fetched} of {src.size} bytes ({s3_key})')
+                return preview, length
+            del preview
+            if budget is not None:
+                budget.release(length)
+        print(f'[TECH_SORT] No embedded preview found by container reader, downloading whole RAW')
 
+    t0 = time.perf_counter()
+    # КРИТИЧНО: Проверяем размер файла ПЕРЕД загрузкой (предотвращение OOM)
+    head_response = s3_client.head_object(Bucket=bucket, Key=s3_key)
+    size = head_response['ContentLength']
+    file_size_mb = size / (1024 * 1024)
+    if timings is not None:
+        timings.add('head', time.perf_counter() - t0)
+    print(f'[TECH_SORT] File size: {file_size_mb:.1f} MB ({s3_key})')
 
-def detect_blur(img: np.ndarray) -> bool:
-    """Проверяет резкость фотографии через Laplacian variance"""
-    try:
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        laplacian_var = cv2.Laplacian(gray, cv2.CV_64F).var()
-        
-        is_blurry = laplacian_var < 100
-        print(f'[TECH_SORT] Blur score: {laplacian_var:.2f} (threshold=100) → {"❌ BLURRY" if is_blurry else "✅ SHARP"}')
-        
-        return is_blurry
-    except Exception as e:
-        print(f'[TECH_SORT] Error in blur detection: {str(e)}')
-        return False
+    limit_mb = MAX_RAW_FILE_MB if s3_key.lower().endswith(RAW_EXTENSIONS) else MAX_ANALYZE_FILE_MB
+    if file_size_mb > limit_mb:
+        print(f'[TECH_SORT] ⚠️ File too large ({file_size_mb:.1f} MB), skipping to prevent OOM')
+        return None, 0
 
+    if budget is not None and not budget.acquire(size):
+        return None, 0
 
-def detect_overexposed(img: np.ndarray) -> bool:
-    """Проверяет пересвет (overexposure)"""
+    t0 = time.perf_counter()
     try:
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        bright_pixels = np.sum(gray > 240)
-        total_pixels = gray.size
-        bright_ratio = bright_pixels / total_pixels
-        
-        is_overexposed = bright_ratio > 0.3
-        print(f'[TECH_SORT] Overexposure: {bright_ratio*100:.1f}% bright pixels (threshold=30%) → {"❌ OVEREXPOSED" if is_overexposed else "✅ OK"}')
-        
-        return is_overexposed
-    except Exception as e:
-        print(f'[TECH_SORT] Error in overexposure detection: {str(e)}')
-        return False
+        response = s3_client.get_object(Bucket=bucket, Key=s3_key)
+        img_data = response['Body'].read()
+    except Exception:
+        if budget is not None:
+            budget.release(size)
+        raise
+    if timings is not None:
+        timings.add('get', time.perf_counter() - t0, len(img_data))
+    print(f'[TECH_SORT] Downloaded {len(img_data)} bytes ({s3_key})')
+    return img_data, size
 
 
-def detect_underexposed(img: np.ndarray) -> bool:
-    """Проверяет недосвет (underexposure)"""
-    try:
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        dark_pixels = np.sum(gray < 30)
-        total_pixels = gray.size
-        dark_ratio = dark_pixels / total_pixels
-        
-        is_underexposed = dark_ratio > 0.4
-        print(f'[TECH_SORT] Underexposure: {dark_ratio*100:.1f}% dark pixels (threshold=40%) → {"❌ UNDEREXPOSED" if is_underexposed else "✅ OK"}')
-        
-        return is_underexposed
-    except Exception as e:
-        print(f'[TECH_SORT] Error in underexposure detection: {str(e)}')
-        return False
+def _reduced_imread_flag(width: int, height: int, max_dim: int) -> int:
+    '''Флаг cv2.IMREAD_REDUCED_* с наибольшим уменьшением, не меньше max_dim.'''
+    longest = max(width, height)
+    for factor, flag in ((8, cv2.IMREAD_REDUCED_COLOR_8),
+                         (4, cv2.IMREAD_REDUCED_COLOR_4),
+                         (2, cv2.IMREAD_REDUCED_COLOR_2)):
+        if longest // factor >= max_dim:
+            return flag
+    return cv2.IMREAD_COLOR
 
 
-def analyze_photo(s3_client, bucket: str, s3_key: str) -> Tuple[bool, str]:
+def _fit(img: np.ndarray, max_dim: int) -> np.ndarray:
+    h, w = img.shape[:2]
+    if max(w, h) <= max_dim:
+        return img
+    scale = max_dim / max(w, h)
+    return cv2.resize(img, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+
+
+def decode_scaled(data: bytes, max_dim: int) -> Optional[np.ndarray]:
     """
-    Анализирует фото на технический брак
-    Returns: (is_rejected, reject_reason)
+    Декодирует JPEG сразу в уменьшенном виде и дожимает до max_dim.
+    libjpeg умеет масштабировать на этапе обратного DCT (1/2, 1/4, 1/8),
+    поэтому 45MP кадр не разворачивается в памяти целиком:
+    вместо ~135MB RGB получаем ~2-8MB. Остальные форматы — обычный декод.
+    Returns: BGR-копия для анализа или None
     """
+    header_size = None
     try:
-        print(f'[TECH_SORT] Analyzing photo: {s3_key}')
-        
-        # КРИТИЧНО: Проверяем размер файла ПЕРЕД загрузкой (предотвращение OOM)
-        head_response = s3_client.head_object(Bucket=bucket, Key=s3_key)
-        file_size_mb = head_response['ContentLength'] / (1024 * 1024)
-        print(f'[TECH_SORT] File size: {file_size_mb:.1f} MB')
-        
-        # Пропускаем файлы > 35 МБ (нехватка памяти в Cloud Functions 256MB)
-        if file_size_mb > 35:
-            print(f'[TECH_SORT] ⚠️ File too large ({file_size_mb:.1f} MB), skipping to prevent OOM')
-            return False, ''  # Не браковать, просто пропустить
-        
-        # Скачиваем фото из S3
-        response = s3_client.get_object(Bucket=bucket, Key=s3_key)
-        img_data = response['Body'].read()
-        print(f'[TECH_SORT] Downloaded {len(img_data)} bytes')
-        
-        # Для RAW файлов используем встроенный thumbnail (экономия памяти)
-        is_raw = s3_key.lower().endswith(('.cr2', '.nef', '.arw', '.raw', '.dng'))
-        
-        if is_raw:
-            print(f'[TECH_SORT] RAW file detected ({len(img_data)} bytes), extracting thumbnail')
-            try:
-                import rawpy
-                import gc
-                
-                # Освобождаем память перед работой с RAW
-                gc.collect()
-                print(f'[TECH_SORT] Memory cleared, opening RAW stream')
-                
-                raw_stream = io.BytesIO(img_data)
-                with rawpy.imread(raw_stream) as raw:
-                    print(f'[TECH_SORT] RAW opened, extracting thumbnail')
-                    # Используем встроенный JPEG preview вместо полного RAW (в 10x меньше памяти)
-                    try:
-                        thumb = raw.extract_thumb()
-                        print(f'[TECH_SORT] Thumbnail extracted, format={thumb.format}')
-                        
-                        if thumb.format == rawpy.ThumbFormat.JPEG:
-                            thumb_data = io.BytesIO(thumb.data)
-                            pil_img = Image.open(thumb_data)
-                            print(f'[TECH_SORT] JPEG thumbnail size: {pil_img.size}')
-                            
-                            # КРИТИЧНО: Уменьшаем thumbnail ДО конвертации в numpy (экономия памяти)
-                            # Понижено до 640px для предотвращения OOM в Cloud Functions (256MB RAM)
-                            max_dim = 640
-                            if max(pil_img.size) > max_dim:
-                                scale = max_dim / max(pil_img.size)
-                                new_size = (int(pil_img.size[0] * scale), int(pil_img.size[1] * scale))
-                                pil_img = pil_img.resize(new_size, Image.Resampling.LANCZOS)
-                                print(f'[TECH_SORT] Resized thumbnail to: {pil_img.size}')
-                            
-                            img = cv2.cvtColor(np.array(pil_img), cv2.COLOR_RGB2BGR)
-                            print(f'[TECH_SORT] ✅ Used embedded JPEG thumbnail from RAW')
-                            # Очищаем промежуточные объекты
-                            del thumb_data, pil_img, thumb
-                            gc.collect()
-                        else:
-                            print(f'[TECH_SORT] No JPEG thumbnail, using half-size decode')
-                            # Если thumbnail нет, используем быстрый demosaic с уменьшением
-                            rgb = raw.postprocess(half_size=True, use_camera_wb=True, no_auto_bright=True)
-                            img = cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR)
-                            print(f'[TECH_SORT] ✅ Used half-size RAW decode')
-                            del rgb
-                            gc.collect()
-                    except Exception as thumb_err:
-                        print(f'[TECH_SORT] Thumbnail extraction failed: {str(thumb_err)}')
-                        # Пробуем fallback на half_size decode
-                        print(f'[TECH_SORT] Trying half_size decode as fallback')
+        pil_img = Image.open(io.BytesIO(data))
+        header_size = pil_img.size
+        original_width, original_height = header_size
+        print(f'[TECH_SORT] Image size: {original_width}x{original_height} ({pil_img.format})')
+
+        if max(original_width, original_height) > max_dim:
+            scale = max_dim / max(original_width, original_height)
+            target = (max(1, int(original_width * scale)), max(1, int(original_height * scale)))
+            if pil_img.format == 'JPEG':
+                # draft() выбирает наибольший DCT-масштаб, при котором кадр
+                # ещё не меньше target — дальше только лёгкий LANCZOS
+                pil_img.draft('RGB', target)
+                print(f'[TECH_SORT] DCT-scaled decode: {original_width}x{original_height} → {pil_img.size}')
+            pil_img = pil_img.resize(target, Image.Resampling.LANCZOS)
+
+        if pil_img.mode != 'RGB':
+            pil_img = pil_img.convert('RGB')
+
+        img = cv2.cvtColor(np.array(pil_img), cv2.COLOR_RGB2BGR)
+        del pil_img
+        return img
+
+    except Exception as decode_err:
+        print(f'[TECH_SORT] PIL decode failed: {str(decode_err)}, trying OpenCV')
+        flag = cv2.IMREAD_COLOR
+        if header_size:
+            flag = _reduced_imread_flag(header_size[0], header_size[1], max_dim)
+        img = cv2.imdecode(np.frombuffer(data, np.uint8), flag)
+        if img is None:
+            return None
+        return _fit(img, max_dim)
+
+
+def decode_photo(img_data: bytes, s3_key: str) -> Optional[np.ndarray]:
+    """
+    Декодирует скачанный файл в уменьшенную BGR-копию для анализа.
+    Returns: кадр или None, если декодировать не удалось
+    """
+    import gc
+
+    # Для RAW файлов используем встроенный thumbnail (экономия памяти).
+    # Если fetch_photo уже достал само превью — это обычный JPEG.
+    is_raw = s3_key.lower().endswith(RAW_EXTENSIONS) and img_data[:2] != b'\xff\xd8'
+    img = None
+
+    if is_raw:
+        print(f'[TECH_SORT] RAW file detected ({len(img_data)} bytes), extracting thumbnail')
+        try:
+            import rawpy
+
+            # Освобождаем память перед работой с RAW
+            gc.collect()
+            print(f'[TECH_SORT] Memory cleared, opening RAW stream')
+
+            raw_stream = io.BytesIO(img_data)
+            with rawpy.imread(raw_stream) as raw:
+                print(f'[TECH_SORT] RAW opened, extracting thumbnail')
+                # Используем встроенный JPEG preview вместо полного RAW (в 10x меньше памяти)
+                try:
+                    thumb = raw.extract_thumb()
+                    print(f'[TECH_SORT] Thumbnail extracted, format={thumb.format}')
+
+                    if thumb.format == rawpy.ThumbFormat.JPEG:
+                        # КРИТИЧНО: Уменьшаем thumbnail ещё при декоде (экономия памяти)
+                        # Понижено до 640px для предотвращения OOM в Cloud Functions (256MB RAM)
+                        img = decode_scaled(thumb.data, RAW_PREVIEW_MAX_DIM)
+                        if img is not None:
+                            print(f'[TECH_SORT] ✅ Used embedded JPEG thumbnail from RAW: {img.shape[1]}x{img.shape[0]}')
+                        # Очищаем промежуточные объекты
+                        del thumb
+                        gc.collect()
+                    else:
+                        print(f'[TECH_SORT] No JPEG thumbnail, using half-size decode')
+                        # Если thumbnail нет, используем быстрый demosaic с уменьшением
                         rgb = raw.postprocess(half_size=True, use_camera_wb=True, no_auto_bright=True)
-                        img = cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR)
-                        print(f'[TECH_SORT] ✅ Used half-size RAW decode (fallback)')
+                        img = _fit(cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR), RAW_PREVIEW_MAX_DIM)
+                        print(f'[TECH_SORT] ✅ Used half-size RAW decode')
                         del rgb
                         gc.collect()
-                
-                # Освобождаем исходные данные RAW
-                del raw_stream
-                del img_data
-                gc.collect()
-                print(f'[TECH_SORT] RAW processing completed, memory cleaned')
-                
-            except Exception as raw_err:
-                print(f'[TECH_SORT] ❌ RAW decode failed: {str(raw_err)}')
-                import traceback
-                traceback.print_exc()
-                img = None
-        else:
+                except Exception as thumb_err:
+                    print(f'[TECH_SORT] Thumbnail extraction failed: {str(thumb_err)}')
+                    # Пробуем fallback на half_size decode
+                    print(f'[TECH_SORT] Trying half_size decode as fallback')
+                    rgb = raw.postprocess(half_size=True, use_camera_wb=True, no_auto_bright=True)
+                    img = _fit(cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR), RAW_PREVIEW_MAX_DIM)
+                    print(f'[TECH_SORT] ✅ Used half-size RAW decode (fallback)')
+                    del rgb
+                    gc.collect()
+
+            # Освобождаем поток RAW (сами байты держит вызывающий код)
+            del raw_stream
+            gc.collect()
+            print(f'[TECH_SORT] RAW processing completed, memory cleaned')
+
+        except Exception as raw_err:
+            print(f'[TECH_SORT] ❌ RAW decode failed: {str(raw_err)}')
+            import traceback
+            traceback.print_exc()
             img = None
-        
-        # Если RAW не обработался или это не RAW - пробуем обычные методы
-        if img is None:
-            try:
-                # КРИТИЧНО: Уменьшаем изображение В PIL ПЕРЕД конвертацией в numpy/OpenCV
-                # Это предотвращает OOM при обработке больших JPEG (9+ МБ сжатых = 50+ МБ в памяти)
-                pil_img = Image.open(io.BytesIO(img_data))
-                
-                # Узнаём размер ДО загрузки полного изображения
-                original_width, original_height = pil_img.size
-                print(f'[TECH_SORT] JPEG size: {original_width}x{original_height}')
-                
-                # Уменьшаем в PIL сразу (в 10х экономичнее по памяти чем в OpenCV)
-                max_dimension = 800
-                if max(original_width, original_height) > max_dimension:
-                    scale = max_dimension / max(original_width, original_height)
-                    new_width = int(original_width * scale)
-                    new_height = int(original_height * scale)
-                    pil_img = pil_img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-                    print(f'[TECH_SORT] Resized in PIL: {original_width}x{original_height} → {new_width}x{new_height}')
-                
-                if pil_img.mode != 'RGB':
-                    pil_img = pil_img.convert('RGB')
-                
-                # Теперь конвертируем УМЕНЬШЕННОЕ изображение в OpenCV
-                img = cv2.cvtColor(np.array(pil_img), cv2.COLOR_RGB2BGR)
-                del pil_img  # Освобождаем PIL объект
-                print(f'[TECH_SORT] Converted to OpenCV: {img.shape[1]}x{img.shape[0]}')
-                
-            except Exception as decode_err:
-                print(f'[TECH_SORT] PIL decode failed: {str(decode_err)}, trying OpenCV')
-                img = cv2.imdecode(np.frombuffer(img_data, np.uint8), cv2.IMREAD_COLOR)
-        
-        if img is None:
-            print(f'[TECH_SORT] ⚠️ Failed to decode image')
-            return False, ''
-        
-        # Освобождаем память от оригинального изображения если было уменьшение
-        import gc
-        gc.collect()
-        
-        # Проверяем технические параметры в порядке приоритета
 
-        # 1. Сначала ищем лица нейросетью — она видит их и в профиль.
-        #    Если люди есть, ВСЕ проверки идут по лицу, а не по кадру:
-        #    тёмный фон студии и белая циклорама больше не дают ложный брак.
-        faces = detect_faces(img)
+    # Если RAW не обработался или это не RAW - пробуем обычные методы
+    if img is None:
+        # КРИТИЧНО: кадр сразу декодируется в уменьшенном виде (DCT scaling),
+        # полноразмерная копия 24-45MP в память не попадает
+        img = decode_scaled(img_data, ANALYSIS_MAX_DIM)
+        if img is not None:
+            print(f'[TECH_SORT] Converted to OpenCV: {img.shape[1]}x{img.shape[0]}')
+
+    if img is None:
+        print(f'[TECH_SORT] ⚠️ Failed to decode image')
+        return None
+
+    # Освобождаем память от оригинального изображения если было уменьшение
+    gc.collect()
+    return img
+
 
-        if not faces:
-            # Людей в кадре нет — судим по всему кадру, как раньше
-            if detect_overexposed(img):
-                return True, 'overexposed'
+def measure_image(img: np.ndarray) -> Dict[str, Any]:
+    """
+    Снимает с уменьшенной копии кадра все «сырые» метрики качества.
+    Вердикт из них считает classify_metrics, поэтому после смены порогов
+    кадр не нужно скачивать и декодировать заново — метрики лежат в БД.
+    Лица упорядочены по площади: первое — главное.
+    """
+    gray = _as_gray(img)
+
+    metrics: Dict[str, Any] = {
+        'frame_sharpness': float(cv2.Laplacian(gray, cv2.CV_64F).var()),
+        'frame_mean': float(np.mean(gray)),
+        'frame_std': float(np.std(gray)),
+        'bright_ratio': float(np.count_nonzero(gray > 240)) / gray.size,
+        'dark_ratio': float(np.count_nonzero(gray < 30)) / gray.size,
+    }
+
+    # Нейросеть получает цветной кадр, остальные проверки — общую серую копию
+    faces = sorted(detect_faces(img), key=lambda f: f['box'][2] * f['box'][3], reverse=True)
+    metrics['face_count'] = len(faces)
+    metrics['face_size'] = []
+    metrics['face_sharpness'] = []
+    metrics['face_luma'] = []
+    metrics['face_blown'] = []
+    metrics['face_crushed'] = []
+    metrics['eye_openness'] = []
 
-            if detect_underexposed(img):
-                return True, 'underexposed'
+    for face in faces:
+        _, _, w, h = face['box']
+        mean, blown, crushed = face_exposure(gray, face)
+        openness, _ = eye_openness(gray, face)
+        metrics['face_size'].append(min(w, h))
+        metrics['face_sharpness'].append(face_sharpness(gray, face))
+        metrics['face_luma'].append(mean)
+        metrics['face_blown'].append(blown)
+        metrics['face_crushed'].append(crushed)
+        metrics['eye_openness'].append(openness)
 
-            if detect_blur(img):
-                return True, 'blur'
+    return metrics
 
-            print('[TECH_SORT] ✅ No faces, photo passed all checks')
-            return False, ''
 
-        # 2. Экспозиция ПО ЛИЦУ: важно, чтобы читалась кожа,
-        #    а не то, какой яркости фон за спиной.
-        main_face_exp = max(faces, key=lambda f: f['box'][2] * f['box'][3])
-        mean, blown, crushed = face_exposure(img, main_face_exp)
-        print(f'[TECH_SORT] Face exposure: mean={mean:.1f}, blown={blown*100:.1f}%, crushed={crushed*100:.1f}%')
+def default_thresholds() -> Dict[str, float]:
+    """Текущие пороги классификации (можно переопределить при переклассификации)."""
+    return {
+        'face_blur_reject': FACE_BLUR_REJECT,
+        'face_blur_ok': FACE_BLUR_OK,
+        'face_too_bright': FACE_TOO_BRIGHT,
+        'face_too_dark': FACE_TOO_DARK,
+        'face_blown_max': FACE_BLOWN_MAX,
+        'face_crushed_max': FACE_CRUSHED_MAX,
+        'face_min_measurable': FACE_MIN_MEASURABLE,
+        'frame_blur': FRAME_BLUR_THRESHOLD,
+        'frame_bright_ratio': FRAME_BRIGHT_RATIO,
+        'frame_dark_ratio': FRAME_DARK_RATIO,
+        'eyes_open_ratio': EYES_OPEN_RATIO,
+        'eyes_closed_ratio': EYES_CLOSED_RATIO,
+    }
+
+
+def classify_metrics(m: Dict[str, Any], th: Optional[Dict[str, float]] = None) -> Tuple[bool, str]:
+    """
+    Вердикт по сохранённым метрикам — без пикселей, только сравнение с порогами.
+    Returns: (is_rejected, reject_reason)
+    """
+    th = th or default_thresholds()
+
+    # Проверяем технические параметры в порядке приоритета
 
-        if mean > FACE_TOO_BRIGHT or blown > 0.5:
-            print('[TECH_SORT] ❌ Face overexposed → REJECT')
+    # 1. Если людей нет — судим по всему кадру, как раньше.
+    #    Если люди есть, ВСЕ проверки идут по лицу, а не по кадру:
+    #    тёмный фон студии и белая циклорама больше не дают ложный брак.
+    if not m['face_count']:
+        if m['bright_ratio'] > th['frame_bright_ratio']:
             return True, 'overexposed'
 
-        if mean < FACE_TOO_DARK or crushed > 0.6:
-            print('[TECH_SORT] ❌ Face underexposed → REJECT')
+        if m['dark_ratio'] > th['frame_dark_ratio']:
             return True, 'underexposed'
 
-        # 3. Резкость по САМОМУ КРУПНОМУ лицу, а не по всему кадру.
-        #    Портрет с размытым фоном больше не считается мыльным.
-        main_face = max(faces, key=lambda f: f['box'][2] * f['box'][3])
+        if m['frame_sharpness'] < th['frame_blur']:
+            return True, 'blur'
+
+        print('[TECH_SORT] ✅ No faces, photo passed all checks')
+        return False, ''
+
+    # 2. Экспозиция ПО ЛИЦУ: важно, чтобы читалась кожа,
+    #    а не то, какой яркости фон за спиной.
+    mean, blown, crushed = m['face_luma'][0], m['face_blown'][0], m['face_crushed'][0]
+    print(f'[TECH_SORT] Face exposure: mean={mean:.1f}, blown={blown*100:.1f}%, crushed={crushed*100:.1f}%')
+
+    if mean > th['face_too_bright'] or blown > th['face_blown_max']:
+        print('[TECH_SORT] ❌ Face overexposed → REJECT')
+        return True, 'overexposed'
+
+    if mean < th['face_too_dark'] or crushed > th['face_crushed_max']:
+        print('[TECH_SORT] ❌ Face underexposed → REJECT')
+        return True, 'underexposed'
+
+    # 3. Резкость по САМОМУ КРУПНОМУ лицу, а не по всему кадру.
+    #    Портрет с размытым фоном больше не считается мыльным.
+    if m['face_size'][0] >= th['face_min_measurable']:
+        sharpness = m['face_sharpness'][0]
+        print(f'[TECH_SORT] Face sharpness: {sharpness:.1f} (blur<{th["face_blur_reject"]}, ok>{th["face_blur_ok"]})')
+
+        if sharpness < th['face_blur_reject']:
+            return True, 'blur'
+
+        if sharpness < th['face_blur_ok']:
+            # Пограничная резкость — не решаем сами, отдаём фотографу
+            return True, 'review_blur'
+    else:
+        # Лицо слишком мелкое для оценки — судим по всему кадру
+        print(f'[TECH_SORT] Face too small ({m["face_size"][0]}px), using frame blur')
+        if m['frame_sharpness'] < th['frame_blur']:
+            return True, 'blur'
+
+    # 4. Глаза: проверяем ВСЕ лица в кадре по точкам от нейросети.
+    #    Взгляд в сторону при резком кадре браком НЕ считается.
+    closed = 0
+    uncertain = 0
+    for openness in m['eye_openness']:
+        if openness is None:
+            uncertain += 1
+        elif openness <= th['eyes_closed_ratio']:
+            closed += 1
+        elif openness < th['eyes_open_ratio']:
+            uncertain += 1
+
+    if closed > 0:
+        print(f'[TECH_SORT] ❌ Closed eyes on {closed} face(s) → REJECT')
+        return True, 'closed_eyes'
+
+    if uncertain > 0:
+        print(f'[TECH_SORT] ⚠️ Uncertain eyes on {uncertain} face(s) → REVIEW')
+        return True, 'review_eyes'
+
+    # Все проверки пройдены - фото ОК
+    print(f'[TECH_SORT] ✅ Photo passed all checks')
+    return False, ''
+
+
+def measure_photo(s3_client, bucket: str, s3_key: str, timings=None) -> Optional[Dict[str, Any]]:
+    """
+    Скачивает, декодирует и измеряет фото.
+    Returns: метрики или None, если файл пропущен или не декодировался
+    """
+    print(f'[TECH_SORT] Analyzing photo: {s3_key}')
+
+    img_data, _ = fetch_photo(s3_client, bucket, s3_key, timings=timings)
+    if img_data is None:
+        return None
+
+    with span('decode'):
+        img = decode_photo(img_data, s3_key)
+    del img_data
+    if img is None:
+        return None
+
+    with span('analyze'):
+        return measure_image(img)
+
+
+METRIC_COLUMNS = (
+    'face_count', 'face_size', 'face_sharpness', 'face_luma', 'face_blown',
+    'face_crushed', 'eye_openness', 'frame_sharpness', 'frame_mean',
+    'frame_std', 'bright_ratio', 'dark_ratio',
+)
+
+
+def load_metrics(cur, photo_ids: List[int]) -> Dict[int, Dict[str, Any]]:
+    """Сохранённые метрики текущей версии алгоритма: {photo_id: metrics}."""
+    if not photo_ids:
+        return {}
+    cur.execute(f'''
+        SELECT photo_id, {', '.join(METRIC_COLUMNS)}
+        FROM t_p28211681_photo_secure_web.photo_tech_metrics
+        WHERE photo_id = ANY(%s) AND algo_version = %s
+    ''', (list(photo_ids), METRICS_VERSION))
+    return {row['photo_id']: dict(row) for row in cur.fetchall()}
+
+
+# Явные типы колонок метрик: без них пустые и NULL-массивы в VALUES
+# получают тип text[] и не приводятся к real[]
+METRIC_CASTS = {
+    'face_count': 'smallint', 'face_size': 'int[]', 'face_sharpness': 'real[]',
+    'face_luma': 'real[]', 'face_blown': 'real[]', 'face_crushed': 'real[]',
+    'eye_openness': 'real[]', 'frame_sharpness': 'real', 'frame_mean': 'real',
+    'frame_std': 'real', 'bright_ratio': 'real', 'dark_ratio': 'real',
+}
+
+# Вердикты копим и пишем в БД одним запросом раз в CHECKPOINT_EVERY фото
+# (и в конце пачки). При падении функции теряется не больше одного
+# чекпойнта — эти фото остаются tech_analyzed = FALSE и пересчитаются.
+CHECKPOINT_EVERY = 10
+
+
+def _values_list(cur, rows: List[Tuple], template: str) -> str:
+    """Собирает безопасный VALUES-список для UPDATE ... FROM (VALUES ...)."""
+    return ', '.join(cur.mogrify(template, row).decode('utf-8') for row in rows)
+
 
-        if face_is_measurable(img, main_face):
-            sharpness = face_sharpness(img, main_face)
-            print(f'[TECH_SORT] Face sharpness: {sharpness:.1f} (blur<{FACE_BLUR_REJECT}, ok>{FACE_BLUR_OK})')
+def save_metrics_batch(cur, rows: List[Tuple[int, Dict[str, Any]]]) -> None:
+    """Сохраняет метрики пачки фото одним INSERT (перезаписывает прежние той же версии)."""
+    if not rows:
+        return
+    template = '(%s, %s, ' + ', '.join(f'%s::{METRIC_CASTS[c]}' for c in METRIC_COLUMNS) + ')'
+    values = _values_list(cur, [
+        (photo_id, METRICS_VERSION, *[m[c] for c in METRIC_COLUMNS]) for photo_id, m in rows
+    ], template)
+    cur.execute(f'''
+        INSERT INTO t_p28211681_photo_secure_web.photo_tech_metrics
+        (photo_id, algo_version, {', '.join(METRIC_COLUMNS)})
+        VALUES {values}
+        ON CONFLICT (photo_id, algo_version) DO UPDATE SET
+        {', '.join(f'{c} = EXCLUDED.{c}' for c in METRIC_COLUMNS)},
+        created_at = NOW()
+    ''')
 
-            if sharpness < FACE_BLUR_REJECT:
-                return True, 'blur'
 
-            if sharpness < FACE_BLUR_OK:
-                # Пограничная резкость — не решаем сами, отдаём фотографу
-                return True, 'review_blur'
+def write_verdicts(cur, verdicts: List[Tuple[int, Optional[int], Optional[str]]],
+                   folder_id: int, user_id: int) -> int:
+    """
+    Применяет вердикты пачки одним UPDATE ... FROM (VALUES ...) и в том же
+    запросе считает, сколько фото папки ещё не проанализировано.
+    verdicts: (photo_id, целевая папка или None — оставить на месте, причина)
+    Returns: remaining
+    """
+    if not verdicts:
+        cur.execute('''
+            SELECT COUNT(*) AS remaining
+            FROM t_p28211681_photo_secure_web.photo_bank
+            WHERE folder_id = %s AND user_id = %s
+              AND is_trashed = FALSE
+              AND (tech_analyzed = FALSE OR tech_analyzed IS NULL)
+        ''', (folder_id, user_id))
+        return cur.fetchone()['remaining']
+
+    # VALUES уже подставлены, а запрос ещё раз идёт через параметры — экранируем %
+    values = _values_list(cur, verdicts, '(%s::int, %s::int, %s::text)').replace('%', '%%')
+
+    # Внешний SELECT видит снимок ДО обновления, поэтому только что
+    # обновлённые фото исключаем из остатка явно
+    cur.execute(f'''
+        WITH v (id, folder_id, reason) AS (VALUES {values}),
+        upd AS (
+            UPDATE t_p28211681_photo_secure_web.photo_bank pb
+            SET folder_id = COALESCE(v.folder_id, pb.folder_id),
+                tech_analyzed = TRUE,
+                tech_reject_reason = CASE WHEN v.folder_id IS NULL
+                                          THEN pb.tech_reject_reason ELSE v.reason END
+            FROM v
+            WHERE pb.id = v.id
+            RETURNING pb.id
+        )
+        SELECT COUNT(*) AS remaining
+        FROM t_p28211681_photo_secure_web.photo_bank
+        WHERE folder_id = %s AND user_id = %s
+          AND is_trashed = FALSE
+          AND (tech_analyzed = FALSE OR tech_analyzed IS NULL)
+          AND id NOT IN (SELECT id FROM upd)
+    ''', (folder_id, user_id))
+    return cur.fetchone()['remaining']
+
+
+def parse_thresholds(raw: Any) -> Dict[str, float]:
+    """Пороги по умолчанию, поверх — переданные в запросе (только известные ключи)."""
+    th = default_thresholds()
+    if isinstance(raw, dict):
+        for key, value in raw.items():
+            if key in th:
+                try:
+                    th[key] = float(value)
+                except (TypeError, ValueError):
+                    pass
+    return th
+
+
+def reclassify_folder(cur, user_id: int, folder_id: int, tech_rejects_id: int,
+                      get_review_folder_id, th: Dict[str, float]) -> Dict[str, int]:
+    """
+    Пересчитывает вердикты всех уже проанализированных фото папки (включая
+    «Технический брак» и «Проверить») по сохранённым метрикам и новым порогам.
+    Ничего не скачивает: только чтение метрик и перекладка по папкам.
+    """
+    cur.execute(f'''
+        SELECT pb.id, pb.folder_id, pb.tech_reject_reason,
+               {', '.join('m.' + c for c in METRIC_COLUMNS)}
+        FROM t_p28211681_photo_secure_web.photo_bank pb
+        JOIN t_p28211681_photo_secure_web.photo_tech_metrics m
+          ON m.photo_id = pb.id AND m.algo_version = %s
+        WHERE pb.user_id = %s AND pb.is_trashed = FALSE AND pb.tech_analyzed = TRUE
+          AND (pb.folder_id = %s OR pb.folder_id IN (
+              SELECT id FROM t_p28211681_photo_secure_web.photo_folders
+              WHERE user_id = %s AND parent_folder_id = %s
+                AND folder_type IN ('tech_rejects', 'review') AND is_trashed = FALSE
+          ))
+    ''', (METRICS_VERSION, user_id, folder_id, user_id, folder_id))
+    rows = cur.fetchall()
+
+    stats = {'reclassified': len(rows), 'moved': 0, 'rejected': 0, 'review': 0, 'accepted': 0}
+    moves = []
+    for row in rows:
+        is_rejected, reason = classify_metrics(row, th)
+        if is_rejected and reason in REVIEW_REASONS:
+            target, stats['review'] = get_review_folder_id(), stats['review'] + 1
+        elif is_rejected:
+            target, stats['rejected'] = tech_rejects_id, stats['rejected'] + 1
         else:
-            # Лицо слишком мелкое для оценки — судим по всему кадру
-            print(f'[TECH_SORT] Face too small ({main_face["box"][2]}x{main_face["box"][3]}), using frame blur')
-            if detect_blur(img):
-                return True, 'blur'
-
-        # 4. Глаза: проверяем ВСЕ лица в кадре по точкам от нейросети.
-        #    Взгляд в сторону при резком кадре браком НЕ считается.
-        closed = 0
-        uncertain = 0
-        for face in faces:
-            state, detail = eyes_state(img, face)
-            print(f'[TECH_SORT] Face {face["box"]}: eyes={state} ({detail})')
-            if state == EYES_CLOSED:
-                closed += 1
-            elif state == EYES_UNCERTAIN:
-                uncertain += 1
-
-        if closed > 0:
-            print(f'[TECH_SORT] ❌ Closed eyes on {closed} face(s) → REJECT')
-            return True, 'closed_eyes'
-
-        if uncertain > 0:
-            print(f'[TECH_SORT] ⚠️ Uncertain eyes on {uncertain} face(s) → REVIEW')
-            return True, 'review_eyes'
-
-        # Все проверки пройдены - фото ОК
-        print(f'[TECH_SORT] ✅ Photo passed all checks')
-        return False, ''
-        
-    except Exception as e:
-        print(f'[TECH_SORT] Error analyzing photo: {str(e)}')
-        return False, ''
+            target, reason, stats['accepted'] = folder_id, None, stats['accepted'] + 1
+
+        if row['folder_id'] != target or row['tech_reject_reason'] != reason:
+            moves.append((row['id'], target, reason))
+
+    if moves:
+        values = _values_list(cur, moves, '(%s::int, %s::int, %s::text)')
+        cur.execute(f'''
+            UPDATE t_p28211681_photo_secure_web.photo_bank pb
+            SET folder_id = v.folder_id, tech_reject_reason = v.reason
+            FROM (VALUES {values}) AS v (id, folder_id, reason)
+            WHERE pb.id = v.id
+        ''')
+        stats['moved'] = cur.rowcount
+
+    return stats
+
+
+def is_warmup_event(event: dict) -> bool:
+    '''Вызов таймер-триггера или POST с {"warmup": true}.'''
+    messages = event.get('messages')
+    if isinstance(messages, list) and messages:
+        meta = messages[0].get('event_metadata', {}) if isinstance(messages[0], dict) else {}
+        if str(meta.get('event_type', '')).endswith('TimerMessage'):
+            return True
+    body = event.get('body')
+    if isinstance(body, str) and '"warmup"' in body:
+        try:
+            body = json.loads(body)
+        except json.JSONDecodeError:
+            return False
+    return isinstance(body, dict) and bool(body.get('warmup'))
 
 
 def handler(event: dict, context) -> dict:
@@ -525,6 +668,16 @@ def handler(event: dict, context) -> dict:
                 'body': ''
             }
         
+        # Прогрев по таймер-триггеру: модели грузятся до первого реального запроса
+        if is_warmup_event(event):
+            stats = warmup()
+            print(f'[TECH_SORT] Warmup done: {json.dumps(stats)}')
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'warmup': True, 'models': stats})
+            }
+
         # Парсим тело запроса
         body_raw = event.get('body', '{}')
         if isinstance(body_raw, str):
@@ -537,6 +690,18 @@ def handler(event: dict, context) -> dict:
         
         folder_id = body.get('folder_id') if isinstance(body, dict) else None
         reset_analysis = body.get('reset_analysis', False) if isinstance(body, dict) else False
+        # Переклассификация по сохранённым метрикам (новые пороги, без скачивания)
+        reclassify = bool(body.get('reclassify', False)) if isinstance(body, dict) else False
+        thresholds = parse_thresholds(body.get('thresholds') if isinstance(body, dict) else None)
+        # Конвейерный режим: большая пачка, фото качаются заранее в фоне
+        pipeline = bool(body.get('pipeline', False)) if isinstance(body, dict) else False
+        batch_size = 5
+        if pipeline:
+            try:
+                batch_size = int(body.get('batch_size') or PIPELINE_BATCH_SIZE)
+            except (TypeError, ValueError):
+                batch_size = PIPELINE_BATCH_SIZE
+            batch_size = max(1, min(batch_size, PIPELINE_MAX_BATCH_SIZE))
         
         if not folder_id:
             return {
@@ -558,7 +723,7 @@ def handler(event: dict, context) -> dict:
             }
         
         user_id = int(user_id)
-        print(f'[TECH_SORT] Processing folder_id={folder_id}, user_id={user_id}, reset_analysis={reset_analysis}')
+        print(f'[TECH_SORT] Processing folder_id={folder_id}, user_id={user_id}, reset_analysis={reset_analysis}, pipeline={pipeline}, batch_size={batch_size}')
         
         # Подключаемся к БД
         dsn = os.environ.get('DATABASE_URL')
@@ -722,8 +887,28 @@ def handler(event: dict, context) -> dict:
                 conn.commit()
                 print(f'[TECH_SORT] Created review folder: {review_folder_id}')
                 return review_folder_id
+
+            if reclassify:
+                started = time.perf_counter()
+                stats = reclassify_folder(cur, user_id, folder_id, tech_rejects_id,
+                                          get_review_folder_id, thresholds)
+                conn.commit()
+                stats['elapsed_ms'] = round((time.perf_counter() - started) * 1000, 1)
+                print(f'[TECH_SORT] Reclassified from stored metrics: {stats}')
+
+                return {
+                    'statusCode': 200,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({
+                        **stats,
+                        'thresholds': thresholds,
+                        'tech_rejects_folder_id': tech_rejects_id,
+                        'review_folder_id': review_folder_id
+                    })
+                }
             
-            # Находим фото которые ещё не анализировались (batch по 5 фото для оптимизации памяти)
+            # Находим фото которые ещё не анализировались (batch по 5 фото для оптимизации памяти,
+            # в конвейерном режиме — по batch_size: память ограничивает бюджет подкачки)
             cur.execute('''
                 SELECT id, s3_key, file_name
                 FROM t_p28211681_photo_secure_web.photo_bank
@@ -731,24 +916,16 @@ def handler(event: dict, context) -> dict:
                   AND is_trashed = FALSE
                   AND (tech_analyzed = FALSE OR tech_analyzed IS NULL)
                 ORDER BY created_at
-                LIMIT 5
-            ''', (folder_id, user_id))
+                LIMIT %s
+            ''', (folder_id, user_id, batch_size))
             
             photos = cur.fetchall()
             print(f'[TECH_SORT] Found {len(photos)} photos to analyze')
             
             if len(photos) == 0:
-                # Проверяем сколько осталось необработанных
-                cur.execute('''
-                    SELECT COUNT(*) as remaining
-                    FROM t_p28211681_photo_secure_web.photo_bank
-                    WHERE folder_id = %s AND user_id = %s 
-                      AND is_trashed = FALSE
-                      AND (tech_analyzed = FALSE OR tech_analyzed IS NULL)
-                ''', (folder_id, user_id))
-                
-                remaining = cur.fetchone()['remaining']
-                
+                # Выборка с тем же условием пуста — значит, необработанных не осталось
+                remaining = 0
+
                 return {
                     'statusCode': 200,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -764,90 +941,169 @@ def handler(event: dict, context) -> dict:
             rejected_count = 0
             review_count = 0
             processed_count = 0
-            
+
+            # Вердикты и метрики копятся здесь и пишутся в БД чекпойнтами
+            pending_verdicts: List[Tuple[int, Optional[int], Optional[str]]] = []
+            pending_metrics: List[Tuple[int, Dict[str, Any]]] = []
+            remaining = None
+
+            def save_verdict(photo_id: int, is_rejected: bool, reject_reason: str) -> None:
+                '''Запоминает, в какую папку разложить фото по вердикту анализа.'''
+                nonlocal rejected_count, review_count
+
+                if is_rejected and reject_reason in REVIEW_REASONS:
+                    # Спорный случай — не браковать, отдать фотографу на решение
+                    pending_verdicts.append((photo_id, get_review_folder_id(), reject_reason))
+                    review_count += 1
+                    print(f'[TECH_SORT] ⚠️ Photo {photo_id} → review: {reject_reason}')
+                elif is_rejected:
+                    # Перемещаем в tech_rejects
+                    pending_verdicts.append((photo_id, tech_rejects_id, reject_reason))
+                    rejected_count += 1
+                    print(f'[TECH_SORT] ❌ Photo {photo_id} rejected: {reject_reason}')
+                else:
+                    # Помечаем как проанализированное
+                    pending_verdicts.append((photo_id, None, None))
+                    print(f'[TECH_SORT] ✅ Photo {photo_id} accepted')
+
+            def mark_failed(photo_id: int, err: Exception) -> None:
+                # Если фото не удалось обработать - помечаем как проанализированное (пропускаем)
+                print(f'[TECH_SORT] ⚠️ Failed to analyze photo {photo_id}: {str(err)}')
+                pending_verdicts.append((photo_id, None, None))
+
+            def checkpoint() -> None:
+                '''Сбрасывает накопленное в БД: метрики + вердикты + остаток, один коммит.'''
+                nonlocal remaining
+                save_metrics_batch(cur, pending_metrics)
+                remaining = write_verdicts(cur, pending_verdicts, folder_id, user_id)
+                conn.commit()
+                print(f'[TECH_SORT] Checkpoint: {len(pending_verdicts)} verdicts, {len(pending_metrics)} metrics, remaining={remaining}')
+                pending_verdicts.clear()
+                pending_metrics.clear()
+
+            # Замеры этапов пачки: JSON-строка в лог + гистограммы в pipeline_stage_stats
+            trace = Trace('photo-tech-sort', mode='pipeline' if pipeline else 'sequential')
+            timings = trace if pipeline else None
+            prefetch_peak_mb = None
+            batch_started = time.perf_counter()
+
+            # Фото, метрики которых уже есть (сброс анализа, повторный прогон),
+            # не скачиваем — вердикт считается по сохранённым числам
+            cached_metrics = load_metrics(cur, [p['id'] for p in photos])
             for photo in photos:
-                photo_id = photo['id']
-                s3_key = photo['s3_key']
-                file_name = photo['file_name']
-                
-                print(f'[TECH_SORT] Processing photo {photo_id}: {file_name}')
-                
-                # Анализируем фото с защитой от краша
-                try:
-                    is_rejected, reject_reason = analyze_photo(s3_client, bucket, s3_key)
-                    
-                    if is_rejected and reject_reason in REVIEW_REASONS:
-                        # Спорный случай — не браковать, отдать фотографу на решение
-                        target_folder = get_review_folder_id()
-                        cur.execute('''
-                            UPDATE t_p28211681_photo_secure_web.photo_bank
-                            SET folder_id = %s, tech_analyzed = TRUE, tech_reject_reason = %s
-                            WHERE id = %s
-                        ''', (target_folder, reject_reason, photo_id))
-
-                        review_count += 1
-                        print(f'[TECH_SORT] ⚠️ Photo {photo_id} → review: {reject_reason}')
-                    elif is_rejected:
-                        # Перемещаем в tech_rejects
-                        cur.execute('''
-                            UPDATE t_p28211681_photo_secure_web.photo_bank
-                            SET folder_id = %s, tech_analyzed = TRUE, tech_reject_reason = %s
-                            WHERE id = %s
-                        ''', (tech_rejects_id, reject_reason, photo_id))
-                        
-                        rejected_count += 1
-                        print(f'[TECH_SORT] ❌ Photo {photo_id} rejected: {reject_reason}')
-                    else:
-                        # Помечаем как проанализированное
-                        cur.execute('''
-                            UPDATE t_p28211681_photo_secure_web.photo_bank
-                            SET tech_analyzed = TRUE
-                            WHERE id = %s
-                        ''', (photo_id,))
-                        
-                        print(f'[TECH_SORT] ✅ Photo {photo_id} accepted')
-                    
+                metrics = cached_metrics.get(photo['id'])
+                if metrics is None:
+                    continue
+                print(f'[TECH_SORT] Photo {photo["id"]}: using stored metrics v{METRICS_VERSION}')
+                save_verdict(photo['id'], *classify_metrics(metrics))
+                processed_count += 1
+            photos = [p for p in photos if p['id'] not in cached_metrics]
+
+            if pipeline:
+                # Конвейер: S3 качается в фоне, здесь только декод, анализ и БД
+                def fetch(s3_key, budget):
+                    return fetch_photo(s3_client, bucket, s3_key, budget=budget, timings=timings)
+
+                prefetcher = PhotoPrefetcher(
+                    fetch, photos, timings,
+                    workers=PREFETCH_WORKERS,
+                    lookahead=PREFETCH_LOOKAHEAD,
+                    budget_bytes=PREFETCH_BUDGET_MB * 1024 * 1024,
+                )
+
+                for photo, img_data, held_bytes, fetch_err in prefetcher:
+                    photo_id = photo['id']
+                    print(f'[TECH_SORT] Processing photo {photo_id}: {photo["file_name"]}')
+
+                    try:
+                        if fetch_err is not None:
+                            raise fetch_err
+
+                        is_rejected, reject_reason = False, ''
+                        if img_data is not None:
+                            with timings.span('decode'):
+                                img = decode_photo(img_data, photo['s3_key'])
+                            # Сжатые байты больше не нужны — отдаём место подкачке
+                            del img_data
+                            prefetcher.release(held_bytes)
+                            held_bytes = 0
+
+                            if img is not None:
+                                with timings.span('analyze'):
+                                    metrics = measure_image(img)
+                                    is_rejected, reject_reason = classify_metrics(metrics)
+                                del img
+                                pending_metrics.append((photo_id, metrics))
+
+                        save_verdict(photo_id, is_rejected, reject_reason)
+                    except Exception as photo_err:
+                        mark_failed(photo_id, photo_err)
+                    finally:
+                        prefetcher.release(held_bytes)
+
                     processed_count += 1
-                    
-                except Exception as photo_err:
-                    # Если фото не удалось обработать - помечаем как проанализированное (пропускаем)
-                    print(f'[TECH_SORT] ⚠️ Failed to analyze photo {photo_id}: {str(photo_err)}')
-                    cur.execute('''
-                        UPDATE t_p28211681_photo_secure_web.photo_bank
-                        SET tech_analyzed = TRUE
-                        WHERE id = %s
-                    ''', (photo_id,))
+                    if len(pending_verdicts) >= CHECKPOINT_EVERY:
+                        with timings.span('db'):
+                            checkpoint()
+
+                prefetch_peak_mb = round(prefetcher.budget.peak / (1024 * 1024), 1)
+            else:
+                for photo in photos:
+                    photo_id = photo['id']
+                    s3_key = photo['s3_key']
+                    file_name = photo['file_name']
+
+                    print(f'[TECH_SORT] Processing photo {photo_id}: {file_name}')
+
+                    # Анализируем фото с защитой от краша
+                    try:
+                        with trace:
+                            metrics = measure_photo(s3_client, bucket, s3_key, timings=trace)
+                        if metrics is None:
+                            # Не браковать, просто пропустить
+                            is_rejected, reject_reason = False, ''
+                        else:
+                            is_rejected, reject_reason = classify_metrics(metrics)
+                            pending_metrics.append((photo_id, metrics))
+                        save_verdict(photo_id, is_rejected, reject_reason)
+                    except Exception as photo_err:
+                        mark_failed(photo_id, photo_err)
                     processed_count += 1
-                
-                # Коммитим после каждого фото + принудительная очистка памяти
-                conn.commit()
-                import gc
-                gc.collect()
-            
-            # Проверяем сколько ещё осталось необработанных
-            cur.execute('''
-                SELECT COUNT(*) as remaining
-                FROM t_p28211681_photo_secure_web.photo_bank
-                WHERE folder_id = %s AND user_id = %s 
-                  AND is_trashed = FALSE
-                  AND (tech_analyzed = FALSE OR tech_analyzed IS NULL)
-            ''', (folder_id, user_id))
-            
-            remaining = cur.fetchone()['remaining']
-            
+
+                    if len(pending_verdicts) >= CHECKPOINT_EVERY:
+                        with trace.span('db'):
+                            checkpoint()
+                    # Принудительная очистка памяти после каждого фото
+                    import gc
+                    gc.collect()
+
+            # Последний чекпойнт пачки; остаток считается тем же запросом
+            with trace.span('db'):
+                checkpoint()
+
             print(f'[TECH_SORT] Batch completed: processed={processed_count}, rejected={rejected_count}, review={review_count}, remaining={remaining}')
-            
+
+            result = {
+                'processed': processed_count,
+                'rejected': rejected_count,
+                'review': review_count,
+                'remaining': remaining,
+                'tech_rejects_folder_id': tech_rejects_id,
+                'review_folder_id': review_folder_id
+            }
+            if timings is not None:
+                result['timings'] = timings.as_dict()
+                result['wall_ms'] = round((time.perf_counter() - batch_started) * 1000, 1)
+                result['prefetch_peak_mb'] = prefetch_peak_mb
+                result['models'] = model_stats()
+
+            trace.emit(folder_id=folder_id, processed=processed_count, prefetch_peak_mb=prefetch_peak_mb)
+            trace.flush(conn)
+
             return {
                 'statusCode': 200,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({
-                    'processed': processed_count,
-                    'rejected': rejected_count,
-                    'review': review_count,
-                    'remaining': remaining,
-                    'tech_rejects_folder_id': tech_rejects_id,
-                    'review_folder_id': review_folder_id
-                })
+                'body': json.dumps(result)
             }
     
     except Exception as e:
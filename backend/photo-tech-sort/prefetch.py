@@ -0,0 +1,147 @@
+'''
+Конвейерная подкачка фото из S3 для пакетного техбрака.
+Пока текущий кадр анализируется, следующие N уже скачиваются в фоне
+ограниченным пулом потоков. Объём скачанных, но ещё не разобранных байт
+держим в пределах бюджета, чтобы не выйти за 256 МБ памяти функции.
+'''
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from stage_timer import Trace
+
+
+class ByteBudget:
+    '''
+    Семафор по байтам. Поток ждёт, пока в памяти не освободится место
+    под очередной файл. Файл больше всего бюджета пропускаем, только
+    когда в памяти больше ничего нет — иначе он не скачался бы никогда.
+
+    Фото, которого прямо сейчас ждёт потребитель (head — его номер в
+    пачке), проходит всегда, даже сверх лимита. Иначе возможен дедлок:
+    потоки подкачки занимают бюджет в порядке завершения head-запросов,
+    более поздние кадры успевают занять всё место, а место освобождает
+    только потребитель — который ждёт как раз head. Пик при этом может
+    превысить лимит на один файл.
+    '''
+
+    def __init__(self, limit_bytes: int):
+        self.limit = limit_bytes
+        self.used = 0
+        self.peak = 0
+        self.head = 0
+        self.closed = False
+        self._cond = threading.Condition()
+
+    def acquire(self, size: int, seq: Optional[int] = None) -> bool:
+        '''Возвращает False, если конвейер уже остановлен и качать не нужно.
+        seq — номер фото в пачке (см. ticket).'''
+        with self._cond:
+            while (not self.closed and self.used > 0 and self.used + size > self.limit
+                   and seq != self.head):
+                self._cond.wait()
+            if self.closed:
+                return False
+            self.used += size
+            self.peak = max(self.peak, self.used)
+            return True
+
+    def release(self, size: int) -> None:
+        with self._cond:
+            self.used = max(0, self.used - size)
+            self._cond.notify_all()
+
+    def advance(self, seq: int) -> None:
+        '''Потребитель перешёл к фото seq — теперь оно проходит без очереди.'''
+        with self._cond:
+            self.head = seq
+            self._cond.notify_all()
+
+    def ticket(self, seq: int) -> 'BudgetTicket':
+        return BudgetTicket(self, seq)
+
+    def close(self) -> None:
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+
+class BudgetTicket:
+    '''Бюджет глазами одного фото пачки: acquire/release с его номером.'''
+
+    __slots__ = ('_budget', '_seq')
+
+    def __init__(self, budget: ByteBudget, seq: int):
+        self._budget = budget
+        self._seq = seq
+
+    def acquire(self, size: int) -> bool:
+        return self._budget.acquire(size, self._seq)
+
+    def release(self, size: int) -> None:
+        self._budget.release(size)
+
+
+class PhotoPrefetcher:
+    '''
+    Отдаёт фото пачки по порядку, скачивая следующие заранее.
+
+    fetch_fn(s3_key, budget) -> (data | None, size) — делает head + get,
+    сама занимает место в бюджете перед скачиванием (и не качает, если
+    budget.acquire вернул False). budget здесь — BudgetTicket этого фото. Освобождает место потребитель через
+    release() после того, как закончил с кадром.
+    '''
+
+    def __init__(self, fetch_fn: Callable[[str, BudgetTicket], Tuple[Optional[bytes], int]],
+                 photos: List[Dict[str, Any]], timings: Trace,
+                 workers: int = 3, lookahead: int = 4, budget_bytes: int = 64 * 1024 * 1024):
+        self._fetch_fn = fetch_fn
+        self._photos = photos
+        self._timings = timings
+        self._lookahead = max(1, lookahead)
+        self.budget = ByteBudget(budget_bytes)
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='prefetch')
+
+    def _submit(self, seq: int):
+        photo = self._photos[seq]
+        return photo, self._pool.submit(self._fetch_fn, photo['s3_key'], self.budget.ticket(seq))
+
+    def __iter__(self) -> Iterator[Tuple[Dict[str, Any], Optional[bytes], int, Optional[Exception]]]:
+        '''Возвращает (photo, data, size, error) в исходном порядке.'''
+        futures = []
+        next_idx = 0
+        try:
+            while next_idx < len(self._photos) and len(futures) < self._lookahead:
+                futures.append(self._submit(next_idx))
+                next_idx += 1
+
+            head = 0
+            while futures:
+                photo, future = futures.pop(0)
+                self.budget.advance(head)
+                head += 1
+                wait_start = time.perf_counter()
+                try:
+                    data, size = future.result()
+                    error = None
+                except Exception as e:
+                    data, size, error = None, 0, e
+                self._timings.add('prefetch_wait', time.perf_counter() - wait_start)
+
+                # Окно подкачки сдвигаем сразу, до анализа текущего кадра
+                if next_idx < len(self._photos):
+                    futures.append(self._submit(next_idx))
+                    next_idx += 1
+
+                yield photo, data, size, error
+        finally:
+            for _, future in futures:
+                future.cancel()
+            # Будим потоки, ждущие бюджет, чтобы shutdown не завис
+            self.budget.close()
+            self._pool.shutdown(wait=True)
+
+    def release(self, size: int) -> None:
+        self.budget.release(size)
@@ -0,0 +1,83 @@
+'''
+Конвейер подкачки: бюджет не должен запирать фото, которого ждёт потребитель.
+
+    python -m unittest test_prefetch
+'''
+
+import threading
+import time
+import unittest
+
+from prefetch import ByteBudget, PhotoPrefetcher
+from stage_timer import Trace
+
+MB = 1024 * 1024
+
+
+def _run_with_deadline(fn, seconds):
+    '''Выполняет fn в отдельном потоке; None, если не уложилась в срок.'''
+    result = {}
+
+    def target():
+        result['value'] = fn()
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(seconds)
+    return result.get('value') if not thread.is_alive() else None
+
+
+class PrefetchOrderingTest(unittest.TestCase):
+
+    def test_head_photo_not_starved_by_later_reservations(self):
+        '''Фото 0 дольше делает head-запрос, поэтому следующие занимают
+        весь бюджет раньше него. Раньше фото 0 ждало место вечно, а
+        потребитель ждал фото 0 — пачка зависала.'''
+        size = 25 * MB
+        photos = [{'id': i, 's3_key': f'photo-{i}.jpg'} for i in range(8)]
+        order = []
+
+        def fetch(s3_key, budget):
+            if s3_key == 'photo-0.jpg':
+                time.sleep(0.3)
+            if not budget.acquire(size):
+                return None, 0
+            return s3_key.encode(), size
+
+        def consume():
+            prefetcher = PhotoPrefetcher(fetch, photos, Trace('test'),
+                                         workers=3, lookahead=4, budget_bytes=64 * MB)
+            for photo, data, held, error in prefetcher:
+                self.assertIsNone(error)
+                order.append(photo['id'])
+                prefetcher.release(held)
+            return prefetcher.budget.peak
+
+        peak = _run_with_deadline(consume, 10)
+        self.assertIsNotNone(peak, 'prefetch pipeline deadlocked')
+        self.assertEqual(order, list(range(8)))
+        # Сверх лимита — не больше одного файла (фото head)
+        self.assertLessEqual(peak, 64 * MB + size)
+
+    def test_non_head_waits_for_budget(self):
+        budget = ByteBudget(10 * MB)
+        budget.advance(0)
+        self.assertTrue(budget.ticket(1).acquire(8 * MB))
+        acquired = threading.Event()
+
+        def later():
+            budget.ticket(2).acquire(8 * MB)
+            acquired.set()
+
+        threading.Thread(target=later, daemon=True).start()
+        self.assertFalse(acquired.wait(0.2))
+        # Фото head проходит сверх лимита
+        self.assertTrue(budget.ticket(0).acquire(8 * MB))
+        budget.release(8 * MB)
+        budget.release(8 * MB)
+        self.assertTrue(acquired.wait(2))
+        budget.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
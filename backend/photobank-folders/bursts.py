@@ -0,0 +1,169 @@
+'''
+Группировка серий (бёрстов) и почти-дублей внутри папки по перцептивным
+хэшам миниатюр (photo_bank.phash / dhash) и выбор лучшего кадра в серии
+по метрикам техбрака (photo_tech_metrics). Картинки не скачиваются:
+вся работа — проход по 64-битным числам в памяти.
+'''
+
+from itertools import combinations
+from typing import Any, Dict, List, Optional, Tuple
+
+# Кадры серии: pHash отличается не больше чем на столько бит из 64...
+BURST_PHASH_DISTANCE = 10
+# ...и dHash подтверждает (отсекает случайные совпадения pHash на однотонных кадрах)
+BURST_DHASH_DISTANCE = 16
+
+# Пороги глаз — копия photo-tech-sort/face_quality.py (EYES_OPEN_RATIO,
+# EYES_CLOSED_RATIO): другая функция, импортировать нельзя. Меняются там —
+# меняйте и здесь. Версию метрик не дублируем: берётся новейшая из
+# photo_tech_metrics (см. action=bursts в index.py).
+EYES_OPEN_RATIO = 0.62
+EYES_CLOSED_RATIO = 0.38
+
+_MASK64 = (1 << 64) - 1
+
+
+# int.bit_count есть с Python 3.10 и в разы быстрее bin().count
+_popcount = int.bit_count if hasattr(int, 'bit_count') else (lambda v: bin(v).count('1'))
+
+
+def hamming(a: int, b: int) -> int:
+    '''Число различающихся бит двух 64-битных хэшей (BIGINT из БД бывает отрицательным).'''
+    return _popcount((a ^ b) & _MASK64)
+
+
+class HammingIndex:
+    '''
+    Multi-index hashing: 64 бита режутся на `bands` полос, по каждой —
+    свой словарь. Если два хэша различаются не больше чем на radius бит,
+    то хотя бы в одной полосе различие не больше radius // bands бит
+    (принцип Дирихле), поэтому кандидатов ищем перебором только этих
+    вариантов полосы. Точный поиск, без сравнения со всеми кадрами папки.
+    '''
+
+    def __init__(self, radius: int, bands: int = 4):
+        self.radius = radius
+        widths = [64 // bands + (1 if i < 64 % bands else 0) for i in range(bands)]
+        self._bands = []
+        shift = 0
+        for width in widths:
+            self._bands.append((shift, (1 << width) - 1, _flip_masks(width, radius // bands), {}))
+            shift += width
+        self._values: List[int] = []
+        self._items: List[Any] = []
+
+    def add(self, value: int, item: Any) -> None:
+        value &= _MASK64
+        idx = len(self._values)
+        self._values.append(value)
+        self._items.append(item)
+        for shift, mask, _, table in self._bands:
+            table.setdefault((value >> shift) & mask, []).append(idx)
+
+    def find(self, value: int) -> List[Any]:
+        '''Все добавленные элементы с хэшем в пределах radius.'''
+        value &= _MASK64
+        seen = set()
+        found = []
+        for shift, mask, flips, table in self._bands:
+            key = (value >> shift) & mask
+            for flip in flips:
+                for idx in table.get(key ^ flip, ()):
+                    if idx in seen:
+                        continue
+                    seen.add(idx)
+                    if hamming(value, self._values[idx]) <= self.radius:
+                        found.append(self._items[idx])
+        return found
+
+
+def _flip_masks(width: int, max_bits: int) -> List[int]:
+    '''Все маски ширины width, в которых выставлено не больше max_bits бит.'''
+    masks = [0]
+    for bits in range(1, max_bits + 1):
+        masks.extend(sum(1 << b for b in combo) for combo in combinations(range(width), bits))
+    return masks
+
+
+def group_bursts(photos: List[Dict[str, Any]],
+                 phash_distance: int = BURST_PHASH_DISTANCE,
+                 dhash_distance: int = BURST_DHASH_DISTANCE) -> List[List[Dict[str, Any]]]:
+    '''
+    Разбивает фото на группы почти-одинаковых кадров (union-find поверх
+    индекса Хэмминга по pHash). Возвращает только группы из 2+ кадров, кадры
+    внутри группы — в порядке съёмки.
+    '''
+    hashed = [p for p in photos if p.get('phash') is not None]
+    parent = list(range(len(hashed)))
+
+    def root(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    index = HammingIndex(phash_distance)
+    for i, photo in enumerate(hashed):
+        for j in index.find(photo['phash']):
+            other = hashed[j]
+            if (photo.get('dhash') is not None and other.get('dhash') is not None
+                    and hamming(photo['dhash'], other['dhash']) > dhash_distance):
+                continue
+            ri, rj = root(i), root(j)
+            if ri != rj:
+                parent[ri] = rj
+        index.add(photo['phash'], i)
+
+    groups: Dict[int, List[Dict[str, Any]]] = {}
+    for i, photo in enumerate(hashed):
+        groups.setdefault(root(i), []).append(photo)
+
+    result = [g for g in groups.values() if len(g) > 1]
+    for g in result:
+        g.sort(key=_shot_order)
+    result.sort(key=lambda g: _shot_order(g[0]))
+    return result
+
+
+def _shot_order(photo: Dict[str, Any]) -> Tuple[str, int]:
+    when = photo.get('shot_date') or photo.get('created_at')
+    return (when.isoformat() if hasattr(when, 'isoformat') else str(when or ''), photo['id'])
+
+
+def _first(values: Optional[List[Any]]) -> Optional[float]:
+    '''Первое (самое крупное лицо) непустое значение метрики.'''
+    for v in values or []:
+        if v is not None:
+            return float(v)
+    return None
+
+
+def frame_score(metrics: Optional[Dict[str, Any]]) -> Tuple[int, float]:
+    '''
+    Оценка кадра для выбора лучшего в серии: сначала состояние глаз
+    главного лица (открыты > не ясно > закрыты), затем резкость по лицу,
+    а если лиц нет — резкость всего кадра. Кадры без метрик — последние.
+    '''
+    if not metrics:
+        return (-1, 0.0)
+
+    openness = _first(metrics.get('eye_openness'))
+    if openness is None:
+        eyes_rank = 1
+    elif openness >= EYES_OPEN_RATIO:
+        eyes_rank = 2
+    elif openness <= EYES_CLOSED_RATIO:
+        # Сравнение как в face_quality.eyes_verdict: порог — уже «закрыты»
+        eyes_rank = 0
+    else:
+        eyes_rank = 1
+
+    sharpness = _first(metrics.get('face_sharpness'))
+    if sharpness is None:
+        sharpness = float(metrics.get('frame_sharpness') or 0.0)
+    return (eyes_rank, sharpness)
+
+
+def pick_best(group: List[Dict[str, Any]], metrics: Dict[int, Dict[str, Any]]) -> Dict[str, Any]:
+    '''Лучший кадр серии; при равенстве — более ранний.'''
+    return max(group, key=lambda p: frame_score(metrics.get(p['id'])))
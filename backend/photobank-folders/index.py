@@ -17,31 +17,28 @@ from botocore.client import Config
 from PIL import Image
 from PIL.ExifTags import Base as ExifBase
 import io
-import requests
 from datetime import datetime
+from bursts import group_bursts, pick_best, frame_score
+from jobs import enqueue_jobs, enqueue_previews, kick_worker, preview_kind, PRIORITY_INTERACTIVE, PRIORITY_UPLOAD
 
-GENERATE_THUMBNAIL_URL = 'https://functions.poehali.dev/40c5290a-b9a7-48e8-a0a6-68468d29a62c'
-BACKFILL_THUMBNAILS_URL = 'https://functions.poehali.dev/d66a105e-b88e-48b6-a351-0ac79b9f9a02'
-RAW_EXTENSIONS = {'.cr2', '.cr3', '.nef', '.nrw', '.arw', '.srf', '.sr2', '.dng',
-                  '.orf', '.rw2', '.raf', '.pef', '.raw', '.rwl', '.iiq', '.3fr'}
-
-
-def trigger_thumbnail(photo_ids, file_names=None):
-    '''Запускает генерацию миниатюр для только что загруженных фото.
-    RAW → тяжёлая generate-thumbnail, обычные JPEG/PNG → лёгкая backfill-thumbnails.
-    Fire-and-forget: не ждём завершения обработки.
+def trigger_thumbnail(conn, user_id, folder_id, photo_ids, file_names=None):
+    '''Ставит генерацию миниатюр для только что загруженных фото в очередь.
+    RAW → raw_preview (тяжёлая generate-thumbnail), обычные JPEG/PNG → thumbnail
+    (лёгкая backfill-thumbnails). Задача пишется в processing_jobs до ответа
+    клиенту, так что таймаут пинка воркера её уже не потеряет.
     '''
     if not photo_ids:
         return
-    file_names = file_names or []
-    is_raw_any = any(os.path.splitext((n or '').lower())[1] in RAW_EXTENSIONS for n in file_names)
-    url = GENERATE_THUMBNAIL_URL if is_raw_any else BACKFILL_THUMBNAILS_URL
+    file_names = file_names or [None] * len(photo_ids)
     try:
-        requests.post(url, json={'photo_ids': photo_ids}, timeout=2)
-    except requests.exceptions.Timeout:
-        pass  # ожидаемо: обработка идёт в фоне
+        with conn.cursor() as cur:
+            queued = enqueue_previews(cur, list(zip(photo_ids, file_names)), user_id, folder_id)
+        conn.commit()
     except Exception as e:
-        print(f'[THUMBNAIL] trigger failed: {e}')
+        conn.rollback()
+        print(f'[THUMBNAIL] enqueue failed: {e}')
+        return
+    kick_worker(queued)
 
 
 def _json_default(o):
@@ -434,31 +431,25 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         
                         result_photos.append(photo)
                 
-                # Авто-триггер генерации превью для RAW-фото без thumbnail
-                # (например, после массового сброса для исправления ориентации).
-                # Обрабатываем по 3 файла за заход — при следующем открытии папки
-                # догенерятся следующие, пока не будут покрыты все RAW.
-                raw_exts = ('.cr2', '.cr3', '.nef', '.nrw', '.arw', '.srf', '.sr2',
-                            '.dng', '.orf', '.rw2', '.raf', '.pef', '.raw', '.rwl', '.iiq', '.3fr')
-                missing_thumb_ids = [
-                    p['id'] for p in result_photos
-                    if not p.get('thumbnail_s3_key')
-                    and (p.get('is_raw') or (p.get('file_name') or '').lower().endswith(raw_exts))
-                ][:3]
-                if missing_thumb_ids:
-                    # fire-and-forget: даём запросу дойти до функции (короткий read-timeout,
-                    # но достаточный на установку соединения), ошибку по таймауту глушим.
+                # Превью для фото без thumbnail (например, после массового сброса
+                # для исправления ориентации) — все сразу ставим в очередь. Папку
+                # сейчас смотрят, поэтому её задачи идут вперёд фоновых; уже
+                # стоящие в очереди не дублируются, у них только растёт приоритет.
+                missing_thumbs = [
+                    (preview_kind(p.get('file_name'), bool(p.get('is_raw'))), p['id'], int(folder_id))
+                    for p in result_photos
+                    if not p.get('thumbnail_s3_key') and not p.get('is_video')
+                ]
+                if missing_thumbs:
                     try:
-                        requests.post(
-                            'https://functions.poehali.dev/40c5290a-b9a7-48e8-a0a6-68468d29a62c',
-                            json={'photo_ids': missing_thumb_ids},
-                            timeout=(5, 5)
-                        )
-                    except requests.exceptions.ReadTimeout:
-                        # Ожидаемо: функция обрабатывает RAW дольше, чем мы ждём ответ.
-                        pass
+                        with conn.cursor() as cur:
+                            queued = enqueue_jobs(cur, missing_thumbs, user_id, PRIORITY_INTERACTIVE)
+                        conn.commit()
+                        # Без воркера — по 3 фото за просмотр, как раньше: RAW тяжёлые
+                        kick_worker(queued, direct_limit=3)
                     except Exception as e:
-                        print(f'[LIST_PHOTOS] thumbnail trigger failed: {e}')
+                        conn.rollback()
+                        print(f'[LIST_PHOTOS] thumbnail enqueue failed: {e}')
                 
                 # Анализ пропусков в нумерации кадров: если имена файлов содержат
                 # порядковый номер (например "IMG_0123" или " (123).CR2"), а часть
@@ -498,6 +489,68 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'isBase64Encoded': False
                 }
             
+            elif action == 'bursts':
+                # Серии почти одинаковых кадров в папке и лучший кадр каждой серии.
+                # Сравниваются только 64-битные хэши миниатюр — без скачивания фото.
+                folder_id = event.get('queryStringParameters', {}).get('folder_id')
+                if not folder_id:
+                    return {
+                        'statusCode': 400,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'folder_id required'}),
+                        'isBase64Encoded': False
+                    }
+
+                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    cur.execute('''
+                        SELECT pb.id, pb.file_name, pb.phash, pb.dhash, pb.shot_date, pb.created_at,
+                               m.face_sharpness, m.eye_openness, m.frame_sharpness
+                        FROM t_p28211681_photo_secure_web.photo_bank pb
+                        LEFT JOIN LATERAL (
+                            SELECT face_sharpness, eye_openness, frame_sharpness
+                            FROM t_p28211681_photo_secure_web.photo_tech_metrics
+                            WHERE photo_id = pb.id
+                            ORDER BY algo_version DESC
+                            LIMIT 1
+                        ) m ON TRUE
+                        WHERE pb.folder_id = %s
+                          AND pb.user_id = %s
+                          AND pb.is_trashed = FALSE
+                          AND (pb.is_video IS NULL OR pb.is_video = FALSE)
+                    ''', (folder_id, user_id))
+                    photos = cur.fetchall()
+
+                metrics = {
+                    p['id']: p for p in photos
+                    if p['face_sharpness'] is not None or p['frame_sharpness'] is not None
+                }
+                groups = group_bursts(photos)
+
+                result_groups = []
+                for group in groups:
+                    best = pick_best(group, metrics)
+                    result_groups.append({
+                        'photo_ids': [p['id'] for p in group],
+                        'best_photo_id': best['id'],
+                        'best_scored': frame_score(metrics.get(best['id']))[0] >= 0,
+                        'size': len(group),
+                    })
+
+                unhashed = sum(1 for p in photos if p['phash'] is None)
+                print(f'[BURSTS] folder={folder_id}: {len(photos)} photos, {len(result_groups)} groups, {unhashed} without hash')
+
+                return {
+                    'statusCode': 200,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({
+                        'groups': result_groups,
+                        'total_photos': len(photos),
+                        'grouped_photos': sum(g['size'] for g in result_groups),
+                        'unhashed': unhashed,
+                    }),
+                    'isBase64Encoded': False
+                }
+
             elif action == 'check_duplicates':
                 folder_id = event.get('queryStringParameters', {}).get('folder_id')
                 if not folder_id:
@@ -786,21 +839,21 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     if photo.get('shot_date'):
                         photo['shot_date'] = photo['shot_date'].isoformat()
                 
-                # Проверяем, нужно ли генерировать превью для RAW
+                # RAW → превью в очереди; для JPG/PNG миниатюра уже сделана выше,
+                # досчитываем только перцептивный хэш (для поиска серий)
                 raw_extensions = {'.cr2', '.nef', '.arw', '.dng', '.orf', '.rw2', '.raw'}
                 file_ext_lower = f".{file_ext.lower()}"
-                if file_ext_lower in raw_extensions:
-                    print(f'[UPLOAD_DIRECT] Detected RAW file, triggering thumbnail generation')
+                if file_ext_lower in raw_extensions or thumbnail_s3_key:
+                    kind = 'raw_preview' if file_ext_lower in raw_extensions else 'hash'
                     try:
-                        generate_thumbnail_url = 'https://functions.poehali.dev/40c5290a-b9a7-48e8-a0a6-68468d29a62c'
-                        requests.post(
-                            generate_thumbnail_url,
-                            json={'photo_id': photo['id']},
-                            timeout=2
-                        )
-                        print(f'[UPLOAD_DIRECT] Thumbnail generation triggered for photo {photo["id"]}')
+                        with conn.cursor() as cur:
+                            queued = enqueue_jobs(cur, [(kind, photo['id'], int(folder_id))], user_id, PRIORITY_UPLOAD)
+                        conn.commit()
+                        print(f'[UPLOAD_DIRECT] Queued {kind} for photo {photo["id"]}')
+                        kick_worker(queued)
                     except Exception as e:
-                        print(f'[UPLOAD_DIRECT] Failed to trigger thumbnail: {e}')
+                        conn.rollback()
+                        print(f'[UPLOAD_DIRECT] Failed to queue {kind}: {e}')
                 
                 print('[UPLOAD_DIRECT] Complete!')
                 return {
@@ -929,7 +982,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         photo['shot_date'] = photo['shot_date'].isoformat()
                 
                 # Генерируем миниатюру для любого фото (RAW и обычные JPEG/PNG)
-                trigger_thumbnail([photo['id']], [file_name])
+                trigger_thumbnail(conn, user_id, int(folder_id), [photo['id']], [file_name])
 
                 print(f'[CONFIRM_UPLOAD] Success!')
                 return {
@@ -1019,17 +1072,21 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 
                 print(f'[UPLOAD_PHOTOS_BATCH] Inserted {len(inserted_ids)} photos, {len(raw_photo_ids)} RAW files')
                 
-                # Фоновая генерация миниатюр (fire-and-forget)
-                if raw_photo_ids:
+                # Фоновая генерация миниатюр — через очередь processing_jobs
+                if raw_photo_ids or regular_photo_ids:
                     try:
-                        requests.post(GENERATE_THUMBNAIL_URL, json={'photo_ids': raw_photo_ids}, timeout=2)
-                    except Exception:
-                        pass
-                if regular_photo_ids:
-                    try:
-                        requests.post(BACKFILL_THUMBNAILS_URL, json={'photo_ids': regular_photo_ids}, timeout=2)
-                    except Exception:
-                        pass
+                        with conn.cursor() as cur:
+                            queued = enqueue_jobs(cur,
+                                                  [('raw_preview', pid, int(folder_id)) for pid in raw_photo_ids]
+                                                  + [('thumbnail', pid, int(folder_id)) for pid in regular_photo_ids]
+                                                  # Дату съёмки RAW пишет generate-thumbnail, обычным — отдельная задача
+                                                  + [('exif', pid, int(folder_id)) for pid in regular_photo_ids],
+                                                  user_id, PRIORITY_UPLOAD)
+                        conn.commit()
+                        kick_worker(queued)
+                    except Exception as e:
+                        conn.rollback()
+                        print(f'[UPLOAD_PHOTOS_BATCH] thumbnail enqueue failed: {e}')
                 
                 return {
                     'statusCode': 200,
@@ -1038,6 +1095,30 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'isBase64Encoded': False
                 }
             
+            elif action == 'queue_tech_sort':
+                # Разбор папки на техбрак в фоне: воркер очереди гоняет photo-tech-sort
+                # пачками, пока в папке не останется непроанализированных фото
+                folder_id = body_data.get('folder_id')
+                if not folder_id:
+                    return {
+                        'statusCode': 400,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'folder_id required'}),
+                        'isBase64Encoded': False
+                    }
+
+                with conn.cursor() as cur:
+                    enqueue_jobs(cur, [('tech_sort', None, int(folder_id))], user_id, PRIORITY_INTERACTIVE)
+                conn.commit()
+                kick_worker()
+
+                return {
+                    'statusCode': 200,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'queued': True, 'folder_id': int(folder_id)}),
+                    'isBase64Encoded': False
+                }
+
             elif action == 'set_video_poster':
                 # Устанавливает обложку (постер) для видео.
                 # image_data — base64 картинки (свой кадр от фотографа или сгенерированный
@@ -1239,7 +1320,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 
                 # Генерируем миниатюру для любого фото (RAW и обычные), кроме видео
                 if not is_video:
-                    trigger_thumbnail([photo['id']], [file_name])
+                    trigger_thumbnail(conn, user_id, int(folder_id), [photo['id']], [file_name])
                 
                 return {
                     'statusCode': 200,
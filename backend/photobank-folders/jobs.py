@@ -0,0 +1,119 @@
+'''
+Постановка задач в очередь фоновой обработки (processing_jobs).
+Задача сначала записывается в БД в той же транзакции, что и фото, и
+только потом будится воркер. Если пинок не дошёл, задачу всё равно
+заберёт воркер по таймеру, так что обработка не теряется.
+
+Пока воркер не подключён (PROCESSING_WORKER_URL не задан), превью
+заказываются у функций миниатюр напрямую, как до очереди.
+'''
+
+import os
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import requests
+
+SCHEMA = 't_p28211681_photo_secure_web'
+
+JOB_KINDS = ('thumbnail', 'raw_preview', 'exif', 'tech_sort', 'hash')
+
+PRIORITY_BACKGROUND = 0
+PRIORITY_UPLOAD = 5
+PRIORITY_INTERACTIVE = 10
+
+# Прямой вызов функций превью — пока воркер очереди не подключён
+GENERATE_THUMBNAIL_URL = 'https://functions.poehali.dev/40c5290a-b9a7-48e8-a0a6-68468d29a62c'
+BACKFILL_THUMBNAILS_URL = 'https://functions.poehali.dev/d66a105e-b88e-48b6-a351-0ac79b9f9a02'
+DIRECT_PREVIEW_URLS = {'raw_preview': GENERATE_THUMBNAIL_URL, 'thumbnail': BACKFILL_THUMBNAILS_URL}
+
+RAW_EXTENSIONS = {'.cr2', '.cr3', '.nef', '.nrw', '.arw', '.srf', '.sr2', '.dng',
+                  '.orf', '.rw2', '.raf', '.pef', '.raw', '.rwl', '.iiq', '.3fr'}
+
+
+def preview_kind(file_name: Optional[str], is_raw: bool = False) -> str:
+    '''RAW → raw_preview (тяжёлая generate-thumbnail), остальное → thumbnail.'''
+    ext = os.path.splitext((file_name or '').lower())[1]
+    return 'raw_preview' if is_raw or ext in RAW_EXTENSIONS else 'thumbnail'
+
+
+def enqueue_jobs(cur, jobs: Iterable[Tuple[str, Optional[int], Optional[int]]],
+                 user_id: int, priority: int = PRIORITY_UPLOAD) -> List[Tuple[str, Optional[int], Optional[int]]]:
+    '''
+    Ставит задачи (kind, photo_id, folder_id) одним INSERT. Уже стоящие в
+    очереди не дублируются — у них только поднимается приоритет. Задачи,
+    исчерпавшие max_attempts (битый файл), заново не ставятся: иначе
+    каждый просмотр папки давал бы им новые попытки.
+    Коммит — на вызывающей стороне. Возвращает поставленные и обновлённые
+    задачи в том же виде (kind, photo_id, folder_id).
+    '''
+    rows = []
+    for kind, photo_id, folder_id in jobs:
+        if kind not in JOB_KINDS:
+            raise ValueError(f'Unknown job kind: {kind}')
+        dedup_key = f'{kind}:{photo_id}' if photo_id is not None else f'{kind}:folder:{folder_id}'
+        rows.append((kind, dedup_key, photo_id, folder_id, int(user_id), priority))
+    if not rows:
+        return []
+
+    values = ', '.join(
+        cur.mogrify('(%s, %s, %s::int, %s::int, %s, %s::smallint)', row).decode('utf-8') for row in rows
+    )
+    cur.execute(f'''
+        INSERT INTO {SCHEMA}.processing_jobs (kind, dedup_key, photo_id, folder_id, user_id, priority)
+        SELECT v.kind, v.dedup_key, v.photo_id, v.folder_id, v.user_id, v.priority
+        FROM (VALUES {values}) AS v (kind, dedup_key, photo_id, folder_id, user_id, priority)
+        WHERE NOT EXISTS (
+            SELECT 1 FROM {SCHEMA}.processing_jobs f
+            WHERE f.dedup_key = v.dedup_key AND f.status = 'failed' AND f.attempts >= f.max_attempts
+        )
+        ON CONFLICT (dedup_key) WHERE status IN ('queued', 'running')
+        DO UPDATE SET priority = GREATEST({SCHEMA}.processing_jobs.priority, EXCLUDED.priority)
+        RETURNING kind, photo_id, folder_id
+    ''')
+    return [tuple(row) for row in cur.fetchall()]
+
+
+def enqueue_previews(cur, photos: List[Tuple[int, Optional[str]]], user_id: int, folder_id: Optional[int],
+                     priority: int = PRIORITY_UPLOAD) -> List[Tuple[str, Optional[int], Optional[int]]]:
+    '''Превью для фото [(photo_id, file_name)] — тип задачи по расширению.'''
+    return enqueue_jobs(cur, [(preview_kind(name), pid, folder_id) for pid, name in photos],
+                        user_id, priority)
+
+
+def kick_worker(jobs: Iterable[Tuple[str, Optional[int], Optional[int]]] = (),
+                direct_limit: Optional[int] = None) -> None:
+    '''
+    Будит воркер очереди, не дожидаясь ответа. Потеря пинка не страшна:
+    задачи уже в БД и будут взяты по таймеру.
+
+    Без PROCESSING_WORKER_URL превью из jobs (thumbnail / raw_preview)
+    заказываются напрямую — не больше direct_limit каждого вида за вызов.
+    '''
+    url = os.environ.get('PROCESSING_WORKER_URL')
+    if not url:
+        _request_previews_directly(jobs, direct_limit)
+        return
+    try:
+        requests.post(url, json={'source': 'photobank-folders'}, timeout=(3, 0.5))
+    except requests.exceptions.Timeout:
+        pass  # ожидаемо: воркер работает дольше, чем мы ждём
+    except Exception as e:
+        print(f'[JOBS] worker kick failed: {e}')
+
+
+def _request_previews_directly(jobs: Iterable[Tuple[str, Optional[int], Optional[int]]],
+                               limit: Optional[int]) -> None:
+    '''Fire-and-forget вызов функций превью, как до очереди processing_jobs.'''
+    by_kind: Dict[str, List[int]] = {}
+    for kind, photo_id, _folder_id in jobs:
+        if kind in DIRECT_PREVIEW_URLS and photo_id is not None:
+            by_kind.setdefault(kind, []).append(photo_id)
+    for kind, photo_ids in by_kind.items():
+        if limit is not None:
+            photo_ids = photo_ids[:limit]
+        try:
+            requests.post(DIRECT_PREVIEW_URLS[kind], json={'photo_ids': photo_ids}, timeout=(3, 2))
+        except requests.exceptions.Timeout:
+            pass  # ожидаемо: обработка идёт в фоне
+        except Exception as e:
+            print(f'[JOBS] direct {kind} request failed: {e}')
@@ -0,0 +1,297 @@
+'''
+Business: Воркер очереди фоновой обработки фото (processing_jobs).
+Забирает пачки задач через FOR UPDATE SKIP LOCKED и выполняет их, вызывая
+профильные функции: generate-thumbnail (raw_preview), backfill-thumbnails
+(thumbnail, hash), backfill-shot-date (exif), photo-tech-sort (tech_sort).
+Параллельные экземпляры воркера не берут одну задачу дважды, поэтому
+пропускная способность растёт с числом одновременных вызовов.
+Ошибка → повтор с экспоненциальной задержкой, после max_attempts — failed.
+Args: event от таймер-триггера или POST (опционально {"kinds": [...]}) из photobank-folders
+Returns: HTTP ответ со статистикой по типам задач
+'''
+import json
+import os
+import random
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+import requests
+
+SCHEMA = 't_p28211681_photo_secure_web'
+
+GENERATE_THUMBNAIL_URL = 'https://functions.poehali.dev/40c5290a-b9a7-48e8-a0a6-68468d29a62c'
+BACKFILL_THUMBNAILS_URL = 'https://functions.poehali.dev/d66a105e-b88e-48b6-a351-0ac79b9f9a02'
+BACKFILL_SHOT_DATE_URL = 'https://functions.poehali.dev/75988ac9-8a62-4dae-befe-71b4f6d8d691'
+PHOTO_TECH_SORT_URL = 'https://functions.poehali.dev/85953b37-509d-4868-bf56-344c1be62404'
+
+# Тип задачи → (сколько брать за раз, таймаут вызова функции, сек)
+KIND_LIMITS = {
+    'raw_preview': (2, 90),
+    'thumbnail': (20, 30),
+    'hash': (40, 30),
+    'exif': (20, 60),
+    'tech_sort': (1, 120),
+}
+
+# Таймаут функции — 5 минут; новую пачку берём, только если она успеет
+WORKER_BUDGET_SEC = 240
+# Задача «running» дольше этого — воркер упал, возвращаем её в очередь
+STALE_RUNNING_MINUTES = 10
+# Задержка повтора: 30с, 60с, 120с ... но не больше часа (±20% разброса)
+BACKOFF_BASE_SEC = 30
+BACKOFF_MAX_SEC = 3600
+
+CORS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'POST, GET, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type',
+    'Content-Type': 'application/json',
+}
+
+
+def reclaim_stale(cur) -> int:
+    '''Возвращает в очередь задачи, зависшие в running (воркер упал по таймауту).'''
+    cur.execute(f'''
+        UPDATE {SCHEMA}.processing_jobs
+        SET status = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'queued' END,
+            finished_at = CASE WHEN attempts >= max_attempts THEN NOW() ELSE NULL END,
+            locked_at = NULL,
+            locked_by = NULL,
+            last_error = 'worker timeout',
+            run_after = NOW()
+        WHERE status = 'running'
+          AND locked_at < NOW() - make_interval(mins => %s)
+    ''', (STALE_RUNNING_MINUTES,))
+    return cur.rowcount
+
+
+def next_kind(cur, kinds: List[str], time_left: float) -> Optional[str]:
+    '''Тип самой приоритетной готовой задачи среди тех, что успеем выполнить.'''
+    fitting = [k for k in kinds if KIND_LIMITS[k][1] <= time_left]
+    if not fitting:
+        return None
+    cur.execute(f'''
+        SELECT kind FROM {SCHEMA}.processing_jobs
+        WHERE status = 'queued' AND run_after <= NOW() AND kind = ANY(%s)
+        ORDER BY priority DESC, run_after, id
+        LIMIT 1
+    ''', (fitting,))
+    row = cur.fetchone()
+    return row['kind'] if row else None
+
+
+def claim(cur, kind: str, limit: int, worker_id: str) -> List[Dict[str, Any]]:
+    '''
+    Забирает до limit задач одного типа. SKIP LOCKED пропускает строки,
+    которые прямо сейчас забирает другой воркер, — без ожидания и без дублей.
+    '''
+    cur.execute(f'''
+        WITH picked AS (
+            SELECT id FROM {SCHEMA}.processing_jobs
+            WHERE status = 'queued' AND run_after <= NOW() AND kind = %s
+            ORDER BY priority DESC, run_after, id
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        UPDATE {SCHEMA}.processing_jobs j
+        SET status = 'running', locked_at = NOW(), locked_by = %s, attempts = j.attempts + 1
+        FROM picked
+        WHERE j.id = picked.id
+        RETURNING j.id, j.kind, j.photo_id, j.folder_id, j.user_id, j.attempts
+    ''', (kind, limit, worker_id))
+    return cur.fetchall()
+
+
+def _post(url: str, payload: dict, timeout: float, headers: Optional[dict] = None) -> dict:
+    resp = requests.post(url, json=payload, headers=headers or {}, timeout=(5, timeout))
+    if resp.status_code != 200:
+        raise RuntimeError(f'HTTP {resp.status_code}: {resp.text[:200]}')
+    try:
+        return resp.json()
+    except ValueError:
+        return {}
+
+
+def _photos_where(cur, photo_ids: List[int], condition: str) -> set:
+    '''Какие из фото уже в нужном состоянии (или удалены — тогда делать нечего).'''
+    cur.execute(f'''
+        SELECT id FROM {SCHEMA}.photo_bank
+        WHERE id = ANY(%s) AND ({condition} OR is_trashed = TRUE)
+    ''', (photo_ids,))
+    return {row['id'] for row in cur.fetchall()}
+
+
+def run_jobs(cur, kind: str, jobs: List[Dict[str, Any]], timeout: float
+             ) -> Tuple[List[int], Dict[int, str], List[int]]:
+    '''
+    Выполняет пачку задач одного типа.
+    Returns: (выполненные, {id: ошибка}, вернуть в очередь без штрафа)
+    '''
+    done: List[int] = []
+    failed: Dict[int, str] = {}
+    requeue: List[int] = []
+    photo_ids = [j['photo_id'] for j in jobs if j['photo_id'] is not None]
+
+    if kind in ('thumbnail', 'raw_preview', 'hash'):
+        errors: Dict[int, str] = {}
+        try:
+            if kind == 'raw_preview':
+                result = _post(GENERATE_THUMBNAIL_URL, {'photo_ids': photo_ids}, timeout)
+                errors = {r['photo_id']: r['error'] for r in result.get('results', []) if r.get('error')}
+            elif kind == 'thumbnail':
+                _post(BACKFILL_THUMBNAILS_URL, {'photo_ids': photo_ids}, timeout)
+            else:
+                _post(BACKFILL_THUMBNAILS_URL + '?mode=hashes', {'photo_ids': photo_ids}, timeout)
+        except Exception as e:
+            # Таймаут ответа не значит, что работа не сделана — решает проверка ниже
+            print(f'[WORKER] {kind} call failed: {e}')
+            errors = {pid: str(e) for pid in photo_ids}
+
+        # Итог проверяем по БД, а не по ответу: backfill-thumbnails отдаёт только счётчики
+        condition = 'phash IS NOT NULL' if kind == 'hash' else 'thumbnail_s3_key IS NOT NULL'
+        ready = _photos_where(cur, photo_ids, condition)
+        for job in jobs:
+            if job['photo_id'] in ready:
+                done.append(job['id'])
+            else:
+                failed[job['id']] = errors.get(job['photo_id']) or f'{kind} not produced'
+
+    elif kind == 'exif':
+        by_user: Dict[int, List[Dict[str, Any]]] = {}
+        for job in jobs:
+            by_user.setdefault(job['user_id'], []).append(job)
+        for user_id, user_jobs in by_user.items():
+            ids = [j['photo_id'] for j in user_jobs]
+            try:
+                # Фото без даты в EXIF — не ошибка: функция отработала, даты просто нет
+                _post(BACKFILL_SHOT_DATE_URL, {'user_id': user_id, 'photo_ids': ids, 'limit': len(ids)}, timeout)
+                done.extend(j['id'] for j in user_jobs)
+            except Exception as e:
+                failed.update({j['id']: str(e) for j in user_jobs})
+
+    elif kind == 'tech_sort':
+        for job in jobs:
+            try:
+                result = _post(PHOTO_TECH_SORT_URL, {'folder_id': job['folder_id'], 'pipeline': True},
+                               timeout, headers={'X-User-Id': str(job['user_id'])})
+                # Папка разбирается пачками: пока есть остаток, задача остаётся в очереди
+                if result.get('remaining'):
+                    requeue.append(job['id'])
+                else:
+                    done.append(job['id'])
+            except Exception as e:
+                failed[job['id']] = str(e)
+
+    return done, failed, requeue
+
+
+def finish(cur, done: List[int], failed: Dict[int, str], requeue: List[int]) -> None:
+    '''Записывает итог пачки тремя set-based UPDATE.'''
+    if done:
+        cur.execute(f'''
+            UPDATE {SCHEMA}.processing_jobs
+            SET status = 'done', finished_at = NOW(), locked_at = NULL, locked_by = NULL, last_error = NULL
+            WHERE id = ANY(%s)
+        ''', (done,))
+    if requeue:
+        # Попытка не тратится: задача просто продолжается следующей пачкой
+        cur.execute(f'''
+            UPDATE {SCHEMA}.processing_jobs
+            SET status = 'queued', attempts = attempts - 1, run_after = NOW(),
+                locked_at = NULL, locked_by = NULL
+            WHERE id = ANY(%s)
+        ''', (requeue,))
+    if failed:
+        values = ', '.join(
+            cur.mogrify('(%s::bigint, %s::text, %s::float)',
+                        (job_id, err[:1000], random.uniform(0.8, 1.2))).decode('utf-8')
+            for job_id, err in failed.items()
+        ).replace('%', '%%')
+        cur.execute(f'''
+            UPDATE {SCHEMA}.processing_jobs j
+            SET status = CASE WHEN j.attempts >= j.max_attempts THEN 'failed' ELSE 'queued' END,
+                finished_at = CASE WHEN j.attempts >= j.max_attempts THEN NOW() ELSE NULL END,
+                run_after = NOW() + make_interval(secs => LEAST(%s * POWER(2, j.attempts - 1), %s) * v.jitter),
+                last_error = v.err,
+                locked_at = NULL,
+                locked_by = NULL
+            FROM (VALUES {values}) AS v (id, err, jitter)
+            WHERE j.id = v.id
+        ''', (BACKOFF_BASE_SEC, BACKOFF_MAX_SEC))
+
+
+def handler(event: dict, context) -> dict:
+    '''Выполняет задачи очереди processing_jobs, пока есть готовые и хватает времени.'''
+    method = event.get('httpMethod', 'POST')
+    if method == 'OPTIONS':
+        return {'statusCode': 200, 'headers': CORS, 'body': '', 'isBase64Encoded': False}
+
+    body = {}
+    if isinstance(event.get('body'), str) and event['body']:
+        try:
+            body = json.loads(event['body'])
+        except json.JSONDecodeError:
+            body = {}
+    kinds = [k for k in (body.get('kinds') or KIND_LIMITS.keys()) if k in KIND_LIMITS]
+
+    worker_id = getattr(context, 'request_id', None) or uuid.uuid4().hex
+    deadline = time.time() + WORKER_BUDGET_SEC
+    stats: Dict[str, Dict[str, int]] = {}
+    misses = 0
+
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            reclaimed = reclaim_stale(cur)
+            conn.commit()
+            if reclaimed:
+                print(f'[WORKER] Reclaimed {reclaimed} stale jobs')
+
+            while True:
+                time_left = deadline - time.time()
+                kind = next_kind(cur, kinds, time_left)
+                if kind is None:
+                    break
+                limit, timeout = KIND_LIMITS[kind]
+                jobs = claim(cur, kind, limit, worker_id)
+                conn.commit()
+                if not jobs:
+                    # Готовые задачи прямо сейчас забирают другие воркеры
+                    misses += 1
+                    if misses >= 5:
+                        break
+                    time.sleep(0.2)
+                    continue
+                misses = 0
+
+                started = time.time()
+                done, failed, requeue = run_jobs(cur, kind, jobs, min(timeout, max(1.0, deadline - time.time())))
+                finish(cur, done, failed, requeue)
+                conn.commit()
+
+                s = stats.setdefault(kind, {'done': 0, 'failed': 0, 'requeued': 0})
+                s['done'] += len(done)
+                s['failed'] += len(failed)
+                s['requeued'] += len(requeue)
+                print(f'[WORKER] {kind}: {len(jobs)} jobs in {time.time() - started:.1f}s '
+                      f'→ done={len(done)} failed={len(failed)} requeued={len(requeue)}')
+
+            cur.execute(f'''
+                SELECT kind, COUNT(*) AS queued
+                FROM {SCHEMA}.processing_jobs
+                WHERE status = 'queued'
+                GROUP BY kind
+            ''')
+            queued = {row['kind']: row['queued'] for row in cur.fetchall()}
+    finally:
+        conn.close()
+
+    return {
+        'statusCode': 200,
+        'headers': CORS,
+        'body': json.dumps({'worker_id': worker_id, 'stats': stats, 'queued': queued}),
+        'isBase64Encoded': False,
+    }
@@ -1,7 +1,11 @@
 """Capture One свадебный пресет — применяется к RGB-массиву ПОСЛЕ ретуши.
 
-Все операции in-place / поканально, без полной float32-копии всего кадра,
-чтобы укладываться в лимит памяти 256MB.
+Все операции in-place и полосами (_run_in_strips), без полнокадровых
+временных массивов, чтобы укладываться в лимит памяти 256MB и на 45 Мп
+кадрах. Попиксельные шаги пресета
+склеены: WB и тон — в одну 1D-таблицу на канал, насыщенность и color
+editor — в 3D LUT, и кадр проходится один раз полосами по
+PIPELINE_STRIP строк (вместе с восстановлением светов и виньеткой).
 
 Параметры подобраны под референс пользователя:
 - WB Kelvin 5390 / Tint -5.4
@@ -15,6 +19,67 @@
 import numpy as np
 from PIL import Image, ImageFilter
 
+# Строк кадра за один проход слитого конвейера пресета: полоса uint8 и её
+# float32-временные (единицы МБ при ширине 6000px) остаются в кэше
+PIPELINE_STRIP = 64
+# Узлов 3D LUT цветовой части на канал: 2^7 = 128, ячейка — 2 уровня.
+# Берём ближайший узел, без интерполяции: трилинейная в numpy — 8 gather'ов
+# и 7 lerp'ов по (N, 3) float32, это не дешевле самого color editor
+LUT3D_BITS = 7
+# Полосы шумодава: размытия читают соседние строки, поэтому полоса
+# обрабатывается с запасом DENOISE_HALO строк сверху и снизу — это
+# больше суммарного радиуса цепочки GaussianBlur 1.5 → 1.0 (кромки) и
+# радиуса растушёвки маски 4 (box-проходы PIL: ±6, ±3 и ±12 строк)
+DENOISE_STRIP = 128
+DENOISE_HALO = 16
+# Color editor — полосы оттенка HSL:
+# (центр °, полуширина °, сдвиг оттенка °, насыщенность %, светлота %)
+COLOR_BANDS = (
+    # Оранжевый (кожа): НЕ душим, только +4 luminance
+    (27.0, 22.0, 0.0, 0.0, 4.0),
+    # Жёлтый: лёгкий сдвиг к оранжевому + чуть насыщеннее
+    (60.0, 18.0, -3.4, 6.0, 8.0),
+    # Голубой/синий: приглушаем (фон)
+    (180.0, 28.0, 0.0, -10.0, 0.0),
+)
+HUE_BINS = 360
+# Хрома в таблицах — с шагом 4 (64 уровня)
+CHROMA_SHIFT = 2
+CHROMA_MIN = 12
+CHROMA_FULL = 24
+
+_color_lut = None
+_color_bands = None
+
+
+def _run_in_strips(arr, op, *aux, halo=0, strip=PIPELINE_STRIP):
+    """Применяет op(block, *aux_blocks) к arr полосами по strip строк.
+
+    op меняет block на месте. aux — массивы той же высоты (маски), их
+    срезы передаются вместе с полосой. halo — сколько строк контекста
+    сверху и снизу (не больше strip) нужно оператору: полоса
+    обрабатывается вместе с ними, а обратно пишутся только её собственные
+    строки, поэтому результат совпадает с обработкой целого кадра, а
+    временная память — O(strip + 2·halo) строк вместо O(кадра).
+    """
+    h = arr.shape[0]
+    if halo <= 0:
+        for y0 in range(0, h, strip):
+            op(arr[y0:y0 + strip], *(a[y0:y0 + strip] for a in aux))
+        return
+    # Исходные строки над текущей полосой: сама полоса выше уже записана
+    # обработанной, а ореолу нужны данные до обработки
+    above = arr[0:0].copy()
+    for y0 in range(0, h, strip):
+        y1 = min(h, y0 + strip)
+        top = y0 - len(above)
+        bottom = min(h, y1 + halo)
+        block = np.concatenate([above, arr[y0:bottom]])
+        above = arr[max(0, y1 - halo):y1].copy()
+        op(block, *(a[top:bottom] for a in aux))
+        arr[y0:y1] = block[y0 - top:y1 - top]
+        del block
+
 
 def apply_skin_denoise_with_mask(
     img: Image.Image,
@@ -49,31 +114,38 @@ def apply_skin_denoise_with_mask(
     if int(skin_mask_u8.max()) < 32:
         return img
 
-    # Перьим маску, чтобы переход кожа/не-кожа был мягким (без обводки)
-    skin_mask_feather = np.array(
-        Image.fromarray(skin_mask_u8, 'L').filter(ImageFilter.GaussianBlur(radius=4)),
-        dtype=np.uint8,
-    )
-
-    # Денойзим копию массива (in-place edge-preserving)
-    arr_denoised = arr.copy()
-    _denoise_luminance(arr_denoised, strength=strength)
-
-    # Бленд: где маска=255 -> denoised, где маска=0 -> оригинал
-    mask_f = skin_mask_feather.astype(np.uint16)
-    inv_f = 255 - mask_f
-    for c in range(3):
-        mixed = (
-            arr_denoised[..., c].astype(np.uint16) * mask_f
-            + arr[..., c].astype(np.uint16) * inv_f
-        ) // 255
-        arr[..., c] = mixed.astype(np.uint8)
-    del arr_denoised, mask_f, inv_f, skin_mask_feather
+    def denoise_block(block, mask_block):
+        # Ни одного пикселя кожи в полосе с ореолом — растушёванная маска
+        # нулевая, бленд вернул бы оригинал
+        if not mask_block.any():
+            return
+        # Перьим маску, чтобы переход кожа/не-кожа был мягким (без обводки)
+        mask_f = np.array(
+            Image.fromarray(mask_block, 'L').filter(ImageFilter.GaussianBlur(radius=4)),
+            dtype=np.uint16,
+        )
+        # Денойзим копию полосы (in-place edge-preserving)
+        denoised = block.copy()
+        _denoise_block(denoised, strength)
+        # Бленд: где маска=255 -> denoised, где маска=0 -> оригинал
+        inv_f = 255 - mask_f
+        for c in range(3):
+            block[..., c] = (
+                (denoised[..., c].astype(np.uint16) * mask_f
+                 + block[..., c].astype(np.uint16) * inv_f) // 255
+            ).astype(np.uint8)
 
+    _run_in_strips(arr, denoise_block, skin_mask_u8, halo=DENOISE_HALO, strip=DENOISE_STRIP)
     return Image.fromarray(arr, 'RGB')
 
 
 def _denoise_luminance(arr: np.ndarray, strength: float = 0.6) -> None:
+    """Шумодав всего кадра (in-place) — полосами, см. _denoise_block."""
+    _run_in_strips(arr, lambda block: _denoise_block(block, strength),
+                   halo=DENOISE_HALO, strip=DENOISE_STRIP)
+
+
+def _denoise_block(arr: np.ndarray, strength: float = 0.6) -> None:
     """Шумодав: убирает зернистость в плоских областях (кожа, фон),
     сохраняет резкость кромок и текстуры (волосы, глаза, ткань).
 
@@ -225,11 +297,6 @@ def _apply_lut_per_channel(arr, lut_r, lut_g, lut_b):
     arr[..., 2] = lut_b[arr[..., 2]]
 
 
-def _apply_lut_global(arr, lut):
-    for c in range(3):
-        arr[..., c] = lut[arr[..., c]]
-
-
 def _saturation_in_place(arr, factor):
     if abs(factor - 1.0) < 0.01:
         return
@@ -239,100 +306,193 @@ def _saturation_in_place(arr, factor):
         arr[..., 2].astype(np.uint16) * 29
     ) >> 8
     for c in range(3):
-        diff = arr[..., c].astype(np.int16) - luma.astype(np.int16)
+        # int32: diff до ±255 × factor·256 не влезает в int16 — насыщенные
+        # цвета переворачивались (жёлтый (255, 250, 90) становился розовым)
+        diff = arr[..., c].astype(np.int32) - luma.astype(np.int32)
         new_diff = (diff * int(factor * 256)) >> 8
         arr[..., c] = np.clip(
-            luma.astype(np.int16) + new_diff, 0, 255
+            luma.astype(np.int32) + new_diff, 0, 255
         ).astype(np.uint8)
     del luma
 
 
-def _hue_classify(arr):
-    r = arr[..., 0].astype(np.int16)
-    g = arr[..., 1].astype(np.int16)
-    b = arr[..., 2].astype(np.int16)
-    max_c = np.maximum(np.maximum(r, g), b)
-    min_c = np.minimum(np.minimum(r, g), b)
-    chroma = max_c - min_c
-    out = np.zeros(arr.shape[:2], dtype=np.uint8)
-    active = chroma >= 18
-    is_orange = active & (r >= g) & (g > b) & ((g * 100) > r * 40) & ((g * 100) < r * 75)
-    out[is_orange] = 1
-    is_yellow = active & (np.abs(r - g) < 25) & (r > b + 25)
-    out[is_yellow & ~is_orange] = 2
-    is_cyan = active & (np.abs(g - b) < 25) & (g > r + 20)
-    out[is_cyan] = 3
-    del r, g, b, max_c, min_c, chroma, active, is_orange, is_yellow, is_cyan
-    return out
-
-
-def _adjust_color_channel(arr, mask, color_code, hue_shift=0.0, sat=0.0, light=0.0):
-    sel = (mask == color_code)
-    if not sel.any():
-        return
-    if light != 0:
-        light_mult = 1.0 + light / 100.0
-        for c in range(3):
-            arr[sel, c] = np.clip(
-                arr[sel, c].astype(np.float32) * light_mult, 0, 255
-            ).astype(np.uint8)
-    if sat != 0:
-        sat_factor = 1.0 + sat / 100.0
-        sub = arr[sel]
-        luma = (sub[..., 0].astype(np.uint16) * 77
-                + sub[..., 1].astype(np.uint16) * 150
-                + sub[..., 2].astype(np.uint16) * 29) >> 8
-        for c in range(3):
-            d = sub[..., c].astype(np.int16) - luma.astype(np.int16)
-            sub[..., c] = np.clip(
-                luma.astype(np.int16) + (d.astype(np.float32) * sat_factor).astype(np.int16),
-                0, 255
-            ).astype(np.uint8)
-        arr[sel] = sub
-    if hue_shift != 0 and color_code == 2:
-        shift = abs(hue_shift) / 100.0
-        sign = -1 if hue_shift < 0 else 1
-        if sign < 0:
-            arr[sel, 1] = np.clip(
-                arr[sel, 1].astype(np.float32) * (1.0 - shift * 0.5), 0, 255
-            ).astype(np.uint8)
+def _band_tables():
+    """Таблицы color editor, плоские float32 по индексу
+    (хрома >> CHROMA_SHIFT) * HUE_BINS + оттенок°:
+    (множитель светлоты, множитель хромы, сдвиг оттенка в градусах).
+
+    Вес полосы — 1 в ядре (половина полуширины) и косинусный спад к её
+    краю, как у color editor Capture One: соседние оттенки меняются
+    плавно, без порога. Полосы включаются по хроме между CHROMA_MIN и
+    CHROMA_FULL — серые и почти серые пиксели не трогаем.
+    """
+    global _color_bands
+    if _color_bands is None:
+        hue = np.arange(HUE_BINS, dtype=np.float32) + 0.5
+        light = np.zeros(HUE_BINS, dtype=np.float32)
+        sat = np.zeros(HUE_BINS, dtype=np.float32)
+        shift = np.zeros(HUE_BINS, dtype=np.float32)
+        for center, half, d_hue, d_sat, d_light in COLOR_BANDS:
+            dist = np.abs((hue - center + 180.0) % 360.0 - 180.0)
+            t = np.clip((dist - half * 0.5) / (half * 0.5), 0.0, 1.0)
+            weight = 0.5 + 0.5 * np.cos(np.pi * t)
+            light += weight * (d_light / 100.0)
+            sat += weight * (d_sat / 100.0)
+            shift += weight * d_hue
+        # Уровень хромы — середина своей ячейки квантования
+        levels = (np.arange(256 >> CHROMA_SHIFT) << CHROMA_SHIFT) + ((1 << CHROMA_SHIFT) >> 1)
+        ramp = np.clip((levels - CHROMA_MIN) / float(CHROMA_FULL - CHROMA_MIN), 0.0, 1.0)
+        ramp = ramp.astype(np.float32)[:, None]
+        _color_bands = (
+            (1.0 + ramp * light).ravel(),
+            (1.0 + ramp * sat).ravel(),
+            (ramp * shift).ravel(),
+        )
+    return _color_bands
+
+
+def _apply_color_bands(arr):
+    """Color editor (in-place) одним векторным проходом: RGB → HSL
+    (оттенок, хрома, светлота), параметры полос — take из _band_tables,
+    HSL → RGB. Без масок и выборок arr[mask]: пиксели вне полос проходят
+    с множителями 1 и возвращаются без изменений.
+
+    Оттенок — в секстантах [0, 6) (1 = 60°): так обратное преобразование
+    обходится без деления по модулю на каждый канал.
+    """
+    light_t, sat_t, shift_t = _band_tables()
+    r = arr[..., 0].astype(np.float32)
+    g = arr[..., 1].astype(np.float32)
+    b = arr[..., 2].astype(np.float32)
+    mx = np.maximum(np.maximum(r, g), b)
+    mn = np.minimum(np.minimum(r, g), b)
+    chroma = mx - mn
+    safe = np.maximum(chroma, 1e-6)
+    hue = np.where(mx == r, (g - b) / safe,
+                   np.where(mx == g, (b - r) / safe + 2.0, (r - g) / safe + 4.0))
+    hue += np.where(hue < 0.0, 6.0, 0.0).astype(np.float32)
+    del r, g, b, safe
+    idx = (chroma.astype(np.int32) >> CHROMA_SHIFT) * HUE_BINS
+    idx += np.minimum((hue * (HUE_BINS / 6.0)).astype(np.int32), HUE_BINS - 1)
+    light = light_t.take(idx)
+
+    # Светлота × light — как умножение всех каналов; хрома растёт вместе
+    # с ней и × sat, затем ужимается в гамут при этой светлоте
+    lum = mx + mn
+    lum *= 0.5 * light
+    np.clip(lum, 0.0, 255.0, out=lum)
+    chroma *= light
+    chroma *= sat_t.take(idx)
+    np.minimum(chroma, 2.0 * np.minimum(lum, 255.0 - lum), out=chroma)
+    hue += shift_t.take(idx) * (1.0 / 60.0)
+    hue %= 6.0
+    del idx, light, mx, mn
+
+    # HSL → RGB: канал = верх − хрома · недобор, недобор — трапеция по
+    # оттенку (0, где канал максимальный, 1 — где минимальный)
+    top = lum + chroma * 0.5
+    for c, center in enumerate((3.0, 2.0, 4.0)):
+        deficit = np.abs(hue - center)
+        deficit -= 1.0
+        np.clip(deficit, 0.0, 1.0, out=deficit)
+        if c == 0:
+            # У красного максимум на стыке 6/0 — берём дополнение
+            deficit = 1.0 - deficit
+        deficit *= chroma
+        arr[..., c] = np.clip(top - deficit + 0.5, 0, 255).astype(np.uint8)
+
+
+def _color_editor(arr):
+    """Насыщенность и color editor пресета (in-place). Чисто попиксельная
+    функция цвета — поэтому по ней строится 3D LUT (_color_lut3d)."""
+    # Saturation — больше сочности (+22)
+    _saturation_in_place(arr, factor=1.22)
+    # Color editor по полосам оттенка (COLOR_BANDS)
+    _apply_color_bands(arr)
+
+
+def _color_lut3d():
+    """3D LUT цветовой части: _color_editor, посчитанный в узлах сетки
+    2^LUT3D_BITS на канал, упакованный в uint32 (R | G << 8 | B << 16).
+
+    Узлы прогоняются через ту же функцию, что раньше шла по кадру, поэтому
+    таблица не может разойтись с логикой color editor. Параметры пресета
+    фиксированы — таблица строится один раз на контейнер (~0.2 с, 8 МБ).
+    """
+    global _color_lut
+    if _color_lut is None:
+        shift = 8 - LUT3D_BITS
+        # Узел — середина своей ячейки входных значений
+        nodes = (np.arange(1 << LUT3D_BITS) << shift) + ((1 << shift) >> 1)
+        grid = np.stack(np.meshgrid(nodes, nodes, nodes, indexing='ij'), axis=-1)
+        # 2M узлов как «картинка» (n², n) — полосами, как обычный кадр
+        grid = grid.astype(np.uint8).reshape(-1, len(nodes), 3)
+        _run_in_strips(grid, _color_editor)
+        rgb = grid.reshape(-1, 3).astype(np.uint32)
+        _color_lut = rgb[:, 0] | (rgb[:, 1] << 8) | (rgb[:, 2] << 16)
+        del grid, rgb
+    return _color_lut
+
+
+def _apply_lut3d(strip, lut):
+    """3D LUT по полосе uint8 RGB (in-place): один gather на пиксель."""
+    shift = 8 - LUT3D_BITS
+    flat = strip.reshape(-1, 3)
+    idx = (flat[:, 0].astype(np.uint32) >> shift) << (2 * LUT3D_BITS)
+    idx |= (flat[:, 1].astype(np.uint32) >> shift) << LUT3D_BITS
+    idx |= flat[:, 2] >> shift
+    packed = lut.take(idx)
+    del idx
+    flat[:, 0] = packed
+    flat[:, 1] = packed >> 8
+    flat[:, 2] = packed >> 16
+
+
+def _highlight_mask(arr, luts=None):
+    """Soft-маска пересвета для восстановления светов (uint8, 255 = пересвет).
+
+    0 при Y<200, 1 при Y>240: берём не только самый clip, но и зону, где
+    света «лезут к 255». Маска растушёвывается Гауссом (мягкие границы,
+    чтобы не было ореолов). Яркость — кадра после поканальных luts, если
+    они переданы; сам arr не меняется.
+    """
+    h, w = arr.shape[:2]
+    mask = np.empty((h, w), dtype=np.uint8)
+    for y0 in range(0, h, PIPELINE_STRIP):
+        strip = arr[y0:y0 + PIPELINE_STRIP]
+        if luts is not None:
+            ch = [lut[strip[..., c]] for c, lut in enumerate(luts)]
+        else:
+            ch = [strip[..., c] for c in range(3)]
+        # Luma BT.601
+        y = (
+            ch[0].astype(np.uint16) * 77
+            + ch[1].astype(np.uint16) * 150
+            + ch[2].astype(np.uint16) * 29
+        ) >> 8
+        mask[y0:y0 + PIPELINE_STRIP] = (
+            np.clip((y.astype(np.float32) - 200.0) / 40.0, 0.0, 1.0) * 255
+        ).astype(np.uint8)
+        del ch, y
+    blur_radius = max(8, min(h, w) // 100)
+    return np.array(Image.fromarray(mask, 'L').filter(ImageFilter.GaussianBlur(radius=blur_radius)))
 
 
-def _apply_highlight_recovery(arr: np.ndarray, strength: float = 0.55) -> None:
+def _recover_highlights(arr: np.ndarray, mask_u8: np.ndarray, strength: float = 0.55) -> None:
     """Локальное затемнение зоны пересвета (вспышки, окна).
 
-    Принцип: строим soft-маску по яркости (Y > 220), растушёвываем её
-    Гауссом, и в этой зоне применяем S-кривую сжатия. Снаружи — кадр
+    В зоне маски (_highlight_mask) применяем S-кривую сжатия, снаружи кадр
     не меняется. Это НЕ восстанавливает clipped-данные (их физически
     нет), но возвращает яркой дыре фактуру за счёт сжатия диапазона
     240-255 → 220-250 и лёгкого обесцвечивания пересвета (он обычно
     тёплый из-за окна).
 
     Args:
-        arr: HxWx3 uint8 (модифицируется in-place)
+        arr: HxWx3 uint8 — кадр или полоса (модифицируется in-place)
+        mask_u8: HxW маска той же высоты/ширины
         strength: 0..1 — сила восстановления (0 = выкл, 1 = максимум)
     """
-    if strength < 0.05:
-        return
-    h, w = arr.shape[:2]
-    # Luma BT.601
-    y = (
-        arr[..., 0].astype(np.uint16) * 77
-        + arr[..., 1].astype(np.uint16) * 150
-        + arr[..., 2].astype(np.uint16) * 29
-    ) >> 8
-    # Soft highlight mask: 0 при Y<200, 1 при Y>240
-    # Расширили зону (200 вместо 220) — берём не только самый clip,
-    # но и зону где света "лезут к 255".
-    mask_f = np.clip((y.astype(np.float32) - 200.0) / 40.0, 0.0, 1.0)
-    del y
-    # Растушёвка маски (мягкие границы, чтобы не было ореолов)
-    blur_radius = max(8, min(h, w) // 100)
-    mask_pil = Image.fromarray(
-        (mask_f * 255).clip(0, 255).astype(np.uint8), 'L'
-    ).filter(ImageFilter.GaussianBlur(radius=blur_radius))
-    mask_f = np.array(mask_pil, dtype=np.float32) / 255.0
-    del mask_pil
+    mask_f = mask_u8.astype(np.float32) / 255.0
 
     # ШАГ 1: Жёсткое сжатие ярких пикселей.
     # Раньше factor=0.18 → max сжатие 13% (для Y=255). Этого мало
@@ -370,24 +530,17 @@ def _apply_highlight_recovery(arr: np.ndarray, strength: float = 0.55) -> None:
     del mask_f
 
 
-def _apply_vignette(arr, amount=-0.34):
-    if abs(amount) < 0.02:
-        return
-    h, w = arr.shape[:2]
-    yy, xx = np.indices((h, w), dtype=np.float32)
+def _vignette_mult(y0, y1, h, w, amount=-0.34):
+    """Множитель виньетки (×256, uint16) для строк y0..y1 кадра h×w."""
+    yy = np.arange(y0, y1, dtype=np.float32)[:, None]
+    xx = np.arange(w, dtype=np.float32)[None, :]
     cx, cy = w / 2.0, h / 2.0
     dx = (xx - cx) / cx
     dy = (yy - cy) / cy
     dist = np.sqrt(dx * dx + dy * dy) / np.sqrt(2.0)
-    del xx, yy, dx, dy
     falloff = np.clip(dist, 0.0, 1.0) ** 2.2
     mult = 1.0 + amount * falloff
-    del dist, falloff
-    mult_u8 = np.clip(mult * 255, 0, 255).astype(np.uint16)
-    del mult
-    for c in range(3):
-        arr[..., c] = ((arr[..., c].astype(np.uint16) * mult_u8) >> 8).astype(np.uint8)
-    del mult_u8
+    return np.clip(mult * 255, 0, 255).astype(np.uint16)
 
 
 def _estimate_scene_wb(arr: np.ndarray) -> tuple[float, float]:
@@ -458,7 +611,7 @@ def _estimate_scene_wb(arr: np.ndarray) -> tuple[float, float]:
     return current_kelvin, current_tint
 
 
-def _estimate_scene_exposure(arr: np.ndarray) -> dict:
+def _estimate_scene_exposure(arr: np.ndarray, luts=None) -> dict:
     """Оценивает текущую экспозицию кадра по гистограмме яркости.
 
     Анализирует:
@@ -468,11 +621,17 @@ def _estimate_scene_exposure(arr: np.ndarray) -> dict:
     - shadow_density: % пикселей в нижних 25% диапазона
     - highlight_density: % пикселей в верхних 10%
 
+    luts — поканальные таблицы (r, g, b): метрики считаются по кадру после
+    них (например, после WB), без прохода по всему arr.
+
     Returns dict с этими метриками + диагностика.
     """
     h, w = arr.shape[:2]
     step = max(1, int(np.sqrt(h * w / 200_000)))
-    sample = arr[::step, ::step].astype(np.int16)
+    sample = arr[::step, ::step]
+    if luts is not None:
+        sample = np.stack([lut[sample[..., c]] for c, lut in enumerate(luts)], axis=-1)
+    sample = sample.astype(np.int16)
     r = sample[..., 0]
     g = sample[..., 1]
     b = sample[..., 2]
@@ -672,15 +831,14 @@ def apply_capture_one_wedding_preset(img: Image.Image) -> Image.Image:
         f"[C1-PRESET] auto-WB: scene≈{cur_k:.0f}K tint={cur_t:+.1f} "
         f"→ shift kelvin_target={wb_k:.0f}K tint={wb_t:+.1f}"
     )
-    lut_r, lut_g, lut_b = _wb_shift_lut(kelvin_target=wb_k, tint=wb_t)
-    _apply_lut_per_channel(arr, lut_r, lut_g, lut_b)
-    del lut_r, lut_g, lut_b
+    wb_luts = _wb_shift_lut(kelvin_target=wb_k, tint=wb_t)
 
     # 2. Tone — АДАПТИВНАЯ экспозиция: измеряем гистограмму кадра и
     #    подбираем brightness / shadow / highlight / contrast индивидуально.
     #    Тёмные кадры подсвечиваем сильнее, пересвеченные — гасим highlights,
     #    плоские получают больше контраста, контрастные — меньше.
-    exp_stats = _estimate_scene_exposure(arr)
+    #    Гистограмма — по выборке кадра уже после WB.
+    exp_stats = _estimate_scene_exposure(arr, luts=wb_luts)
     exp_params = _compute_exposure_correction(exp_stats)
     skin_info = (
         f"skin_y={exp_stats['skin_y']:.0f} "
@@ -697,7 +855,10 @@ def apply_capture_one_wedding_preset(img: Image.Image) -> Image.Image:
         f"highlight={exp_params['highlight']:+.1f} "
         f"contrast={exp_params['contrast']:+.1f}"
     )
-    _apply_lut_global(arr, _build_lut_curve(**exp_params))
+    tone = _build_lut_curve(**exp_params)
+    # WB и тон — поканальные: склеиваем в одну таблицу на канал
+    shaper = [tone[lut] for lut in wb_luts]
+    del wb_luts, tone
 
     # 2.5. HIGHLIGHT RECOVERY — локальное приглушение пересвета (окна,
     # вспышки). Включается АДАПТИВНО по плотности светов в кадре:
@@ -718,29 +879,36 @@ def apply_capture_one_wedding_preset(img: Image.Image) -> Image.Image:
             f"[C1-PRESET] highlight-recovery: density={hd:.1f}% → "
             f"strength={hr_strength:.2f}"
         )
-        _apply_highlight_recovery(arr, strength=hr_strength)
-
-    # 3. Saturation — больше сочности (+22)
-    _saturation_in_place(arr, factor=1.22)
+    # Маске светов нужен размытый по всему кадру снимок яркости после
+    # WB/тона — это единственный шаг, которому нужен отдельный проход.
+    hl_mask = _highlight_mask(arr, shaper) if hr_strength > 0 else None
 
-    # 4. Color editor — НЕ душим оранжевый (это кожа!), голубой приглушаем.
-    color_mask = _hue_classify(arr)
-    # Оранжевый (кожа): не трогаем насыщенность, только +4 luminance
-    _adjust_color_channel(arr, color_mask, 1, sat=0, light=4)
-    # Жёлтый: лёгкий сдвиг к оранжевому + чуть насыщеннее
-    _adjust_color_channel(arr, color_mask, 2, hue_shift=-3.4, sat=6, light=8)
-    # Голубой/синий: приглушаем (фон)
-    _adjust_color_channel(arr, color_mask, 3, sat=-10)
-    del color_mask
+    # 3–4. Saturation + color editor (_color_editor) — одной 3D LUT.
+    lut3d = _color_lut3d()
 
     # 5. Адаптивная виньетка — ТОЛЬКО при сильном пересвете в кадре
     # (вспышки, контровой свет). Лёгкая, чтобы не сделать кадр "мутным".
+    vignette_amount = 0.0
     if exp_stats['highlight_density'] > 6.0:
         vignette_amount = -0.22 if exp_stats['highlight_density'] > 12.0 else -0.14
         print(
             f"[C1-PRESET] adaptive vignette: amount={vignette_amount:.2f} "
             f"(highlight_density={exp_stats['highlight_density']:.1f}%)"
         )
-        _apply_vignette(arr, amount=vignette_amount)
 
-    return Image.fromarray(arr, 'RGB')
+    # Один проход по кадру полосами: WB+тон → свет → цвет → виньетка.
+    h, w = arr.shape[:2]
+    for y0 in range(0, h, PIPELINE_STRIP):
+        y1 = min(h, y0 + PIPELINE_STRIP)
+        strip = arr[y0:y1]
+        _apply_lut_per_channel(strip, *shaper)
+        if hl_mask is not None:
+            _recover_highlights(strip, hl_mask[y0:y1], strength=hr_strength)
+        _apply_lut3d(strip, lut3d)
+        if abs(vignette_amount) >= 0.02:
+            mult_u8 = _vignette_mult(y0, y1, h, w, amount=vignette_amount)
+            for c in range(3):
+                strip[..., c] = ((strip[..., c].astype(np.uint16) * mult_u8) >> 8).astype(np.uint8)
+    del hl_mask, lut3d
+
+    return Image.fromarray(arr, 'RGB')
\ No newline at end of file
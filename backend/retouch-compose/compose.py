@@ -0,0 +1,246 @@
+"""
+Композиция результата ретуши с оригиналом по маске кожи — полосами.
+
+    out = orig + (ret - orig) * m * alpha
+
+m — маска кожи лиц в фокусе (SegFormer + SCRFD, как в старом
+_compose_with_original_by_mask из retouch), alpha — множитель плана
+(крупный/средний/дальний) × alpha_multiplier пресета. Вне маски (волосы,
+брови, одежда, фон) остаются пиксели оригинала в полном разрешении.
+
+Старая версия держала в памяти несколько float32-копий кадра и поэтому
+ужимала фото до max_compose_side и падала по OOM. Здесь:
+  - превью для маски декодируется прямо из JPEG в уменьшенном масштабе
+    (draft, DCT-scaling) — полный кадр ради него не нужен;
+  - маска строится, эродируется и растушёвывается только в разрешении
+    превью (preview_side) и растягивается билинейно на лету — по полосе;
+  - ret приводится к размеру оригинала тоже по полосе (resize с box —
+    ядро берёт соседние строки за краем полосы, швов нет);
+  - смешивание — в int32 по полосе ~COMPOSE_STRIP_PIXELS пикселей и
+    пишется прямо в декодированный оригинал, который затем кодируется в JPEG.
+Pillow не умеет декодировать и кодировать JPEG построчно, поэтому оригинал
+и ret в памяти целиком (RGB в Pillow — 4 байта на пиксель) — это и есть пик;
+ret декодируется, только если смешивать есть что.
+Кадры, которые вместе не укладываются в MAX_FRAME_BYTES, не смешиваются:
+ret отдаётся как есть (reason=too_large), а не роняет функцию по памяти.
+"""
+
+import base64
+import io
+import time
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from gauss_blur import gaussian_blur
+from morphology import erode
+from skin_mask import build_face_skin_mask, build_focus_mask_via_server
+
+# Полоса смешивания: столько пикселей (строк — по ширине кадра), int32 ×3
+COMPOSE_STRIP_PIXELS = 512 * 1024
+# Два декодированных кадра (оригинал + ret) — не больше этого. Лимит функции
+# 256 МБ; остальное — интерпретатор с numpy/Pillow/boto3 (~70 МБ), входные и
+# выходной JPEG и полосы. 128 МБ — два кадра по ~16 Мп
+MAX_FRAME_BYTES = 128 * 1024 * 1024
+# Pillow хранит RGB как RGBX
+FRAME_BYTES_PER_PIXEL = 4
+# Эрозия и растушёвка маски — в пикселях ПОЛНОГО кадра до 2400px
+# (значения из старой композиции), в превью пересчитываются по масштабу
+MASK_ERODE_PX = 6
+MASK_FEATHER_PX = 7
+FOCUS_FEATHER_PX = 12
+REFERENCE_SIDE = 2400
+# Соотношение сторон ret и оригинала расходится сильнее — ret искажён,
+# композиция «сдвинет» лицо; отдаём ret как есть
+MAX_ASPECT_DIFF = 0.02
+# Маска с покрытием меньше этого — кожи в кадре нет, смешивать нечего
+MIN_MASK_COVERAGE = 0.002
+
+
+def _open_rgb(data, oriented=False):
+    img = Image.open(io.BytesIO(data))
+    # exif_transpose копирует кадр и без поворота — зовём, только если он нужен
+    if oriented and img.getexif().get(0x0112, 1) not in (0, 1):
+        img = ImageOps.exif_transpose(img)
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    return img
+
+
+def _oriented_size(img):
+    """Размер кадра после поворота по EXIF — без декодирования."""
+    w, h = img.size
+    if img.getexif().get(0x0112, 1) in (5, 6, 7, 8):
+        return h, w
+    return w, h
+
+
+def _open_preview(data, side):
+    """Превью оригинала не больше side: JPEG декодируется сразу в 1/2..1/8
+    масштабе (draft), остальные форматы — целиком и уменьшаются."""
+    img = Image.open(io.BytesIO(data))
+    img.draft('RGB', (side, side))
+    img = ImageOps.exif_transpose(img)
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    img.thumbnail((side, side), Image.LANCZOS)
+    return img
+
+
+def _alpha_channel(mask_b64):
+    """build_face_skin_mask отдаёт RGBA PNG — маска в альфе."""
+    m = Image.open(io.BytesIO(base64.b64decode(mask_b64)))
+    m = m.split()[-1] if m.mode == 'RGBA' else m.convert('L')
+    return np.array(m)
+
+
+def build_compose_mask(preview, full_side):
+    """Маска смешивания в разрешении превью.
+
+    Args:
+        preview: RGB Image оригинала, уменьшенный до preview_side.
+        full_side: большая сторона полного кадра — для пересчёта радиусов.
+
+    Returns:
+        (mask float32 [0..1] размера превью, plan_multiplier, info)
+    """
+    h, w = preview.size[1], preview.size[0]
+    scale = min(1.0, max(h, w) / float(min(full_side, REFERENCE_SIDE)))
+    buf = io.BytesIO()
+    preview.save(buf, format='JPEG', quality=88)
+    preview_bytes = buf.getvalue()
+
+    skin = _alpha_channel(build_face_skin_mask(preview_bytes))
+    if skin.shape != (h, w):
+        skin = np.array(Image.fromarray(skin, mode='L').resize((w, h), Image.NEAREST))
+    skin = erode(skin, max(1, round(MASK_ERODE_PX * scale)))
+    mask = gaussian_blur(skin, MASK_FEATHER_PX * scale)
+    mask *= 1.0 / 255.0
+
+    plan_multiplier = 1.0
+    info = {'source': 'segformer'}
+    try:
+        focus, focus_info = build_focus_mask_via_server(preview_bytes, np.asarray(preview))
+    except Exception as e:
+        print(f"[COMPOSE] focus mask failed: {e}")
+        focus, focus_info = None, None
+    if focus_info is not None:
+        info = focus_info
+        plan_multiplier = float(focus_info.get('plan_multiplier', 1.0))
+    if focus is not None and focus.any():
+        # Кожа только у лиц в фокусе: SegFormer видит и размытые лица на
+        # бокэ — их ретушь даёт «кубики». Зону фокуса растушёвываем, но не
+        # сужаем (max с исходной).
+        focus_soft = gaussian_blur(focus, FOCUS_FEATHER_PX * scale)
+        np.maximum(focus_soft, focus, out=focus_soft)
+        focus_soft *= 1.0 / 255.0
+        mask *= focus_soft
+    np.clip(mask, 0.0, 1.0, out=mask)
+    return mask, plan_multiplier, info
+
+
+def _bilinear_axis(n_out, n_in):
+    """Индексы и веса билинейного растяжения n_in → n_out (центры пикселей)."""
+    pos = (np.arange(n_out, dtype=np.float32) + 0.5) * (n_in / float(n_out)) - 0.5
+    np.clip(pos, 0, n_in - 1, out=pos)
+    i0 = pos.astype(np.int32)
+    i1 = np.minimum(i0 + 1, n_in - 1)
+    return i0, i1, pos - i0
+
+
+def _mask_rows(mask, rows, cols, y0, y1):
+    """Строки y0..y1 маски, растянутой до полного кадра, как int32 0..256."""
+    r0, r1, ry = rows[0][y0:y1], rows[1][y0:y1], rows[2][y0:y1, None]
+    c0, c1, cx = cols
+    top = mask[r0][:, c0] * (1 - cx) + mask[r0][:, c1] * cx
+    bottom = mask[r1][:, c0] * (1 - cx) + mask[r1][:, c1] * cx
+    m = top * (1 - ry) + bottom * ry
+    return (m * 256.0 + 0.5).astype(np.int32)
+
+
+def blend_in_strips(orig, ret, mask, alpha, strip=None):
+    """Смешивает ret в orig на месте: orig += (ret - orig) * mask * alpha.
+
+    orig — RGB Image, в который пишется результат; ret — RGB Image того же
+    соотношения сторон любого размера; mask — float32 [0..1] любого размера.
+    Полосы без маски пропускаются целиком.
+    """
+    w, h = orig.size
+    rw, rh = ret.size
+    strip = strip or max(16, COMPOSE_STRIP_PIXELS // w)
+    rows = _bilinear_axis(h, mask.shape[0])
+    cols = _bilinear_axis(w, mask.shape[1])
+    # Строки маски, где есть хоть что-то, — чтобы пропускать пустые полосы
+    mask_rows_live = mask.max(axis=1) > 0
+    sy = rh / float(h)
+    for y0 in range(0, h, strip):
+        y1 = min(h, y0 + strip)
+        if not mask_rows_live[rows[0][y0]:rows[1][y1 - 1] + 1].any():
+            continue
+        m = _mask_rows(mask, rows, cols, y0, y1)
+        if alpha < 1.0:
+            m = (m * alpha).astype(np.int32)
+        if not m.any():
+            continue
+        if (rw, rh) == (w, h):
+            ret_strip = ret.crop((0, y0, w, y1))
+        else:
+            ret_strip = ret.resize((w, y1 - y0), Image.LANCZOS, box=(0, y0 * sy, rw, y1 * sy))
+        o = np.asarray(orig.crop((0, y0, w, y1)), dtype=np.int32)
+        r = np.asarray(ret_strip, dtype=np.int32)
+        r -= o
+        r *= m[..., None]
+        r += 128
+        r >>= 8
+        o += r
+        orig.paste(Image.fromarray(o.astype(np.uint8), mode='RGB'), (0, y0))
+
+
+def compose(orig_bytes, ret_bytes, preset):
+    """Композиция ретуши с оригиналом.
+
+    Returns:
+        (jpeg_bytes, composed, info). composed=False — вернули ret как есть
+        (маски нет / ret искажён); на дальнем плане (alpha=0) результат —
+        перекодированный оригинал.
+    """
+    t0 = time.time()
+    # Размеры — из заголовков, кадры декодируются только если смешивать есть что
+    ow, oh = _oriented_size(Image.open(io.BytesIO(orig_bytes)))
+    rw, rh = Image.open(io.BytesIO(ret_bytes)).size
+    ar_diff = abs(ow / float(oh) - rw / float(rh)) / max(ow / float(oh), rw / float(rh))
+    print(f"[COMPOSE] orig={ow}x{oh} ret={rw}x{rh} ar_diff={ar_diff * 100:.2f}%")
+    if ar_diff > MAX_ASPECT_DIFF:
+        return ret_bytes, False, {'reason': 'aspect_mismatch'}
+    frame_bytes = FRAME_BYTES_PER_PIXEL * (ow * oh + rw * rh)
+    if frame_bytes > MAX_FRAME_BYTES:
+        print(f"[COMPOSE] frames need {frame_bytes >> 20} MB > {MAX_FRAME_BYTES >> 20} MB, returning ret as-is")
+        return ret_bytes, False, {'reason': 'too_large'}
+
+    preview = _open_preview(orig_bytes, int(preset.get('preview_side', 1024)))
+    mask, plan_multiplier, info = build_compose_mask(preview, max(ow, oh))
+    del preview
+
+    alpha = max(0.0, min(1.0, plan_multiplier * float(preset.get('alpha_multiplier', 1.0))))
+    coverage = float(mask.mean())
+    print(f"[COMPOSE] mask={mask.shape[1]}x{mask.shape[0]} coverage={coverage * 100:.2f}% "
+          f"shot={info.get('shot_type')} plan={plan_multiplier:.2f} alpha={alpha:.2f} "
+          f"({time.time() - t0:.1f}s)")
+    quality = int(preset.get('jpeg_quality', 95))
+    if plan_multiplier == 0:
+        # Массовка / лиц нет — ретушь не нужна, отдаём оригинал
+        alpha = 0.0
+    elif coverage < MIN_MASK_COVERAGE:
+        return ret_bytes, False, dict(info, reason='empty_mask')
+
+    orig = _open_rgb(orig_bytes, oriented=True)
+    if alpha > 0:
+        ret = _open_rgb(ret_bytes)
+        blend_in_strips(orig, ret, mask, alpha)
+        del ret
+    del mask
+
+    out = io.BytesIO()
+    orig.save(out, format='JPEG', quality=quality, optimize=False)
+    print(f"[COMPOSE] done in {time.time() - t0:.1f}s, {out.tell()} bytes")
+    return out.getvalue(), True, dict(info, alpha=round(alpha, 3), coverage=round(coverage, 4))
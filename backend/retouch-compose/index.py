@@ -1,33 +1,48 @@
 """Cloud Function retouch-compose — тяжёлая обработка изображений ретуши.
 
-Принимает по HTTP результат от внешнего AI-сервера ретуши и (опционально)
-делает композицию с оригиналом по маске кожи. Это вынесено из retouch
+Принимает по HTTP результат от внешнего AI-сервера ретуши и делает
+композицию с оригиналом (in_key) по маске кожи: ретушь — только на коже
+лиц в фокусе, остальное — пиксели оригинала. Это вынесено из retouch
 чтобы retouch не падала по таймауту деплоя из-за тяжёлых зависимостей
-(numpy + Pillow + boto3).
-
-MVP-этап 1: pass-through. Принимает retouched_b64, возвращает его же.
-Логика _compose_with_original_by_mask будет добавлена в следующем шаге.
+(numpy + Pillow + boto3). Сама композиция — compose.py, полосами, без
+ограничения разрешения. Без in_key или при ошибке — ret как есть.
 
 Endpoint:
   POST /  Body: {"in_key": str, "retouched_b64": str, "preset": "medium"}
   Response: {"result_b64": str, "size_bytes": int, "composed": bool}
+
+  Режим по ключам — картинка не идёт через тело запроса/ответа (лимиты
+  размера HTTP у функций), результат ретуши уже лежит в бакете:
+  POST /  Body: {"in_key": str, "retouched_key": str, "out_key": str?, "preset": "medium"}
+  Response: {"result_key": str, "size_bytes": int, "composed": bool}
+  retouched_key и out_key — только ключи результатов ретуши (…/retouch/<файл>).
+
+  Оба режима — только с ?token=RETOUCH_COMPOSE_SECRET (вызывает функция retouch).
 """
 
 import json
 import os
 import io
 import base64
+import hmac
 import time
 from typing import Dict, Any
 
 import boto3
 from botocore.client import Config
 
+from compose import compose
+from mask_cache import MaskCache, MemoMaskCache
+from presets import get_preset
+from skin_mask import set_mask_cache
 
-COMPOSE_VERSION = "v1-2026-05-25-pass-through-mvp"
+
+COMPOSE_VERSION = "v2-tiled-skin-composite"
 print(f"[RETOUCH-COMPOSE] Version: {COMPOSE_VERSION}")
 
 S3_BUCKET = "foto-mix"
+# Общий секрет с функцией retouch: без него POST не принимается
+RETOUCH_COMPOSE_SECRET = os.environ.get("RETOUCH_COMPOSE_SECRET", "")
 
 
 def _get_s3_client():
@@ -56,6 +71,91 @@ def _cors_response(status_code: int, body: Dict[str, Any]) -> Dict[str, Any]:
     }
 
 
+def _open_mask_cache(s3_client):
+    """Кэш масок face_parse на один вызов: в памяти (protect нужен обеим
+    маскам композиции) поверх общего с retouch кэша в БД/S3 — повторная
+    ретушь того же фото масок на сервере не считает. Returns: (cache, conn)."""
+    conn = None
+    database_url = os.environ.get('DATABASE_URL')
+    if database_url:
+        try:
+            import psycopg2
+            conn = psycopg2.connect(database_url)
+        except Exception as e:
+            print(f"[RETOUCH-COMPOSE] mask cache DB unavailable: {e}")
+    backing = MaskCache(conn, s3_client, S3_BUCKET) if conn is not None else None
+    return MemoMaskCache(backing), conn
+
+
+def _compose_bytes(s3_client, in_key: str, retouched_bytes: bytes, preset_name: str):
+    """Композиция с оригиналом из S3. Returns: (bytes, composed)."""
+    if not in_key:
+        return retouched_bytes, False
+    cache, conn = _open_mask_cache(s3_client)
+    set_mask_cache(cache)
+    try:
+        orig_bytes = s3_client.get_object(Bucket=S3_BUCKET, Key=in_key)['Body'].read()
+        out_bytes, composed, info = compose(orig_bytes, retouched_bytes, get_preset(preset_name))
+        print(f"[RETOUCH-COMPOSE] compose info: {info}")
+        return out_bytes, composed
+    except Exception as e:
+        import traceback
+        print(f"[RETOUCH-COMPOSE] compose failed, returning ret as-is: {e}")
+        traceback.print_exc()
+        return retouched_bytes, False
+    finally:
+        set_mask_cache(None)
+        if conn is not None:
+            conn.close()
+
+
+def _is_result_key(key: str) -> bool:
+    """Ключ результата ретуши: <каталог>/retouch/<файл> или retouch/<файл>
+    (см. _build_out_key в retouch). Оригиналы и чужие объекты — нельзя."""
+    folder, _, name = key.rpartition('/')
+    if not name or '..' in key.split('/'):
+        return False
+    return folder == 'retouch' or folder.endswith('/retouch')
+
+
+def _compose_by_key(in_key: str, retouched_key: str, out_key: str, preset_name: str) -> Dict[str, Any]:
+    """Композиция по ключам S3: читаем/пишем бакет сами, в ответе — только ключ.
+    Результат пишется в out_key (по умолчанию — поверх retouched_key).
+    """
+    t_start = time.time()
+    s3_client = _get_s3_client()
+    try:
+        retouched_bytes = s3_client.get_object(Bucket=S3_BUCKET, Key=retouched_key)['Body'].read()
+    except Exception as e:
+        return _cors_response(404, {'error': f'retouched_key not found: {e}'})
+    print(f"[RETOUCH-COMPOSE] in_key={in_key} retouched_key={retouched_key} "
+          f"size={len(retouched_bytes)} preset={preset_name}")
+
+    composed_bytes, composed = _compose_bytes(s3_client, in_key, retouched_bytes, preset_name)
+    del retouched_bytes
+    result_key = out_key or retouched_key
+    if composed or result_key != retouched_key:
+        s3_client.put_object(
+            Bucket=S3_BUCKET,
+            Key=result_key,
+            Body=composed_bytes,
+            ContentType='image/jpeg',
+        )
+    size_bytes = len(composed_bytes)
+
+    elapsed_ms = int((time.time() - t_start) * 1000)
+    print(f"[RETOUCH-COMPOSE] done by key composed={composed} result_key={result_key} elapsed={elapsed_ms}ms")
+
+    return _cors_response(200, {
+        'result_key': result_key,
+        'size_bytes': size_bytes,
+        'composed': composed,
+        'preset': preset_name,
+        'elapsed_ms': elapsed_ms,
+        'version': COMPOSE_VERSION,
+    })
+
+
 def handler(event: Dict[str, Any], context) -> Dict[str, Any]:
     """HTTP-обработчик композиции ретуши.
 
@@ -81,6 +181,11 @@ def handler(event: Dict[str, Any], context) -> Dict[str, Any]:
     if method != 'POST':
         return _cors_response(405, {'error': 'Method not allowed'})
 
+    params = event.get('queryStringParameters') or {}
+    token = params.get('token') or ''
+    if not RETOUCH_COMPOSE_SECRET or not hmac.compare_digest(token, RETOUCH_COMPOSE_SECRET):
+        return _cors_response(403, {'error': 'Invalid compose token'})
+
     try:
         body_raw = event.get('body') or '{}'
         if not body_raw or body_raw == '':
@@ -97,10 +202,17 @@ def handler(event: Dict[str, Any], context) -> Dict[str, Any]:
 
         in_key = body.get('in_key') or ''
         retouched_b64 = body.get('retouched_b64') or ''
+        retouched_key = body.get('retouched_key') or ''
         preset_name = body.get('preset') or 'medium'
 
+        if retouched_key:
+            out_key = body.get('out_key') or ''
+            if not _is_result_key(retouched_key) or (out_key and not _is_result_key(out_key)):
+                return _cors_response(400, {'error': 'retouched_key/out_key must be retouch result keys'})
+            return _compose_by_key(in_key, retouched_key, out_key, preset_name)
+
         if not retouched_b64:
-            return _cors_response(400, {'error': 'retouched_b64 required'})
+            return _cors_response(400, {'error': 'retouched_b64 or retouched_key required'})
 
         try:
             retouched_bytes = base64.b64decode(retouched_b64)
@@ -110,12 +222,7 @@ def handler(event: Dict[str, Any], context) -> Dict[str, Any]:
         t_start = time.time()
         print(f"[RETOUCH-COMPOSE] in_key={in_key} size={len(retouched_bytes)} preset={preset_name}")
 
-        # === MVP ЭТАП 1: pass-through ===
-        # Полная логика _compose_with_original_by_mask (бленд по маске кожи,
-        # erosion, feather, skin smooth, red-cast removal) будет добавлена
-        # в следующем шаге. Сейчас просто возвращаем retouched_bytes.
-        composed_bytes = retouched_bytes
-        composed = False
+        composed_bytes, composed = _compose_bytes(_get_s3_client(), in_key, retouched_bytes, preset_name)
 
         elapsed_ms = int((time.time() - t_start) * 1000)
         print(f"[RETOUCH-COMPOSE] done composed={composed} elapsed={elapsed_ms}ms")
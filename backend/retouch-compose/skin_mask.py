@@ -1,10 +1,18 @@
 import io
 import os
 import base64
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
 import numpy as np
 import requests
 from PIL import Image, ImageFilter
 
+from components import label_components
+from gauss_blur import convolve_separable, gaussian_blur
+from morphology import closing, dilate, erode, opening
+
 
 FACE_PARSE_URL = os.environ.get(
     "FACE_PARSE_URL",
@@ -18,29 +26,68 @@ FACE_PARSE_USER = os.environ.get("RETOUCH_BASIC_USER", "admin")
 FACE_PARSE_PASS = os.environ.get("RETOUCH_BASIC_PASS", "")
 FACE_PARSE_TIMEOUT = float(os.environ.get("FACE_PARSE_TIMEOUT", "15"))
 DETECT_FACES_TIMEOUT = float(os.environ.get("DETECT_FACES_TIMEOUT", "20"))
-
-
-def _call_ai_face_parse(image_bytes, mode="skin", bbox=None):
-    """Вызывает ИИ-сегментацию на сервере retouch (SegFormer).
-    Возвращает np.uint8 маску (0/255) или None при любой ошибке — тогда
-    вызывающий код откатится на эвристику.
-
-    Если передан bbox=[x1,y1,x2,y2] — SegFormer работает только внутри bbox
-    (намного точнее на сложном свете, тёмных сценах, цветных фонах).
-    """
-    if not FACE_PARSE_PASS:
-        return None
+# Общий дедлайн на пачку параллельных face_parse (skin + protect): раньше
+# они шли подряд и в худшем случае ждали 2 × FACE_PARSE_TIMEOUT
+FACE_PARSE_DEADLINE = float(os.environ.get("FACE_PARSE_DEADLINE", str(FACE_PARSE_TIMEOUT)))
+# Одновременных запросов к серверу ИИ (и соединений в keep-alive пуле)
+AI_POOL_SIZE = 4
+
+# Ядра до стольких отсчётов сворачиваем напрямую — дешевле каскада коробок
+BLUR_DIRECT_TAPS = 9
+
+# Кэш ответов face_parse: объект с get(image_bytes, mode, bbox) и
+# put(image_bytes, mode, bbox, mask) — см. mask_cache.py в retouch.
+# None — каждый вызов идёт на сервер.
+_mask_cache = None
+
+# Keep-alive сессия и пул потоков для запросов к серверу ИИ — ленивые,
+# живут всё время жизни контейнера
+_ai_lock = threading.Lock()
+_session = None
+_executor = None
+
+
+def set_mask_cache(cache):
+    """Подключает (или отключает, cache=None) кэш масок face_parse."""
+    global _mask_cache
+    _mask_cache = cache
+
+
+def _ai_session():
+    """Общая keep-alive сессия к серверу ИИ: соединения переиспользуются
+    между вызовами и потоками, TLS-рукопожатие — один раз на контейнер."""
+    global _session
+    with _ai_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=AI_POOL_SIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.auth = (FACE_PARSE_USER, FACE_PARSE_PASS)
+            _session = session
+        return _session
+
+
+def _ai_executor():
+    global _executor
+    with _ai_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=AI_POOL_SIZE, thread_name_prefix="ai")
+        return _executor
+
+
+def _remaining(deadline, cap):
+    """Таймаут запроса: не дольше cap и не позже общего дедлайна."""
+    return max(0.5, min(cap, deadline - time.monotonic()))
+
+
+def _request_face_parse(b64, mode, bbox, timeout):
+    """Один запрос face_parse (картинка уже в base64). Маска или None."""
     try:
-        b64 = base64.b64encode(image_bytes).decode('ascii')
         payload = {"image": b64, "mode": mode}
         if bbox is not None:
             payload["bbox"] = list(bbox)
-        r = requests.post(
-            FACE_PARSE_URL,
-            auth=(FACE_PARSE_USER, FACE_PARSE_PASS),
-            json=payload,
-            timeout=FACE_PARSE_TIMEOUT,
-        )
+        r = _ai_session().post(FACE_PARSE_URL, json=payload, timeout=timeout)
         if r.status_code != 200:
             print(f"[AI MASK] bad status {r.status_code}: {r.text[:200]}")
             return None
@@ -61,26 +108,84 @@ def _call_ai_face_parse(image_bytes, mode="skin", bbox=None):
         return None
 
 
-def _call_ai_detect_faces(image_bytes, max_side=1280, min_score=0.4):
-    """Запрашивает на сервере детектор лиц (SCRFD-10G через InsightFace).
-    Работает по геометрии лица — устойчив к темноте, цветному свету, бликам.
+def _face_parse_start(image_bytes, specs, deadline):
+    """Запускает face_parse для всех specs = [(mode, bbox|None), ...] разом.
 
-    Returns:
-        list[dict] | None — список лиц с полями:
-          {bbox: [x1,y1,x2,y2], score, landmarks, width, height,
-           height_ratio, sharpness}
-        отсортирован по height_ratio убыв. (главное лицо первым).
-        None — если сервер недоступен или ошибка.
+    Сначала кэш (в вызывающем потоке — у кэша одно DB-соединение), на
+    промахи — параллельные запросы в пуле. Результат забирает
+    _face_parse_finish; между ними можно делать другую работу.
     """
+    pending = {"image_bytes": image_bytes, "ready": {}, "futures": {}}
     if not FACE_PARSE_PASS:
-        return None
+        pending["ready"] = {spec: None for spec in specs}
+        return pending
+    cache = _mask_cache
+    b64 = None
+    for mode, bbox in specs:
+        spec = (mode, tuple(bbox) if bbox is not None else None)
+        if cache is not None:
+            cached = cache.get(image_bytes, mode, bbox)
+            if cached is not None:
+                pending["ready"][spec] = cached
+                continue
+        if b64 is None:
+            b64 = base64.b64encode(image_bytes).decode('ascii')
+        timeout = _remaining(deadline, FACE_PARSE_TIMEOUT)
+        pending["futures"][spec] = _ai_executor().submit(_request_face_parse, b64, mode, bbox, timeout)
+    return pending
+
+
+def _face_parse_finish(pending, deadline):
+    """Ждёт запросы из _face_parse_start до общего дедлайна.
+
+    Returns:
+        dict {(mode, bbox): маска | None}. None — ошибка или не уложились
+        в дедлайн: вызывающий откатывается на эвристику по этому режиму.
+    """
+    results = dict(pending["ready"])
+    futures = pending["futures"]
+    if futures:
+        done, _ = wait(list(futures.values()), timeout=max(0.0, deadline - time.monotonic()))
+        cache = _mask_cache
+        for spec, fut in futures.items():
+            if fut not in done:
+                # Поток досидит до своего таймаута сам — ответ просто не ждём
+                print(f"[AI MASK] mode={spec[0]} deadline exceeded — heuristic fallback")
+                results[spec] = None
+                continue
+            results[spec] = fut.result()
+            if cache is not None and results[spec] is not None:
+                cache.put(pending["image_bytes"], spec[0], spec[1], results[spec])
+    return results
+
+
+def _face_parse_many(image_bytes, specs, deadline=None):
+    """face_parse по нескольким режимам параллельно, с одним дедлайном."""
+    if deadline is None:
+        deadline = time.monotonic() + FACE_PARSE_DEADLINE
+    return _face_parse_finish(_face_parse_start(image_bytes, specs, deadline), deadline)
+
+
+def _call_ai_face_parse(image_bytes, mode="skin", bbox=None):
+    """Вызывает ИИ-сегментацию на сервере retouch (SegFormer).
+    Возвращает np.uint8 маску (0/255) или None при любой ошибке — тогда
+    вызывающий код откатится на эвристику.
+
+    Если передан bbox=[x1,y1,x2,y2] — SegFormer работает только внутри bbox
+    (намного точнее на сложном свете, тёмных сценах, цветных фонах).
+    Несколько независимых масок — через _face_parse_many (параллельно).
+    """
+    spec = (mode, tuple(bbox) if bbox is not None else None)
+    return _face_parse_many(image_bytes, [spec])[spec]
+
+
+def _request_detect_faces(image_bytes, max_side, min_score, timeout):
     try:
         b64 = base64.b64encode(image_bytes).decode('ascii')
-        r = requests.post(
+        r = _ai_session().post(
             DETECT_FACES_URL,
-            auth=(FACE_PARSE_USER, FACE_PARSE_PASS),
             json={"image": b64, "max_side": max_side, "min_score": min_score},
-            timeout=DETECT_FACES_TIMEOUT,
+            timeout=timeout,
         )
         if r.status_code != 200:
             print(f"[AI FACES] bad status {r.status_code}: {r.text[:200]}")
@@ -99,6 +204,22 @@ def _call_ai_detect_faces(image_bytes, max_side=1280, min_score=0.4):
         return None
 
 
+def _call_ai_detect_faces(image_bytes, max_side=1280, min_score=0.4, timeout=None):
+    """Запрашивает на сервере детектор лиц (SCRFD-10G через InsightFace).
+    Работает по геометрии лица — устойчив к темноте, цветному свету, бликам.
+
+    Returns:
+        list[dict] | None — список лиц с полями:
+          {bbox: [x1,y1,x2,y2], score, landmarks, width, height,
+           height_ratio, sharpness}
+        отсортирован по height_ratio убыв. (главное лицо первым).
+        None — если сервер недоступен или ошибка.
+    """
+    if not FACE_PARSE_PASS:
+        return None
+    return _request_detect_faces(image_bytes, max_side, min_score, timeout or DETECT_FACES_TIMEOUT)
+
+
 def _detect_skin_color(img_arr):
     r = img_arr[:, :, 0].astype(np.float32)
     g = img_arr[:, :, 1].astype(np.float32)
@@ -137,56 +258,27 @@ def _find_face_regions(skin_mask):
     # Max чуть больше Min — результирующее расширение ~2–3px.
     pre_r_max = max(4, int(min(h, w) * 0.008))
     pre_r_min = max(3, int(min(h, w) * 0.006))
-    pre_pil = Image.fromarray(skin_mask, mode='L')
-    pre_pil = pre_pil.filter(ImageFilter.MaxFilter(min(pre_r_max * 2 + 1, 13)))
-    pre_pil = pre_pil.filter(ImageFilter.MinFilter(min(pre_r_min * 2 + 1, 11)))
-    skin_mask = np.array(pre_pil)
+    skin_mask = closing(skin_mask, min(pre_r_max, 6), min(pre_r_min, 5))
 
     step = max(1, min(h, w) // 300)
     small = skin_mask[::step, ::step]
     sh, sw = small.shape
 
-    labels = np.zeros((sh, sw), dtype=np.int32)
-    label_id = 0
-    label_sizes = {}
-
-    visited = set()
-    for y0 in range(0, sh, 4):
-        for x0 in range(0, sw, 4):
-            if small[y0, x0] > 0 and (y0, x0) not in visited:
-                label_id += 1
-                stack = [(y0, x0)]
-                count = 0
-                while stack:
-                    cy, cx = stack.pop()
-                    if (cy, cx) in visited:
-                        continue
-                    if cy < 0 or cy >= sh or cx < 0 or cx >= sw:
-                        continue
-                    if small[cy, cx] == 0:
-                        continue
-                    visited.add((cy, cx))
-                    labels[cy, cx] = label_id
-                    count += 1
-                    if count > 200000:
-                        break
-                    for dy, dx in [(-2, 0), (2, 0), (0, -2), (0, 2)]:
-                        ny, nx = cy + dy, cx + dx
-                        if 0 <= ny < sh and 0 <= nx < sw and (ny, nx) not in visited and small[ny, nx] > 0:
-                            stack.append((ny, nx))
-                label_sizes[label_id] = count
-
-    if not label_sizes:
+    # Связность — соседи через пиксель (как у прежнего обхода с шагом 2),
+    # т.е. 4-связные компоненты сетки small[::2, ::2]. Компоненты любого
+    # размера размечаются целиком, без обрезки.
+    grid = small[::2, ::2]
+    labels, areas, _ = label_components(grid)
+    if len(areas) == 0:
         return skin_mask
 
     # Берём ТОЛЬКО самый большой connected-компонент. Если одежда+кожа
     # связаны через шею, это тоже один компонент, но дальше ограничим bbox'ом.
-    biggest = max(label_sizes, key=label_sizes.get)
+    biggest = int(np.argmax(areas)) + 1
     face_labels = [biggest]
 
     face_small = np.zeros((sh, sw), dtype=np.uint8)
-    for lid in face_labels:
-        face_small[labels == lid] = 255
+    face_small[::2, ::2][labels == biggest] = 255
 
     if step > 1:
         face_pil = Image.fromarray(face_small, mode='L').resize((w, h), Image.NEAREST)
@@ -196,19 +288,18 @@ def _find_face_regions(skin_mask):
 
     # Заполняем дыры (тени, глаза, рот, ЩЕТИНА) через агрессивный closing.
     # Радиус closing зависит от размера кадра — на крупных планах щетинистые
-    # "дыры" в маске достигают 20-30px, нужно большое MaxFilter.
+    # "дыры" в маске достигают 20-30px, нужна большая дилатация.
     close_r = max(9, int(min(h, w) * 0.025))
     close_k = min(close_r * 2 + 1, 51)
     if close_k % 2 == 0:
         close_k += 1
-    face_closed_pil = Image.fromarray(face_small_up, mode='L')
-    # Расширяем (закрываем дыры от щетины и теней)
-    face_closed_pil = face_closed_pil.filter(ImageFilter.MaxFilter(close_k))
-    # Сжимаем обратно, но чуть меньше — чтобы маска осталась с запасом.
+    # Расширяем (закрываем дыры от щетины и теней), затем сжимаем обратно,
+    # но чуть меньше — чтобы маска осталась с запасом.
     shrink_k = max(5, close_k - 6)
     if shrink_k % 2 == 0:
         shrink_k += 1
-    face_closed_pil = face_closed_pil.filter(ImageFilter.MinFilter(shrink_k))
+    face_closed = closing(face_small_up, close_k // 2, shrink_k // 2)
+    face_closed_pil = Image.fromarray(face_closed, mode='L')
     blur_r = max(3, min(h, w) // 200)
     face_closed_pil = face_closed_pil.filter(ImageFilter.GaussianBlur(radius=blur_r))
     face_closed = np.array(face_closed_pil)
@@ -323,10 +414,38 @@ def _exclude_non_skin(img_arr, mask):
     return mask
 
 
+def _grid_integrals(values, mask, ys, xs):
+    """Таблицы сумм (summed-area tables) value·mask, value²·mask и mask,
+    но только в узлах сетки ys × xs — больше для оконной статистики не
+    нужно. Кадр проходится полосами между соседними ys, поэтому в памяти
+    никогда нет полноразмерной float64-копии.
+
+    Returns: (3, len(ys), len(xs)) float64 — суммы по прямоугольнику
+    [0:ys[i], 0:xs[j]].
+    """
+    w = values.shape[1]
+    rows = np.zeros((3, len(ys), w), dtype=np.float64)
+    acc = np.zeros((3, w), dtype=np.float64)
+    for k in range(len(ys) - 1):
+        band_m = mask[ys[k]:ys[k + 1]]
+        band_v = np.where(band_m, values[ys[k]:ys[k + 1]], 0).astype(np.float64)
+        acc[0] += band_v.sum(axis=0)
+        acc[1] += (band_v * band_v).sum(axis=0)
+        acc[2] += band_m.sum(axis=0)
+        rows[:, k + 1] = acc
+    cols = np.zeros((3, len(ys), w + 1), dtype=np.float64)
+    np.cumsum(rows, axis=2, out=cols[:, :, 1:])
+    return cols[:, :, xs]
+
+
 def _local_stats(values, skin_mask, tile=64):
     """Локальное среднее/std по тайлам с ПЕРЕКРЫТИЕМ, затем апсемпл +
     сильное гауссово сглаживание. Так граница между тайлами перестаёт
     проявляться в маске как резкая "ступенька" на лице.
+
+    Суммы по окнам тайлов берутся из таблиц сумм (_grid_integrals): четыре
+    обращения на тайл вместо булевой выборки и np.mean/np.std в цикле —
+    цена не зависит ни от размера тайла, ни от их числа.
     """
     h, w = values.shape
     # Перекрывающиеся тайлы: шаг = tile/2, окно = tile.
@@ -334,26 +453,29 @@ def _local_stats(values, skin_mask, tile=64):
     ty = max(1, (h + step - 1) // step)
     tx = max(1, (w + step - 1) // step)
 
-    means = np.zeros((ty, tx), dtype=np.float32)
-    stds = np.zeros((ty, tx), dtype=np.float32)
-
-    for i in range(ty):
-        for j in range(tx):
-            cy = i * step
-            cx = j * step
-            y1 = max(0, cy - tile // 2)
-            y2 = min(h, cy + tile // 2 + step)
-            x1 = max(0, cx - tile // 2)
-            x2 = min(w, cx + tile // 2 + step)
-            block_vals = values[y1:y2, x1:x2]
-            block_mask = skin_mask[y1:y2, x1:x2] > 0
-            if np.count_nonzero(block_mask) > 30:
-                v = block_vals[block_mask]
-                means[i, j] = np.mean(v)
-                stds[i, j] = max(5, np.std(v))
-            else:
-                means[i, j] = np.nan
-                stds[i, j] = np.nan
+    cy = np.arange(ty) * step
+    cx = np.arange(tx) * step
+    y1 = np.maximum(0, cy - tile // 2)
+    y2 = np.minimum(h, cy + tile // 2 + step)
+    x1 = np.maximum(0, cx - tile // 2)
+    x2 = np.minimum(w, cx + tile // 2 + step)
+
+    ys = np.unique(np.concatenate(([0, h], y1, y2)))
+    xs = np.unique(np.concatenate(([0, w], x1, x2)))
+    sat = _grid_integrals(values, skin_mask > 0, ys, xs)
+    iy1, iy2 = np.searchsorted(ys, y1), np.searchsorted(ys, y2)
+    ix1, ix2 = np.searchsorted(xs, x1), np.searchsorted(xs, x2)
+    sums = (sat[:, iy2][:, :, ix2] - sat[:, iy1][:, :, ix2]
+            - sat[:, iy2][:, :, ix1] + sat[:, iy1][:, :, ix1])
+    del sat
+    s1, s2, count = sums
+
+    valid = count > 30
+    n = np.maximum(count, 1)
+    mean = s1 / n
+    var = np.maximum(s2 / n - mean * mean, 0.0)
+    means = np.where(valid, mean, np.nan).astype(np.float32)
+    stds = np.where(valid, np.maximum(5, np.sqrt(var)), np.nan).astype(np.float32)
 
     # Итеративно заполним NaN соседями — избегаем «дырок» там, где
     # тайл пустой (вне маски лица), чтобы после blur не было тёмных пятен.
@@ -377,38 +499,31 @@ def _local_stats(values, skin_mask, tile=64):
     mean_img = _upsample(means, w, h)
     std_img = _upsample(stds, w, h)
 
-    # Сглаживание через собственную separable-гауссову свёртку numpy —
+    # Сглаживание на месте через gauss_blur (numpy, float32) —
     # избегаем проблем с режимом 'F' в PIL и гарантированно убираем
     # "ступеньки" на границах тайлов.
     smooth_r = max(16, tile // 2)
-    mean_img = _gaussian_blur_np(mean_img, smooth_r)
-    std_img = _gaussian_blur_np(std_img, smooth_r)
+    _gaussian_blur_np(mean_img, smooth_r, out=mean_img)
+    _gaussian_blur_np(std_img, smooth_r, out=std_img)
     return mean_img, std_img
 
 
-def _gaussian_blur_np(arr, radius):
-    """Быстрый сепарабельный гауссов блюр на numpy (без SciPy)."""
+def _gaussian_blur_np(arr, radius, out=None):
+    """Гауссов блюр с σ=radius/2 и ядром, обрезанным на ±radius.
+    Короткие ядра сворачиваются напрямую, длинные — каскадом box-фильтров
+    (gauss_blur) с той же дисперсией: цена на пиксель не растёт с радиусом.
+    out=arr — на месте, без копии кадра.
+    """
     if radius <= 0:
         return arr.astype(np.float32)
     sigma = float(radius) / 2.0
     k = int(max(3, radius * 2 + 1))
-    x = np.arange(k, dtype=np.float32) - (k - 1) / 2.0
+    x = np.arange(k, dtype=np.float64) - (k - 1) / 2.0
     kernel = np.exp(-(x * x) / (2.0 * sigma * sigma))
     kernel /= kernel.sum()
-    # Конволюция по строкам, потом по столбцам.
-    pad = (k - 1) // 2
-    a = arr.astype(np.float32)
-    # По оси X
-    ap = np.pad(a, ((0, 0), (pad, pad)), mode='edge')
-    tmp = np.zeros_like(a)
-    for i, w in enumerate(kernel):
-        tmp += ap[:, i:i + a.shape[1]] * w
-    # По оси Y
-    ap2 = np.pad(tmp, ((pad, pad), (0, 0)), mode='edge')
-    out = np.zeros_like(a)
-    for i, w in enumerate(kernel):
-        out += ap2[i:i + a.shape[0], :] * w
-    return out
+    if k <= BLUR_DIRECT_TAPS:
+        return convolve_separable(arr, kernel, out=out)
+    return gaussian_blur(arr, float(np.sqrt(np.sum(kernel * x * x))), out=out)
 
 
 def _dog_response(channel, sigma_small, sigma_large):
@@ -417,8 +532,8 @@ def _dog_response(channel, sigma_small, sigma_large):
     Ровная краснота, щетина и шум на этом масштабе ≈ 0.
     """
     s = _gaussian_blur_np(channel, max(1, int(sigma_small)))
-    L = _gaussian_blur_np(channel, max(1, int(sigma_large)))
-    return s - L
+    s -= _gaussian_blur_np(channel, max(1, int(sigma_large)))
+    return s
 
 
 def _detect_defects(img_arr, skin_mask):
@@ -490,10 +605,7 @@ def _detect_defects(img_arr, skin_mask):
 
     # Расширяем зону щетины с запасом, чтобы прыщи между волосками тоже
     # не попадали в маску (LaMa там сгладит щетину).
-    stubble_pil = Image.fromarray(
-        (stubble_zone.astype(np.uint8) * 255), mode='L'
-    ).filter(ImageFilter.MaxFilter(7))
-    stubble_zone = np.array(stubble_pil) > 0
+    stubble_zone = dilate(stubble_zone, 3)
 
     # Дефекты = пики, но НЕ в зоне щетины (там оставляем кожу как есть).
     # Красные пики оставляем даже в щетине — это явные воспаления.
@@ -507,10 +619,7 @@ def _detect_defects(img_arr, skin_mask):
     if max_k % 2 == 0:
         max_k += 1
     max_k = min(max_k, 21)  # лимит 21px чтобы не раздувать тени
-    peaks_pil = Image.fromarray(peaks, mode='L').filter(
-        ImageFilter.MaxFilter(max_k)
-    )
-    defects = np.array(peaks_pil)
+    defects = dilate(peaks, max_k // 2)
     defects = np.minimum(defects, skin_mask)
     stubble_cnt = int(np.count_nonzero(stubble_zone))
 
@@ -518,12 +627,7 @@ def _detect_defects(img_arr, skin_mask):
     # ~30px — это уже не прыщ, а тень/брови/складка).
     before_blob = int(np.count_nonzero(defects))
     blob_r = max(8, int(min(h, w) * 0.018))
-    erode_pil = Image.fromarray(defects, mode='L')
-    for _ in range(blob_r):
-        erode_pil = erode_pil.filter(ImageFilter.MinFilter(3))
-    for _ in range(blob_r + 2):
-        erode_pil = erode_pil.filter(ImageFilter.MaxFilter(3))
-    big_blobs = np.array(erode_pil)
+    big_blobs = opening(defects, blob_r, blob_r + 2)
     defects = np.where(big_blobs > 0, 0, defects).astype(np.uint8)
     after_blob = int(np.count_nonzero(defects))
 
@@ -541,13 +645,11 @@ def _detect_defects(img_arr, skin_mask):
 def _dilate_mask(mask, px):
     if px <= 0:
         return mask
-    m = Image.fromarray(mask, mode='L')
-    # Два прохода: crude dilate + closing для склейки соседних пятен.
-    for _ in range(max(1, px // 2)):
-        m = m.filter(ImageFilter.MaxFilter(min(px * 2 + 1, 13)))
-    # Closing: dilate затем erode — заполняет мелкие промежутки
-    m = m.filter(ImageFilter.MaxFilter(5)).filter(ImageFilter.MinFilter(3))
-    return np.array(m)
+    # Два прохода: crude dilate (раньше — px // 2 итераций MaxFilter с
+    # радиусом до 6) + closing для склейки соседних пятен: dilate на 2,
+    # erode на 1 — заполняет мелкие промежутки.
+    grow = min(px, 6) * max(1, px // 2)
+    return closing(mask, grow + 2, 1)
 
 
 def build_face_skin_mask(image_bytes):
@@ -558,21 +660,20 @@ def build_face_skin_mask(image_bytes):
     Сначала пробует ИИ (SegFormer face-parsing на сервере), при недоступности —
     откат на YCrCb-эвристику.
     """
-    # ИИ-маска: точная, разделяет кожу/волосы/одежду/глаза.
-    ai_mask = _call_ai_face_parse(image_bytes, mode="skin")
+    # ИИ-маска: точная, разделяет кожу/волосы/одежду/глаза. skin и protect
+    # независимы — запрашиваем параллельно, с одним дедлайном на обе.
+    ai = _face_parse_many(image_bytes, [("skin", None), ("protect", None)])
+    ai_mask = ai[("skin", None)]
     if ai_mask is not None:
         # Вычитаем "защищённые" зоны (губы/глаза/брови/волосы/одежда/очки) —
         # расширенные с буфером, чтобы в композиции они остались оригинальными.
-        protect = _call_ai_face_parse(image_bytes, mode="protect")
+        protect = ai[("protect", None)]
         if protect is not None:
             h_arr, w_arr = ai_mask.shape
             # Умеренное расширение protect-зон (0.004 → 0.006). Этого достаточно
             # для защиты губ/глаз/зубов, без RGB-ореолов как при 0.012.
             expand_r = max(4, int(min(h_arr, w_arr) * 0.006))
-            pp = Image.fromarray(protect, mode='L').filter(
-                ImageFilter.MaxFilter(min(expand_r * 2 + 1, 19))
-            )
-            protect_exp = np.array(pp)
+            protect_exp = dilate(protect, min(expand_r, 9))
             ai_mask = np.where(protect_exp > 128, 0, ai_mask).astype(np.uint8)
         # Лёгкое сглаживание краёв, чтобы не было ступенек.
         m = Image.fromarray(ai_mask, mode='L').filter(ImageFilter.GaussianBlur(radius=1.5))
@@ -597,12 +698,10 @@ def build_face_skin_mask(image_bytes):
     # Closing: заполняем мелкие дыры (глаза, рот, тени под бровями),
     # но с радиусом, который НЕ надувает маску в чёлку и нос.
     close_r = max(4, int(min(h, w) * 0.007))
-    m = Image.fromarray(face_skin, mode='L')
-    m = m.filter(ImageFilter.MaxFilter(min(close_r * 2 + 1, 13)))
-    m = m.filter(ImageFilter.MinFilter(min(close_r * 2 + 1, 13)))
+    m = closing(face_skin, min(close_r, 6))
     # Финальная лёгкая эрозия по периметру — убираем «заход» в чёлку/волосы.
     erode_r = max(2, int(min(h, w) * 0.004))
-    m = m.filter(ImageFilter.MinFilter(min(erode_r * 2 + 1, 7)))
+    m = Image.fromarray(erode(m, min(erode_r, 3)), mode='L')
     # Мягкое сглаживание границ.
     m = m.filter(ImageFilter.GaussianBlur(radius=2))
     face_skin = np.array(m)
@@ -625,22 +724,21 @@ def build_auto_mask(image_bytes):
     del img
 
     # === ИИ-путь: быстро и точно. Возвращаем ЧИСТУЮ маску кожи без DoG. ===
-    ai_face_skin = _call_ai_face_parse(image_bytes, mode="skin")
+    ai = _face_parse_many(image_bytes, [("skin", None), ("protect", None)])
+    ai_face_skin = ai[("skin", None)]
+    protect = ai[("protect", None)]
+    del ai
     if ai_face_skin is not None:
-        # Освобождаем большой numpy перед вторым тяжёлым AI-запросом.
+        # Кадр для эвристики больше не нужен — освобождаем большой numpy.
         del img_arr
         gc.collect()
 
         # Вычитаем защищённые зоны (губы/глаза/брови/волосы/одежда/очки).
-        protect = _call_ai_face_parse(image_bytes, mode="protect")
         if protect is not None:
             expand_r = max(3, int(min(h, w) * 0.004))
-            pp = Image.fromarray(protect, mode='L').filter(
-                ImageFilter.MaxFilter(min(expand_r * 2 + 1, 15))
-            )
-            protect_np = np.array(pp)
+            protect_np = dilate(protect, min(expand_r, 7))
             face_skin = np.where(protect_np > 128, 0, ai_face_skin).astype(np.uint8)
-            del pp, protect_np, protect
+            del protect_np, protect
         else:
             face_skin = ai_face_skin.copy()
         del ai_face_skin
@@ -679,7 +777,7 @@ def build_auto_mask(image_bytes):
     expanded = _dilate_mask(defects, dilate_px)
     expanded = np.minimum(expanded, face_skin)
 
-    # Смягчаем края маски — иначе прямоугольные ядра MaxFilter оставляют
+    # Смягчаем края маски — иначе квадратные окна дилатации оставляют
     # угловатые следы на коже после инпейнта.
     soft_r = max(2, dilate_px // 3)
     soft = np.array(
@@ -702,10 +800,7 @@ def build_auto_mask(image_bytes):
         sm, ss = np.mean(sp), max(8, np.std(sp))
         # Мягче порог: 1.8·std вместо 2.3·std, чтобы fallback не обнулял маску.
         strict = ((gray < sm - 1.8 * ss) & (face_skin > 0)).astype(np.uint8) * 255
-        strict_pil = Image.fromarray(strict, mode='L')
-        strict = np.array(strict_pil.filter(ImageFilter.MinFilter(3)))
-        strict_pil2 = Image.fromarray(strict, mode='L')
-        strict = np.array(strict_pil2.filter(ImageFilter.MaxFilter(3)))
+        strict = opening(strict, 1)
         strict_expanded = _dilate_mask(strict, dilate_px)
         strict_expanded = np.minimum(strict_expanded, face_skin)
         strict_pct = np.count_nonzero(strict_expanded) * 100 / (h * w)
@@ -990,6 +1085,11 @@ def analyze_faces_via_server(image_bytes, h_full, w_full):
            area_px, height_ratio, sharpness, score, landmarks, in_focus, is_largest}
     """
     server_faces = _call_ai_detect_faces(image_bytes, max_side=1280, min_score=0.4)
+    return _faces_from_server(server_faces, h_full, w_full)
+
+
+def _faces_from_server(server_faces, h_full, w_full):
+    """Ответ detect_faces → лица с пометкой in_focus (см. analyze_faces_via_server)."""
     if server_faces is None:
         return None
     if not server_faces:
@@ -1070,7 +1170,17 @@ def build_focus_mask_via_server(image_bytes, orig_img_arr):
         (mask_uint8, info_dict) или (None, None) при ошибке сервера.
     """
     h, w = orig_img_arr.shape[:2]
-    faces = analyze_faces_via_server(image_bytes, h, w)
+    deadline = time.monotonic() + DETECT_FACES_TIMEOUT + FACE_PARSE_DEADLINE
+    # protect нужен по всему кадру и от лиц не зависит — запрашиваем его
+    # параллельно с детектором, а маски лиц — параллельно друг другу.
+    protect_pending = _face_parse_start(image_bytes, [("protect", None)], deadline)
+    detect = _ai_executor().submit(
+        _call_ai_detect_faces, image_bytes, 1280, 0.4, _remaining(deadline, DETECT_FACES_TIMEOUT),
+    )
+    done, _ = wait([detect], timeout=max(0.0, deadline - time.monotonic()))
+    if detect not in done:
+        print("[AI FACES] deadline exceeded — heuristic fallback")
+    faces = _faces_from_server(detect.result() if detect in done else None, h, w)
     if faces is None:
         return None, None  # сервер не ответил — пусть вызывающий упадёт на fallback
 
@@ -1096,14 +1206,15 @@ def build_focus_mask_via_server(image_bytes, orig_img_arr):
     combined = np.zeros((h, w), dtype=np.uint8)
     bbox_only = np.zeros((h, w), dtype=np.uint8)  # на случай если SegFormer вернёт пусто
     succeed = 0
-    for f in focus_faces:
+    face_specs = [("skin", (l, t, r, b)) for t, b, l, r in (f['bbox'] for f in focus_faces)]
+    face_masks = _face_parse_many(image_bytes, face_specs, deadline)
+    for f, spec in zip(focus_faces, face_specs):
         t, b, l, r = f['bbox']
         # Пометим bbox как fallback (мягкий эллипс по bbox).
         # Если SegFormer вернул пустоту — хоть что-то будет.
         bbox_only[t:b, l:r] = 255
 
-        bbox_xyxy = [l, t, r, b]
-        face_skin = _call_ai_face_parse(image_bytes, mode="skin", bbox=bbox_xyxy)
+        face_skin = face_masks[spec]
         if face_skin is None:
             continue
         # Размер маски от сервера должен совпадать с h×w (мы отдали полный кадр).
@@ -1124,19 +1235,16 @@ def build_focus_mask_via_server(image_bytes, orig_img_arr):
 
     # Вычитаем "защищённые" зоны (губы/глаза/брови/волосы/одежда) — общим вызовом.
     # Это эффективнее, чем по каждому bbox: protect нужен по всему кадру.
+    protect = _face_parse_finish(protect_pending, deadline)[("protect", None)]
     if succeed > 0 and combined.max() > 0:
         try:
-            protect = _call_ai_face_parse(image_bytes, mode="protect")
             if protect is not None:
                 if protect.shape != (h, w):
                     protect = np.array(
                         Image.fromarray(protect, mode='L').resize((w, h), Image.NEAREST)
                     )
                 expand_r = max(3, int(min(h, w) * 0.004))
-                pp = Image.fromarray(protect, mode='L').filter(
-                    ImageFilter.MaxFilter(min(expand_r * 2 + 1, 15))
-                )
-                protect_exp = np.array(pp)
+                protect_exp = dilate(protect, min(expand_r, 7))
                 combined = np.where(protect_exp > 128, 0, combined).astype(np.uint8)
         except Exception as e:
             print(f"[FOCUS MASK] protect step failed (non-critical): {e}")
@@ -1,11 +1,32 @@
+import hmac
 import json
 import os
 import time
 from urllib import request as urlreq
+import psycopg2
+from psycopg2.extras import RealDictCursor
 import requests
 
 
 RETOUCH_BASE_URL = os.environ.get("RETOUCH_BASE_URL", "").rstrip("/")
+SCHEMA = "t_p28211681_photo_secure_web"
+ACTIVE_STATUSES = ("queued", "started", "processing", "pending")
+
+# Контроллер (?action=control, таймер раз в минуту):
+# VM гасится, если задач нет столько минут подряд и прогноз пуст
+IDLE_STOP_MINUTES = int(os.environ.get("RETOUCH_IDLE_STOP_MINUTES", "20"))
+# Только что поднятую VM не гасим — загрузка дороже пары минут простоя
+MIN_UPTIME_MINUTES = 10
+# Поток задач: сколько минут назад смотреть на новые задачи
+ARRIVAL_WINDOW_MINUTES = 5
+# Прогноз: задачи в окне [сейчас, сейчас + lead] в тот же день недели
+# за HISTORY_WEEKS прошлых недель; lead = ожидаемая загрузка + запас
+HISTORY_WEEKS = 4
+PREWARM_MIN_TASKS = float(os.environ.get("RETOUCH_PREWARM_MIN_TASKS", "2"))
+PREWARM_MARGIN_MINUTES = 5
+DEFAULT_BOOT_SECONDS = 180
+# ?action=control по HTTP — только с этим токеном (таймер-триггер — без)
+RETOUCH_CONTROL_SECRET = os.environ.get("RETOUCH_CONTROL_SECRET", "")
 
 YC_INSTANCE_ID = os.environ.get("YC_INSTANCE_ID", "")
 YC_OAUTH_TOKEN = os.environ.get("YC_OAUTH_TOKEN", "")
@@ -56,6 +77,165 @@ def _get_vm_status(iam):
     ).get("status", "UNKNOWN")
 
 
+def _stop_vm(iam):
+    return _yc_http(
+        "POST",
+        f"{COMPUTE_BASE}/instances/{YC_INSTANCE_ID}:stop",
+        headers={"Authorization": f"Bearer {iam}"},
+    )
+
+
+def _db():
+    return psycopg2.connect(os.environ["DATABASE_URL"])
+
+
+def _open_boot(conn, trigger):
+    """Запоминает момент старта VM — от него считается boot-to-healthy."""
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            INSERT INTO {SCHEMA}.retouch_vm_boots (trigger) VALUES (%s)
+        """, (trigger,))
+    conn.commit()
+
+
+def _close_boot(conn):
+    """VM ответила на /health — закрывает открытый запуск. Возвращает boot_ms."""
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            UPDATE {SCHEMA}.retouch_vm_boots
+            SET healthy_at = NOW(),
+                boot_ms = (EXTRACT(EPOCH FROM NOW() - started_at) * 1000)::int
+            WHERE healthy_at IS NULL AND stopped_at IS NULL
+              AND started_at > NOW() - INTERVAL '30 minutes'
+            RETURNING boot_ms
+        """)
+        row = cur.fetchone()
+    conn.commit()
+    if row:
+        print(f"[BOOT] VM healthy after {row[0]} ms")
+    return row[0] if row else None
+
+
+def _boot_stats(conn):
+    """Текущий запуск (если VM грузится) и медиана последних загрузок."""
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute(f"""
+            SELECT
+                (SELECT EXTRACT(EPOCH FROM NOW() - started_at) FROM {SCHEMA}.retouch_vm_boots
+                 WHERE healthy_at IS NULL AND stopped_at IS NULL
+                   AND started_at > NOW() - INTERVAL '30 minutes'
+                 ORDER BY started_at DESC LIMIT 1) AS booting_s,
+                (SELECT EXTRACT(EPOCH FROM NOW() - MAX(started_at)) / 60 FROM {SCHEMA}.retouch_vm_boots
+                 WHERE stopped_at IS NULL) AS uptime_min,
+                (SELECT percentile_cont(0.5) WITHIN GROUP (ORDER BY boot_ms) / 1000.0
+                 FROM (SELECT boot_ms FROM {SCHEMA}.retouch_vm_boots
+                       WHERE boot_ms IS NOT NULL ORDER BY started_at DESC LIMIT 20) b) AS expected_s
+        """)
+        row = cur.fetchone()
+    return {
+        "booting_s": float(row["booting_s"]) if row["booting_s"] is not None else None,
+        "uptime_min": float(row["uptime_min"]) if row["uptime_min"] is not None else None,
+        "expected_s": float(row["expected_s"] or DEFAULT_BOOT_SECONDS),
+    }
+
+
+def _demand(conn, lead_minutes):
+    """Спрос на GPU: задачи в работе, очередь пакетной ретуши, поток за
+    последние минуты, минуты с последней активности и прогноз на lead."""
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute(f"""
+            SELECT
+                (SELECT COUNT(*) FROM {SCHEMA}.retouch_tasks
+                 WHERE status IN %s AND created_at > NOW() - INTERVAL '10 minutes') AS active,
+                (SELECT COUNT(*) FROM {SCHEMA}.retouch_queue
+                 WHERE status IN ('queued', 'submitting')) AS queued,
+                (SELECT COUNT(*) FROM {SCHEMA}.retouch_tasks
+                 WHERE created_at > NOW() - make_interval(mins => %s)) AS arrivals,
+                (SELECT EXTRACT(EPOCH FROM NOW() - MAX(updated_at)) / 60
+                 FROM {SCHEMA}.retouch_tasks) AS idle_min,
+                (SELECT COUNT(*)::float / %s FROM {SCHEMA}.retouch_tasks t
+                 JOIN generate_series(1, %s) AS w(n)
+                   ON t.created_at >= NOW() - make_interval(weeks => w.n)
+                  AND t.created_at < NOW() - make_interval(weeks => w.n) + make_interval(mins => %s)
+                ) AS predicted
+        """, (ACTIVE_STATUSES, ARRIVAL_WINDOW_MINUTES, HISTORY_WEEKS, HISTORY_WEEKS, lead_minutes))
+        row = cur.fetchone()
+    return {
+        "active": int(row["active"]),
+        "queued": int(row["queued"]),
+        "arrivals": int(row["arrivals"]),
+        "idle_min": float(row["idle_min"]) if row["idle_min"] is not None else None,
+        "predicted": round(float(row["predicted"] or 0), 2),
+    }
+
+
+def _decide(vm_status, demand, uptime_min):
+    """Что делать с VM: (действие, причина). Действие — start/stop/keep."""
+    for reason, wanted in (("demand", demand["active"] or demand["queued"]),
+                           ("prewarm", demand["predicted"] >= PREWARM_MIN_TASKS)):
+        if wanted:
+            return ("start" if vm_status == "STOPPED" else "keep"), reason
+    if vm_status != "RUNNING":
+        return "keep", "idle"
+    if demand["arrivals"]:
+        return "keep", "arrivals"
+    if demand["idle_min"] is not None and demand["idle_min"] < IDLE_STOP_MINUTES:
+        return "keep", "warm"
+    if uptime_min is not None and uptime_min < MIN_UPTIME_MINUTES:
+        return "keep", "min_uptime"
+    return "stop", "idle"
+
+
+def _handle_control():
+    """Предиктивное управление VM по очереди retouch_tasks / retouch_queue.
+
+    Загрузку VM не ждёт: старт записывается в retouch_vm_boots, а закрывает
+    замер следующий тик контроллера (или ?probe=1), когда /health ответит.
+    """
+    err = _ensure_credentials()
+    if err:
+        return err
+    conn = _db()
+    try:
+        boot = _boot_stats(conn)
+        lead = int(boot["expected_s"] // 60) + PREWARM_MARGIN_MINUTES
+        demand = _demand(conn, lead)
+        iam = _get_iam_token()
+        st = _get_vm_status(iam)
+        action, reason = _decide(st, demand, boot["uptime_min"])
+        print(f"[CONTROL] VM={st} demand={demand} boot={boot} -> {action} ({reason})")
+
+        result = {"status": st, "action": action, "reason": reason, "demand": demand,
+                  "expected_boot_s": round(boot["expected_s"], 1)}
+        if action == "start":
+            op = _yc_http(
+                "POST",
+                f"{COMPUTE_BASE}/instances/{YC_INSTANCE_ID}:start",
+                headers={"Authorization": f"Bearer {iam}"},
+            )
+            _open_boot(conn, reason)
+            result["operationId"] = op.get("id")
+        elif action == "stop":
+            op = _stop_vm(iam)
+            with conn.cursor() as cur:
+                cur.execute(f"""
+                    UPDATE {SCHEMA}.retouch_vm_boots SET stopped_at = NOW() WHERE stopped_at IS NULL
+                """)
+            conn.commit()
+            result["operationId"] = op.get("id")
+        elif st == "RUNNING" and boot["booting_s"] is not None:
+            # VM загружается (с прошлого тика или после wake) — одна проверка
+            # /health, без ожидания: не ответила — закроет следующий тик
+            if _probe_health().get("reachable"):
+                result["boot_ms"] = _close_boot(conn)
+        return _response(200, result)
+    except Exception as e:
+        print(f"[CONTROL] Error: {e}")
+        return _response(500, {"error": str(e)})
+    finally:
+        conn.close()
+
+
 def _ensure_credentials():
     if not YC_INSTANCE_ID:
         return _response(500, {"error": "YC_INSTANCE_ID not configured"})
@@ -86,6 +266,7 @@ def _handle_wake():
                 f"{COMPUTE_BASE}/instances/{YC_INSTANCE_ID}:start",
                 headers={"Authorization": f"Bearer {iam}"},
             )
+            _record_boot_start("wake")
             return _response(200, {"action": "starting", "statusBefore": st, "operationId": op.get("id")})
         except Exception as e:
             return _response(500, {"error": f"Start: {e}"})
@@ -96,6 +277,39 @@ def _handle_wake():
     return _response(200, {"action": "noop", "status": st})
 
 
+def _record_boot_start(trigger):
+    try:
+        conn = _db()
+        try:
+            _open_boot(conn, trigger)
+        finally:
+            conn.close()
+    except Exception as e:
+        print(f"[BOOT] Failed to record boot start: {e}")
+
+
+def _probe_boot(health):
+    """Для ?probe=1: закрывает замер загрузки, если VM ответила, иначе —
+    сколько VM уже грузится и сколько обычно занимает загрузка."""
+    try:
+        conn = _db()
+        try:
+            if health.get("reachable"):
+                boot_ms = _close_boot(conn)
+                return {"in_progress": False, "boot_ms": boot_ms}
+            stats = _boot_stats(conn)
+            return {
+                "in_progress": stats["booting_s"] is not None,
+                "elapsed_s": round(stats["booting_s"], 1) if stats["booting_s"] is not None else None,
+                "expected_s": round(stats["expected_s"], 1),
+            }
+        finally:
+            conn.close()
+    except Exception as e:
+        print(f"[BOOT] Boot stats unavailable: {e}")
+        return None
+
+
 def _probe_health():
     if not RETOUCH_BASE_URL:
         return {"reachable": False, "error": "RETOUCH_BASE_URL is empty"}
@@ -114,7 +328,12 @@ def _probe_health():
 
 
 def handler(event: dict, context) -> dict:
-    """Пробуждение сервера ретуши — запуск VM и проверка здоровья."""
+    """Пробуждение сервера ретуши — запуск VM и проверка здоровья.
+
+    Таймер-триггер (и ?action=control&token=...) — контроллер: по очереди
+    задач и прогнозу по истории сам включает VM заранее, держит тёплой,
+    пока идут задачи, и гасит после IDLE_STOP_MINUTES простоя.
+    """
     method = event.get("httpMethod", "GET")
 
     if method == "OPTIONS":
@@ -122,11 +341,24 @@ def handler(event: dict, context) -> dict:
 
     params = event.get("queryStringParameters", {}) or {}
 
+    # Таймер-триггер приходит без httpMethod
+    if "httpMethod" not in event:
+        return _handle_control()
+
+    if params.get("action") == "control":
+        token = params.get("token") or ""
+        if not RETOUCH_CONTROL_SECRET or not hmac.compare_digest(token, RETOUCH_CONTROL_SECRET):
+            return _response(403, {"error": "Invalid control token"})
+        return _handle_control()
+
     if params.get("action") == "wake":
         return _handle_wake()
 
     if params.get("probe") == "1":
         result = _probe_health()
+        boot = _probe_boot(result)
+        if boot is not None:
+            result["boot"] = boot
         return _response(200, {"probe": result})
 
-    return _response(400, {"error": "Unknown action — use ?action=wake or ?probe=1"})
\ No newline at end of file
+    return _response(400, {"error": "Unknown action — use ?action=wake, ?action=control or ?probe=1"})
\ No newline at end of file
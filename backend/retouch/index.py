@@ -1,19 +1,29 @@
+import time
+# Отсчёт холодного старта — до первого импорта (см. _startup_report)
+_IMPORT_STARTED = time.perf_counter()
+
 import json
 import os
 import io
-import time
+import sys
 import base64
 import uuid
+import hmac
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 from typing import Dict, Any
 import psycopg2
 from psycopg2.extras import RealDictCursor
 import requests
-import boto3
-from botocore.client import Config
-from PIL import Image, ImageOps  # ImageFilter и numpy вынесены в retouch-compose
+from stage_timer import Trace, span, record as record_stage
+import retouch_queue
 
 
-RETOUCH_CODE_VERSION = "v8-2026-05-25-COMPOSE-EXTRACTED-TO-SEPARATE-FN"
+# Pillow и boto3 импортируются внутри функций, которым они нужны: опрос
+# статуса (самый частый вызов) обходится psycopg2 + requests, и свежий
+# инстанс под него поднимается без импорта стека обработки изображений.
+# Что реально загрузил первый вызов — в отчёте _startup_report.
+RETOUCH_CODE_VERSION = "v9-2026-10-16-LAZY-IMPORTS"
 print(f"[RETOUCH] Code version: {RETOUCH_CODE_VERSION}")
 
 RAW_EXTENSIONS = ('.cr2', '.cr3', '.nef', '.arw', '.dng', '.orf', '.rw2', '.raw', '.raf')
@@ -42,6 +52,7 @@ def _open_image_oriented(image_bytes):
     """Открывает фото и применяет EXIF Orientation (вертикальные кадры
     остаются вертикальными). Возвращает RGB Image.
     """
+    from PIL import Image, ImageOps
     img = Image.open(io.BytesIO(image_bytes))
     try:
         img = ImageOps.exif_transpose(img)
@@ -59,24 +70,90 @@ RETOUCH_BASIC_PASS = os.environ.get("RETOUCH_BASIC_PASS", "")
 MAX_ACTIVE_TASKS_PER_USER = 10
 DEFAULT_STRENGTH = 0.6
 DEFAULT_ENHANCE_FACE = False
+# url — API ретуши получает presigned GET исходника и presigned PUT для
+# результата и сам читает/пишет S3; base64 — картинка в теле запроса
+RETOUCH_SUBMIT_MODE = os.environ.get("RETOUCH_SUBMIT_MODE", "url")
+# Ссылки живут дольше, чем задача может провисеть в processing (5 мин)
+TASK_URL_TTL = 900
+# Сколько байт начала файла читаем, чтобы узнать формат и EXIF Orientation:
+# у JPEG заголовок и APP1 (EXIF, до 64 КБ) идут первыми
+SOURCE_PROBE_BYTES = 256 * 1024
+# Ответы /submit, которые означают «ссылки не поддерживаются» — тогда base64
+SUBMIT_URL_REJECTED = (400, 404, 415, 422)
+ACTIVE_STATUSES = ('queued', 'started', 'processing', 'pending')
+# Батч-опрос статусов: все запросы к API идут параллельно и укладываются
+# в один общий дедлайн; не успевшие задачи отдаются со статусом из БД
+STATUS_POLL_DEADLINE = float(os.environ.get("STATUS_POLL_DEADLINE", "8"))
+STATUS_POOL_SIZE = 8
+# Колбэк о завершении: сервер ретуши дёргает ?action=callback&token=...
+# Пока колбэк включён, свежие задачи в API не опрашиваем — статус
+# обновит колбэк; после CALLBACK_TRUST_SECONDS опрос страхует потерянный.
+RETOUCH_CALLBACK_URL = os.environ.get("RETOUCH_CALLBACK_URL", "")
+RETOUCH_CALLBACK_SECRET = os.environ.get("RETOUCH_CALLBACK_SECRET", "")
+# Токен функции retouch-compose (её ?token=); без него композиции нет
+RETOUCH_COMPOSE_SECRET = os.environ.get("RETOUCH_COMPOSE_SECRET", "")
+CALLBACK_TRUST_SECONDS = 90
+# Поля retouch_tasks, нужные _sync_tasks_from_api / _apply_api_status
+TASK_COLUMNS = ('task_id, photo_id, status, result_key, result_url, in_key, result_upload_key, '
+                'error_message, retry_count, preset, created_at, updated_at')
+
+# Раздача пакетной очереди: сколько секунд вызова на неё тратить.
+# При опросе статуса/колбэке — немного (ответ фронту не должен ждать),
+# в ?action=dispatch от таймера — почти весь лимит функции.
+DISPATCH_POLL_BUDGET = 5
+DISPATCH_TIMER_BUDGET = 240
+# Таймауты POST /submit (connect, read); в диспетчере урезаются до остатка
+# бюджета, а фото не начинаем, если от бюджета осталось меньше минимума
+SUBMIT_TIMEOUT = (30, 120)
+DISPATCH_MIN_SUBMIT_SEC = 2
+# Композиция результата (retouch-compose) — не в опросе статуса, а в колбэке
+# и в начале таймерного ?action=dispatch (не дольше COMPOSE_TIMER_BUDGET)
+COMPOSE_TIMEOUT = (5, 120)
+COMPOSE_TIMER_BUDGET = 60
+COMPOSE_MIN_SEC = 10
+
+# Модули, импорт которых заметен на холодном старте, — для отчёта
+HEAVY_MODULES = ('PIL', 'numpy', 'boto3', 'skin_mask', 'presets')
+
+_api_lock = threading.Lock()
+_api_session = None
+_status_pool = None
+_s3_client = None
+_startup_reported = False
 
 
 def _get_s3_client():
-    return boto3.client(
-        's3',
-        endpoint_url='https://storage.yandexcloud.net',
-        region_name='ru-central1',
-        aws_access_key_id=os.environ.get('YC_S3_KEY_ID'),
-        aws_secret_access_key=os.environ.get('YC_S3_SECRET'),
-        config=Config(signature_version='s3v4')
-    )
+    """S3-клиент инстанса: boto3 импортируется при первом обращении.
+    Клиенты boto3 потокобезопасны — один на все вызовы и потоки."""
+    global _s3_client
+    with _api_lock:
+        if _s3_client is None:
+            import boto3
+            from botocore.client import Config
+            _s3_client = boto3.client(
+                's3',
+                endpoint_url='https://storage.yandexcloud.net',
+                region_name='ru-central1',
+                aws_access_key_id=os.environ.get('YC_S3_KEY_ID'),
+                aws_secret_access_key=os.environ.get('YC_S3_SECRET'),
+                config=Config(signature_version='s3v4')
+            )
+        return _s3_client
 
 
-def _presigned_url(s3_key):
+def _presigned_url(s3_key, expires=3600):
     return _get_s3_client().generate_presigned_url(
         'get_object',
         Params={'Bucket': S3_BUCKET, 'Key': s3_key},
-        ExpiresIn=3600
+        ExpiresIn=expires
+    )
+
+
+def _presigned_put_url(s3_key, expires=TASK_URL_TTL):
+    return _get_s3_client().generate_presigned_url(
+        'put_object',
+        Params={'Bucket': S3_BUCKET, 'Key': s3_key},
+        ExpiresIn=expires
     )
 
 
@@ -117,10 +194,40 @@ def _build_out_key(in_key):
     return f"retouch/{in_key}"
 
 
+def _build_result_key(in_key, unique_suffix):
+    """Ключ JPEG-результата: retouch/<имя>__<suffix>.jpg рядом с исходником."""
+    out_key = _build_out_key(in_key)
+    if not out_key.endswith('.jpg'):
+        out_key = out_key.rsplit('.', 1)[0] + '.jpg' if '.' in out_key else out_key + '.jpg'
+    return f"{out_key[:-4]}__{unique_suffix[:12]}.jpg"
+
+
+def _source_is_api_ready(s3_client, key):
+    """Можно ли отдать файл API ретуши по ссылке как есть — JPEG без поворота
+    по EXIF (те же условия, при которых _ensure_jpeg_bytes его не трогает).
+    Читает только начало файла, а не весь кадр.
+    """
+    try:
+        with span('s3_probe') as sp:
+            head = s3_client.get_object(
+                Bucket=S3_BUCKET, Key=key, Range=f'bytes=0-{SOURCE_PROBE_BYTES - 1}'
+            )['Body'].read()
+            sp.bytes = len(head)
+        from PIL import Image
+        img = Image.open(io.BytesIO(head))
+        if (img.format or '').upper() not in ('JPEG', 'JPG'):
+            return False
+        return img.getexif().get(0x0112, 1) in (1, 0)
+    except Exception as e:
+        print(f"[RETOUCH] Source probe failed ({key}): {e}")
+        return False
+
+
 def _ensure_jpeg_bytes(image_bytes, file_name=None):
     """Конвертирует изображение в JPEG, если формат не JPG/PNG — внешний API ретуши не умеет webp/heic/bmp/tiff/gif.
     Возвращает (bytes, was_converted).
     """
+    from PIL import Image, ImageOps
     try:
         img = Image.open(io.BytesIO(image_bytes))
         fmt = (img.format or '').upper()
@@ -195,28 +302,31 @@ def _load_retouch_settings(conn):
     return strength, enhance_face
 
 
-def _submit_async_task(image_base64, strength=0.6, enhance_face=False):
-    """POST /api/v2/submit — поставить задачу в очередь, получить task_id."""
-    # HARD OFF: face-restore смещает черты лица и при композиции по маске
-    # даёт «увеличенное / съехавшее» лицо и RGB-радугу по краю.
-    # Принудительно отключаем независимо от пресета / request body.
-    enhance_face = False
-    print(f"[RETOUCH] Submit: strength={strength} enhance_face={enhance_face} (forced OFF)")
+def _callback_url():
+    if not (RETOUCH_CALLBACK_URL and RETOUCH_CALLBACK_SECRET):
+        return None
+    sep = '&' if '?' in RETOUCH_CALLBACK_URL else '?'
+    return f"{RETOUCH_CALLBACK_URL}{sep}action=callback&token={RETOUCH_CALLBACK_SECRET}"
+
+
+def _post_submit(payload, timeout=SUBMIT_TIMEOUT):
+    callback_url = _callback_url()
+    if callback_url:
+        payload = dict(payload, callback_url=callback_url)
     resp = requests.post(
         f"{API_BASE}/submit",
         headers={
             'Content-Type': 'application/json',
             'Authorization': _auth_header()
         },
-        json={
-            'image': image_base64,
-            'strength': strength,
-            'enhance_face': enhance_face
-        },
-        timeout=(30, 120)
+        json=payload,
+        timeout=timeout
     )
     print(f"[RETOUCH] Submit response: status={resp.status_code} body={resp.text[:500]}")
+    return resp
+
 
+def _parse_submit_response(resp):
     if resp.status_code in (200, 201, 202):
         data = resp.json()
         api_task_id = data.get('task_id')
@@ -229,15 +339,72 @@ def _submit_async_task(image_base64, strength=0.6, enhance_face=False):
             error_msg = error_data.get('error', f'HTTP {resp.status_code}')
         except Exception:
             error_msg = f'HTTP {resp.status_code}: {resp.text[:200]}'
+        if resp.status_code == 429 or resp.status_code >= 500:
+            raise RetouchApiUnavailable(f"Retouch API submit error: {error_msg}")
         raise RuntimeError(f"Retouch API submit error: {error_msg}")
 
 
-def _check_api_status(api_task_id):
+def _submit_async_task(image_base64, strength=0.6, enhance_face=False, timeout=SUBMIT_TIMEOUT):
+    """POST /api/v2/submit — поставить задачу в очередь, получить task_id."""
+    # HARD OFF: face-restore смещает черты лица и при композиции по маске
+    # даёт «увеличенное / съехавшее» лицо и RGB-радугу по краю.
+    # Принудительно отключаем независимо от пресета / request body.
+    enhance_face = False
+    print(f"[RETOUCH] Submit: strength={strength} enhance_face={enhance_face} (forced OFF)")
+    return _parse_submit_response(_post_submit({
+        'image': image_base64,
+        'strength': strength,
+        'enhance_face': enhance_face
+    }, timeout))
+
+
+def _submit_url_task(image_url, output_url, strength=0.6, enhance_face=False, timeout=SUBMIT_TIMEOUT):
+    """POST /api/v2/submit со ссылками вместо картинки: сервер сам скачивает
+    исходник по image_url и кладёт JPEG-результат PUT'ом на output_url.
+
+    Returns:
+        (api_task_id, status) или None, если сервер ссылки не принял —
+        тогда вызывающий отправляет картинку base64 через _submit_async_task.
+    """
+    enhance_face = False  # см. _submit_async_task
+    print(f"[RETOUCH] Submit by URL: strength={strength} enhance_face={enhance_face} (forced OFF)")
+    resp = _post_submit({
+        'image_url': image_url,
+        'output_url': output_url,
+        'strength': strength,
+        'enhance_face': enhance_face
+    }, timeout)
+    if resp.status_code in SUBMIT_URL_REJECTED:
+        print(f"[RETOUCH] URL submit rejected ({resp.status_code}), falling back to base64")
+        return None
+    return _parse_submit_response(resp)
+
+
+def _get_api_session():
+    """Общая keep-alive сессия к API ретуши для опроса статусов."""
+    global _api_session
+    with _api_lock:
+        if _api_session is None:
+            _api_session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=STATUS_POOL_SIZE)
+            _api_session.mount('https://', adapter)
+        return _api_session
+
+
+def _get_status_pool():
+    global _status_pool
+    with _api_lock:
+        if _status_pool is None:
+            _status_pool = ThreadPoolExecutor(max_workers=STATUS_POOL_SIZE, thread_name_prefix='retouch-status')
+        return _status_pool
+
+
+def _check_api_status(api_task_id, timeout=(5, 30)):
     """GET /api/v2/status/<task_id> — проверить статус задачи."""
-    resp = requests.get(
+    resp = _get_api_session().get(
         f"{API_BASE}/status/{api_task_id}",
         headers={'Authorization': _auth_header()},
-        timeout=(5, 30)
+        timeout=timeout
     )
     print(f"[RETOUCH] Status check {api_task_id}: status={resp.status_code} body={resp.text[:500]}")
 
@@ -252,30 +419,32 @@ def _check_api_status(api_task_id):
 
 
 def _generate_thumbnails_from_bytes(s3_client, result_key, file_bytes):
+    from PIL import Image
     try:
-        img = Image.open(io.BytesIO(file_bytes))
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
-
-        prefix = result_key.rsplit('/', 1)[0] if '/' in result_key else ''
-        thumb_prefix = f"{prefix}/thumbnails" if prefix else "thumbnails"
-
-        img.thumbnail((800, 800), Image.Resampling.LANCZOS)
-        thumb_buf = io.BytesIO()
-        img.save(thumb_buf, format='JPEG', quality=85)
-        thumb_key = f"{thumb_prefix}/{uuid.uuid4()}.jpg"
-        s3_client.put_object(Bucket=S3_BUCKET, Key=thumb_key, Body=thumb_buf.getvalue(), ContentType='image/jpeg')
-        thumb_url = f"https://storage.yandexcloud.net/{S3_BUCKET}/{thumb_key}"
-
-        img.thumbnail((400, 400), Image.Resampling.LANCZOS)
-        grid_buf = io.BytesIO()
-        img.save(grid_buf, format='JPEG', quality=60, optimize=True)
-        grid_key = f"{thumb_prefix}/grid_{uuid.uuid4()}.jpg"
-        s3_client.put_object(Bucket=S3_BUCKET, Key=grid_key, Body=grid_buf.getvalue(), ContentType='image/jpeg')
-        grid_url = f"https://storage.yandexcloud.net/{S3_BUCKET}/{grid_key}"
-
-        print(f"[RETOUCH] Thumbnails created: {thumb_key}, {grid_key}")
-        return thumb_key, thumb_url, grid_key, grid_url
+        with span('thumbnails', len(file_bytes)):
+            img = Image.open(io.BytesIO(file_bytes))
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+
+            prefix = result_key.rsplit('/', 1)[0] if '/' in result_key else ''
+            thumb_prefix = f"{prefix}/thumbnails" if prefix else "thumbnails"
+
+            img.thumbnail((800, 800), Image.Resampling.LANCZOS)
+            thumb_buf = io.BytesIO()
+            img.save(thumb_buf, format='JPEG', quality=85)
+            thumb_key = f"{thumb_prefix}/{uuid.uuid4()}.jpg"
+            s3_client.put_object(Bucket=S3_BUCKET, Key=thumb_key, Body=thumb_buf.getvalue(), ContentType='image/jpeg')
+            thumb_url = f"https://storage.yandexcloud.net/{S3_BUCKET}/{thumb_key}"
+
+            img.thumbnail((400, 400), Image.Resampling.LANCZOS)
+            grid_buf = io.BytesIO()
+            img.save(grid_buf, format='JPEG', quality=60, optimize=True)
+            grid_key = f"{thumb_prefix}/grid_{uuid.uuid4()}.jpg"
+            s3_client.put_object(Bucket=S3_BUCKET, Key=grid_key, Body=grid_buf.getvalue(), ContentType='image/jpeg')
+            grid_url = f"https://storage.yandexcloud.net/{S3_BUCKET}/{grid_key}"
+
+            print(f"[RETOUCH] Thumbnails created: {thumb_key}, {grid_key}")
+            return thumb_key, thumb_url, grid_key, grid_url
     except Exception as e:
         print(f"[RETOUCH] Thumbnail generation failed: {e}")
         return None, None, None, None
@@ -305,7 +474,7 @@ def _get_or_create_retouch_folder(conn, user_id, parent_folder_id):
         return new_folder['id']
 
 
-def _save_retouched_photo(conn, user_id, photo_id, result_key, result_url, result_bytes=None):
+def _save_retouched_photo(conn, user_id, photo_id, result_key, result_url, result_bytes=None, result_size=None):
     with conn.cursor(cursor_factory=RealDictCursor) as cur:
         cur.execute(
             "SELECT folder_id, file_name, file_size, width, height, content_type FROM photo_bank WHERE id = %s",
@@ -355,7 +524,7 @@ def _save_retouched_photo(conn, user_id, photo_id, result_key, result_url, resul
                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)''',
                 (retouch_folder_id, user_id, file_name, result_key, result_url,
                  thumb_key, thumb_url, grid_key, grid_url,
-                 len(result_bytes) if result_bytes else original['file_size'] or 0,
+                 len(result_bytes) if result_bytes else result_size or original['file_size'] or 0,
                  original['width'], original['height'], 'image/jpeg')
             )
             conn.commit()
@@ -366,6 +535,7 @@ def _normalize_image_bytes(raw_bytes):
     """Привести байты к валидному JPEG. Поддерживает JPEG/PNG/PPM/WEBP и JSON-обёртку с base64."""
     if not raw_bytes:
         raise RuntimeError("Empty result bytes")
+    from PIL import Image
 
     head = raw_bytes[:1]
     if head in (b'{', b'['):
@@ -403,1352 +573,213 @@ def _normalize_image_bytes(raw_bytes):
         raise RuntimeError(f"Invalid image bytes: {e}")
 
 
-def _compose_via_retouch_compose(in_key, retouched_bytes, preset_name="medium"):
-    """Вызывает функцию retouch-compose через HTTP для тяжёлой обработки.
-    Передаёт base64 байты retouched_bytes, получает обратно композированные.
-    Если функция недоступна или вернула ошибку — возвращает retouched_bytes
-    без изменений (fallback к pass-through).
+def _compose_via_retouch_compose(in_key, retouched_key, preset_name="medium", out_key=None,
+                                 timeout=COMPOSE_TIMEOUT):
+    """Вызывает функцию retouch-compose по HTTP в режиме ключей: она сама
+    читает оригинал и ретушь из S3, смешивает их по маске кожи и кладёт
+    результат в out_key (по умолчанию — поверх retouched_key), так что
+    картинка через retouch не ходит.
+
+    Returns: (result_key, size_bytes) или None, если функция недоступна
+    или вернула ошибку — тогда остаётся ретушь без композиции.
     """
     compose_url = os.environ.get(
         "RETOUCH_COMPOSE_URL",
         "https://functions.poehali.dev/52c57076-75a7-48a0-8f6c-a1e31c46cd8b",
     )
+    payload = {
+        'in_key': in_key,
+        'retouched_key': retouched_key,
+        'preset': preset_name,
+    }
+    if out_key:
+        payload['out_key'] = out_key
+    if not RETOUCH_COMPOSE_SECRET:
+        print(f"[RETOUCH] RETOUCH_COMPOSE_SECRET not set, skipping compose")
+        return None
     try:
-        b64 = base64.b64encode(retouched_bytes).decode('ascii')
-        r = requests.post(
-            compose_url,
-            json={
-                'in_key': in_key,
-                'retouched_b64': b64,
-                'preset': preset_name,
-            },
-            timeout=120,
-        )
+        r = requests.post(compose_url, params={'token': RETOUCH_COMPOSE_SECRET},
+                          json=payload, timeout=timeout)
         if r.status_code != 200:
             print(f"[RETOUCH] compose returned {r.status_code}: {r.text[:200]}")
-            return retouched_bytes
+            return None
         data = r.json()
-        out_b64 = data.get('result_b64')
-        if not out_b64:
-            print(f"[RETOUCH] compose returned empty result_b64")
-            return retouched_bytes
-        out_bytes = base64.b64decode(out_b64)
+        result_key = data.get('result_key')
+        if not result_key:
+            print(f"[RETOUCH] compose returned empty result_key")
+            return None
         print(f"[RETOUCH] compose ok: composed={data.get('composed')} "
               f"size={data.get('size_bytes')} elapsed={data.get('elapsed_ms')}ms")
-        return out_bytes
+        return result_key, data.get('size_bytes')
     except Exception as e:
         print(f"[RETOUCH] compose call failed: {e}")
-        return retouched_bytes
-
-
-def _DEAD_compose_with_original_by_mask_LEGACY_BLOB(*args, **kwargs):
-    """LEGACY — старая функция, удалена ради уменьшения размера деплой-пакета.
-    Логика перенесена в отдельную функцию retouch-compose (Cloud Function).
-    Вызывайте _compose_via_retouch_compose(...) вместо неё.
-    Старая документация:
-    Смешивает результат внешнего API с оригиналом по маске кожи:
-    - внутри маски (кожа, дефекты) — пиксели ретуши,
-    - снаружи (волосы, брови, одежда, фон) — пиксели оригинала.
-
-    Это защищает не-кожу от сглаживания внешним API.
-
-    preset_name: light/medium/strong — управляет разрешением, шумодавом, шарпингом,
-    защитой фона, dodge&burn и пр.
-    """
-    raise NotImplementedError(
-        "Эта функция удалена из retouch для уменьшения размера деплой-пакета. "
-        "Используйте _compose_via_retouch_compose() — она вызывает функцию "
-        "retouch-compose по HTTP."
-    )
-
-
-# ===== СТАРОЕ ТЕЛО ФУНКЦИИ УДАЛЕНО (1230+ строк) =====
-# Вся логика SegFormer/SCRFD-масок, alpha-блендинга, smoothing, sharpening,
-# red-cast removal перенесена в Cloud Function retouch-compose
-# (backend/retouch-compose/). Это уменьшило размер пакета retouch в 3 раза
-# и решило проблему timeout 60 сек при деплое.
-# ====================================================
+        return None
 
 
-def _DEAD_old_body_remnants_keep_for_grep():
-    """Заглушка, чтобы старый код помечен явно. НЕ ВЫЗЫВАТЬ."""
-    return None
-
+def _compose_finished_task(conn, api_task_id, timeout=COMPOSE_TIMEOUT):
+    """Смешать результат завершённой задачи с оригиналом (in_key) на месте.
 
-def _LEGACY_BLOB_START_marker():
-    """LEGACY: висячий код снизу — был телом удалённой функции. Сейчас будет
-    схлопнут в один блок. НЕ ВЫЗЫВАТЬ.
+    Флаг compose_pending снимается до вызова: колбэк и таймер не
+    композируют одну задачу дважды, а упавшая композиция оставляет ретушь
+    от сервера как есть. Миниатюры не перестраиваем — маска меняет только
+    кожу, на превью разницы не видно. Returns: удалась ли композиция.
     """
-    pass
-
-_LEGACY_BLOB_DEAD_CODE_BLOB_START = '''
-    # 1) Скачиваем оригинал
-    try:
-        orig_obj = s3_client.get_object(Bucket=S3_BUCKET, Key=in_key)
-        orig_bytes = orig_obj['Body'].read()
-    except Exception as e:
-        print(f"[RETOUCH] Cannot fetch original {in_key}: {e}")
-        return retouched_bytes
-
-    try:
-        orig_img = Image.open(io.BytesIO(orig_bytes)).convert('RGB')
-        ret_img = Image.open(io.BytesIO(retouched_bytes)).convert('RGB')
-    except Exception as e:
-        print(f"[RETOUCH] Cannot open images for compose: {e}")
-        return retouched_bytes
-
-    # === ДИАГНОСТИКА РАЗМЕРОВ ===
-    ow_in, oh_in = orig_img.size
-    rw_in, rh_in = ret_img.size
-    orig_ar = ow_in / max(1, oh_in)
-    ret_ar = rw_in / max(1, rh_in)
-    print(f"[RETOUCH] [SIZE] orig={ow_in}x{oh_in} (AR={orig_ar:.4f}) "
-          f"ret={rw_in}x{rh_in} (AR={ret_ar:.4f})")
-
-    # === DEBUG: сохраняем СЫРОЙ ret_img от сервера в S3 для визуальной проверки ===
-    try:
-        debug_key = in_key.rsplit('.', 1)[0] + '_raw_ret_debug.jpg'
-        s3_client.put_object(
-            Bucket=S3_BUCKET,
-            Key=debug_key,
-            Body=retouched_bytes,
-            ContentType='image/jpeg',
-        )
-        print(f"[RETOUCH] [DEBUG] Saved raw ret_img to s3://{S3_BUCKET}/{debug_key}")
-        print(f"[RETOUCH] [DEBUG] CDN: https://cdn.poehali.dev/projects/{os.environ.get('AWS_ACCESS_KEY_ID','')}/bucket/{debug_key}")
-    except Exception as e:
-        print(f"[RETOUCH] [DEBUG] Failed to save raw ret_img: {e}")
-
-    # === ASPECT RATIO GUARD ===
-    # Если ret_img пришёл с другим соотношением сторон — любой resize его РАСТЯНЕТ,
-    # и при композиции по маске лицо «съедет» и увеличится. Лучше вернуть оригинал.
-    ar_diff = abs(orig_ar - ret_ar) / max(orig_ar, ret_ar)
-    if ar_diff > 0.02:
-        print(f"[RETOUCH] [SIZE] !!! Aspect ratio mismatch {ar_diff*100:.1f}% — "
-              f"возвращаем оригинал, чтобы не калечить геометрию лица")
-        return orig_bytes
-
-    # ОГРАНИЧЕНИЕ ПАМЯТИ: Cloud Function имеет 256MB лимита.
-    # Фото >MAX_COMPOSE_SIDE по стороне не помещается (float32 * 3 канала * 3 копии = OOM).
-    # Ресайзим ДО композиции, это же разрешение отдаём наружу.
-    # Пресет управляет разрешением: light/medium=2400, strong=2200 (больше памяти под обработку).
-    MAX_COMPOSE_SIDE = int(preset.get("max_compose_side", 2400))
-    ow_orig, oh_orig = orig_img.size
-    if max(ow_orig, oh_orig) > MAX_COMPOSE_SIDE:
-        scale = MAX_COMPOSE_SIDE / max(ow_orig, oh_orig)
-        new_w = int(ow_orig * scale)
-        new_h = int(oh_orig * scale)
-        orig_img = orig_img.resize((new_w, new_h), Image.LANCZOS)
-        print(f"[RETOUCH] Downscaled {ow_orig}x{oh_orig} -> {new_w}x{new_h} для композиции (лимит памяти)")
-
-    # Приводим результат к размеру оригинала (после возможного ресайза).
-    if ret_img.size != orig_img.size:
-        print(f"[RETOUCH] [SIZE] Resize ret {ret_img.size} -> orig {orig_img.size}")
-        ret_img = ret_img.resize(orig_img.size, Image.LANCZOS)
-
-    # 2) Строим маску по оригиналу (тот же алгоритм, что и preview_mask).
-    #    Ограничиваем размер превью для скорости. Поднимаем с 1024 до 1280 (preset)
-    #    — даёт более точные границы у глаз/губ и снижает RGB-ореол после ресайза маски.
-    preview_side = int(preset.get("preview_side", 1280))
-    ow, oh = orig_img.size
-    if max(ow, oh) > preview_side:
-        ratio = preview_side / max(ow, oh)
-        small = orig_img.resize((int(ow * ratio), int(oh * ratio)), Image.LANCZOS)
-    else:
-        small = orig_img
-
-    buf = io.BytesIO()
-    small.save(buf, format='JPEG', quality=85)
-    try:
-        mask_b64 = build_face_skin_mask(buf.getvalue())
-    except Exception as e:
-        print(f"[RETOUCH] build_face_skin_mask failed: {e}")
-        return retouched_bytes
-
-    try:
-        mask_png = base64.b64decode(mask_b64)
-        mask_img = Image.open(io.BytesIO(mask_png))
-        # build_auto_mask теперь возвращает RGBA; берём альфу как интенсивность маски.
-        if mask_img.mode == 'RGBA':
-            mask_gray = mask_img.split()[-1]
-        else:
-            mask_gray = mask_img.convert('L')
-    except Exception as e:
-        print(f"[RETOUCH] Cannot decode mask: {e}")
-        return retouched_bytes
-
-    # Маска сейчас в размере small — растягиваем до размера оригинала.
-    # NEAREST даёт чёткие края без размытия по диагонали; финальный 2px Gaussian
-    # ниже уберёт ступеньки. Раньше BILINEAR размазывал маску на 2-3px ещё ДО feather.
-    if mask_gray.size != orig_img.size:
-        mask_gray = mask_gray.resize(orig_img.size, Image.NEAREST)
-
-    # 3) EROSION + feather: убираем и «дымку по контуру головы», и «волну
-    # маски» на границе кожа/волосы.
-    # - erosion=6px сжимает маску внутрь, чтобы она точно не выходила за
-    #   лицо (раньше было 4 — местами всё ещё цепляло волосы).
-    # - feather=7px даёт плавный переход вместо «волнообразной» границы,
-    #   которая видна как зигзаг на лбу под волосами.
-    erode_r = 6   # было 4 — недостаточно на сложных причёсках
-    feather_r = 7  # было 2 — давало видимую границу маски
-    erode_size = erode_r * 2 + 1
-    mask_gray = mask_gray.filter(ImageFilter.MinFilter(size=erode_size))
-    mask_gray = mask_gray.filter(ImageFilter.GaussianBlur(radius=feather_r))
-    print(f"[RETOUCH] [mask] Erosion={erode_r}px + feather={feather_r}px applied "
-          f"(плавная граница, без «волны» на лбу)")
-
-    # 4) Композиция: где маска — берём ретушь, где нет — оригинал.
-    mask_arr = np.array(mask_gray, dtype=np.float32) / 255.0
-    initial_mask_pct = float(np.count_nonzero(mask_arr > 0.3)) * 100 / mask_arr.size
-    print(f"[RETOUCH] [v3] Initial SegFormer mask: {initial_mask_pct:.2f}% — checking SCRFD...")
-
-    # === ВСЕГДА запускаем SCRFD ===
-    # SCRFD находит лица по геометрии (надёжно в темноте/цветном свете) и затем
-    # SegFormer вызывается per-bbox каждого лица — даёт намного точнее маску.
-    # Если у SegFormer и так >5% — берём максимум двух (страховка).
-    cached_scrfd_mask = None
-    cached_scrfd_info = None
-    try:
-        from skin_mask import build_focus_mask_via_server
-        srv_buf = io.BytesIO()
-        orig_img.save(srv_buf, format='JPEG', quality=88)
-        srv_bytes = srv_buf.getvalue()
-        del srv_buf
-        srv_arr = np.array(orig_img, dtype=np.uint8)
-        scrfd_mask, scrfd_info = build_focus_mask_via_server(srv_bytes, srv_arr)
-        del srv_arr, srv_bytes
-        if scrfd_mask is not None:
-            cached_scrfd_info = scrfd_info
-            scrfd_pct = float(np.count_nonzero(scrfd_mask)) * 100 / scrfd_mask.size
-            print(f"[RETOUCH] [v3] SCRFD result: mask={scrfd_pct:.2f}% "
-                  f"shot={scrfd_info.get('shot_type')} "
-                  f"focus={scrfd_info.get('focus_faces_count')}/"
-                  f"{scrfd_info.get('total_faces')}")
-            if np.count_nonzero(scrfd_mask) > 0:
-                cached_scrfd_mask = scrfd_mask
-                # ВАЖНО: SCRFD даёт маску ТОЛЬКО лиц В ФОКУСЕ.
-                # SegFormer находит ВСЮ кожу в кадре, включая размытые вне-фокусные
-                # лица. Если их оставить — LaMa обработает их и появятся "кубики"
-                # на бокэ-лицах. Поэтому ОГРАНИЧИВАЕМ SegFormer-маску маской фокуса:
-                # берём пересечение (min), а не объединение (max).
-                scrfd_norm = scrfd_mask.astype(np.float32) / 255.0
-                if scrfd_norm.shape != mask_arr.shape:
-                    scrfd_norm = np.array(
-                        Image.fromarray(scrfd_mask, mode='L').resize(
-                            (mask_arr.shape[1], mask_arr.shape[0]), Image.NEAREST
-                        )
-                    ).astype(np.float32) / 255.0
-                # Растушёвываем focus-маску, чтобы границы фокусной зоны были мягкими
-                # (иначе резкая обводка вокруг лица в фокусе).
-                from PIL import ImageFilter as _IF
-                scrfd_soft = np.array(
-                    Image.fromarray((scrfd_norm * 255).astype(np.uint8), 'L').filter(
-                        _IF.GaussianBlur(radius=12)
-                    ),
-                    dtype=np.float32,
-                ) / 255.0
-                # Не уменьшаем зону фокуса — берём максимум растушёванной и оригинальной
-                scrfd_soft = np.maximum(scrfd_norm, scrfd_soft)
-                # Пересечение: оставляем кожу SegFormer ТОЛЬКО в зоне фокуса
-                mask_arr = mask_arr * scrfd_soft
-                final_pct = float(np.count_nonzero(mask_arr > 0.3)) * 100 / mask_arr.size
-                print(f"[RETOUCH] [v3] Focus-limited mask: {final_pct:.2f}% "
-                      f"(SegFormer={initial_mask_pct:.2f}%, SCRFD={scrfd_pct:.2f}%, "
-                      f"intersected with feathered focus zone)")
-        else:
-            print("[RETOUCH] [v3] SCRFD returned None (server unavailable)")
-    except Exception as e:
-        print(f"[RETOUCH] [v3] SCRFD step failed: {e}")
-
-    if mask_arr.max() < 0.05:
-        print("[RETOUCH] [v3] Empty mask after SegFormer+SCRFD — keeping raw retouched")
-        return retouched_bytes
-
-    # === АДАПТИВНАЯ КОМПОЗИЦИЯ с Frequency Separation ===
-    # Идея: разделяем изображение на низкие частоты (тон, цвет, пятна)
-    # и высокие (поры, волоски, текстура). LaMa убирает прыщи на LF, но ломает HF.
-    # Поэтому берём LF от LaMa + HF от оригинала → чистая кожа С СОХРАНЁННОЙ ТЕКСТУРОЙ.
-    #
-    # Адаптивность: анализируем "возраст кожи" по текстурной активности:
-    # - молодая с акне → сильное LF-сглаживание, полная HF (чистая кожа с порами)
-    # - молодая чистая → слабое LF, полная HF (почти не трогаем)
-    # - зрелая/пожилая → очень слабое LF, полная HF (НЕ превращаем в молодого)
-    coverage = float(mask_arr.mean())
-    if coverage < 0.01:
-        print("[RETOUCH] Empty mask — keeping raw retouched")
-        return retouched_bytes
-
-    # === ДЕТЕКТОР ПЛАНА ПО ОТДЕЛЬНЫМ ЛИЦАМ ===
-    # Иерархия источников (от лучшего к худшему):
-    # 1) Серверный SCRFD-детектор (InsightFace) — работает в темноте, при цветном
-    #    свете, на профилях. Возвращает bbox+score+sharpness каждого лица. Затем
-    #    SegFormer вызывается с bbox каждого лица в фокусе → точная маска кожи.
-    # 2) Локальный анализ skin-маски (connected components) — если сервер не ответил.
-    # 3) Старый coverage-детектор — самый последний фоллбек.
-    #
-    # Классификация плана по самому крупному лицу В ФОКУСЕ:
-    #   ≥22% высоты — крупный план (полная ретушь, alpha ×1.0)
-    #   8-22%      — средний план (alpha ×0.45)
-    #   4-8%       — дальний план (только разглаживание, alpha ×0.20)
-    #   <4%        — массовка, ретушь не нужна.
-    shot_type = "closeup"
-    plan_multiplier = 1.0
-    used_source = "fallback_coverage"
-
-    # --- Путь 1: серверный SCRFD ---
-    # Если ниже выше уже сделали SCRFD-recovery — переиспользуем результат.
-    if cached_scrfd_mask is not None:
-        focus_mask_u8 = cached_scrfd_mask
-        shot_info = cached_scrfd_info
-    elif cached_scrfd_info is not None and cached_scrfd_info.get('shot_type') == 'no_face':
-        # SCRFD уже отвечал и сказал "нет лиц" — не дублируем.
-        focus_mask_u8, shot_info = None, cached_scrfd_info
-    else:
-        try:
-            from skin_mask import build_focus_mask_via_server
-            # Готовим JPEG того же изображения что в orig_img (после ресайза).
-            srv_buf = io.BytesIO()
-            orig_img.save(srv_buf, format='JPEG', quality=88)
-            srv_bytes = srv_buf.getvalue()
-            orig_for_faces = np.array(orig_img, dtype=np.uint8)
-            focus_mask_u8, shot_info = build_focus_mask_via_server(srv_bytes, orig_for_faces)
-            del orig_for_faces, srv_bytes, srv_buf
-        except Exception as e:
-            print(f"[RETOUCH] SCRFD path failed: {e}")
-            focus_mask_u8, shot_info = None, None
-
-    # --- Путь 2: локальный анализ skin-маски ---
-    if focus_mask_u8 is None:
-        try:
-            from skin_mask import build_focus_mask
-            orig_for_faces = np.array(orig_img, dtype=np.uint8)
-            mask_u8 = (mask_arr * 255.0).clip(0, 255).astype(np.uint8)
-            focus_mask_u8, shot_info = build_focus_mask(orig_for_faces, mask_u8)
-            used_source = "local_components"
-            del orig_for_faces
-        except Exception as e:
-            print(f"[RETOUCH] Local face detector also failed: {e}")
-            focus_mask_u8, shot_info = None, None
-    else:
-        used_source = shot_info.get('source', 'scrfd_server')
-
-    if shot_info is not None:
-        shot_type = shot_info.get('shot_type', 'closeup')
-        plan_multiplier = float(shot_info.get('plan_multiplier', 1.0))
-        print(
-            f"[RETOUCH] Shot detector ({used_source}): {shot_info.get('reason')} "
-            f"focus_faces={shot_info.get('focus_faces_count')} "
-            f"total_faces={shot_info.get('total_faces')} → "
-            f"shot={shot_type} plan_mult={plan_multiplier:.2f}"
-        )
-        # Подменяем mask_arr на маску только лиц в фокусе.
-        if focus_mask_u8 is not None and np.count_nonzero(focus_mask_u8) > 0:
-            mask_arr = focus_mask_u8.astype(np.float32) / 255.0
-    else:
-        # --- Путь 3: старый coverage fallback ---
-        skin_pct = coverage * 100
-        if skin_pct >= 15:
-            shot_type = "closeup"
-            plan_multiplier = 1.0
-        elif skin_pct >= 5:
-            shot_type = "medium"
-            plan_multiplier = 0.45
-        elif skin_pct >= 2:
-            shot_type = "wide"
-            plan_multiplier = 0.22
-        else:
-            shot_type = "very_wide"
-            plan_multiplier = 0.0
-        print(f"[RETOUCH] Coverage fallback: {shot_type} (skin={skin_pct:.1f}%) → plan_mult={plan_multiplier:.2f}")
-
-    # На очень дальнем плане ретушь бесполезна — слишком мало пикселей на лицах.
-    # Возвращаем оригинал (без применения ретуши сервера вообще).
-    if plan_multiplier == 0:
-        print("[RETOUCH] Very wide shot — skipping retouch, returning original")
-        # Возвращаем оригинал в исходном размере:
-        out_buf = io.BytesIO()
-        orig_img.save(out_buf, format='JPEG', quality=95)
-        return out_buf.getvalue()
-
-    # ЭКОНОМИЯ ПАМЯТИ: работаем в int16 вместо float32 (в 2 раза меньше RAM).
-    # Детектор возраста кожи запускаем ДО создания больших массивов.
-    w_full, h_full = orig_img.size
-
-    # --- Детектор "возраста кожи" на уменьшенной версии (512px) ---
-    det_side = 512
-    scale = det_side / max(h_full, w_full)
-    if scale < 1:
-        det_w, det_h = int(w_full * scale), int(h_full * scale)
-        det_orig = np.array(orig_img.resize((det_w, det_h), Image.BILINEAR), dtype=np.float32)
-        det_mask = np.array(
-            Image.fromarray((mask_arr > 0.3).astype(np.uint8) * 255, 'L').resize((det_w, det_h), Image.BILINEAR)
-        ) > 128
-    else:
-        det_orig = np.array(orig_img, dtype=np.float32)
-        det_mask = mask_arr > 0.3
-
-    mask_bool = mask_arr > 0.3
-
-    gray = np.mean(det_orig, axis=2).astype(np.float32)
-    blur_gray = np.array(
-        Image.fromarray(gray.clip(0, 255).astype(np.uint8), 'L').filter(ImageFilter.GaussianBlur(radius=4)),
-        dtype=np.float32,
-    )
-    hf = gray - blur_gray
-    skin_hf = hf[det_mask]
-    if skin_hf.size > 100:
-        hf_std = float(np.std(skin_hf))
-        # Плотность локальных "всплесков" — грубая оценка дефектов.
-        blob_density = float(np.mean(np.abs(skin_hf) > 12)) * 100
-    else:
-        hf_std, blob_density = 6.0, 0.0
-
-    # === ДЕТЕКТОР МОРЩИН через структурный тензор ===
-    # Морщины = линейные структуры (λ1 >> λ2, coherence → 1.0)
-    # Прыщи/пятна = круглые blob'ы (λ1 ≈ λ2, coherence → 0)
-    try:
-        gx = np.gradient(blur_gray, axis=1).astype(np.float32)
-        gy = np.gradient(blur_gray, axis=0).astype(np.float32)
-
-        # Сглаживание компонент тензора через uint8-подход (stable в PIL).
-        def _blur_tensor(a):
-            # Нормализуем в uint8 → blur → обратно.
-            amax = float(np.max(np.abs(a))) + 1e-6
-            a_u8 = ((a / amax) * 127.0 + 128.0).clip(0, 255).astype(np.uint8)
-            b_u8 = np.array(
-                Image.fromarray(a_u8, 'L').filter(ImageFilter.GaussianBlur(radius=5))
-            )
-            return (b_u8.astype(np.float32) - 128.0) * (amax / 127.0)
-
-        Jxx = _blur_tensor(gx * gx)
-        Jyy = _blur_tensor(gy * gy)
-        Jxy = _blur_tensor(gx * gy)
-        del gx, gy
-        trace = Jxx + Jyy
-        det_val = Jxx * Jyy - Jxy * Jxy
-        disc = np.maximum(trace * trace / 4.0 - det_val, 0.0)
-        sq = np.sqrt(disc)
-        lam1 = trace / 2.0 + sq
-        lam2 = trace / 2.0 - sq
-        denom = (lam1 + lam2) + 1e-6
-        coherence = ((lam1 - lam2) / denom) ** 2
-        strong = (trace > 4.0) & det_mask
-        if strong.sum() > 100:
-            wrinkle_score = float(np.mean(coherence[strong])) * 100
-        else:
-            wrinkle_score = 0.0
-        del Jxx, Jyy, Jxy, trace, det_val, disc, sq, lam1, lam2, coherence
-    except Exception as e:
-        print(f"[RETOUCH] wrinkle detector failed: {e} — fallback to 0")
-        wrinkle_score = 0.0
-
-    # === АДАПТИВНАЯ СИЛА РЕТУШИ ===
-    # wrinkle_score (0-100): высокий → много линейных структур (морщины) → щадяще
-    # hf_std: общая активность текстуры
-    # blob_density: круглые пятна (прыщи/постакне)
-    #
-    # ПРИОРИТЕТ: сильное акне (много blob) → ВСЕГДА young_acne, даже если
-    # wrinkle_score высокий. Причина: скопления прыщей дают ложно-высокий
-    # wrinkle_score (детектор линий путает кластеры прыщей с морщинами).
-    # Без этого парень-подросток с акне классифицируется как "mature".
-    if blob_density > 5.0:
-        skin_type = "young_acne"
-        lf_strength = 0.85
-    # Главная идея: ВЫСОКИЙ wrinkle_score → alpha ВНИЗ, независимо от других метрик.
-    # Это защищает пожилые лица от "омолаживания".
-    elif wrinkle_score > 18:
-        # Пожилая кожа: alpha=0.60. Сервер для mature НЕ делает cleanup (морщины
-        # защищены), поэтому мы можем применить его результат сильнее — это уберёт
-        # возрастные пигментные пятна (их сервер чистит на первом проходе LaMa),
-        # но при этом морщины сохранятся, потому что сервер их не трогал.
-        skin_type = "mature"
-        lf_strength = 0.60
-    elif wrinkle_score > 12 and hf_std > 8:
-        # Зрелая с текстурой — тоже сильнее, пятна заметнее на таком лице.
-        skin_type = "mature_textured"
-        lf_strength = 0.65
-    elif blob_density > 2.5 and wrinkle_score < 10:
-        # Акне на молодой коже (пятна, но мало линий).
-        skin_type = "young_acne"
-        lf_strength = 0.85
-    elif hf_std < 5:
-        skin_type = "young_clean"
-        lf_strength = 0.35
-    else:
-        skin_type = "normal"
-        lf_strength = 0.55
-    hf_from_orig = 1.0
-
-    print(f"[RETOUCH] Skin: type={skin_type} hf_std={hf_std:.1f} blob={blob_density:.1f}% "
-          f"wrinkle={wrinkle_score:.1f} → alpha={lf_strength:.2f}")
-
-    # --- ПРОСТОЙ АЛЬФА-BLEND ---
-    # Сервер уже сам делает: детекцию, LaMa, frequency separation, skin texture,
-    # restore volume, GFPGAN. Наша задача — применить его результат ТОЛЬКО
-    # на области кожи, а всё остальное (губы/глаза/брови/волосы/одежда/фон)
-    # оставить оригинальным.
-    #
-    # Адаптивная сила: тип кожи → коэффициент смешивания с оригиналом.
-    # Смесь = orig * (1 - m * alpha) + ret * (m * alpha)
-    # где m = маска кожи, alpha = сила под тип кожи.
-
-    # Эффективная сила смешивания: тип кожи × тип плана × множитель пресета.
-    # alpha_multiplier даёт реальную разницу между light/medium/strong:
-    # light=0.65, medium=1.00, strong=1.35. Финальная alpha клиппится в [0..1].
-    alpha_mult = float(preset.get("alpha_multiplier", 1.0))
-    alpha = lf_strength * plan_multiplier * alpha_mult
-    alpha = max(0.0, min(1.0, alpha))
-    print(f"[RETOUCH] [ALPHA] Start: lf={lf_strength:.2f} × plan={plan_multiplier:.2f} × preset_mult={alpha_mult:.2f} = {alpha:.3f}")
-
-    # === DARK SCENE GUARD ===
-    # На тёмных сценах LaMa склонен делать тёмные/цветные артефакты.
-    # Если лицо явно недосвечено (Y<60) и не близкий план — лучше не рисковать.
-    try:
-        det_orig_u8 = det_orig.astype(np.uint8)
-        if det_mask.sum() > 50:
-            face_y = (
-                det_orig_u8[:, :, 0].astype(np.float32) * 0.299
-                + det_orig_u8[:, :, 1].astype(np.float32) * 0.587
-                + det_orig_u8[:, :, 2].astype(np.float32) * 0.114
-            )
-            mean_face_y = float(np.mean(face_y[det_mask]))
-        else:
-            mean_face_y = 128.0
-
-        # Базовый коэффициент по яркости
-        if mean_face_y < 40:
-            dark_factor = 0.0       # очень темно — не трогаем вообще
-        elif mean_face_y < 80:
-            # 40→80: плавно 0→1
-            dark_factor = (mean_face_y - 40) / 40.0
-        else:
-            dark_factor = 1.0
-
-        # Дополнительный штраф для не-крупных планов в темноте:
-        # на medium/wide артефакты LaMa особенно заметны.
-        if mean_face_y < 100 and shot_type in ("medium", "wide"):
-            dark_factor *= 0.8
-            print(f"[RETOUCH] [v3] Dark + non-closeup penalty applied")
-
-        if dark_factor < 1.0:
-            print(f"[RETOUCH] [v3] Dark scene guard: face_Y={mean_face_y:.0f} "
-                  f"shot={shot_type} → factor={dark_factor:.2f}")
-        alpha_before = alpha
-        alpha *= dark_factor
-        print(f"[RETOUCH] [ALPHA] After DARK guard: {alpha_before:.3f} × {dark_factor:.2f} = {alpha:.3f}")
-    except Exception as e:
-        print(f"[RETOUCH] Dark scene guard failed (non-critical): {e}")
-
-    # === COLOR DRIFT GUARD ===
-    # Если LaMa изменил средний цвет/яркость кожи — у него артефакт.
-    # Особенно отслеживаем ПОТЕМНЕНИЕ (это и есть «чёрное пятно»):
-    # отрицательное смещение на 8+ единиц при тёмной сцене — критично.
-    try:
-        ret_arr_check = np.array(ret_img, dtype=np.float32)
-        orig_arr_check = np.array(orig_img, dtype=np.float32)
-        m_check = mask_arr > 0.3
-        if m_check.sum() > 100:
-            d_r = float(np.mean(ret_arr_check[m_check, 0] - orig_arr_check[m_check, 0]))
-            d_g = float(np.mean(ret_arr_check[m_check, 1] - orig_arr_check[m_check, 1]))
-            d_b = float(np.mean(ret_arr_check[m_check, 2] - orig_arr_check[m_check, 2]))
-            max_drift = max(abs(d_r), abs(d_g), abs(d_b))
-
-            # Расчёт средней яркости разницы (отрицательная = LaMa затемнил)
-            d_y = 0.299 * d_r + 0.587 * d_g + 0.114 * d_b
-
-            # Защита от ПОТЕМНЕНИЯ (артефакт «чёрное пятно»).
-            # Пороги ослаблены: лёгкое выравнивание тонов (ΔY ~ -5..-10) — норма,
-            # это не артефакт, и резать alpha из-за этого нельзя.
-            alpha_before_drift = alpha
-            drift_factor = 1.0
-            if d_y < -30:
-                print(f"[RETOUCH] [v3] LaMa darkening guard: ΔY={d_y:+.1f} → alpha×0.5 (soft)")
-                drift_factor = 0.5
-            elif d_y < -20:
-                drift_factor = 1.0 - (abs(d_y) - 20) / 10.0 * 0.3
-                drift_factor = max(0.7, min(1.0, drift_factor))
-                print(f"[RETOUCH] [v3] LaMa darkening partial: ΔY={d_y:+.1f} → alpha×{drift_factor:.2f}")
-            elif max_drift > 45:
-                print(f"[RETOUCH] [v3] Color drift heavy: ΔRGB=({d_r:+.1f},{d_g:+.1f},{d_b:+.1f}) → alpha×0.5")
-                drift_factor = 0.5
-            elif max_drift > 28:
-                drift_factor = 1.0 - (max_drift - 28) / 17.0 * 0.4
-                drift_factor = max(0.6, min(1.0, drift_factor))
-                print(f"[RETOUCH] [v3] Color drift partial: max={max_drift:.1f} → alpha×{drift_factor:.2f}")
-            alpha *= drift_factor
-            print(f"[RETOUCH] [ALPHA] After COLOR_DRIFT guard: {alpha_before_drift:.3f} × {drift_factor:.2f} = {alpha:.3f}")
-
-            # === CHROMA DRIFT GUARD ===
-            # Артефакт «серое пятно»: LaMa не темнит, но ОБЕСЦВЕЧИВАЕТ кожу
-            # (особенно на мелких/боковых лицах, где мало текстуры).
-            # Считаем chroma = max(R,G,B) - min(R,G,B) внутри маски.
-            # Если LaMa уронил chroma > 35% — это серое пятно, откатываем.
-            ret_max = np.maximum(np.maximum(
-                ret_arr_check[m_check, 0], ret_arr_check[m_check, 1]),
-                ret_arr_check[m_check, 2])
-            ret_min = np.minimum(np.minimum(
-                ret_arr_check[m_check, 0], ret_arr_check[m_check, 1]),
-                ret_arr_check[m_check, 2])
-            orig_max = np.maximum(np.maximum(
-                orig_arr_check[m_check, 0], orig_arr_check[m_check, 1]),
-                orig_arr_check[m_check, 2])
-            orig_min = np.minimum(np.minimum(
-                orig_arr_check[m_check, 0], orig_arr_check[m_check, 1]),
-                orig_arr_check[m_check, 2])
-            chroma_ret = float(np.mean(ret_max - ret_min))
-            chroma_orig = float(np.mean(orig_max - orig_min))
-            if chroma_orig > 5:  # имеет смысл проверять только если кожа цветная
-                chroma_ratio = chroma_ret / chroma_orig
-                alpha_before_chroma = alpha
-                chroma_factor = 1.0
-                if chroma_ratio < 0.55:
-                    print(f"[RETOUCH] [v3] Chroma drift heavy: "
-                          f"{chroma_orig:.1f}→{chroma_ret:.1f} "
-                          f"(ratio={chroma_ratio:.2f}) → alpha=0 (revert)")
-                    chroma_factor = 0.0
-                    alpha = 0.0
-                elif chroma_ratio < 0.75:
-                    # ratio=0.75 → 1.0, ratio=0.55 → 0.2
-                    chroma_factor = (chroma_ratio - 0.55) / 0.20 * 0.8 + 0.2
-                    chroma_factor = max(0.2, min(1.0, chroma_factor))
-                    print(f"[RETOUCH] [v3] Chroma drift partial: "
-                          f"ratio={chroma_ratio:.2f} → alpha×{chroma_factor:.2f}")
-                    alpha *= chroma_factor
-                if chroma_factor < 1.0:
-                    print(f"[RETOUCH] [ALPHA] After CHROMA guard: {alpha_before_chroma:.3f} × {chroma_factor:.2f} = {alpha:.3f}")
-            del ret_max, ret_min, orig_max, orig_min
-        del ret_arr_check, orig_arr_check
-    except Exception as e:
-        print(f"[RETOUCH] Color drift guard failed (non-critical): {e}")
-
-    print(f"[RETOUCH] [v3] Final alpha = {lf_strength:.2f} × {plan_multiplier:.2f} (after guards) = {alpha:.2f}")
-
-    # Если после защит alpha почти 0 — просто возвращаем оригинал.
-    if alpha < 0.02:
-        print("[RETOUCH] [v3] alpha≈0 after guards — returning ORIGINAL")
-        out_buf = io.BytesIO()
-        orig_img.save(out_buf, format='JPEG', quality=95)
-        return out_buf.getvalue()
-
-    # ЭКОНОМНАЯ КОМПОЗИЦИЯ: работаем в uint8 + int16 (в 2 раза меньше памяти чем float32).
-    # Формула: out = orig + (ret - orig) * (effective_alpha_per_pixel)
-    #
-    # Базовая маска: m_u8 = mask * alpha
-    m_u8 = (mask_arr * alpha * 255.0).clip(0, 255).astype(np.uint8)
-
-    # === ЛОКАЛЬНЫЙ DARKENING GUARD (per-pixel) ===
-    # Глобальный guard выше ловит общее затемнение всего лица.
-    # Этот ловит ЛОКАЛЬНЫЕ тёмные пятна (нос, под глазами) — частая ошибка LaMa
-    # на тёмных сценах. Если в пикселе ret_Y - orig_Y < -10 → обнуляем там маску.
-    try:
-        if mean_face_y < 110:  # активируем только в недосвете
-            ret_arr_loc = np.array(ret_img, dtype=np.float32)
-            orig_arr_loc = np.array(orig_img, dtype=np.float32)
-            ret_y_loc = (
-                ret_arr_loc[:, :, 0] * 0.299
-                + ret_arr_loc[:, :, 1] * 0.587
-                + ret_arr_loc[:, :, 2] * 0.114
-            )
-            orig_y_loc = (
-                orig_arr_loc[:, :, 0] * 0.299
-                + orig_arr_loc[:, :, 1] * 0.587
-                + orig_arr_loc[:, :, 2] * 0.114
-            )
-            d_y_loc = ret_y_loc - orig_y_loc
-            # Сглаживаем чтобы не было жёстких границ
-            d_y_pil = Image.fromarray(
-                (d_y_loc.clip(-50, 50) + 50).astype(np.uint8), mode='L'
-            ).filter(ImageFilter.GaussianBlur(radius=4))
-            d_y_smooth = np.array(d_y_pil, dtype=np.float32) - 50.0
-            # Маска местного потемнения: 1.0 в нормальных зонах, 0.0 где LaMa затемнил >10
-            local_attenuate = np.clip(1.0 + d_y_smooth / 10.0, 0.0, 1.0).astype(np.float32)
-            # Ослабляем mask там где локальное потемнение
-            m_u8 = (m_u8.astype(np.float32) * local_attenuate).clip(0, 255).astype(np.uint8)
-            dark_pct = float(np.count_nonzero(d_y_smooth < -10)) * 100 / d_y_smooth.size
-            print(f"[RETOUCH] [v3] Local darkening guard: {dark_pct:.2f}% pixels suppressed")
-            del ret_arr_loc, orig_arr_loc, ret_y_loc, orig_y_loc, d_y_loc, d_y_smooth, local_attenuate
-    except Exception as e:
-        print(f"[RETOUCH] Local darkening guard failed (non-critical): {e}")
-
-    # NOSE BOOST: усиливаем alpha до 0.95 на носу для ВСЕХ типов планов.
-    # У подростков прыщи на крыльях носа — самое частое место, и базовая
-    # alpha (0.55-0.7) их часто не вытягивает полностью. Раньше boost работал
-    # только на closeup — но на medium/wide нос тоже видно, и прыщи там тоже
-    # надо чистить. Теперь работает всегда, для всех планов.
-    try:
-        from skin_mask import _call_ai_face_parse
-        buf_nose = io.BytesIO()
-        orig_img.save(buf_nose, format='JPEG', quality=85)
-        nose_mask_np = _call_ai_face_parse(buf_nose.getvalue(), mode="nose")
-        if nose_mask_np is not None and nose_mask_np.size > 0:
-            nose_pil = Image.fromarray(nose_mask_np, mode='L').filter(
-                ImageFilter.GaussianBlur(radius=4)
-            )
-            nose_u8 = np.array(nose_pil)
-            # Для acne-кожи 0.98 (максимум), для остальных 0.92
-            nose_target = 0.98 if skin_type == "young_acne" else 0.92
-            nose_alpha = int(nose_target * 255)
-            nose_component = ((nose_u8.astype(np.float32) / 255.0) * nose_alpha).astype(np.uint8)
-            m_u8 = np.maximum(m_u8, nose_component)
-            nose_cov = float(np.count_nonzero(nose_u8 > 128)) * 100 / max(1, nose_u8.size)
-            print(f"[RETOUCH] Nose boost: coverage={nose_cov:.1f}% alpha_on_nose={nose_target:.2f} (skin={skin_type} shot={shot_type})")
-            del nose_u8, nose_component, nose_mask_np
-    except Exception as e:
-        print(f"[RETOUCH] Nose boost failed (non-critical): {e}")
-
-    # CHIN/MOUTH AREA BOOST: подбородок и зона вокруг рта.
-    # Прыщи на подбородке часто не чистятся, потому что:
-    #  1) попадают в stubble_zone (легкая щетина)
-    #  2) SCRFD focus-mask имеет мягкие края — alpha там ниже
-    # Поднимаем alpha до 0.85 в нижней трети маски кожи (где подбородок).
-    try:
-        h_m, w_m = m_u8.shape
-        # Нижняя треть лица — там обычно подбородок
-        chin_top = int(h_m * 0.55)
-        chin_band = np.zeros_like(m_u8)
-        chin_band[chin_top:, :] = 255
-        # Сглаживаем верх перехода чтобы не было резкой границы
-        chin_pil = Image.fromarray(chin_band, mode='L').filter(
-            ImageFilter.GaussianBlur(radius=max(8, h_m // 40))
-        )
-        chin_band_f = np.asarray(chin_pil, dtype=np.float32) / 255.0
-        # Чтобы не задевало шею/одежду — пересекаем с skin-маской mask_arr
-        chin_only_skin = chin_band_f * mask_arr  # mask_arr float32 [0..1]
-        # Поднимаем alpha до 0.85 в этой зоне (для acne — 0.92)
-        chin_target = 0.92 if skin_type == "young_acne" else 0.85
-        chin_alpha_u8 = (chin_only_skin * chin_target * 255.0).clip(0, 255).astype(np.uint8)
-        m_u8 = np.maximum(m_u8, chin_alpha_u8)
-        chin_cov = float(np.count_nonzero(chin_alpha_u8 > 80)) * 100 / chin_alpha_u8.size
-        print(f"[RETOUCH] Chin boost: coverage={chin_cov:.1f}% alpha_on_chin={chin_target:.2f}")
-        del chin_band, chin_pil, chin_band_f, chin_only_skin, chin_alpha_u8
-    except Exception as e:
-        print(f"[RETOUCH] Chin boost failed (non-critical): {e}")
-
-    # Сохраняем bool-маску ДО удаления mask_arr — нужна для post-обработки
-    # (smoothing + WB correction в самом конце)
-    skin_mask_for_post = (mask_arr > 0.3).copy()
-
-    del mask_arr, det_orig, det_mask  # освобождаем лишнее
-
-    orig_u8 = np.array(orig_img, dtype=np.uint8)
-    ret_u8 = np.array(ret_img, dtype=np.uint8)
-
-    # === ЗАЩИТА ОТ ПЯТНА ПЕРЕСВЕТА ===
-    # На средних/общих планах ретушь часто осветляет уже яркие участки кожи
-    # (нос, лоб, скулы при контровом свете) — получается белое пятно.
-    # Гасим маску там, где:
-    #   1) пиксель оригинала уже очень светлый (Y > 215) — это естественный блик;
-    #   2) ретушь пытается сделать пиксель ЕЩЁ ярче (ret_Y > orig_Y).
-    # На closeup эффект слабее (там нос-усиление полезно), для medium/wide подавляем
-    # сильнее, т.к. лицо мелкое и пятно сразу бросается в глаза.
-    try:
-        orig_y = (
-            orig_u8[:, :, 0].astype(np.float32) * 0.299
-            + orig_u8[:, :, 1].astype(np.float32) * 0.587
-            + orig_u8[:, :, 2].astype(np.float32) * 0.114
-        )
-        ret_y = (
-            ret_u8[:, :, 0].astype(np.float32) * 0.299
-            + ret_u8[:, :, 1].astype(np.float32) * 0.587
-            + ret_u8[:, :, 2].astype(np.float32) * 0.114
-        )
-        # 0 в самых ярких бликах, 1 в средних/тёмных тонах
-        knee_lo, knee_hi = 200.0, 245.0
-        bright = np.clip((orig_y - knee_lo) / (knee_hi - knee_lo), 0.0, 1.0)
-        # подавление активно только если ретушь делает пиксель ярче
-        brightening = np.clip((ret_y - orig_y) / 20.0, 0.0, 1.0)
-        suppress_strength = 0.55 if shot_type == "closeup" else 0.85
-        attenuation = 1.0 - bright * brightening * suppress_strength
-        # сглаживаем чтобы не было резких границ
-        att_pil = Image.fromarray((attenuation * 255.0).clip(0, 255).astype(np.uint8), 'L')
-        att_pil = att_pil.filter(ImageFilter.GaussianBlur(radius=3))
-        m_u8 = (m_u8.astype(np.float32) * (np.array(att_pil, dtype=np.float32) / 255.0)).clip(0, 255).astype(np.uint8)
-        del orig_y, ret_y, bright, brightening, attenuation, att_pil
-    except Exception as e:
-        print(f"[RETOUCH] Highlight guard failed (non-critical): {e}")
-
-    # diff = ret - orig (в int16 чтобы не терять знак)
-    diff = ret_u8.astype(np.int16) - orig_u8.astype(np.int16)
-    del ret_u8
-
-    # Применяем маску канально: diff[y,x,c] *= m_u8[y,x] / 255
-    # Работаем с одним каналом за раз чтобы экономить память.
-    m_f = m_u8.astype(np.float32) / 255.0
-    del m_u8
-    for c in range(3):
-        diff[:, :, c] = (diff[:, :, c].astype(np.float32) * m_f).astype(np.int16)
-    del m_f
-
-    # out = orig + diff (с клиппингом в uint8)
-    result = np.clip(orig_u8.astype(np.int16) + diff, 0, 255).astype(np.uint8)
-    del diff
-
-    # === CHROMA RESTORATION ПРИНУДИТЕЛЬНО ОТКЛЮЧЁН ===
-    # Подмешивал оригинал (с прыщами) обратно через маску, посчитанную на 384px
-    # масштабе → размытые "пятна оригинала" возвращались на лицо, давая туман.
-    # Полностью выключаем до доработки на полноразмерных операциях.
-    if False:  # DISABLED
-        import gc as _gc_cr
-        _gc_cr.collect()
-        H_, W_ = result.shape[:2]
-        long_side = 384
-        scale_cr = min(1.0, long_side / float(max(H_, W_)))
-        sH_ = max(8, int(round(H_ * scale_cr)))
-        sW_ = max(8, int(round(W_ * scale_cr)))
-
-        res_small = np.asarray(
-            Image.fromarray(result, 'RGB').resize((sW_, sH_), Image.BILINEAR),
-            dtype=np.uint8,
-        )
-        orig_small = np.asarray(
-            Image.fromarray(orig_u8, 'RGB').resize((sW_, sH_), Image.BILINEAR),
-            dtype=np.uint8,
-        )
-        # Chroma = max-min RGB (прокси насыщенности, дёшево)
-        res_c = res_small.max(axis=2).astype(np.int16) - res_small.min(axis=2).astype(np.int16)
-        orig_c = orig_small.max(axis=2).astype(np.int16) - orig_small.min(axis=2).astype(np.int16)
-        # Потеря насыщенности: orig был насыщеннее, result стал серее.
-        # Порог 5 — реагируем на умеренную потерю цвета (LaMa-артефакты).
-        chroma_loss = np.clip((orig_c - res_c - 5).astype(np.float32) / 20.0, 0.0, 1.0)
-        del res_c, orig_c
-
-        # ВАЖНО: не подмешиваем оригинал там где он сам был ОЧЕНЬ ярким (блик).
-        # Иначе блик с оригинала возвращается и создаёт нимб.
-        # Раньше порог 200 был слишком жёстким — блокировал здоровые светлые
-        # участки кожи, и серые пятна не лечились.
-        orig_y_small = (
-            orig_small[:, :, 0].astype(np.float32) * 0.299
-            + orig_small[:, :, 1].astype(np.float32) * 0.587
-            + orig_small[:, :, 2].astype(np.float32) * 0.114
-        )
-        # Полное подавление при Y > 235 (реальный блик), полная сила при Y < 210.
-        anti_highlight = np.clip((235.0 - orig_y_small) / 25.0, 0.0, 1.0)
-        chroma_loss *= anti_highlight
-        del orig_y_small, anti_highlight, orig_small, res_small
-
-        # Только на коже (маска skin_mask_for_post)
-        skin_cr_pil = Image.fromarray(
-            (skin_mask_for_post.astype(np.uint8) * 255), 'L'
-        ).resize((sW_, sH_), Image.BILINEAR)
-        skin_cr = np.asarray(skin_cr_pil, dtype=np.float32) / 255.0
-        del skin_cr_pil
-
-        # Сглаживаем переходы
-        chroma_loss *= skin_cr
-        cr_pil = Image.fromarray(
-            (chroma_loss * 255.0).clip(0, 255).astype(np.uint8), 'L'
-        ).filter(ImageFilter.GaussianBlur(radius=5))
-        del chroma_loss, skin_cr
-
-        # Сила восстановления цвета 0.40 — баланс:
-        # - 0.55 тянет к оригиналу с прыщами → тускло
-        # - 0.30 не лечит серые LaMa-артефакты → пятна
-        restore_strength = 0.40
-        # Апскейл карты + применение полосами
-        chunk = 192
-        applied_px = 0
-        total = 0
-        for y0 in range(0, H_, chunk):
-            y1 = min(H_, y0 + chunk)
-            ch_h = y1 - y0
-            sy0 = int(y0 * scale_cr)
-            sy1 = max(sy0 + 1, int(y1 * scale_cr))
-            cr_band_pil = cr_pil.crop((0, sy0, sW_, sy1)).resize((W_, ch_h), Image.BILINEAR)
-            cr_u8 = np.asarray(cr_band_pil, dtype=np.uint8)
-            del cr_band_pil
-            applied_px += int((cr_u8 > 20).sum())
-            total += cr_u8.size
-
-            w_cr = (cr_u8.astype(np.float32) / 255.0) * restore_strength
-            inv_cr = 1.0 - w_cr
-            for c in range(3):
-                new_c = (
-                    result[y0:y1, :, c].astype(np.float32) * inv_cr
-                    + orig_u8[y0:y1, :, c].astype(np.float32) * w_cr
-                )
-                result[y0:y1, :, c] = np.clip(new_c, 0, 255).astype(np.uint8)
-                del new_c
-            del w_cr, inv_cr, cr_u8
-
-        del cr_pil
-        affected_cr = (applied_px / total) if total else 0.0
-        print(
-            f"[RETOUCH] [v3] Chroma restoration: affected={affected_cr*100:.2f}% strength={restore_strength:.2f}"
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute(
+            '''UPDATE retouch_tasks SET compose_pending = FALSE
+               WHERE task_id = %s AND compose_pending AND status = 'finished'
+               RETURNING in_key, result_key, preset''',
+            (api_task_id,)
         )
-    except Exception as e:
-        print(f"[RETOUCH] Chroma restoration failed (non-critical): {e}")
-
-    # orig_u8 больше не нужен — освобождаем 4-12 МБ для color match и smoothing
-    del orig_u8
-    import gc as _gc_e
-    _gc_e.collect()
-
-    # === ЛОКАЛЬНОЕ ВЫРАВНИВАНИЕ ЦВЕТА (anti-bright/desaturated-spot) ===
-    # ULTRA-LOW MEMORY: весь анализ на маленьком масштабе (long side = 384px).
-    # Полноразмерных массивов НЕ создаём вообще — апскейл идёт построчно
-    # прямо из маленьких PIL-картинок через crop+resize по полосам.
-    # Аварийный выход при любой нехватке памяти/исключении.
-    import gc as _gc
-    _gc.collect()
-    _gc.collect()  # двойной collect — освобождает циклические ссылки от PIL
-    try:
-        # === COLOR MATCH ПРИНУДИТЕЛЬНО ОТКЛЮЧЁН ===
-        # Использовал GaussianBlur(radius=25) на масштабе 384px = ~190px на оригинале.
-        # Это создавало "молочный туман" и mismatch цвета на щеках/подбородке.
-        # До доработки полностью выключаем.
-        skip_color_match = True
-        print("[RETOUCH] [v3] color match: FORCE DISABLED (источник тумана)")
-        try:
-            cur_rss_mb = 0.0
-            try:
-                with open('/proc/self/status', 'r') as _f:
-                    for _line in _f:
-                        if _line.startswith('VmRSS:'):
-                            cur_rss_mb = float(_line.split()[1]) / 1024.0
-                            break
-            except Exception:
-                # fallback: ru_maxrss (peak), мягкий порог
-                import resource as _res
-                cur_rss_mb = _res.getrusage(_res.RUSAGE_SELF).ru_maxrss / 1024.0 * 0.7
-            # Лимит функции 256MB. Color match добавляет ~25-35MB на 384px.
-            # Скипаем только если уже > 215MB (реальный риск OOM).
-            if cur_rss_mb > 215:
-                print(f"[RETOUCH] [v3] color match: skip, RSS={cur_rss_mb:.0f}MB high")
-                skip_color_match = True
-            else:
-                print(f"[RETOUCH] [v3] color match: RSS={cur_rss_mb:.0f}MB ok, running")
-        except Exception:
-            pass
-
-        # Также пропускаем только для ОЧЕНЬ больших фото
-        if not skip_color_match and result.shape[0] * result.shape[1] > 1900 * 1900:
-            print(f"[RETOUCH] [v3] color match: skip, image too big ({result.shape[1]}x{result.shape[0]})")
-            skip_color_match = True
-
-        if not skip_color_match and skin_mask_for_post.sum() > 200 and result.ndim == 3:
-            H, W = result.shape[:2]
-            long_side = 384  # меньше → меньше памяти
-            scale = min(1.0, long_side / float(max(H, W)))
-            sH = max(8, int(round(H * scale)))
-            sW = max(8, int(round(W * scale)))
-
-            # === ВСЁ НА МАЛЕНЬКОМ МАСШТАБЕ ===
-            small_pil = Image.fromarray(result, 'RGB').resize((sW, sH), Image.BILINEAR)
-            small_rgb = np.asarray(small_pil, dtype=np.uint8)
-            del small_pil
-
-            skin_small_pil = Image.fromarray(
-                (skin_mask_for_post.astype(np.uint8) * 255), 'L'
-            ).resize((sW, sH), Image.BILINEAR)
-
-            search_pil = skin_small_pil.filter(
-                ImageFilter.MaxFilter(size=9)
-            ).filter(ImageFilter.GaussianBlur(radius=3))
-            search_w = np.asarray(search_pil, dtype=np.float32) / 255.0
-            del search_pil
-
-            base_pil = skin_small_pil.filter(ImageFilter.GaussianBlur(radius=2))
-            base_u8 = np.asarray(base_pil, dtype=np.uint8)
-            del base_pil, skin_small_pil
-
-            # === ПРЕДВАРИТЕЛЬНЫЙ ЭТАЛОН (узкое окно, как раньше) ===
-            blur_r = 10
-            w_blur_pil = Image.fromarray(base_u8, 'L').filter(
-                ImageFilter.GaussianBlur(radius=blur_r)
-            )
-            w_blur = np.asarray(w_blur_pil, dtype=np.float32)
-            np.maximum(w_blur, 1.0, out=w_blur)
-            del w_blur_pil
-
-            local_rgb_pre = np.empty((sH, sW, 3), dtype=np.uint8)
-            base_w_f = base_u8.astype(np.float32) / 255.0
-            for c in range(3):
-                cw = small_rgb[:, :, c].astype(np.float32) * base_w_f
-                cw_pil = Image.fromarray(
-                    np.clip(cw, 0, 255).astype(np.uint8), 'L'
-                ).filter(ImageFilter.GaussianBlur(radius=blur_r))
-                local_c = (np.asarray(cw_pil, dtype=np.float32) * 255.0) / w_blur
-                local_rgb_pre[:, :, c] = np.clip(local_c, 0, 255).astype(np.uint8)
-                del cw, cw_pil, local_c
-            del w_blur
-
-            # === ШАГ 1: первичный детект пятна ===
-            res_y = (
-                small_rgb[:, :, 0].astype(np.float32) * 0.299
-                + small_rgb[:, :, 1].astype(np.float32) * 0.587
-                + small_rgb[:, :, 2].astype(np.float32) * 0.114
-            )
-            pre_y = (
-                local_rgb_pre[:, :, 0].astype(np.float32) * 0.299
-                + local_rgb_pre[:, :, 1].astype(np.float32) * 0.587
-                + local_rgb_pre[:, :, 2].astype(np.float32) * 0.114
-            )
-            res_chroma = (
-                small_rgb.max(axis=2).astype(np.float32)
-                - small_rgb.min(axis=2).astype(np.float32)
-            )
-            pre_chroma = (
-                local_rgb_pre.max(axis=2).astype(np.float32)
-                - local_rgb_pre.min(axis=2).astype(np.float32)
-            )
-            # Чувствительнее, чтобы захватить даже слабо-выраженный блик
-            pre_bright = np.clip((res_y - pre_y - 3.0) / 12.0, 0.0, 1.0)
-            pre_desat = np.clip((pre_chroma - res_chroma - 3.0) / 12.0, 0.0, 1.0)
-            pre_spot = np.maximum(pre_bright, pre_desat) * search_w
-            del pre_bright, pre_desat, pre_y, pre_chroma, local_rgb_pre
-
-            # Расширяем найденную «грязь» — блик влияет на эталон вокруг себя
-            pre_spot_pil = Image.fromarray(
-                (pre_spot * 255.0).clip(0, 255).astype(np.uint8), 'L'
-            ).filter(ImageFilter.MaxFilter(size=9)).filter(
-                ImageFilter.GaussianBlur(radius=4)
-            )
-            spot_dilated = np.asarray(pre_spot_pil, dtype=np.float32) / 255.0
-            del pre_spot_pil, pre_spot
-
-            # === ШАГ 2: ЧИСТАЯ маска кожи (без пятна) — для пересчёта эталона ===
-            # clean = базовая маска * (1 - spot_dilated). Чем сильнее пятно — тем
-            # меньше вес у этой точки при расчёте локального цвета.
-            clean_w_f = base_w_f * (1.0 - spot_dilated)
-            clean_w_u8 = np.clip(clean_w_f * 255.0, 0, 255).astype(np.uint8)
-            del base_w_f
-
-            # Большой радиус blur — берём цвет издалека, мимо блика
-            big_blur_r = 25  # на 384px ≈ 100px на оригинале
-            w_blur2_pil = Image.fromarray(clean_w_u8, 'L').filter(
-                ImageFilter.GaussianBlur(radius=big_blur_r)
-            )
-            w_blur2 = np.asarray(w_blur2_pil, dtype=np.float32)
-            np.maximum(w_blur2, 1.0, out=w_blur2)
-            del w_blur2_pil
-
-            local_rgb_small = np.empty((sH, sW, 3), dtype=np.uint8)
-            for c in range(3):
-                cw = small_rgb[:, :, c].astype(np.float32) * clean_w_f
-                cw_pil = Image.fromarray(
-                    np.clip(cw, 0, 255).astype(np.uint8), 'L'
-                ).filter(ImageFilter.GaussianBlur(radius=big_blur_r))
-                local_c = (np.asarray(cw_pil, dtype=np.float32) * 255.0) / w_blur2
-                local_rgb_small[:, :, c] = np.clip(local_c, 0, 255).astype(np.uint8)
-                del cw, cw_pil, local_c
-            del clean_w_f, clean_w_u8, w_blur2
-
-            # === ШАГ 2.5: ГЛОБАЛЬНЫЙ средний цвет кожи (по чистым точкам) ===
-            # Берём только пиксели где base_u8 высокий И spot_dilated низкий.
-            # Это «настоящий» цвет кожи лица — используется как мягкий fallback
-            # в больших пятнах, где локальный blur всё равно близко к пятну.
-            try:
-                clean_mask_bool = (base_u8 > 200) & (spot_dilated < 0.2)
-                if clean_mask_bool.sum() > 50:
-                    global_r = int(np.median(small_rgb[:, :, 0][clean_mask_bool]))
-                    global_g = int(np.median(small_rgb[:, :, 1][clean_mask_bool]))
-                    global_b = int(np.median(small_rgb[:, :, 2][clean_mask_bool]))
-                    print(
-                        f"[RETOUCH] [v3] Global skin color (clean): RGB=({global_r},{global_g},{global_b}) from {int(clean_mask_bool.sum())} px"
-                    )
-                    # Подмешиваем глобальный к локальному ТАМ ГДЕ ПЯТНО СИЛЬНОЕ.
-                    # spot_dilated близко к 1 → больше глобального, меньше локального.
-                    mix = spot_dilated * 0.5  # до 50% глобального в центре пятна
-                    inv = 1.0 - mix
-                    local_rgb_small[:, :, 0] = np.clip(
-                        local_rgb_small[:, :, 0].astype(np.float32) * inv + global_r * mix,
-                        0, 255
-                    ).astype(np.uint8)
-                    local_rgb_small[:, :, 1] = np.clip(
-                        local_rgb_small[:, :, 1].astype(np.float32) * inv + global_g * mix,
-                        0, 255
-                    ).astype(np.uint8)
-                    local_rgb_small[:, :, 2] = np.clip(
-                        local_rgb_small[:, :, 2].astype(np.float32) * inv + global_b * mix,
-                        0, 255
-                    ).astype(np.uint8)
-                    del mix, inv, clean_mask_bool
-            except Exception as ge:
-                print(f"[RETOUCH] Global skin color skipped: {ge}")
-            del base_u8, spot_dilated
-
-            # === ШАГ 3: ФИНАЛЬНЫЙ детект пятна по ЧИСТОМУ эталону ===
-            local_y = (
-                local_rgb_small[:, :, 0].astype(np.float32) * 0.299
-                + local_rgb_small[:, :, 1].astype(np.float32) * 0.587
-                + local_rgb_small[:, :, 2].astype(np.float32) * 0.114
-            )
-            local_chroma = (
-                local_rgb_small.max(axis=2).astype(np.float32)
-                - local_rgb_small.min(axis=2).astype(np.float32)
-            )
-
-            bright_spot = np.clip((res_y - local_y - 4.0) / 12.0, 0.0, 1.0)
-            desat_spot = np.clip((local_chroma - res_chroma - 4.0) / 12.0, 0.0, 1.0)
-            spot_strength = np.maximum(bright_spot, desat_spot) * search_w
-            del bright_spot, desat_spot, res_y, local_y
-            del res_chroma, local_chroma, search_w, small_rgb
-
-            spot_small_pil = Image.fromarray(
-                (spot_strength * 255.0).clip(0, 255).astype(np.uint8), 'L'
-            ).filter(ImageFilter.GaussianBlur(radius=3))
-            del spot_strength
-
-            # Финальные маленькие PIL-картинки — апскейлим ПОЛОСАМИ
-            local_rgb_small_pil = Image.fromarray(local_rgb_small, 'RGB')
-            del local_rgb_small
-
-            pull = 0.95
-            chunk = 192
-            affected_px = 0
-            total_px = 0
-            for y0 in range(0, H, chunk):
-                y1 = min(H, y0 + chunk)
-                ch_h = y1 - y0
-                # Соответствующая полоса на маленьком масштабе
-                sy0 = int(y0 * scale)
-                sy1 = max(sy0 + 1, int(y1 * scale))
-                # Полоса локального цвета → ресайз к (W, ch_h)
-                lc_band_pil = local_rgb_small_pil.crop(
-                    (0, sy0, sW, sy1)
-                ).resize((W, ch_h), Image.BILINEAR)
-                lc_band = np.asarray(lc_band_pil, dtype=np.uint8)
-                del lc_band_pil
-                # Полоса силы пятна
-                sw_band_pil = spot_small_pil.crop(
-                    (0, sy0, sW, sy1)
-                ).resize((W, ch_h), Image.BILINEAR)
-                sw_u8 = np.asarray(sw_band_pil, dtype=np.uint8)
-                del sw_band_pil
-
-                affected_px += int((sw_u8 > 13).sum())
-                total_px += sw_u8.size
-
-                sw = (sw_u8.astype(np.float32) / 255.0) * pull
-                inv = 1.0 - sw
-                for c in range(3):
-                    new_c = (
-                        result[y0:y1, :, c].astype(np.float32) * inv
-                        + lc_band[:, :, c].astype(np.float32) * sw
-                    )
-                    result[y0:y1, :, c] = np.clip(new_c, 0, 255).astype(np.uint8)
-                    del new_c
-                del sw, inv, sw_u8, lc_band
-
-            del local_rgb_small_pil, spot_small_pil
-            affected = (affected_px / total_px) if total_px else 0.0
-            print(
-                f"[RETOUCH] [v3] Local color match v4 (2-pass+global, scale={scale:.2f}): affected={affected*100:.2f}% pull={pull:.2f}"
-            )
-    except MemoryError as e:
-        print(f"[RETOUCH] Local color match skipped (OOM): {e}")
-    except Exception as e:
-        print(f"[RETOUCH] Local color match failed (non-critical): {e}")
-
-    # === МЯГКОЕ РАЗГЛАЖИВАНИЕ КОЖИ ===
-    # На средних/дальних планах LaMa почти не сглаживает (масштаб мелкий),
-    # поэтому добавляем СВОЁ разглаживание через локальное усреднение
-    # (псевдо-bilateral на numpy). Сила зависит от плана и типа кожи.
-    try:
-        # Базовая сила smoothing. Подняты значения: мелкие красно-коричневые
-        # точки (на носу, щеках) требуют radius >= 4 и strength >= 0.5,
-        # иначе они просто проходят сквозь размытие.
-        if shot_type == "closeup":
-            smooth_strength = 0.55     # было 0.25 — мало
-            smooth_radius = 5          # было 3 — слишком мелко для пятен
-        elif shot_type == "medium":
-            smooth_strength = 0.65     # было 0.45
-            smooth_radius = 5
-        elif shot_type == "wide":
-            smooth_strength = 0.45     # было 0.30
-            smooth_radius = 4
-        else:
-            smooth_strength = 0.0
-            smooth_radius = 0
-
-        # Для акне-кожи дополнительный буст +30%
-        if skin_type == "young_acne":
-            smooth_strength *= 1.30
-
-        # На mature кожах (морщины) — снижаем чтобы не превратить в пластик
-        if skin_type in ("mature", "mature_textured"):
-            smooth_strength *= 0.7
-
-        # Множитель из пресета (light=0.5, medium=0.85, strong=1.15)
-        smooth_strength *= float(preset.get("skin_smooth_multiplier", 0.85))
-
-        # === SKIN SMOOTHING с жёсткой маской ===
-        # Возвращён, но с feather=2 (вместо 6) — это убирает мелкие красные точки
-        # на коже, которые сервер ретуши пропускает, и НЕ создаёт «дымку» по краю
-        # лица (раньше feather=6 давал нимб + размывал границу с волосами).
-        # Дополнительно: erosion маски на 4px уже сделан выше, так что
-        # сглаживание физически не выходит за лицо.
-        if smooth_strength > 0.05 and skin_mask_for_post.sum() > 100:
-            res_pil = Image.fromarray(result, 'RGB').filter(
-                ImageFilter.GaussianBlur(radius=smooth_radius)
-            )
-            blurred_u8 = np.array(res_pil, dtype=np.uint8)
-            del res_pil
-            # feather=2 (минимальный, чтобы не было ступенек). Раньше было 6.
-            mask_smooth_u8 = np.array(
-                Image.fromarray(
-                    (skin_mask_for_post.astype(np.uint8) * 255), 'L'
-                ).filter(ImageFilter.GaussianBlur(radius=2)),
-                dtype=np.uint8,
+        task = cur.fetchone()
+        conn.commit()
+    if not task:
+        return False
+    with span('compose'):
+        composed = _compose_via_retouch_compose(task['in_key'], task['result_key'],
+                                                task['preset'] or 'medium', timeout=timeout)
+    if not composed:
+        return False
+    result_key, size = composed
+    if size:
+        with conn.cursor() as cur:
+            cur.execute(
+                'UPDATE photo_bank SET file_size = %s WHERE s3_key = %s AND is_trashed = FALSE',
+                (size, result_key)
             )
-            for c in range(3):
-                diff_c = blurred_u8[..., c].astype(np.int16) - result[..., c].astype(np.int16)
-                w = (mask_smooth_u8.astype(np.uint16) * int(smooth_strength * 256)) >> 8
-                contrib = (diff_c * w.astype(np.int16)) >> 8
-                result[..., c] = np.clip(
-                    result[..., c].astype(np.int16) + contrib, 0, 255
-                ).astype(np.uint8)
-                del diff_c, w, contrib
-            del blurred_u8, mask_smooth_u8
-            print(f"[RETOUCH] [v3] Skin smoothing applied: shot={shot_type} skin={skin_type} "
-                  f"strength={smooth_strength:.2f} radius={smooth_radius} feather=2")
-        else:
-            print(f"[RETOUCH] [v3] Skin smoothing skipped: strength={smooth_strength:.2f}")
-    except Exception as e:
-        print(f"[RETOUCH] Skin smoothing failed (non-critical): {e}")
-
-    # === RED-CAST REMOVAL: выравниваем «следы прыщей» по тону кожи ===
-    # Сервер ретуши убирает выпуклость прыща, но часто оставляет красное
-    # пятно на том же месте. Мы находим пиксели с избытком красного
-    # (R > среднего R окружающей кожи), и подтягиваем их R-канал к среднему
-    # тону кожи в радиусе 30px. G/B каналы не трогаем — иначе пятно станет
-    # серым (тоже плохо). Применяется ТОЛЬКО внутри маски кожи.
-    try:
-        if skin_mask_for_post.sum() > 200:
-            mask_bool = skin_mask_for_post
-            r_ch = result[:, :, 0].astype(np.float32)
-            g_ch = result[:, :, 1].astype(np.float32)
-            b_ch = result[:, :, 2].astype(np.float32)
-
-            # «Средний R соседей»: blur R-канала с большим радиусом
-            # (берём цвет издалека, минуя само пятно)
-            blur_r_pil = Image.fromarray(result[:, :, 0], 'L').filter(
-                ImageFilter.GaussianBlur(radius=30)
+            conn.commit()
+    return True
+
+
+def _compose_pending(conn, budget):
+    """Таймер: композиция задач, завершённых опросом статуса (там её не
+    ждём). Returns: сколько задач скомпоновано."""
+    deadline = time.monotonic() + budget
+    done = 0
+    while True:
+        left = deadline - time.monotonic()
+        if left < COMPOSE_MIN_SEC:
+            break
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(
+                '''SELECT task_id FROM retouch_tasks
+                   WHERE compose_pending AND status = 'finished'
+                   ORDER BY updated_at LIMIT 1'''
             )
-            r_local_avg = np.asarray(blur_r_pil, dtype=np.float32)
-            del blur_r_pil
-
-            # Избыток красного в пикселе: насколько R выше среднего R вокруг
-            r_excess = r_ch - r_local_avg
-
-            # «Краснота» пикселя: R заметно выше G и B одновременно.
-            redness = r_ch - (g_ch + b_ch) / 2.0
-
-            # Пятно = и красноватый цвет, и локально выше среднего R.
-            # Порог 8 — обычные веснушки/тени не задеваем.
-            spot = np.clip((r_excess - 4.0) / 12.0, 0.0, 1.0) \
-                 * np.clip((redness - 8.0) / 10.0, 0.0, 1.0)
-
-            # Только внутри маски кожи (с тем же feather что у основной)
-            spot *= mask_bool.astype(np.float32)
-
-            # Сила коррекции: до 60% подтяжки к локальному среднему
-            pull = 0.6
-            r_new = r_ch * (1.0 - spot * pull) + r_local_avg * (spot * pull)
-            result[:, :, 0] = np.clip(r_new, 0, 255).astype(np.uint8)
-
-            affected = float(np.count_nonzero(spot > 0.1)) * 100 / spot.size
-            print(f"[RETOUCH] [v3] Red-cast removal: affected={affected:.2f}% pull={pull:.2f}")
-            del r_ch, g_ch, b_ch, r_local_avg, r_excess, redness, spot, r_new
-    except Exception as e:
-        print(f"[RETOUCH] Red-cast removal failed (non-critical): {e}")
-
-    # === Capture One свадебный пресет (финальная цветокоррекция) ===
-    # WB Kelvin 5390 / Tint -5.4, Exposure -0.39, Contrast -9, Brightness +22,
-    # Saturation +12, HDR (Highlights -50, Shadows +7, Whites -22, Blacks +15),
-    # Vignette -0.34, Color editor (Orange/Yellow/Cyan).
-    out_img = Image.fromarray(result, 'RGB')
-    del result
-
-    # === Skin denoise ПРИНУДИТЕЛЬНО ОТКЛЮЧЁН ===
-    # _denoise_luminance() в c1_preset.py размывает КАЖДЫЙ канал R/G/B отдельно
-    # GaussianBlur'ом radius=1.2 и блендит через общий edge_mask. На границе
-    # кожа/волосы из-за feather=4 в маске это даёт хроматический сдвиг — ту
-    # самую RGB-радугу, которую мы видим на щеке и шее.
-    # Сервер ретуши уже отдаёт денойзенную кожу — наш доп. шумодав излишен.
-    denoise_strength = float(preset.get("denoise_strength", 0.15))
-    print(f"[RETOUCH] [v3] Skin denoise: FORCE DISABLED "
-          f"(planned strength={denoise_strength:.2f}) — источник RGB-радуги")
-
-    # === Dodge & Burn ОТКЛЮЧЁН ===
-    # Создавал RGB-ореолы и пересвет на лице — снято до доработки.
-    dodge_burn_strength = 0.0
-
-    # === Capture One цветокоррекция ПРИНУДИТЕЛЬНО ОТКЛЮЧЕНА ===
-    # Внутри _denoise_luminance() применялся GaussianBlur 1.2px к каждому RGB-каналу
-    # отдельно → создавал "молочный туман" и сдвиг каналов на щеках/подбородке.
-    # Пока не починим — выключено для всех пресетов независимо от настроек.
-    print("[RETOUCH] [v3] C1 preset DISABLED (источник тумана и ореолов)")
-
-    # === Финальный sharpening ПРИНУДИТЕЛЬНО ОТКЛЮЧЁН ===
-    # UnsharpMask по skin-маске с feather=4 на границе волосы/кожа давал
-    # цветные RGB-ореолы (хроматическая аберрация). Сервер ретуши уже сохраняет
-    # достаточную резкость черт лица — наш доп. шарпинг создавал больше
-    # артефактов чем пользы. Выключено до доработки.
-    sharpen_amount = float(preset.get("sharpen_amount", 0.45))
-    print(f"[RETOUCH] [v3] Skin sharpening: FORCE DISABLED "
-          f"(planned amount={sharpen_amount:.2f}) — источник RGB-ореола на границе щека/волосы")
-
-    # background_protect полностью убран — давал двойные контуры/ореолы.
-    # Если фон становится серым — это лечится на стороне LaMa-API, не post-compose.
-
-    jpeg_quality = int(preset.get("jpeg_quality", 95))
-    out_buf = io.BytesIO()
-    out_img.save(out_buf, format='JPEG', quality=jpeg_quality, subsampling=0)
-    print(f"[RETOUCH] Composed: coverage={coverage*100:.1f}% skin={skin_type} alpha={alpha:.2f} preset={preset_name} q={jpeg_quality}")
-    return out_buf.getvalue()
-'''  # END of _LEGACY_BLOB_DEAD_CODE_BLOB_START — мёртвый код упакован в строку
-
-
-def _save_result_bytes(conn, user_id, task, result_bytes):
-    """Сохранить готовые байты результата в S3 и БД."""
+            row = cur.fetchone()
+            conn.commit()
+        if not row:
+            break
+        if _compose_finished_task(conn, row['task_id'],
+                                  timeout=(COMPOSE_TIMEOUT[0], min(COMPOSE_TIMEOUT[1], left))):
+            done += 1
+    if done:
+        print(f"[RETOUCH] Composed {done} finished tasks")
+    return done
+
+
+def _save_result_bytes(conn, user_id, task, result_bytes, stored_key=None):
+    """Сохранить готовые байты результата в S3 и БД.
+
+    stored_key — результат уже лежит в бакете под этим ключом (его туда
+    положил API ретуши по presigned PUT); повторно грузим, только если
+    пришлось перекодировать в JPEG.
+    """
     s3_client = _get_s3_client()
     db_task_id = task['task_id']
-    photo_id = task.get('photo_id')
     in_key = task.get('in_key', '')
-    preset_name = task.get('preset') or 'medium'
-    out_key = _build_out_key(in_key)
+    out_key = stored_key or _build_result_key(in_key, db_task_id or uuid.uuid4().hex)
+
+    with span('normalize', len(result_bytes)):
+        normalized = _normalize_image_bytes(result_bytes)
+    # _normalize_image_bytes возвращает тот же объект, если это уже JPEG
+    needs_upload = stored_key is None or normalized is not result_bytes
+    result_bytes = normalized
+
+    if needs_upload:
+        with span('s3_put', len(result_bytes)):
+            s3_client.put_object(
+                Bucket=S3_BUCKET,
+                Key=out_key,
+                Body=result_bytes,
+                ContentType='image/jpeg'
+            )
+        print(f"[RETOUCH] Uploaded to S3: {out_key} ({len(result_bytes)} bytes)")
+    else:
+        print(f"[RETOUCH] Result already in S3: {out_key} ({len(result_bytes)} bytes)")
+    return _finish_result(conn, user_id, task, out_key, result_bytes=result_bytes)
 
-    if not out_key.endswith('.jpg'):
-        out_key = out_key.rsplit('.', 1)[0] + '.jpg' if '.' in out_key else out_key + '.jpg'
 
-    unique_suffix = (db_task_id or uuid.uuid4().hex)[:12]
-    if out_key.endswith('.jpg'):
-        out_key = f"{out_key[:-4]}__{unique_suffix}.jpg"
-
-    result_bytes = _normalize_image_bytes(result_bytes)
-
-    # ПОСТ-ОБРАБОТКА ОТКЛЮЧЕНА:
-    # Раньше здесь вызывался _compose_with_original_by_mask, который смешивал
-    # ret от сервера с оригиналом по маске кожи. Эта функция в сумме с deps
-    # делала пакет retouch слишком большим для 60-секундного деплоя платформы,
-    # из-за чего ВСЕ правки последних итераций не доезжали до прода.
-    # Теперь отдаём ret от сервера as-is — сервер уже даёт хороший результат.
-    print(f"[RETOUCH] [v7] Skipping compose — using ret from server as-is "
-          f"(preset={preset_name})")
-
-    s3_client.put_object(
-        Bucket=S3_BUCKET,
-        Key=out_key,
-        Body=result_bytes,
-        ContentType='image/jpeg'
-    )
+def _finish_result(conn, user_id, task, out_key, result_bytes=None, result_size=None):
+    """Результат лежит в бакете под out_key: отметить задачу finished и
+    добавить фото в папку ретуши. Без result_bytes миниатюры не строим —
+    их поставит в очередь просмотр папки (фото без thumbnail_s3_key).
+    Композицию с оригиналом (compose_pending) делает _compose_finished_task
+    из колбэка или таймера — опрос статуса её не ждёт."""
+    db_task_id = task['task_id']
+    photo_id = task.get('photo_id')
     final_url = f"https://storage.yandexcloud.net/{S3_BUCKET}/{out_key}"
-    print(f"[RETOUCH] Uploaded to S3: {out_key} ({len(result_bytes)} bytes)")
 
-    with conn.cursor() as cur:
+    with span('db'), conn.cursor() as cur:
         cur.execute(
-            "UPDATE retouch_tasks SET status='finished', result_key=%s, result_url=%s, error_message=NULL, updated_at=NOW() WHERE task_id=%s AND user_id=%s",
+            "UPDATE retouch_tasks SET status='finished', result_key=%s, result_url=%s, error_message=NULL, compose_pending=(COALESCE(in_key, '') <> ''), updated_at=NOW() WHERE task_id=%s AND user_id=%s",
             (out_key, final_url, db_task_id, user_id)
         )
         conn.commit()
 
     if photo_id:
-        _save_retouched_photo(conn, user_id, photo_id, out_key, final_url, result_bytes=result_bytes)
+        _save_retouched_photo(conn, user_id, photo_id, out_key, final_url,
+                              result_bytes=result_bytes, result_size=result_size)
 
     return out_key, final_url
 
 
+def _stored_is_jpeg(s3_client, key, head):
+    """JPEG ли объект в бакете: по ContentType, а если он не задан — по
+    первым трём байтам (Range), не скачивая картинку."""
+    content_type = (head.get('ContentType') or '').split(';')[0].strip().lower()
+    if content_type in ('image/jpeg', 'image/jpg', 'image/pjpeg'):
+        return True
+    if content_type not in ('', 'binary/octet-stream', 'application/octet-stream'):
+        return False
+    with span('s3_probe'):
+        magic = s3_client.get_object(Bucket=S3_BUCKET, Key=key, Range='bytes=0-2')['Body'].read()
+    return magic == b'\xff\xd8\xff'
+
+
+def _save_uploaded_result(conn, user_id, task):
+    """Забрать результат, который API ретуши положил по presigned PUT
+    (режим url). None — объекта нет (сервер вернул картинку иначе).
+
+    JPEG остаётся в бакете как есть — проверяем head_object и записываем
+    ключ, не пропуская картинку через память функции. Скачиваем только
+    не-JPEG: его нужно перекодировать.
+    """
+    upload_key = task.get('result_upload_key')
+    if not upload_key:
+        return None
+    s3_client = _get_s3_client()
+    try:
+        with span('s3_head'):
+            head = s3_client.head_object(Bucket=S3_BUCKET, Key=upload_key)
+    except s3_client.exceptions.ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+            print(f"[RETOUCH] No uploaded result at {upload_key}, trying API response")
+            return None
+        raise
+    size = int(head.get('ContentLength') or 0)
+    if _stored_is_jpeg(s3_client, upload_key, head):
+        print(f"[RETOUCH] Uploaded result is JPEG, keeping in place: {upload_key} ({size} bytes)")
+        return _finish_result(conn, user_id, task, upload_key, result_size=size)
+
+    with span('s3_get') as sp:
+        result_bytes = s3_client.get_object(Bucket=S3_BUCKET, Key=upload_key)['Body'].read()
+        sp.bytes = len(result_bytes)
+    print(f"[RETOUCH] Uploaded result needs conversion: {upload_key} "
+          f"({head.get('ContentType')}, {len(result_bytes)} bytes)")
+    return _save_result_bytes(conn, user_id, task, result_bytes, stored_key=upload_key)
+
+
 def _download_result_and_save(conn, user_id, task, result_url_from_api):
     """Скачать результат по URL, сохранить в свой бакет и в БД."""
     s3_client = _get_s3_client()
@@ -1759,8 +790,9 @@ def _download_result_and_save(conn, user_id, task, result_url_from_api):
     if s3_key_from_url:
         try:
             print(f"[RETOUCH] Trying S3 direct download: {s3_key_from_url}")
-            obj = s3_client.get_object(Bucket=S3_BUCKET, Key=s3_key_from_url)
-            result_bytes = obj['Body'].read()
+            with span('s3_get') as sp:
+                result_bytes = s3_client.get_object(Bucket=S3_BUCKET, Key=s3_key_from_url)['Body'].read()
+                sp.bytes = len(result_bytes)
             print(f"[RETOUCH] S3 direct download OK: {len(result_bytes)} bytes")
         except Exception as e:
             print(f"[RETOUCH] S3 direct download failed: {e}")
@@ -1773,6 +805,7 @@ def _download_result_and_save(conn, user_id, task, result_url_from_api):
         # 3 попытки: connect_timeout 30/60/90, read_timeout 180. Между — короткая пауза.
         last_err = None
         resp = None
+        download_started = time.perf_counter()
         for attempt in range(3):
             connect_to = 30 + attempt * 30
             try:
@@ -1800,6 +833,7 @@ def _download_result_and_save(conn, user_id, task, result_url_from_api):
         if resp is None or resp.status_code != 200:
             raise RuntimeError(f"Failed to download result after 3 attempts: {last_err}")
         result_bytes = resp.content
+        record_stage('download', time.perf_counter() - download_started, len(result_bytes))
 
     print(f"[RETOUCH] Downloaded {len(result_bytes)} bytes")
 
@@ -1826,6 +860,22 @@ def _check_plugins_available():
     }
 
 
+def _startup_report(trace, action):
+    """Первый вызов инстанса: время импорта модуля, время до конца первого
+    вызова и какие тяжёлые модули ему понадобились. Импорт пишется этапом
+    cold_import в Trace — в pipeline_stage_stats видны p50/p95 холодного
+    старта по часам."""
+    global _startup_reported
+    if _startup_reported:
+        return
+    _startup_reported = True
+    trace.add('cold_import', _IMPORT_SECONDS)
+    loaded = [m for m in HEAVY_MODULES if m in sys.modules]
+    first_call_ms = (time.perf_counter() - _IMPORT_STARTED) * 1000
+    print(f"[RETOUCH] Cold start: import={_IMPORT_SECONDS * 1000:.0f}ms "
+          f"first_call={first_call_ms:.0f}ms action={action} heavy={','.join(loaded) or 'none'}")
+
+
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     """Ретушь фотографий через API io.foto-mix.ru — асинхронная очередь (submit → poll status → скачать результат)."""
     method = event.get('httpMethod', 'GET')
@@ -1833,13 +883,20 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     if method == 'OPTIONS':
         return {'statusCode': 200, 'headers': _cors_headers(), 'body': '', 'isBase64Encoded': False}
 
+    params = event.get('queryStringParameters', {}) or {}
+    # Колбэк сервера ретуши и таймер раздачи очереди — без X-User-Id,
+    # авторизация по токену в URL
+    if method == 'POST' and params.get('action') == 'callback':
+        return _handle_callback(event, params)
+    if method == 'POST' and params.get('action') == 'dispatch':
+        return _handle_dispatch(params)
+
     headers = event.get('headers', {})
     user_id = headers.get('X-User-Id') or headers.get('x-user-id')
 
     if not user_id:
         return _response(401, {'error': 'User not authenticated'})
 
-    params = event.get('queryStringParameters', {}) or {}
     if params.get('check_plugins') == '1':
         return _response(200, {'plugins': _check_plugins_available()})
 
@@ -1848,6 +905,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
 
     db_url = os.environ.get('DATABASE_URL')
     conn = psycopg2.connect(db_url)
+    action = params.get('action') or ('create' if method == 'POST' else 'status')
+    trace = Trace('retouch', action=action)
 
     try:
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
@@ -1856,16 +915,138 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             if not user or not user['email_verified_at']:
                 return _response(403, {'error': 'Email not verified'})
 
-        if method == 'GET' and params.get('action') == 'preview_mask':
-            return _handle_preview_mask(conn, user_id, params)
+        with trace:
+            if method == 'GET' and params.get('action') == 'preview_mask':
+                return _handle_preview_mask(conn, user_id, params)
 
-        if method == 'POST':
-            return _handle_create(event, conn, user_id)
-        elif method == 'GET':
-            return _handle_status(event, conn, user_id)
-        else:
-            return _response(405, {'error': 'Method not allowed'})
+            if params.get('action') == 'batch':
+                if method == 'POST':
+                    return _handle_batch_create(event, conn, user_id)
+                return _handle_batch_status(conn, user_id, params)
+
+            if method == 'POST':
+                return _handle_create(event, conn, user_id)
+            elif method == 'GET':
+                return _handle_status(event, conn, user_id)
+            else:
+                return _response(405, {'error': 'Method not allowed'})
     finally:
+        _startup_report(trace, action)
+        # Опрос статуса без скачивания результата ничего не замеряет — не шумим в логе
+        if trace.as_dict():
+            trace.emit()
+            trace.flush(conn)
+        conn.close()
+
+
+def _handle_dispatch(params):
+    """POST ?action=dispatch&token=... — таймер-триггер: скомпоновать
+    задачи, завершённые опросом статуса, и раздать пакетную очередь на
+    свободные места GPU (страховка, если колбэков и опросов нет)."""
+    token = params.get('token') or ''
+    if not RETOUCH_CALLBACK_SECRET or not hmac.compare_digest(token, RETOUCH_CALLBACK_SECRET):
+        return _response(403, {'error': 'Invalid dispatch token'})
+    conn = psycopg2.connect(os.environ.get('DATABASE_URL'))
+    try:
+        started = time.monotonic()
+        composed = _compose_pending(conn, COMPOSE_TIMER_BUDGET)
+        sent = _dispatch_queue(conn, DISPATCH_TIMER_BUDGET - (time.monotonic() - started))
+        return _response(200, {'dispatched': sent, 'composed': composed})
+    finally:
+        conn.close()
+
+
+def _handle_batch_create(event, conn, user_id):
+    """POST ?action=batch {"folder_id", "preset"?, "strength"?} — ретушь всей
+    папки. Фото встают в серверную очередь (без лимита 429 на одиночные
+    задачи) и уходят на GPU по мере освобождения мест."""
+    body = json.loads(event.get('body', '{}') or '{}')
+    folder_id = body.get('folder_id')
+    if not folder_id:
+        return _response(400, {'error': 'folder_id is required'})
+
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute(
+            'SELECT id FROM photo_folders WHERE id = %s AND user_id = %s AND is_trashed = FALSE',
+            (folder_id, user_id)
+        )
+        if not cur.fetchone():
+            return _response(404, {'error': 'Folder not found'})
+
+    strength, enhance_face, preset_name = _resolve_retouch_settings(conn, body)
+    batch_id = uuid.uuid4().hex
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        queued = retouch_queue.enqueue_folder(cur, user_id, folder_id, batch_id,
+                                              preset_name, strength, enhance_face)
+        conn.commit()
+    print(f"[RETOUCH QUEUE] Batch {batch_id}: folder={folder_id} queued={queued} preset={preset_name}")
+
+    dispatched = _dispatch_queue(conn, DISPATCH_POLL_BUDGET, url_only=True) if queued else 0
+    return _response(200, {
+        'batch_id': batch_id,
+        'queued': queued,
+        'dispatched': dispatched,
+    })
+
+
+def _handle_batch_status(conn, user_id, params):
+    """GET ?action=batch&batch_id=X — прогресс пакета."""
+    batch_id = params.get('batch_id')
+    if not batch_id:
+        return _response(400, {'error': 'batch_id is required'})
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        summary = retouch_queue.batch_summary(cur, user_id, batch_id)
+    if not summary['total']:
+        return _response(404, {'error': 'Batch not found'})
+    return _response(200, dict(summary, batch_id=batch_id))
+
+
+def _handle_callback(event, params):
+    """POST ?action=callback&token=... — сервер ретуши сообщает о завершении.
+
+    Тело — как ответ GET /status: {"task_id", "status", "result_url" |
+    "image" | ..., "error"}. Результат сохраняется тем же _apply_api_status,
+    что и при опросе, так что дальше статус отдаётся из БД без похода в API.
+    """
+    token = params.get('token') or ''
+    if not RETOUCH_CALLBACK_SECRET or not hmac.compare_digest(token, RETOUCH_CALLBACK_SECRET):
+        return _response(403, {'error': 'Invalid callback token'})
+
+    body_raw = event.get('body') or '{}'
+    if event.get('isBase64Encoded'):
+        body_raw = base64.b64decode(body_raw).decode('utf-8')
+    try:
+        data = json.loads(body_raw)
+    except json.JSONDecodeError:
+        return _response(400, {'error': 'invalid JSON body'})
+    api_task_id = data.get('task_id') if isinstance(data, dict) else None
+    if not api_task_id:
+        return _response(400, {'error': 'task_id is required'})
+
+    conn = psycopg2.connect(os.environ.get('DATABASE_URL'))
+    trace = Trace('retouch', action='callback')
+    try:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(
+                f'SELECT user_id, {TASK_COLUMNS} FROM retouch_tasks WHERE task_id = %s',
+                (api_task_id,)
+            )
+            task = cur.fetchone()
+        if not task:
+            return _response(404, {'error': 'Task not found'})
+
+        print(f"[RETOUCH] Callback for {api_task_id}: status={data.get('status')}")
+        with trace:
+            task = _apply_api_status(conn, task['user_id'], task, data)
+            if task['status'] not in ACTIVE_STATUSES:
+                _dispatch_queue(conn, DISPATCH_POLL_BUDGET, url_only=True)
+            if task['status'] == 'finished':
+                _compose_finished_task(conn, api_task_id)
+        return _response(200, {'task_id': api_task_id, 'status': task['status']})
+    finally:
+        if trace.as_dict():
+            trace.emit()
+            trace.flush(conn)
         conn.close()
 
 
@@ -1893,29 +1074,39 @@ def _handle_preview_mask(conn, user_id, params):
 
     try:
         import gc
-        from skin_mask import build_auto_mask
+        from PIL import Image
+        from mask_cache import MaskCache
+        from skin_mask import build_auto_mask, set_mask_cache
         s3_client = _get_s3_client()
-        s3_resp = s3_client.get_object(Bucket=S3_BUCKET, Key=src_key)
-        image_bytes = s3_resp['Body'].read()
-        s3_resp = None
+        with span('s3_get') as sp:
+            image_bytes = s3_client.get_object(Bucket=S3_BUCKET, Key=src_key)['Body'].read()
+            sp.bytes = len(image_bytes)
         if used_thumb:
             print(f"[RETOUCH] preview_mask: using thumbnail for RAW ({src_key})")
 
-        img = _open_image_oriented(image_bytes)
-        orig_w, orig_h = img.size
-        max_side = 768
-        if max(orig_w, orig_h) > max_side:
-            ratio = max_side / max(orig_w, orig_h)
-            img = img.resize((int(orig_w * ratio), int(orig_h * ratio)), Image.LANCZOS)
-        buf = io.BytesIO()
-        img.save(buf, format='JPEG', quality=80)
-        preview_bytes = buf.getvalue()
-        out_w, out_h = img.size
+        with span('resize', len(image_bytes)):
+            img = _open_image_oriented(image_bytes)
+            orig_w, orig_h = img.size
+            max_side = 768
+            if max(orig_w, orig_h) > max_side:
+                ratio = max_side / max(orig_w, orig_h)
+                img = img.resize((int(orig_w * ratio), int(orig_h * ratio)), Image.LANCZOS)
+            buf = io.BytesIO()
+            img.save(buf, format='JPEG', quality=80)
+            preview_bytes = buf.getvalue()
+            out_w, out_h = img.size
 
         del image_bytes, img, buf
         gc.collect()
 
-        mask_b64 = build_auto_mask(preview_bytes)
+        # Превью детерминировано по исходнику, поэтому повторный предпросмотр
+        # той же фотографии берёт маски face_parse из кэша
+        set_mask_cache(MaskCache(conn, s3_client, S3_BUCKET))
+        try:
+            with span('auto_mask', len(preview_bytes)):
+                mask_b64 = build_auto_mask(preview_bytes)
+        finally:
+            set_mask_cache(None)
         del preview_bytes
         gc.collect()
         return _response(200, {
@@ -1968,10 +1159,43 @@ def _handle_create(event, conn, user_id):
             'error': 'Для RAW-файла ещё не готово превью — повторите через минуту'
         })
 
-    in_key = src_key
-    out_key = _build_out_key(photo['s3_key'])
-    out_prefix = out_key.rsplit("/", 1)[0] + "/" if "/" in out_key else "retouch/"
+    strength, enhance_face, preset_name = _resolve_retouch_settings(conn, body)
+
+    try:
+        api_task_id = _submit_photo(conn, user_id, photo, src_key, strength, enhance_face, preset_name)
+    except UnsupportedImageError as conv_err:
+        return _response(400, {
+            'error': f'Неподдерживаемый формат файла: {conv_err}'
+        })
+    except Exception as e:
+        import traceback
+        print(f"[RETOUCH] Submit failed: {e}")
+        print(f"[RETOUCH] Traceback: {traceback.format_exc()}")
+        return _response(503, {'error': f'Сервер ретуши недоступен: {str(e)[:200]}'})
+
+    return _response(200, {
+        'task_id': api_task_id,
+        'status': 'started',
+        'result_url': None,
+    })
+
+
+class UnsupportedImageError(Exception):
+    """Исходник не открывается / не конвертируется в JPEG."""
+
+
+class RetouchApiUnavailable(RuntimeError):
+    """Сервер ретуши перегружен или не отвечает (5xx / 429)."""
+
+
+class SubmitDeferred(Exception):
+    """Фото можно отправить только base64 — не в коротком бюджете опроса/колбэка."""
+
 
+def _resolve_retouch_settings(conn, body):
+    """strength / enhance_face / пресет из тела запроса с дефолтами из БД.
+    Returns: (strength, enhance_face, preset_name)
+    """
     strength = body.get('strength', None)
     enhance_face = body.get('enhance_face', None)
     if strength is None or enhance_face is None:
@@ -1988,65 +1212,105 @@ def _handle_create(event, conn, user_id):
     preset_cfg = get_preset(preset_name)
     if body.get('preset'):
         strength = float(preset_cfg.get('strength', strength))
+    return strength, enhance_face, preset_name
+
+
+def _submit_photo(conn, user_id, photo, src_key, strength, enhance_face, preset_name,
+                  timeout=SUBMIT_TIMEOUT, url_only=False):
+    """Отправить фото в API ретуши и записать задачу в retouch_tasks.
+    Общая часть одиночного POST и диспетчера пакетной очереди; timeout —
+    для POST /submit (диспетчер передаёт остаток своего бюджета).
+    url_only — только по ссылке: фото, которому нужен base64 (скачивание,
+    конвертация, загрузка тела), не отправляется — SubmitDeferred.
+
+    Returns: api_task_id. UnsupportedImageError — формат не читается.
+    """
+    photo_id = photo['id']
+    in_key = src_key
+    out_key = _build_out_key(photo['s3_key'])
+    out_prefix = out_key.rsplit("/", 1)[0] + "/" if "/" in out_key else "retouch/"
 
     print(f"[RETOUCH] Starting: photo_id={photo_id}, in_key={in_key}, strength={strength}, preset={preset_name}")
 
-    try:
-        s3_client = _get_s3_client()
+    s3_client = _get_s3_client()
+    submit_by_url = RETOUCH_SUBMIT_MODE == 'url'
+    image_bytes = None
+    _converted = False
+    # В режиме url готовый JPEG в функцию не качаем вовсе — API ретуши
+    # прочитает его из S3 сам. Иначе (base64 или нужна конвертация)
+    # скачиваем и приводим к JPEG, как раньше.
+    api_ready = submit_by_url and _source_is_api_ready(s3_client, in_key)
+    if url_only and not api_ready:
+        raise SubmitDeferred('source needs base64 submit')
+    if not api_ready:
         print(f"[RETOUCH] Downloading from S3: {in_key}")
-        s3_resp = s3_client.get_object(Bucket=S3_BUCKET, Key=in_key)
-        image_bytes = s3_resp['Body'].read()
+        with span('s3_get') as sp:
+            image_bytes = s3_client.get_object(Bucket=S3_BUCKET, Key=in_key)['Body'].read()
+            sp.bytes = len(image_bytes)
         print(f"[RETOUCH] Downloaded {len(image_bytes)} bytes")
 
         try:
-            image_bytes, _converted = _ensure_jpeg_bytes(image_bytes, photo.get('file_name'))
+            with span('convert', len(image_bytes)):
+                image_bytes, _converted = _ensure_jpeg_bytes(image_bytes, photo.get('file_name'))
         except Exception as conv_err:
-            return _response(400, {
-                'error': f'Неподдерживаемый формат файла: {conv_err}'
-            })
-
-        # Если оригинал был не-JPEG (PNG/WEBP/HEIC и т.п.) — сохраняем JPEG-копию
-        # в S3 и используем её как in_key. Это критично: PNG на больших размерах
-        # вызывает OOM в композиции (декодирование PNG тяжелее JPEG, плюс альфа).
-        # Композиция и весь дальнейший пайплайн будут работать с лёгким JPEG.
-        if _converted:
-            try:
-                compose_key = in_key.rsplit('.', 1)[0] + '.compose.jpg'
+            raise UnsupportedImageError(str(conv_err))
+    # Если оригинал был не-JPEG (PNG/WEBP/HEIC и т.п.) — сохраняем JPEG-копию
+    # в S3 и используем её как in_key. Это критично: PNG на больших размерах
+    # вызывает OOM в композиции (декодирование PNG тяжелее JPEG, плюс альфа).
+    # Композиция и весь дальнейший пайплайн будут работать с лёгким JPEG.
+    if _converted:
+        try:
+            compose_key = in_key.rsplit('.', 1)[0] + '.compose.jpg'
+            with span('s3_put', len(image_bytes)):
                 s3_client.put_object(
                     Bucket=S3_BUCKET,
                     Key=compose_key,
                     Body=image_bytes,
                     ContentType='image/jpeg',
                 )
-                print(f"[RETOUCH] Saved JPEG copy for composing: {compose_key} ({len(image_bytes)} bytes)")
-                in_key = compose_key
-            except Exception as conv_save_err:
-                print(f"[RETOUCH] Failed to save JPEG copy (non-critical): {conv_save_err}")
-
-        image_base64 = base64.b64encode(image_bytes).decode('utf-8')
-
-        api_task_id, api_status = _submit_async_task(image_base64, strength=strength, enhance_face=enhance_face)
-        print(f"[RETOUCH] Submitted: api_task_id={api_task_id}, status={api_status}")
-
-        with conn.cursor() as cur:
-            cur.execute(
-                '''INSERT INTO retouch_tasks (user_id, photo_id, task_id, status, in_bucket, in_key, out_bucket, out_prefix, preset)
-                   VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)''',
-                (user_id, photo_id, api_task_id, 'started', S3_BUCKET, in_key, S3_BUCKET, out_prefix, preset_name)
+            print(f"[RETOUCH] Saved JPEG copy for composing: {compose_key} ({len(image_bytes)} bytes)")
+            in_key = compose_key
+        except Exception as conv_save_err:
+            print(f"[RETOUCH] Failed to save JPEG copy (non-critical): {conv_save_err}")
+            # JPEG-версии в бакете нет — по ссылке отдать нечего
+            submit_by_url = False
+
+    submitted = None
+    upload_key = None
+    if submit_by_url:
+        upload_key = _build_result_key(in_key, uuid.uuid4().hex)
+        with span('submit'):
+            submitted = _submit_url_task(
+                _presigned_url(in_key, TASK_URL_TTL),
+                _presigned_put_url(upload_key),
+                strength=strength, enhance_face=enhance_face, timeout=timeout,
             )
-            conn.commit()
+    if submitted is None and url_only:
+        raise SubmitDeferred('URL submit rejected')
+    if submitted is None:
+        upload_key = None
+        if image_bytes is None:
+            with span('s3_get') as sp:
+                image_bytes = s3_client.get_object(Bucket=S3_BUCKET, Key=in_key)['Body'].read()
+                sp.bytes = len(image_bytes)
+        with span('b64_encode', len(image_bytes)):
+            image_base64 = base64.b64encode(image_bytes).decode('utf-8')
+
+        with span('submit', len(image_base64)):
+            submitted = _submit_async_task(image_base64, strength=strength,
+                                           enhance_face=enhance_face, timeout=timeout)
+    api_task_id, api_status = submitted
+    print(f"[RETOUCH] Submitted: api_task_id={api_task_id}, status={api_status}, by_url={upload_key is not None}")
 
-        return _response(200, {
-            'task_id': api_task_id,
-            'status': 'started',
-            'result_url': None,
-        })
+    with conn.cursor() as cur:
+        cur.execute(
+            '''INSERT INTO retouch_tasks (user_id, photo_id, task_id, status, in_bucket, in_key, out_bucket, out_prefix, preset, result_upload_key)
+               VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)''',
+            (user_id, photo_id, api_task_id, 'started', S3_BUCKET, in_key, S3_BUCKET, out_prefix, preset_name, upload_key)
+        )
+        conn.commit()
 
-    except Exception as e:
-        import traceback
-        print(f"[RETOUCH] Submit failed: {e}")
-        print(f"[RETOUCH] Traceback: {traceback.format_exc()}")
-        return _response(503, {'error': f'Сервер ретуши недоступен: {str(e)[:200]}'})
+    return api_task_id
 
 
 def _handle_status(event, conn, user_id):
@@ -2061,13 +1325,28 @@ def _handle_status(event, conn, user_id):
         placeholders = ','.join(['%s'] * len(ids))
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
             cur.execute(
-                f'SELECT task_id, photo_id, status, result_key, result_url, in_key, error_message, retry_count, preset, created_at, updated_at FROM retouch_tasks WHERE task_id IN ({placeholders}) AND user_id = %s',
+                f'SELECT {TASK_COLUMNS} FROM retouch_tasks WHERE task_id IN ({placeholders}) AND user_id = %s',
                 (*ids, user_id)
             )
             tasks = cur.fetchall()
-        results = [_check_single_task(conn, user_id, t) for t in tasks]
+        results = [_task_payload(t) for t in _sync_tasks_from_api(conn, user_id, tasks)]
         return _response(200, {'tasks': results})
 
+    if params.get('action') == 'active':
+        # Все незавершённые задачи пользователя одним запросом — фронт
+        # опрашивает его, пока ретушируется серия
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(
+                f'''SELECT {TASK_COLUMNS} FROM retouch_tasks
+                   WHERE user_id = %s AND status IN %s ORDER BY created_at LIMIT 100''',
+                (user_id, ACTIVE_STATUSES)
+            )
+            tasks = cur.fetchall()
+        results = [_task_payload(t) for t in _sync_tasks_from_api(conn, user_id, tasks)]
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            queued = retouch_queue.queued_count(cur, user_id)
+        return _response(200, {'tasks': results, 'queued': queued})
+
     if not task_id:
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
             cur.execute(
@@ -2080,7 +1359,7 @@ def _handle_status(event, conn, user_id):
 
     with conn.cursor(cursor_factory=RealDictCursor) as cur:
         cur.execute(
-            'SELECT task_id, photo_id, status, result_key, result_url, in_key, error_message, retry_count, preset, created_at, updated_at FROM retouch_tasks WHERE task_id = %s AND user_id = %s',
+            f'SELECT {TASK_COLUMNS} FROM retouch_tasks WHERE task_id = %s AND user_id = %s',
             (task_id, user_id)
         )
         task = cur.fetchone()
@@ -2091,9 +1370,7 @@ def _handle_status(event, conn, user_id):
     return _response(200, _check_single_task(conn, user_id, task))
 
 
-def _check_single_task(conn, user_id, task):
-    """Проверить статус задачи — если ещё не finished, опросить API."""
-    task = _sync_task_from_api(conn, user_id, task)
+def _task_payload(task):
     return {
         'task_id': task['task_id'],
         'status': task['status'],
@@ -2102,21 +1379,209 @@ def _check_single_task(conn, user_id, task):
     }
 
 
+def _check_single_task(conn, user_id, task):
+    """Проверить статус задачи — если ещё не finished, опросить API."""
+    return _task_payload(_sync_task_from_api(conn, user_id, task))
+
+
+def _needs_api_poll(task):
+    """Активная задача, статус которой не придёт сам колбэком."""
+    if task['status'] not in ACTIVE_STATUSES:
+        return False
+    if not _callback_url():
+        return True
+    try:
+        from datetime import datetime, timezone
+        created = task.get('created_at')
+        if created and isinstance(created, datetime):
+            return (datetime.now(timezone.utc) - created).total_seconds() > CALLBACK_TRUST_SECONDS
+    except Exception as e:
+        print(f"[RETOUCH] Task age check failed: {e}")
+    return True
+
+
 def _sync_task_from_api(conn, user_id, task):
     """Если задача ещё активна — проверить статус через API и обновить."""
-    if task['status'] not in ('queued', 'started', 'processing', 'pending'):
-        return task
+    return _sync_tasks_from_api(conn, user_id, [task])[0]
 
-    api_task_id = task['task_id']
+
+def _sync_tasks_from_api(conn, user_id, tasks):
+    """Батч-версия _sync_task_from_api: статусы всех активных задач
+    запрашиваются у API параллельно под одним дедлайном, затем
+    применяются по очереди (соединение с БД одно на вызов).
+    Задачи, по которым API не ответил вовремя, возвращаются как есть.
+    """
+    tasks = list(tasks)
+    due = [i for i, t in enumerate(tasks) if _needs_api_poll(t)]
+    if not due:
+        return tasks
+
+    deadline = time.monotonic() + STATUS_POLL_DEADLINE
+    pool = _get_status_pool()
+    timeout = (min(5.0, STATUS_POLL_DEADLINE), STATUS_POLL_DEADLINE)
+    futures = [(i, pool.submit(_check_api_status, tasks[i]['task_id'], timeout)) for i in due]
+    with span('status_poll'):
+        wait([f for _, f in futures], timeout=max(0.0, deadline - time.monotonic()))
+
+    for i, fut in futures:
+        api_task_id = tasks[i]['task_id']
+        if not fut.done():
+            fut.cancel()
+            print(f"[RETOUCH] API status check for {api_task_id} missed the deadline")
+            continue
+        try:
+            data = fut.result()
+        except Exception as e:
+            print(f"[RETOUCH] API status check failed for {api_task_id}: {e}")
+            continue
+        tasks[i] = _apply_api_status(conn, user_id, tasks[i], data)
+
+    # Место на GPU освободилось — сразу отдаём его следующему из очереди
+    if any(tasks[i]['status'] not in ACTIVE_STATUSES for i, _ in futures):
+        _dispatch_queue(conn, DISPATCH_POLL_BUDGET, url_only=True)
+    return tasks
+
+
+def _dispatch_queue(conn, budget, url_only=False):
+    """Отправить в API ретуши фото из пакетной очереди на свободные места GPU.
+    Порядок — fair-share между пользователями (см. retouch_queue).
+    url_only — короткий бюджет опроса/колбэка: только отправка по ссылке,
+    фото под base64 остаются таймерному ?action=dispatch.
+    Returns: сколько фото отправлено.
+    """
+    deadline = time.monotonic() + budget
+    sent = 0
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        if not retouch_queue.try_lock(cur):
+            conn.commit()
+            return 0
+        try:
+            reclaimed = retouch_queue.reclaim_stale(cur)
+            conn.commit()
+            if reclaimed:
+                print(f"[RETOUCH QUEUE] Reclaimed {reclaimed} stale items")
+
+            while time.monotonic() < deadline:
+                free = retouch_queue.free_slots(cur)
+                items = retouch_queue.claim(cur, free) if free else []
+                conn.commit()
+                if not items:
+                    break
+                api_down = False
+                held = False
+                for n, item in enumerate(items):
+                    left = deadline - time.monotonic()
+                    if api_down or left < DISPATCH_MIN_SUBMIT_SEC:
+                        retouch_queue.release(cur, [it['id'] for it in items[n:]])
+                        conn.commit()
+                        break
+                    # Опрос статуса и колбэк ждут раздачу не дольше бюджета
+                    timeout = (min(SUBMIT_TIMEOUT[0], left), min(SUBMIT_TIMEOUT[1], left))
+                    outcome = _submit_queue_item(conn, cur, item, timeout, url_only)
+                    conn.commit()
+                    if outcome == 'sent':
+                        sent += 1
+                    # Возвращённое в очередь фото claim выдал бы снова —
+                    # после этой пачки проход заканчиваем
+                    held = held or outcome == 'held'
+                    # Сервер ретуши недоступен — остальным не поможет
+                    api_down = outcome == 'api_down'
+                if api_down or held:
+                    break
+        except Exception as e:
+            print(f"[RETOUCH QUEUE] Dispatch failed: {e}")
+            conn.rollback()
+        finally:
+            retouch_queue.unlock(cur)
+            conn.commit()
+    if sent:
+        print(f"[RETOUCH QUEUE] Dispatched {sent} photos")
+    return sent
+
+
+def _submit_queue_item(conn, cur, item, timeout=SUBMIT_TIMEOUT, url_only=False):
+    """Отправить одно фото очереди и записать итог в retouch_queue.
+
+    Returns: 'sent'; 'deferred' — RAW-превью ещё не готово; 'held' — фото
+    возвращено в очередь без траты попытки (нужен base64 при url_only или
+    /submit не уложился в урезанный бюджетом таймаут); 'failed' — ошибка
+    этого фото (повтор с backoff или failed); 'api_down' — сервер ретуши
+    недоступен, раздачу в этом проходе пора прекратить.
+    """
+    cur.execute(
+        'SELECT id, s3_key, file_name, is_raw, thumbnail_s3_key FROM photo_bank WHERE id = %s AND user_id = %s AND is_trashed = FALSE',
+        (item['photo_id'], item['user_id'])
+    )
+    photo = cur.fetchone()
+    if not photo or not photo['s3_key']:
+        retouch_queue.mark_failed(cur, item['id'], 'Photo not found', retry=False)
+        return 'failed'
+    src_key, _ = _pick_source_key_for_processing(photo)
+    if not src_key:
+        # RAW без готового превью — оно ещё генерируется: ждём его, не
+        # тратя попыток и не мешая остальным фото пачки
+        retouch_queue.defer(cur, [item['id']], retouch_queue.RAW_PREVIEW_WAIT_SEC)
+        return 'deferred'
     try:
-        data = _check_api_status(api_task_id)
+        api_task_id = _submit_photo(conn, item['user_id'], photo, src_key,
+                                    item['strength'], item['enhance_face'], item['preset'],
+                                    timeout=timeout, url_only=url_only)
+    except UnsupportedImageError as e:
+        retouch_queue.mark_failed(cur, item['id'], f'Неподдерживаемый формат файла: {e}', retry=False)
+        return 'failed'
+    except SubmitDeferred as e:
+        print(f"[RETOUCH QUEUE] Photo {item['photo_id']} left for timer dispatch: {e}")
+        conn.rollback()
+        retouch_queue.release(cur, [item['id']])
+        return 'held'
+    except requests.Timeout as e:
+        if timeout[1] >= SUBMIT_TIMEOUT[1]:
+            print(f"[RETOUCH QUEUE] Retouch API timed out for photo {item['photo_id']}: {e}")
+            conn.rollback()
+            retouch_queue.mark_failed(cur, item['id'], str(e))
+            return 'api_down'
+        # Таймаут урезан нашим бюджетом — API не виноват, попытку не тратим
+        print(f"[RETOUCH QUEUE] Submit for photo {item['photo_id']} hit the dispatch budget: {e}")
+        conn.rollback()
+        retouch_queue.release(cur, [item['id']])
+        return 'held'
+    except (RetouchApiUnavailable, requests.RequestException) as e:
+        print(f"[RETOUCH QUEUE] Retouch API unavailable for photo {item['photo_id']}: {e}")
+        conn.rollback()
+        retouch_queue.mark_failed(cur, item['id'], str(e))
+        return 'api_down'
     except Exception as e:
-        print(f"[RETOUCH] API status check failed for {api_task_id}: {e}")
+        print(f"[RETOUCH QUEUE] Submit failed for photo {item['photo_id']}: {e}")
+        conn.rollback()
+        retouch_queue.mark_failed(cur, item['id'], str(e))
+        return 'failed'
+    retouch_queue.mark_submitted(cur, item['id'], api_task_id)
+    return 'sent'
+
+
+def _apply_api_status(conn, user_id, task, data):
+    """Применить ответ API (GET /status или тело колбэка) к задаче в БД."""
+    if task['status'] not in ACTIVE_STATUSES:
         return task
 
+    api_task_id = task['task_id']
     api_status = data.get('status', 'pending')
 
     if api_status == 'completed':
+        if task.get('result_upload_key'):
+            try:
+                saved = _save_uploaded_result(conn, user_id, task)
+            except Exception as e:
+                print(f"[RETOUCH] Failed to save uploaded result: {e}")
+                saved = None
+            if saved:
+                out_key, final_url = saved
+                task = dict(task)
+                task['status'] = 'finished'
+                task['result_key'] = out_key
+                task['result_url'] = final_url
+                return task
+
         inline_b64 = data.get('image') or data.get('result') or data.get('image_base64')
         result_url_from_api = data.get('result_url')
 
@@ -2290,4 +1755,8 @@ def _probe_retouch_api():
     except Exception as e:
         results["submit_test"] = {"error": str(e)}
 
-    return _response(200, results)
\ No newline at end of file
+    return _response(200, results)
+
+
+_IMPORT_SECONDS = time.perf_counter() - _IMPORT_STARTED
+print(f"[RETOUCH] Module import: {_IMPORT_SECONDS * 1000:.0f}ms")
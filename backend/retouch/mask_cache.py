@@ -0,0 +1,193 @@
+"""
+Кэш масок face_parse (SegFormer на io.foto-mix.ru) по содержимому картинки.
+
+Ключ — SHA-256 байт, которые уходят на сервер, плюс mode (skin/protect/...)
+и bbox. Маски хранятся в S3 PNG-файлами (0/255 жмётся в десятки КБ вместо
+мегабайтного base64 в обе стороны), индекс — таблица face_parse_mask_cache.
+Повторный предпросмотр той же фотографии (смена пресета, перезапуск
+ретуши) берёт маски из кэша и не гоняет картинку на сервер.
+
+Вытеснение — LRU по last_used_at: после записи удаляем самые давно
+использованные маски, пока суммарный размер не уложится в
+MASK_CACHE_MAX_MB. Любая ошибка кэша — только лог: маска в худшем
+случае будет посчитана сервером заново.
+
+    cache = MaskCache(conn, s3_client, S3_BUCKET)
+    set_mask_cache(cache)        # skin_mask._call_ai_face_parse
+
+MemoMaskCache — маски одного вызова в памяти (поверх MaskCache или без
+него): маска, нужная двум построителям подряд, запрашивается один раз.
+"""
+
+import hashlib
+import io
+import os
+
+import numpy as np
+from PIL import Image
+
+from stage_timer import span
+
+SCHEMA = 't_p28211681_photo_secure_web'
+MASK_CACHE_PREFIX = 'mask-cache/face-parse/'
+MASK_CACHE_MAX_BYTES = int(os.environ.get('MASK_CACHE_MAX_MB', '2048')) * 1024 * 1024
+# delete_objects принимает не больше 1000 ключей за запрос
+S3_DELETE_BATCH = 1000
+
+
+class MaskCache:
+    """Кэш масок одного вызова функции: DB-соединение и S3-клиент вызывающего."""
+
+    def __init__(self, conn, s3_client, bucket, max_bytes=MASK_CACHE_MAX_BYTES):
+        self.conn = conn
+        self.s3 = s3_client
+        self.bucket = bucket
+        self.max_bytes = max_bytes
+        # Одни и те же байты хэшируются на get и на put — считаем один раз
+        self._digest_of = None
+        self._digest = None
+
+    def _key(self, image_bytes, mode, bbox):
+        if self._digest_of is not image_bytes:
+            self._digest = hashlib.sha256(image_bytes).hexdigest()
+            self._digest_of = image_bytes
+        parts = [self._digest, mode]
+        if bbox is not None:
+            parts.append('-'.join(str(int(v)) for v in bbox))
+        return self._digest, ':'.join(parts)
+
+    @staticmethod
+    def _s3_key(cache_key):
+        digest = cache_key.split(':', 1)[0]
+        return f"{MASK_CACHE_PREFIX}{digest[:2]}/{cache_key.replace(':', '_')}.png"
+
+    def get(self, image_bytes, mode, bbox=None):
+        """np.uint8 маска из кэша или None."""
+        try:
+            _, cache_key = self._key(image_bytes, mode, bbox)
+            with self.conn.cursor() as cur:
+                cur.execute(f'''
+                    UPDATE {SCHEMA}.face_parse_mask_cache
+                    SET last_used_at = NOW(), hits = hits + 1
+                    WHERE cache_key = %s
+                    RETURNING s3_key
+                ''', (cache_key,))
+                row = cur.fetchone()
+            self.conn.commit()
+            if not row:
+                return None
+            s3_key = row[0]
+            try:
+                with span('mask_cache_get') as sp:
+                    data = self.s3.get_object(Bucket=self.bucket, Key=s3_key)['Body'].read()
+                    sp.bytes = len(data)
+            except self.s3.exceptions.NoSuchKey:
+                # Объект вытеснен параллельным вызовом — строка индекса устарела
+                self._forget(cache_key)
+                return None
+            mask = np.array(Image.open(io.BytesIO(data)).convert('L'))
+            print(f"[MASK CACHE] hit mode={mode} {mask.shape[1]}x{mask.shape[0]} {len(data)}B")
+            return mask
+        except Exception as e:
+            print(f"[MASK CACHE] get failed: {e}")
+            self._rollback()
+            return None
+
+    def put(self, image_bytes, mode, bbox, mask):
+        """Сохраняет маску в S3 и индекс, затем вытесняет лишнее."""
+        try:
+            digest, cache_key = self._key(image_bytes, mode, bbox)
+            s3_key = self._s3_key(cache_key)
+            buf = io.BytesIO()
+            Image.fromarray(mask, mode='L').save(buf, format='PNG')
+            data = buf.getvalue()
+            with span('mask_cache_put', len(data)):
+                self.s3.put_object(Bucket=self.bucket, Key=s3_key, Body=data, ContentType='image/png')
+            with self.conn.cursor() as cur:
+                cur.execute(f'''
+                    INSERT INTO {SCHEMA}.face_parse_mask_cache
+                    (cache_key, source_sha256, mode, s3_key, bytes, width, height)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s)
+                    ON CONFLICT (cache_key) DO UPDATE SET
+                        s3_key = EXCLUDED.s3_key,
+                        bytes = EXCLUDED.bytes,
+                        last_used_at = NOW()
+                ''', (cache_key, digest, mode, s3_key, len(data), mask.shape[1], mask.shape[0]))
+                evicted = self._evict(cur)
+            self.conn.commit()
+            print(f"[MASK CACHE] stored mode={mode} {len(data)}B evicted={len(evicted)}")
+            self._delete_objects(evicted)
+        except Exception as e:
+            print(f"[MASK CACHE] put failed: {e}")
+            self._rollback()
+
+    def _evict(self, cur):
+        """Удаляет из индекса самые старые по last_used_at записи сверх
+        max_bytes и возвращает их S3-ключи."""
+        cur.execute(f'''
+            DELETE FROM {SCHEMA}.face_parse_mask_cache
+            WHERE cache_key IN (
+                SELECT cache_key FROM (
+                    SELECT cache_key,
+                           SUM(bytes) OVER (ORDER BY last_used_at DESC, cache_key) AS kept
+                    FROM {SCHEMA}.face_parse_mask_cache
+                ) x
+                WHERE x.kept > %s
+            )
+            RETURNING s3_key
+        ''', (self.max_bytes,))
+        return [row[0] for row in cur.fetchall()]
+
+    def _delete_objects(self, keys):
+        for i in range(0, len(keys), S3_DELETE_BATCH):
+            batch = keys[i:i + S3_DELETE_BATCH]
+            try:
+                self.s3.delete_objects(
+                    Bucket=self.bucket,
+                    Delete={'Objects': [{'Key': k} for k in batch], 'Quiet': True},
+                )
+            except Exception as e:
+                print(f"[MASK CACHE] delete {len(batch)} objects failed: {e}")
+
+    def _forget(self, cache_key):
+        with self.conn.cursor() as cur:
+            cur.execute(f'DELETE FROM {SCHEMA}.face_parse_mask_cache WHERE cache_key = %s', (cache_key,))
+        self.conn.commit()
+
+    def _rollback(self):
+        try:
+            self.conn.rollback()
+        except Exception:
+            pass
+
+
+class MemoMaskCache:
+    """Маски одного вызова в памяти поверх постоянного кэша (backing может
+    быть None). Например, protect нужен и маске кожи, и маске фокуса —
+    второй построитель берёт его отсюда, без face_parse и без S3."""
+
+    def __init__(self, backing=None):
+        self.backing = backing
+        self._masks = {}
+        self._digest_of = None
+        self._digest = None
+
+    def _key(self, image_bytes, mode, bbox):
+        if self._digest_of is not image_bytes:
+            self._digest = hashlib.sha256(image_bytes).hexdigest()
+            self._digest_of = image_bytes
+        return self._digest, mode, tuple(bbox) if bbox is not None else None
+
+    def get(self, image_bytes, mode, bbox=None):
+        key = self._key(image_bytes, mode, bbox)
+        mask = self._masks.get(key)
+        if mask is None and self.backing is not None:
+            mask = self.backing.get(image_bytes, mode, bbox)
+            if mask is not None:
+                self._masks[key] = mask
+        return mask
+
+    def put(self, image_bytes, mode, bbox, mask):
+        self._masks[self._key(image_bytes, mode, bbox)] = mask
+        if self.backing is not None:
+            self.backing.put(image_bytes, mode, bbox, mask)
@@ -0,0 +1,207 @@
+"""
+Очередь пакетной ретуши (retouch_queue): папка целиком ставится одним
+запросом, а в API ретуши фото уходят по мере освобождения мест на GPU.
+
+Справедливость — round-robin между фотографами: каждому фото очереди
+присваивается «очередь в очереди» rn (номер среди ждущих фото того же
+пользователя) плюс число его задач, уже идущих на GPU. Диспетчер берёт
+фото с наименьшей суммой, при равенстве — того, кого дольше не
+обслуживали. Поэтому серия из 300 кадров занимает все места, пока
+других нет, но новый пользователь получает следующее же место.
+
+Глобальный лимит — RETOUCH_GPU_SLOTS одновременно активных задач
+retouch_tasks (вместе с одиночными). Диспетчер один на весь сервис:
+advisory-lock, остальные вызовы просто пропускают раздачу.
+
+    if retouch_queue.try_lock(cur):
+        try:
+            items = retouch_queue.claim(cur, free_slots)
+            ...
+        finally:
+            retouch_queue.unlock(cur)
+"""
+
+import os
+import random
+
+SCHEMA = 't_p28211681_photo_secure_web'
+
+# Сколько задач ретуши GPU-сервер обрабатывает одновременно без роста очереди у себя
+RETOUCH_GPU_SLOTS = int(os.environ.get('RETOUCH_GPU_SLOTS', '4'))
+ACTIVE_STATUSES = ('queued', 'started', 'processing', 'pending')
+# Активной считаем задачу не старше этого (как лимит в _handle_create):
+# зависшие дольше всё равно помечаются failed при опросе
+ACTIVE_WINDOW_MINUTES = 10
+# Фото в submitting дольше этого — диспетчер упал, возвращаем в очередь
+STALE_SUBMITTING_MINUTES = 10
+MAX_ATTEMPTS = 3
+# Повтор после ошибки API: 30с, 60с, 120с (±20%)
+BACKOFF_BASE_SEC = 30
+# RAW без готового превью — проверяем снова через минуту, попытка не тратится
+RAW_PREVIEW_WAIT_SEC = 60
+# Ключ pg_advisory_lock диспетчера
+DISPATCH_LOCK_KEY = 0x52455451  # 'RETQ'
+
+
+def enqueue_folder(cur, user_id, folder_id, batch_id, preset, strength, enhance_face):
+    """Ставит в очередь все фото папки (кроме удалённых). Фото, которые уже
+    ждут в очереди пользователя, повторно не ставятся.
+    Коммит — на вызывающей стороне. Возвращает число поставленных.
+    """
+    cur.execute(f'''
+        INSERT INTO {SCHEMA}.retouch_queue
+            (batch_id, user_id, photo_id, folder_id, preset, strength, enhance_face)
+        SELECT %s, %s, p.id, p.folder_id, %s, %s, %s
+        FROM {SCHEMA}.photo_bank p
+        WHERE p.folder_id = %s AND p.user_id = %s AND p.is_trashed = FALSE
+          AND p.s3_key IS NOT NULL
+        ORDER BY p.id
+        ON CONFLICT (user_id, photo_id) WHERE status IN ('queued', 'submitting') DO NOTHING
+    ''', (batch_id, user_id, preset, strength, bool(enhance_face), folder_id, user_id))
+    return cur.rowcount
+
+
+def try_lock(cur):
+    cur.execute('SELECT pg_try_advisory_lock(%s) AS locked', (DISPATCH_LOCK_KEY,))
+    return bool(cur.fetchone()['locked'])
+
+
+def unlock(cur):
+    cur.execute('SELECT pg_advisory_unlock(%s)', (DISPATCH_LOCK_KEY,))
+
+
+def reclaim_stale(cur):
+    """Возвращает в очередь фото, зависшие в submitting."""
+    cur.execute(f'''
+        UPDATE {SCHEMA}.retouch_queue
+        SET status = 'queued', locked_at = NULL, last_error = 'dispatcher timeout'
+        WHERE status = 'submitting'
+          AND locked_at < NOW() - make_interval(mins => %s)
+    ''', (STALE_SUBMITTING_MINUTES,))
+    return cur.rowcount
+
+
+def free_slots(cur):
+    """Сколько задач ещё можно отправить на GPU прямо сейчас."""
+    cur.execute(f'''
+        SELECT COUNT(*) AS n FROM {SCHEMA}.retouch_tasks
+        WHERE status IN %s AND created_at > NOW() - make_interval(mins => %s)
+    ''', (ACTIVE_STATUSES, ACTIVE_WINDOW_MINUTES))
+    return max(0, RETOUCH_GPU_SLOTS - int(cur.fetchone()['n']))
+
+
+def claim(cur, limit):
+    """Забирает до limit фото в порядке fair-share (см. модуль) и переводит
+    их в submitting. Возвращает их в порядке отправки.
+    """
+    cur.execute(f'''
+        WITH inflight AS (
+            SELECT user_id, COUNT(*) AS n FROM {SCHEMA}.retouch_tasks
+            WHERE status IN %s AND created_at > NOW() - make_interval(mins => %s)
+            GROUP BY user_id
+        ), served AS (
+            SELECT user_id, MAX(submitted_at) AS last_served FROM {SCHEMA}.retouch_queue
+            WHERE submitted_at > NOW() - INTERVAL '1 day'
+            GROUP BY user_id
+        ), ranked AS (
+            SELECT q.id, q.user_id,
+                   ROW_NUMBER() OVER (PARTITION BY q.user_id ORDER BY q.id) AS rn
+            FROM {SCHEMA}.retouch_queue q
+            WHERE q.status = 'queued' AND q.run_after <= NOW()
+        ), picked AS (
+            SELECT r.id,
+                   ROW_NUMBER() OVER (
+                       ORDER BY r.rn + COALESCE(i.n, 0), s.last_served NULLS FIRST, r.id
+                   ) AS turn
+            FROM ranked r
+            LEFT JOIN inflight i ON i.user_id = r.user_id
+            LEFT JOIN served s ON s.user_id = r.user_id
+            ORDER BY turn
+            LIMIT %s
+        )
+        UPDATE {SCHEMA}.retouch_queue q
+        SET status = 'submitting', locked_at = NOW(), attempts = q.attempts + 1
+        FROM picked
+        WHERE q.id = picked.id AND q.status = 'queued'
+        RETURNING q.id, q.batch_id, q.user_id, q.photo_id, q.preset, q.strength,
+                  q.enhance_face, q.attempts, picked.turn
+    ''', (ACTIVE_STATUSES, ACTIVE_WINDOW_MINUTES, limit))
+    return sorted(cur.fetchall(), key=lambda row: row['turn'])
+
+
+def mark_submitted(cur, item_id, task_id):
+    cur.execute(f'''
+        UPDATE {SCHEMA}.retouch_queue
+        SET status = 'submitted', task_id = %s, submitted_at = NOW(),
+            locked_at = NULL, last_error = NULL
+        WHERE id = %s
+    ''', (task_id, item_id))
+
+
+def mark_failed(cur, item_id, error, retry=True):
+    """Ошибка отправки: повтор с экспоненциальной задержкой, после
+    MAX_ATTEMPTS (или retry=False — фото не читается) — failed."""
+    cur.execute(f'''
+        UPDATE {SCHEMA}.retouch_queue
+        SET status = CASE WHEN %s AND attempts < %s THEN 'queued' ELSE 'failed' END,
+            run_after = NOW() + make_interval(secs => %s * POWER(2, attempts - 1) * %s),
+            locked_at = NULL,
+            last_error = %s
+        WHERE id = %s
+    ''', (retry, MAX_ATTEMPTS, BACKOFF_BASE_SEC, random.uniform(0.8, 1.2), error[:1000], item_id))
+
+
+def release(cur, item_ids):
+    """Вернуть забранные, но не отправленные фото без траты попытки."""
+    if not item_ids:
+        return
+    cur.execute(f'''
+        UPDATE {SCHEMA}.retouch_queue
+        SET status = 'queued', attempts = attempts - 1, locked_at = NULL
+        WHERE id = ANY(%s) AND status = 'submitting'
+    ''', (list(item_ids),))
+
+
+def defer(cur, item_ids, delay_sec):
+    """Отложить забранные фото на delay_sec без траты попытки (фото ещё
+    не готово к отправке — например, генерируется превью RAW)."""
+    if not item_ids:
+        return
+    cur.execute(f'''
+        UPDATE {SCHEMA}.retouch_queue
+        SET status = 'queued', attempts = attempts - 1, locked_at = NULL,
+            run_after = NOW() + make_interval(secs => %s)
+        WHERE id = ANY(%s) AND status = 'submitting'
+    ''', (delay_sec, list(item_ids)))
+
+
+def queued_count(cur, user_id):
+    cur.execute(f'''
+        SELECT COUNT(*) AS n FROM {SCHEMA}.retouch_queue
+        WHERE user_id = %s AND status IN ('queued', 'submitting')
+    ''', (user_id,))
+    return int(cur.fetchone()['n'])
+
+
+def batch_summary(cur, user_id, batch_id):
+    """Счётчики пакета: ждут места / на GPU / готовы / с ошибкой."""
+    cur.execute(f'''
+        SELECT q.status AS queue_status, t.status AS task_status, COUNT(*) AS n
+        FROM {SCHEMA}.retouch_queue q
+        LEFT JOIN {SCHEMA}.retouch_tasks t ON t.task_id = q.task_id
+        WHERE q.batch_id = %s AND q.user_id = %s
+        GROUP BY q.status, t.status
+    ''', (batch_id, user_id))
+    summary = {'queued': 0, 'processing': 0, 'finished': 0, 'failed': 0}
+    for row in cur.fetchall():
+        if row['queue_status'] in ('queued', 'submitting'):
+            key = 'queued'
+        elif row['queue_status'] == 'failed' or row['task_status'] == 'failed':
+            key = 'failed'
+        elif row['task_status'] == 'finished':
+            key = 'finished'
+        else:
+            key = 'processing'
+        summary[key] += int(row['n'])
+    summary['total'] = sum(summary.values())
+    return summary
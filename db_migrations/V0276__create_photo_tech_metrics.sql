@@ -0,0 +1,29 @@
+-- Сырые метрики техбрака по каждому фото. Вердикт (tech_reject_reason) считается
+-- из них сравнением с порогами, поэтому при смене порогов или сбросе анализа
+-- фото не нужно заново скачивать и декодировать.
+CREATE TABLE IF NOT EXISTS t_p28211681_photo_secure_web.photo_tech_metrics (
+    photo_id INTEGER NOT NULL,
+    algo_version SMALLINT NOT NULL,
+    face_count SMALLINT NOT NULL DEFAULT 0,
+    face_size INTEGER[] NOT NULL DEFAULT '{}',
+    face_sharpness REAL[] NOT NULL DEFAULT '{}',
+    face_luma REAL[] NOT NULL DEFAULT '{}',
+    face_blown REAL[] NOT NULL DEFAULT '{}',
+    face_crushed REAL[] NOT NULL DEFAULT '{}',
+    eye_openness REAL[] NOT NULL DEFAULT '{}',
+    frame_sharpness REAL NOT NULL,
+    frame_mean REAL NOT NULL,
+    frame_std REAL NOT NULL,
+    bright_ratio REAL NOT NULL,
+    dark_ratio REAL NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (photo_id, algo_version)
+);
+
+COMMENT ON TABLE t_p28211681_photo_secure_web.photo_tech_metrics IS 'Метрики качества фото для техбрака (по версии алгоритма); лица упорядочены по площади, первое — главное';
+COMMENT ON COLUMN t_p28211681_photo_secure_web.photo_tech_metrics.face_size IS 'Меньшая сторона рамки лица, px на копии для анализа';
+COMMENT ON COLUMN t_p28211681_photo_secure_web.photo_tech_metrics.face_sharpness IS 'Дисперсия лапласиана по центральной зоне лица';
+COMMENT ON COLUMN t_p28211681_photo_secure_web.photo_tech_metrics.face_luma IS 'Средняя яркость кожи лица, 0-255';
+COMMENT ON COLUMN t_p28211681_photo_secure_web.photo_tech_metrics.eye_openness IS 'Раскрытость глаз (высота/ширина зрачка), NULL — не удалось оценить';
+COMMENT ON COLUMN t_p28211681_photo_secure_web.photo_tech_metrics.bright_ratio IS 'Доля пикселей кадра ярче 240';
+COMMENT ON COLUMN t_p28211681_photo_secure_web.photo_tech_metrics.dark_ratio IS 'Доля пикселей кадра темнее 30';
@@ -0,0 +1,11 @@
+-- Перцептивные хэши миниатюры для группировки серий и почти-дублей
+ALTER TABLE t_p28211681_photo_secure_web.photo_bank
+    ADD COLUMN IF NOT EXISTS dhash BIGINT,
+    ADD COLUMN IF NOT EXISTS phash BIGINT;
+
+COMMENT ON COLUMN t_p28211681_photo_secure_web.photo_bank.dhash IS '64-битный разностный хэш миниатюры (dHash)';
+COMMENT ON COLUMN t_p28211681_photo_secure_web.photo_bank.phash IS '64-битный DCT-хэш миниатюры (pHash), по нему ищутся серии';
+
+CREATE INDEX IF NOT EXISTS idx_photo_bank_phash_missing
+    ON t_p28211681_photo_secure_web.photo_bank (id)
+    WHERE phash IS NULL AND thumbnail_s3_key IS NOT NULL;
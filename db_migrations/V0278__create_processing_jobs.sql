@@ -0,0 +1,40 @@
+-- Очередь фоновой обработки фото (миниатюры, RAW-превью, EXIF, техбрак, хэши).
+-- Воркеры забирают задачи пачками через FOR UPDATE SKIP LOCKED, поэтому
+-- несколько параллельных воркеров не берут одну и ту же задачу.
+CREATE TABLE IF NOT EXISTS t_p28211681_photo_secure_web.processing_jobs (
+    id BIGSERIAL PRIMARY KEY,
+    kind TEXT NOT NULL CHECK (kind IN ('thumbnail', 'raw_preview', 'exif', 'tech_sort', 'hash')),
+    dedup_key TEXT NOT NULL,
+    photo_id INTEGER,
+    folder_id INTEGER,
+    user_id INTEGER NOT NULL,
+    priority SMALLINT NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'queued' CHECK (status IN ('queued', 'running', 'done', 'failed')),
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL DEFAULT 5,
+    run_after TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    locked_at TIMESTAMP,
+    locked_by TEXT,
+    last_error TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    finished_at TIMESTAMP
+);
+
+COMMENT ON TABLE t_p28211681_photo_secure_web.processing_jobs IS 'Очередь фоновой обработки фото с повторами и приоритетом';
+COMMENT ON COLUMN t_p28211681_photo_secure_web.processing_jobs.dedup_key IS 'kind:photo_id (или kind:folder:folder_id) — не даёт поставить одну задачу дважды';
+COMMENT ON COLUMN t_p28211681_photo_secure_web.processing_jobs.priority IS '0 — фон, 5 — свежая загрузка, 10 — папку сейчас смотрят';
+COMMENT ON COLUMN t_p28211681_photo_secure_web.processing_jobs.run_after IS 'Не брать раньше этого времени (отложенный повтор после ошибки)';
+
+-- Одна активная задача на ключ; завершённые не мешают поставить новую
+CREATE UNIQUE INDEX IF NOT EXISTS uq_processing_jobs_active
+    ON t_p28211681_photo_secure_web.processing_jobs (dedup_key)
+    WHERE status IN ('queued', 'running');
+
+-- Выборка воркером: самые приоритетные из готовых к запуску
+CREATE INDEX IF NOT EXISTS idx_processing_jobs_claim
+    ON t_p28211681_photo_secure_web.processing_jobs (kind, priority DESC, run_after, id)
+    WHERE status = 'queued';
+
+CREATE INDEX IF NOT EXISTS idx_processing_jobs_running
+    ON t_p28211681_photo_secure_web.processing_jobs (locked_at)
+    WHERE status = 'running';
@@ -0,0 +1,24 @@
+-- Почасовая статистика этапов конвейера обработки фото (S3 GET, декод, анализ, PUT ...).
+-- hist — логарифмическая гистограмма длительностей: корзина i = до 1.2^i мс.
+CREATE TABLE IF NOT EXISTS t_p28211681_photo_secure_web.pipeline_stage_stats (
+    fn TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    period_start TIMESTAMP NOT NULL,
+    count BIGINT NOT NULL DEFAULT 0,
+    total_ms DOUBLE PRECISION NOT NULL DEFAULT 0,
+    max_ms REAL NOT NULL DEFAULT 0,
+    bytes_total BIGINT NOT NULL DEFAULT 0,
+    hist INTEGER[] NOT NULL,
+    p50_ms REAL,
+    p95_ms REAL,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (fn, stage, period_start)
+);
+
+COMMENT ON TABLE t_p28211681_photo_secure_web.pipeline_stage_stats IS 'Длительности этапов обработки фото по функциям и часам (p50/p95 из гистограммы)';
+COMMENT ON COLUMN t_p28211681_photo_secure_web.pipeline_stage_stats.fn IS 'Функция: backfill-thumbnails, generate-thumbnail, photo-tech-sort, retouch';
+COMMENT ON COLUMN t_p28211681_photo_secure_web.pipeline_stage_stats.hist IS 'Число замеров по корзинам: корзина i — длительность до 1.2^i мс';
+COMMENT ON COLUMN t_p28211681_photo_secure_web.pipeline_stage_stats.bytes_total IS 'Байт прочитано/записано на этапе (S3 GET/PUT)';
+
+CREATE INDEX IF NOT EXISTS idx_pipeline_stage_stats_period
+    ON t_p28211681_photo_secure_web.pipeline_stage_stats (period_start DESC);
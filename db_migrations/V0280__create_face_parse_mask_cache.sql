@@ -0,0 +1,22 @@
+-- Индекс кэша масок face_parse (SegFormer): сами маски лежат PNG-файлами в S3
+-- (mask-cache/face-parse/...), здесь — ключ, размер и время последнего
+-- использования для LRU-вытеснения.
+CREATE TABLE IF NOT EXISTS t_p28211681_photo_secure_web.face_parse_mask_cache (
+    cache_key TEXT PRIMARY KEY,
+    source_sha256 CHAR(64) NOT NULL,
+    mode TEXT NOT NULL,
+    s3_key TEXT NOT NULL,
+    bytes INTEGER NOT NULL,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    last_used_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+COMMENT ON TABLE t_p28211681_photo_secure_web.face_parse_mask_cache IS 'Кэш масок face_parse по SHA-256 картинки и режиму (skin/protect/...), LRU по last_used_at';
+COMMENT ON COLUMN t_p28211681_photo_secure_web.face_parse_mask_cache.cache_key IS 'sha256:mode[:bbox] — bbox только для масок по рамке лица';
+COMMENT ON COLUMN t_p28211681_photo_secure_web.face_parse_mask_cache.bytes IS 'Размер PNG в S3 — из суммы считается лимит MASK_CACHE_MAX_MB';
+
+CREATE INDEX IF NOT EXISTS idx_face_parse_mask_cache_last_used
+    ON t_p28211681_photo_secure_web.face_parse_mask_cache (last_used_at DESC);
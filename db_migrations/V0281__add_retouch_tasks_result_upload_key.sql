@@ -0,0 +1,3 @@
+-- Режим url: API ретуши кладёт результат сам по presigned PUT на этот ключ
+-- (NULL — задача отправлена base64, результат забираем из ответа API).
+ALTER TABLE retouch_tasks ADD COLUMN IF NOT EXISTS result_upload_key TEXT;
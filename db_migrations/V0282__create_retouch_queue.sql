@@ -0,0 +1,38 @@
+-- Очередь пакетной ретуши (вся папка одним запросом). Диспетчер в функции
+-- retouch отправляет фото в API ретуши по мере освобождения мест на GPU,
+-- чередуя фотографов (round-robin), чтобы одна большая серия не занимала
+-- сервер целиком.
+CREATE TABLE IF NOT EXISTS t_p28211681_photo_secure_web.retouch_queue (
+    id BIGSERIAL PRIMARY KEY,
+    batch_id TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    photo_id INTEGER NOT NULL,
+    folder_id INTEGER,
+    preset VARCHAR(16) NOT NULL DEFAULT 'medium',
+    strength REAL NOT NULL,
+    enhance_face BOOLEAN NOT NULL DEFAULT FALSE,
+    status TEXT NOT NULL DEFAULT 'queued' CHECK (status IN ('queued', 'submitting', 'submitted', 'failed')),
+    task_id VARCHAR(255),
+    attempts INTEGER NOT NULL DEFAULT 0,
+    run_after TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    locked_at TIMESTAMP,
+    last_error TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    submitted_at TIMESTAMP
+);
+
+COMMENT ON TABLE t_p28211681_photo_secure_web.retouch_queue IS 'Пакетная ретушь: фото ждут свободного места на GPU, выдача — по кругу между пользователями';
+COMMENT ON COLUMN t_p28211681_photo_secure_web.retouch_queue.task_id IS 'retouch_tasks.task_id после отправки в API (status = submitted)';
+COMMENT ON COLUMN t_p28211681_photo_secure_web.retouch_queue.run_after IS 'Не отправлять раньше этого времени (повтор после ошибки API)';
+
+-- Одно фото стоит в очереди пользователя один раз
+CREATE UNIQUE INDEX IF NOT EXISTS uq_retouch_queue_pending
+    ON t_p28211681_photo_secure_web.retouch_queue (user_id, photo_id)
+    WHERE status IN ('queued', 'submitting');
+
+CREATE INDEX IF NOT EXISTS idx_retouch_queue_claim
+    ON t_p28211681_photo_secure_web.retouch_queue (user_id, id)
+    WHERE status = 'queued';
+
+CREATE INDEX IF NOT EXISTS idx_retouch_queue_batch
+    ON t_p28211681_photo_secure_web.retouch_queue (batch_id);
@@ -0,0 +1,21 @@
+-- Запуски GPU-VM сервера ретуши: от команды start до первого успешного
+-- /health. По этой таблице retouch-waker оценивает ожидаемое время
+-- загрузки и решает, насколько заранее будить VM.
+CREATE TABLE IF NOT EXISTS t_p28211681_photo_secure_web.retouch_vm_boots (
+    id BIGSERIAL PRIMARY KEY,
+    trigger TEXT NOT NULL CHECK (trigger IN ('wake', 'demand', 'prewarm')),
+    started_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+    healthy_at TIMESTAMP WITH TIME ZONE,
+    boot_ms INTEGER,
+    stopped_at TIMESTAMP WITH TIME ZONE
+);
+
+COMMENT ON TABLE t_p28211681_photo_secure_web.retouch_vm_boots IS 'Запуски VM ретуши и время boot-to-healthy';
+COMMENT ON COLUMN t_p28211681_photo_secure_web.retouch_vm_boots.trigger IS 'wake — запрос фронта, demand — задачи в очереди, prewarm — прогноз по истории';
+COMMENT ON COLUMN t_p28211681_photo_secure_web.retouch_vm_boots.boot_ms IS 'healthy_at - started_at в мс; NULL — VM ещё не ответила на /health';
+
+CREATE INDEX IF NOT EXISTS idx_retouch_vm_boots_started
+    ON t_p28211681_photo_secure_web.retouch_vm_boots (started_at DESC);
+
+-- Прогноз спроса считает задачи в тех же окнах прошлых недель
+CREATE INDEX IF NOT EXISTS idx_retouch_tasks_created_at ON retouch_tasks(created_at);
@@ -0,0 +1,6 @@
+-- Постановка задач пропускает ключи, чья задача уже исчерпала max_attempts
+-- (битый файл): без этого каждый просмотр папки ставил бы её заново с
+-- новыми попытками. Индекс — под эту проверку NOT EXISTS.
+CREATE INDEX IF NOT EXISTS idx_processing_jobs_failed
+    ON t_p28211681_photo_secure_web.processing_jobs (dedup_key)
+    WHERE status = 'failed';
@@ -0,0 +1,8 @@
+-- Композиция результата с оригиналом (retouch-compose) не идёт в опросе
+-- статуса: задача завершается с ретушью как есть, а смешивание делают
+-- колбэк или таймер ?action=dispatch.
+ALTER TABLE retouch_tasks ADD COLUMN IF NOT EXISTS compose_pending BOOLEAN NOT NULL DEFAULT FALSE;
+
+CREATE INDEX IF NOT EXISTS idx_retouch_tasks_compose_pending
+    ON retouch_tasks (updated_at)
+    WHERE compose_pending;
@@ -0,0 +1,521 @@
+#!/usr/bin/env python3
+'''
+Офлайн-бенчмарк горячих путей обработки фото: маска кожи и детектор
+дефектов (retouch/skin_mask.py), пресет Capture One и шумодав по маске
+(retouch/c1_preset.py), YuNet и глаза (photo-tech-sort/face_quality.py),
+ресайз миниатюр (generate-thumbnail / backfill-thumbnails).
+
+Картинки синтетические — «портрет» (два лица с прыщиками, волосы, фон) и
+«пейзаж» (небо, солнце, трава) на 6/24/45 Мп, генерируются детерминированно
+из seed, поэтому прогоны сравнимы между машинами и коммитами. Сеть
+выключается целиком: ИИ-эндпоинты io.foto-mix.ru не вызываются, skin_mask
+идёт по эвристической ветке.
+
+    python scripts/bench_image_pipeline.py                      # всё, сравнение с baseline
+    python scripts/bench_image_pipeline.py --sizes 6,24 --only mask
+    python scripts/bench_image_pipeline.py --save-baseline      # записать новый baseline
+
+Для каждого кейса печатается медиана wall time, пик памяти numpy/Python
+(tracemalloc) и пик RSS процесса (VmHWM, учитывает буферы PIL/cv2) — если
+ядро позволяет сбросить его через /proc/self/clear_refs. При замедлении
+больше --tolerance относительно baseline скрипт завершается с кодом 1.
+'''
+
+import argparse
+import gc
+import io
+import json
+import os
+import platform
+import socket
+import statistics
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKEND = os.path.join(ROOT, 'backend')
+DEFAULT_BASELINE = os.path.join(ROOT, 'scripts', 'bench_baseline.json')
+
+# Разрешения как у реальных камер: 3000x2000 (6 Мп), 6000x4000 (24 Мп),
+# 8256x5504 (45 Мп — Nikon D850/Z7)
+SIZES = {
+    6: (3000, 2000),
+    24: (6000, 4000),
+    45: (8256, 5504),
+}
+SEED = 20240901
+JPEG_QUALITY = 92
+
+# Как в photo-tech-sort: анализ лиц идёт по уменьшенной копии кадра
+ANALYSIS_MAX_DIM = 800
+
+
+def _block_network() -> None:
+    '''Любая попытка сетевого соединения — ошибка: бенчмарк строго офлайн.'''
+    def _refuse(*args, **kwargs):
+        raise OSError('bench: network access is disabled')
+
+    socket.create_connection = _refuse
+    socket.socket.connect = _refuse
+    socket.socket.connect_ex = _refuse
+
+
+def _load_modules() -> Dict[str, Any]:
+    # Пароль ИИ-сервера пустой → face_parse/detect_faces сразу возвращают None
+    os.environ['RETOUCH_BASIC_PASS'] = ''
+    for name in ('retouch', 'photo-tech-sort'):
+        path = os.path.join(BACKEND, name)
+        if path not in sys.path:
+            sys.path.insert(0, path)
+
+    import c1_preset
+    import face_quality
+    import skin_mask
+
+    # Страховка на случай, если ИИ-клиент научится ходить в сеть без пароля
+    skin_mask._request_face_parse = lambda *args, **kwargs: None
+    skin_mask._request_detect_faces = lambda *args, **kwargs: None
+    return {'skin_mask': skin_mask, 'c1_preset': c1_preset, 'face_quality': face_quality}
+
+
+# ---------------------------------------------------------------------------
+# Синтетические кадры
+# ---------------------------------------------------------------------------
+
+# Лица портрета в долях кадра: центр, полуоси, цвет кожи (RGB)
+PORTRAIT_FACES = (
+    ((0.38, 0.42), (0.075, 0.11), (208, 162, 136)),
+    ((0.63, 0.46), (0.065, 0.095), (196, 146, 118)),
+)
+
+
+def _ellipse(xx, yy, cx, cy, rx, ry):
+    '''Нормированное «расстояние» до центра эллипса: <1 — внутри.'''
+    return ((xx - cx) / rx) ** 2 + ((yy - cy) / ry) ** 2
+
+
+def synth_portrait(w: int, h: int, seed: int = SEED):
+    '''
+    Портрет: тёплый фон с градиентом, волосы, два лица с глазами, губами и
+    тенью, шея, плюс мелкие красные и тёмные пятна на коже и зерно. Рисуется
+    в 1/4 разрешения и растягивается — так 45 Мп генерируются за секунды.
+    Возвращает (uint8 RGB, список лиц в формате face_quality.detect_faces
+    в долях кадра).
+    '''
+    import numpy as np
+    from PIL import Image
+
+    rng = np.random.default_rng(seed)
+    sw, sh = max(64, w // 4), max(64, h // 4)
+    yy, xx = np.mgrid[0:sh, 0:sw].astype(np.float32)
+    xx /= sw
+    yy /= sh
+    # Полуоси лиц заданы в долях высоты кадра; по X переводим их в доли ширины
+    aspect = sw / sh
+
+    img = np.empty((sh, sw, 3), dtype=np.float32)
+    img[..., 0] = 96 + 70 * xx
+    img[..., 1] = 84 + 36 * yy
+    img[..., 2] = 74 + 52 * (1 - xx)
+
+    faces = []
+    for (cx, cy), (rx, ry), skin in PORTRAIT_FACES:
+        rx_a = rx / aspect
+        hair = _ellipse(xx, yy, cx, cy - ry * 0.25, rx_a * 1.35, ry * 1.3) < 1
+        img[hair] = (46, 34, 28)
+        neck = (np.abs(xx - cx) < rx_a * 0.45) & (yy > cy) & (yy < cy + ry * 2.2)
+        d = _ellipse(xx, yy, cx, cy, rx_a, ry)
+        face = (d < 1) | neck
+        shade = (1.0 - 0.22 * np.clip(d, 0, 1))[face]
+        for c in range(3):
+            img[..., c][face] = skin[c] * shade
+
+        eye_dy = -ry * 0.2
+        eyes = []
+        for side in (-1, 1):
+            ex, ey = cx + side * rx_a * 0.42, cy + eye_dy
+            img[_ellipse(xx, yy, ex, ey, rx_a * 0.16, ry * 0.06) < 1] = (245, 240, 236)
+            img[_ellipse(xx, yy, ex, ey, rx_a * 0.07, ry * 0.05) < 1] = (52, 38, 30)
+            eyes.append((ex, ey))
+        img[_ellipse(xx, yy, cx, cy + ry * 0.5, rx_a * 0.35, ry * 0.08) < 1] = (170, 70, 72)
+
+        faces.append({
+            'box': (cx - rx_a, cy - ry, rx_a * 2, ry * 2),
+            # У YuNet «правый глаз» — правый для человека на фото, т.е. слева в кадре
+            'right_eye': eyes[0],
+            'left_eye': eyes[1],
+            'nose': (cx, cy + ry * 0.15),
+            'score': 1.0,
+        })
+
+    small = Image.fromarray(np.clip(img, 0, 255).astype(np.uint8), 'RGB')
+    del img, xx, yy
+    arr = np.array(small.resize((w, h), Image.BICUBIC))
+    del small
+
+    # Пятна на коже: красные воспаления и тёмные точки радиусом ~0.3% кадра
+    spot_r = max(3, int(min(w, h) * 0.003))
+    for (cx, cy), (rx, ry), _ in PORTRAIT_FACES:
+        rx_a = rx / (w / h)
+        for _ in range(24):
+            px = int((cx + rng.uniform(-0.6, 0.6) * rx_a) * w)
+            py = int((cy + rng.uniform(-0.1, 0.7) * ry) * h)
+            y1, y2 = max(0, py - spot_r), min(h, py + spot_r + 1)
+            x1, x2 = max(0, px - spot_r), min(w, px + spot_r + 1)
+            sy, sx = np.ogrid[y1:y2, x1:x2]
+            disk = (sy - py) ** 2 + (sx - px) ** 2 <= spot_r ** 2
+            patch = arr[y1:y2, x1:x2].astype(np.int16)
+            delta = (28, -14, -12) if rng.random() < 0.7 else (-40, -40, -36)
+            for c in range(3):
+                patch[..., c][disk] += delta[c]
+            arr[y1:y2, x1:x2] = np.clip(patch, 0, 255).astype(np.uint8)
+
+    _add_grain(arr, rng, sigma=4.0)
+    return arr, faces
+
+
+def synth_landscape(w: int, h: int, seed: int = SEED):
+    '''
+    Пейзаж без людей: небо с пересвеченным солнцем (включает
+    highlight recovery в пресете), горизонт, трава с крупной текстурой.
+    '''
+    import numpy as np
+    from PIL import Image
+
+    rng = np.random.default_rng(seed + 1)
+    sw, sh = max(64, w // 4), max(64, h // 4)
+    yy, xx = np.mgrid[0:sh, 0:sw].astype(np.float32)
+    xx /= sw
+    yy /= sh
+
+    img = np.empty((sh, sw, 3), dtype=np.float32)
+    sky = yy < 0.55
+    t = yy / 0.55
+    img[..., 0] = np.where(sky, 120 + 90 * t, 0)
+    img[..., 1] = np.where(sky, 160 + 70 * t, 0)
+    img[..., 2] = np.where(sky, 235 - 10 * t, 0)
+
+    texture = rng.random((sh // 16 + 2, sw // 16 + 2)).astype(np.float32)
+    texture = np.array(
+        Image.fromarray((texture * 255).astype(np.uint8), 'L').resize((sw, sh), Image.BICUBIC),
+        dtype=np.float32,
+    ) / 255.0
+    ground = ~sky
+    img[..., 0][ground] = (60 + 50 * texture)[ground]
+    img[..., 1][ground] = (95 + 60 * texture)[ground]
+    img[..., 2][ground] = (40 + 25 * texture)[ground]
+
+    sun = _ellipse(xx, yy, 0.72, 0.18, 0.09 * sh / sw, 0.09)
+    glow = np.clip(1.4 - sun * 0.35, 0, 1)[..., None]
+    img = img * (1 - glow) + 255 * glow
+
+    small = Image.fromarray(np.clip(img, 0, 255).astype(np.uint8), 'RGB')
+    del img, xx, yy
+    arr = np.array(small.resize((w, h), Image.BICUBIC))
+    del small
+    _add_grain(arr, rng, sigma=3.0)
+    return arr, []
+
+
+def _add_grain(arr, rng, sigma: float, strip: int = 512) -> None:
+    '''Гауссово зерно полосами — без полной int16-копии 45 Мп кадра.'''
+    import numpy as np
+
+    for y in range(0, arr.shape[0], strip):
+        block = arr[y:y + strip]
+        noise = rng.normal(0, sigma, block.shape).astype(np.int16)
+        block[...] = np.clip(block.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+
+
+SCENES = {
+    'portrait': synth_portrait,
+    'landscape': synth_landscape,
+}
+
+
+# ---------------------------------------------------------------------------
+# Кейсы
+# ---------------------------------------------------------------------------
+
+class Frame:
+    '''Один синтетический кадр и лениво посчитанные производные от него.'''
+
+    def __init__(self, mods: Dict[str, Any], scene: str, mp: int):
+        self.mods = mods
+        self.scene = scene
+        self.mp = mp
+        w, h = SIZES[mp]
+        self.arr, self.faces_rel = SCENES[scene](w, h)
+        self._cache: Dict[str, Any] = {}
+
+    def get(self, key: str, build: Callable[[], Any]) -> Any:
+        if key not in self._cache:
+            self._cache[key] = build()
+        return self._cache[key]
+
+    def pil(self):
+        from PIL import Image
+        return Image.fromarray(self.arr, 'RGB')
+
+    def jpeg(self) -> bytes:
+        def build():
+            buf = io.BytesIO()
+            self.pil().save(buf, format='JPEG', quality=JPEG_QUALITY)
+            return buf.getvalue()
+        return self.get('jpeg', build)
+
+    def skin(self):
+        '''Маска кожи эвристикой skin_mask — вход для детектора и шумодава.'''
+        sm = self.mods['skin_mask']
+        return self.get('skin', lambda: sm._exclude_non_skin(
+            self.arr, sm._find_face_regions(sm._detect_skin_color(self.arr))))
+
+    def gray(self):
+        import numpy as np
+        return self.get('gray', lambda: self.arr.mean(axis=2, dtype=np.float32))
+
+    def analysis_bgr(self):
+        '''Кадр, каким его видит photo-tech-sort: BGR, длинная сторона 800.'''
+        import cv2
+
+        def build():
+            h, w = self.arr.shape[:2]
+            scale = ANALYSIS_MAX_DIM / max(w, h)
+            small = cv2.resize(self.arr, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+            return cv2.cvtColor(small, cv2.COLOR_RGB2BGR)
+        return self.get('analysis_bgr', build)
+
+    def analysis_faces(self) -> List[dict]:
+        '''Лица с известной геометрией в координатах кадра анализа.'''
+        img = self.analysis_bgr()
+        h, w = img.shape[:2]
+        faces = []
+        for f in self.faces_rel:
+            x, y, fw, fh = f['box']
+            faces.append({
+                'box': (int(x * w), int(y * h), int(fw * w), int(fh * h)),
+                'right_eye': (f['right_eye'][0] * w, f['right_eye'][1] * h),
+                'left_eye': (f['left_eye'][0] * w, f['left_eye'][1] * h),
+                'nose': (f['nose'][0] * w, f['nose'][1] * h),
+                'score': f['score'],
+            })
+        return faces
+
+
+class Case(NamedTuple):
+    name: str
+    scenes: Tuple[str, ...]
+    # setup готовит входы вне замера, run — то, что замеряется
+    setup: Callable[[Frame], Any]
+    run: Callable[[Frame, Any], Any]
+
+
+def _thumbnail(max_side: int):
+    def run(frame, img):
+        from PIL import Image
+        img.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+    return run
+
+
+def _eyes(frame, faces):
+    fq = frame.mods['face_quality']
+    img = frame.analysis_bgr()
+    return [fq.eyes_state(img, face) for face in faces]
+
+
+CASES = (
+    Case('build_auto_mask', ('portrait', 'landscape'),
+         lambda f: f.jpeg(),
+         lambda f, data: f.mods['skin_mask'].build_auto_mask(data)),
+    Case('_detect_defects', ('portrait',),
+         lambda f: f.skin(),
+         lambda f, skin: f.mods['skin_mask']._detect_defects(f.arr, skin)),
+    Case('_local_stats', ('portrait',),
+         lambda f: (f.gray(), f.skin()),
+         lambda f, args: f.mods['skin_mask']._local_stats(*args)),
+    Case('c1_wedding_preset', ('portrait', 'landscape'),
+         lambda f: f.pil(),
+         lambda f, img: f.mods['c1_preset'].apply_capture_one_wedding_preset(img)),
+    Case('skin_denoise', ('portrait',),
+         lambda f: (f.pil(), f.skin()),
+         lambda f, args: f.mods['c1_preset'].apply_skin_denoise_with_mask(*args)),
+    Case('detect_faces', ('portrait', 'landscape'),
+         lambda f: f.analysis_bgr(),
+         lambda f, img: f.mods['face_quality'].detect_faces(img)),
+    Case('eyes_state', ('portrait',),
+         lambda f: f.analysis_faces(),
+         _eyes),
+    Case('thumb_2400', ('portrait', 'landscape'),
+         lambda f: f.pil(),
+         _thumbnail(2400)),
+    Case('thumb_500', ('portrait', 'landscape'),
+         lambda f: f.pil(),
+         _thumbnail(500)),
+)
+
+
+# ---------------------------------------------------------------------------
+# Замер
+# ---------------------------------------------------------------------------
+
+def _read_status_kb(field: str) -> Optional[int]:
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _reset_peak_rss() -> bool:
+    '''Сбрасывает VmHWM до текущего RSS (Linux 4.0+).'''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def measure(case: Case, frame: Frame, repeat: int) -> Dict[str, Any]:
+    '''
+    Первый прогон — под tracemalloc и со сброшенным VmHWM, только ради
+    памяти (он же прогрев). Время меряем отдельными прогонами без
+    tracemalloc: трассировка заметно тормозит циклы на чистом Python.
+    '''
+    args = case.setup(frame)
+    gc.collect()
+    rss_before = _read_status_kb('VmRSS')
+    has_hwm = rss_before is not None and _reset_peak_rss()
+    tracemalloc.start()
+    result = case.run(frame, args)
+    py_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    hwm = _read_status_kb('VmHWM') if has_hwm else None
+    rss_peak = hwm - rss_before if hwm is not None else None
+    del result, args
+
+    walls = []
+    for _ in range(repeat):
+        args = case.setup(frame)
+        gc.collect()
+        started = time.perf_counter()
+        result = case.run(frame, args)
+        walls.append(time.perf_counter() - started)
+        del result, args
+    return {
+        'wall_ms': round(statistics.median(walls) * 1000, 1),
+        'min_ms': round(min(walls) * 1000, 1),
+        'peak_mb': round(py_peak / 2 ** 20, 1),
+        'rss_peak_mb': round(rss_peak / 1024, 1) if rss_peak is not None else None,
+    }
+
+
+def compare(res: Dict[str, Any], base: Optional[Dict[str, Any]]) -> None:
+    '''Проставляет в res отношение времени и памяти к baseline.'''
+    if not base or not base.get('wall_ms'):
+        return
+    res['vs_base'] = round(res['wall_ms'] / base['wall_ms'], 2)
+    if base.get('peak_mb'):
+        res['mem_vs_base'] = round(res['peak_mb'] / base['peak_mb'], 2)
+
+
+def _print_row(key: str, res: Dict[str, Any]) -> None:
+    rss = f"{res['rss_peak_mb']:>8.1f}" if res.get('rss_peak_mb') is not None else '       -'
+    vs = f"{res['vs_base']:>6.2f}x" if 'vs_base' in res else '       '
+    print(f"{key:<36} {res['wall_ms']:>10.1f} {res['peak_mb']:>8.1f} {rss} {vs}", flush=True)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Офлайн-бенчмарк обработки фото')
+    parser.add_argument('--sizes', default='6,24,45', help='мегапиксели через запятую: 6,24,45')
+    parser.add_argument('--only', default='', help='подстроки имён кейсов через запятую')
+    parser.add_argument('--scenes', default=','.join(SCENES), help='portrait,landscape')
+    parser.add_argument('--repeat', type=int, default=3, help='замеров времени на кейс (берётся медиана)')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='JSON с эталонными результатами')
+    parser.add_argument('--save-baseline', action='store_true', help='записать результаты как baseline')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='допустимое замедление, доля')
+    parser.add_argument('--json', dest='json_out', help='куда сохранить результаты')
+    args = parser.parse_args(argv)
+
+    sizes = [int(s) for s in args.sizes.split(',') if s.strip()]
+    unknown = [s for s in sizes if s not in SIZES]
+    if unknown:
+        parser.error(f'unknown sizes: {unknown}, expected {sorted(SIZES)}')
+    only = [s.strip() for s in args.only.split(',') if s.strip()]
+    scenes = [s.strip() for s in args.scenes.split(',') if s.strip()]
+    cases = [c for c in CASES if not only or any(o in c.name for o in only)]
+
+    _block_network()
+    mods = _load_modules()
+    # Загрузка YuNet — цена холодного старта, а не детекции: прогреваем заранее
+    mods['face_quality'].warmup()
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f).get('results', {})
+
+    print(f"{'case@scene/size':<36} {'wall_ms':>10} {'py_mb':>8} {'rss_mb':>8} {'vs_base':>7}")
+    results: Dict[str, Dict[str, Any]] = {}
+    for mp in sizes:
+        for scene in scenes:
+            scene_cases = [c for c in cases if scene in c.scenes]
+            if not scene_cases:
+                continue
+            frame = Frame(mods, scene, mp)
+            for case in scene_cases:
+                key = f'{case.name}@{scene}/{mp}mp'
+                try:
+                    res = measure(case, frame, args.repeat)
+                except MemoryError:
+                    res = {'wall_ms': None, 'error': 'MemoryError'}
+                    print(f'{key:<36} MemoryError', flush=True)
+                    results[key] = res
+                    continue
+                results[key] = res
+                compare(res, baseline.get(key))
+                _print_row(key, res)
+            del frame
+            gc.collect()
+
+    regressions = [k for k, r in results.items()
+                   if r.get('vs_base') is not None and r['vs_base'] > 1 + args.tolerance]
+    max_rss = _read_status_kb('VmHWM')
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'cpus': os.cpu_count(),
+            'repeat': args.repeat,
+            'seed': SEED,
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'results': results,
+    }
+
+    if args.json_out:
+        with open(args.json_out, 'w') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f'Baseline saved: {args.baseline}')
+    elif not baseline:
+        print(f'No baseline at {args.baseline} — run with --save-baseline to create one')
+
+    if max_rss is not None:
+        print(f'Process peak RSS: {max_rss / 1024:.0f} MB')
+    if regressions:
+        print(f'REGRESSIONS (> {args.tolerance:.0%} slower): {", ".join(regressions)}')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -160,7 +160,8 @@ export const usePhotoBankApi = (
 
         const requestBody = { 
           folder_id: folderId,
-          reset_analysis: shouldReset
+          reset_analysis: shouldReset,
+          pipeline: true
         };
         console.log('[TECH_SORT] Request body:', JSON.stringify(requestBody));
 